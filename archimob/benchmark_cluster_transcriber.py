@@ -0,0 +1,96 @@
+#!/usr/bin/python
+#! -*- mode: python; coding: utf-8 -*-
+
+"""
+Compares ClusterTranscriber with transcribe_simple from
+create_simple_lexicon.py: both have to generate the same pronunciations, and
+the time taken by each of them is printed.
+input:
+
+        python2 archimob/benchmark_cluster_transcriber.py \
+            -v vocabulary.txt -c manual/clusters_extend.txt
+"""
+
+import sys
+import time
+import argparse
+
+from create_simple_lexicon import read_clusters, transcribe_simple
+from cluster_transcriber import ClusterTranscriber
+
+
+def get_args():
+    """
+    Returns the command line arguments
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark of the cluster '
+                                     'transcribers')
+
+    parser.add_argument('--vocabulary', '-v', help='Input vocabulary',
+                        required=True)
+
+    parser.add_argument('--cluster-file', '-c', help='File with the consonant'
+                        ' clusters', required=True)
+
+    parser.add_argument('--map-diacritic', '-m', help='Map compound '
+                        'diacritics to alternative character. If null, '
+                        'just recombines', default=u'1')
+
+    parser.add_argument('--repeat', '-r', help='Number of passes over the '
+                        'vocabulary (later passes hit the memo)', type=int,
+                        default=2)
+
+    return parser.parse_args()
+
+
+def main():
+    """
+    Main function of the program
+    """
+
+    args = get_args()
+
+    map_diacritic = args.map_diacritic
+    if isinstance(map_diacritic, str):
+        map_diacritic = map_diacritic.decode('utf8') or None
+
+    clusters = read_clusters(args.cluster_file)
+    max_length_cluster = max(len(c) for c in clusters)
+
+    vocab = set()
+    with open(args.vocabulary, 'r') as input_f:
+        for line in input_f:
+            for w in line.decode('utf8').strip().split():
+                if not '*' in w:
+                    vocab.add(w.lower())
+    vocab = sorted(vocab)
+
+    start = time.time()
+    for _ in range(args.repeat):
+        reference = [transcribe_simple(w, clusters, max_length_cluster,
+                                       map_diacritic) for w in vocab]
+    simple_time = time.time() - start
+
+    start = time.time()
+    transcriber = ClusterTranscriber(clusters, map_diacritic)
+    for _ in range(args.repeat):
+        output = [transcriber.transcribe(w) for w in vocab]
+    trie_time = time.time() - start
+
+    if output != reference:
+        for word, ref, out in zip(vocab, reference, output):
+            if ref != out:
+                sys.stderr.write(u'Mismatch for {0}: {1} vs {2}\n'.format(
+                    word, ref, out).encode('utf8'))
+                break
+        sys.exit(1)
+
+    print '{0} words x {1} passes, {2} pronunciations'.format(
+        len(vocab), args.repeat, sum(len(p) for p in output))
+    print 'transcribe_simple:  {0:.3f}s'.format(simple_time)
+    print 'ClusterTranscriber: {0:.3f}s'.format(trie_time)
+
+
+if __name__ == '__main__':
+    main()
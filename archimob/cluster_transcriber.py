@@ -0,0 +1,265 @@
+#!/usr/bin/python
+#! -*- mode: python; coding: utf-8 -*-
+
+"""
+Definition of the class ClusterTranscriber, which generates the pseudo
+phonetic transcriptions of create_simple_lexicon.py and
+create_simple_lexicon_2.py: every grapheme is mapped to itself, besides the
+clusters of graphemes found in the clusters file.
+
+Words without combining characters (where graphemes and characters are the
+same) are segmented by a single regular expression over all the clusters,
+longest first. The other words walk a trie of the clusters, so the longest
+cluster starting at a given grapheme is found in one pass instead of slicing
+and joining the word once per candidate length. The segmentation of every word
+is kept in an LRU memo, and the pronunciation variants produced by
+multi-valued clusters are generated lazily, in the same order as
+transcribe_simple, and can be capped.
+"""
+
+import re
+import sys
+import itertools
+import unicodedata
+from collections import OrderedDict
+
+# Signs to exclude from the transcriptions (when --add-signs is not specified)
+EXCLUDE_SET = set(["'", '-', '.'])
+
+# Any combining character (of the basic multilingual plane):
+COMBINING_REGEX = re.compile(u'[{0}]'.format(u''.join(
+    re.escape(unichr(c)) for c in range(min(sys.maxunicode, 0xffff) + 1)
+    if unicodedata.combining(unichr(c)))), re.UNICODE)
+
+
+def ProcessUnicodeCompounds(data, map_diacritic=None):
+    """
+    Correctly re-combines compound unicode characters.
+    input:
+        * data (str|list) Input unicode data. String or list.
+        * map_diacritic (None|unicode) Unicode string to map all combining
+          characters to.  Default to original character.
+    returns:
+        * a list of unicode characters, where all compounds have been
+          recombined, either using the original, or the map_diacritic value.
+    """
+    for char in data:
+        if not isinstance(char, unicode):
+            raise TypeError('All chars in data must be '
+                            'valid unicode instances!')
+
+    if map_diacritic != None and \
+       not isinstance(map_diacritic, unicode):
+        raise TypeError('map_diacritic MUST be None '
+                        'or a valid unicode string.')
+
+    # Split into individual characters (not graphemes!)
+    # it is necessary to recombine once, just in case the user
+    # provided a list
+    chars = [char for char in u''.join(data)]
+
+    # Recombine unicode compounds. NOTE: unicodedata.normalize
+    # does NOT cover all examples in the data, so we have to
+    # do this manually.  The compound diacritics always follow
+    # the letter they combine with.
+    chars.reverse()
+    chunk = []
+    tmp_chars = []
+    for char in chars:
+        if unicodedata.combining(char):
+            if map_diacritic:
+                chunk.append(map_diacritic)
+            else:
+                chunk.append(char)
+        else:
+            chunk.append(char)
+            chunk.reverse()
+            tmp_chars.append(u''.join(chunk))
+            chunk = []
+    # After successful recombination we finally have a list
+    # of actual graphemes
+    chars = [char for char in tmp_chars]
+    chars.reverse()
+
+    return chars
+
+
+class ClusterTranscriber(object):
+    """
+    Transcribes words mapping each grapheme to itself, besides the clusters
+    of graphemes given in the clusters dictionary.
+    """
+
+    ## Key of the trie nodes where a cluster ends.
+    _END = None
+
+    def __init__(self, clusters, map_diacritic=None, cache_size=100000,
+                 max_variants=None):
+        """
+        Init function of the class
+        input:
+            * clusters (dict): dictionary mapping clusters of graphemes to
+              lists of phones (as returned by read_clusters).
+            * map_diacritic (None|unicode): see ProcessUnicodeCompounds.
+            * cache_size (int): number of words whose segmentation is kept.
+            * max_variants (None|int): maximum number of pronunciations
+              generated per word. None means all of them.
+        """
+
+        ## Maximum length of the clusters, in characters.
+        self.max_length_cluster = max([len(c) for c in clusters] or [0])
+        ## Trie of characters. Nodes where a cluster ends have the entry
+        ## _END: (cluster, phones).
+        self.trie = {}
+        ## Phones of each cluster:
+        self.clusters = dict((c, tuple(p)) for c, p in clusters.iteritems())
+        for cluster, phones in clusters.iteritems():
+            node = self.trie
+            for char in cluster:
+                node = node.setdefault(char, {})
+            node[self._END] = (cluster, tuple(phones))
+
+        ## Words without combining characters (graphemes are characters) are
+        ## segmented with a single regular expression: excluded signs first,
+        ## then the clusters of two or more characters, longest first, and
+        ## finally any single character.
+        multi = sorted([c for c in clusters if len(c) > 1],
+                       key=lambda c: (-len(c), c))
+        self.simple_regex = re.compile(
+            u'([{0}])|({1})|(.)'.format(
+                u''.join(re.escape(c) for c in sorted(EXCLUDE_SET)),
+                u'|'.join(re.escape(c) for c in multi) or u'(?!)'),
+            re.UNICODE | re.DOTALL)
+
+        self.map_diacritic = map_diacritic
+        self.cache_size = cache_size
+        self.max_variants = max_variants
+        self._memo = OrderedDict()
+
+    def graphemes(self, word):
+        """
+        Same list of graphemes as ProcessUnicodeCompounds, in a single pass:
+        combining characters are appended (or mapped) to the grapheme before
+        them, and dropped if there is none.
+        """
+
+        combining = unicodedata.combining
+        output = []
+        for char in word:
+            if not combining(char):
+                output.append(char)
+            elif output:
+                output[-1] += self.map_diacritic or char
+
+        return output
+
+    def longest_cluster(self, graphemes, start):
+        """
+        Finds the longest cluster of at least two graphemes (and at most
+        max_length_cluster) beginning at the grapheme start.
+        returns:
+            * a tuple (cluster, phones), or None if there is no such cluster.
+        """
+
+        match = None
+        node = self.trie
+        end = min(len(graphemes), start + self.max_length_cluster)
+
+        for index in range(start, end):
+            for char in graphemes[index]:
+                node = node.get(char)
+                if node is None:
+                    return match
+            if index > start and self._END in node:
+                match = node[self._END]
+
+        return match
+
+    def segment(self, word):
+        """
+        Splits a word into the options of each of its phonetic positions.
+        returns:
+            * a tuple with, for each position, the tuple of possible phones.
+        """
+
+        if word in self._memo:
+            segmentation = self._memo.pop(word)
+            self._memo[word] = segmentation
+            return segmentation
+
+        if COMBINING_REGEX.search(word) is None:
+            segmentation = []
+            for match in self.simple_regex.finditer(word):
+                if match.group(2) is not None:
+                    segmentation.append(self.clusters[match.group(2)])
+                elif match.group(3) is not None:
+                    segmentation.append((match.group(3),))
+            return self._remember(word, tuple(segmentation))
+
+        graphemes = self.graphemes(word)
+        word_length = len(graphemes)
+
+        segmentation = []
+        graph_index = 0
+
+        while graph_index < word_length:
+
+            if graphemes[graph_index] in EXCLUDE_SET:
+                graph_index += 1
+                continue
+
+            match = None
+            if graphemes[graph_index][0] in self.trie:
+                match = self.longest_cluster(graphemes, graph_index)
+
+            if match is not None:
+                cluster, phones = match
+                segmentation.append(phones)
+                # As in transcribe_simple, the index moves by the length of
+                # the cluster in characters.
+                graph_index += len(cluster)
+            else:
+                segmentation.append((graphemes[graph_index],))
+                graph_index += 1
+
+        return self._remember(word, tuple(segmentation))
+
+    def _remember(self, word, segmentation):
+        """
+        Adds the segmentation of a word to the memo, dropping the least
+        recently used one if the memo is full.
+        """
+
+        self._memo[word] = segmentation
+        if len(self._memo) > self.cache_size:
+            self._memo.popitem(last=False)
+
+        return segmentation
+
+    def variants(self, word):
+        """
+        Generates the pronunciations of a word, in the same order as
+        transcribe_simple. At most max_variants are generated.
+        """
+
+        segmentation = self.segment(word)
+
+        if all(len(phones) == 1 for phones in segmentation):
+            return iter([u''.join(u' ' + phones[0]
+                                  for phones in segmentation).strip()])
+
+        # transcribe_simple expands the variants of each new position in the
+        # outer loop, so the first positions vary fastest:
+        options = reversed(segmentation)
+        variants = (u''.join(u' ' + phone
+                             for phone in reversed(combination)).strip()
+                    for combination in itertools.product(*options))
+
+        return itertools.islice(variants, self.max_variants)
+
+    def transcribe(self, word):
+        """
+        Returns the list of pronunciations of a word.
+        """
+
+        return list(self.variants(word))
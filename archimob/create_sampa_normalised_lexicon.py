@@ -3,6 +3,9 @@
 
 """
 This program creates a lexicon using SAMPA transcriptions.
+The pronunciations are read from a compact binary store built once from the
+SAMPA JSON file (see sampa_lexicon.py), which is rebuilt when the JSON file
+changes.
 Example call:
     python3 create_sampa_normalised_lexicon.py -s norm2sampa.json -v normalised_vocabulary.txt -o normalised_lexicon.txt
 """
@@ -11,8 +14,9 @@ import sys
 import re
 import argparse
 # from pathlib import Path
-import json
-from collections import Counter, defaultdict
+from collections import Counter
+
+from sampa_lexicon import SampaLexicon
 
 
 def get_args():
@@ -33,41 +37,46 @@ def get_args():
     parser.add_argument('--outfile', '-o',
                         help='Output lexicon', required=True)
 
+    parser.add_argument('--index_file', '-i',
+                        help='Binary pronunciation store of the SAMPA file. '
+                        'Built if missing or older than the SAMPA file. '
+                        'Default: the SAMPA file with the extension .idx')
+
     args = parser.parse_args()
 
     return args
 
 
-def write_lexicon(vocab, outfile, sampa_dict):
+def write_lexicon(vocab, outfile, sampa_lexicon):
     """
     Side effects: produces output file equivalent to 'lexicon.txt'. Multiple pronunciations for the same word are written to their own lines.
     format:
         <word> <pronunciation>
     ** Note **
         words containing multiple tokens in the input vocabulary are expected to be glued together with '_'.
+        the vocabulary is expected to be unique (sort -u), so duplicated pronunciations are only removed within each word.
     """
 
     no_pron = Counter()
     line_c = 0
     c = 0
-    seen_pairs = set()
 
     with open(vocab, 'r', encoding='utf8') as inf, open(outfile, 'w', encoding='utf8') as outf:
         for line in inf:
             line_c += 1
             vocab_word = line.strip()
-            prons = sampa_dict.get(vocab_word)
-            if prons:
-                c += 1
-                for pron in prons:
-                    # remove joining underscore from SAMPA pronunciation
-                    pron = re.sub(r'\s?_\s?', ' ', pron)
+            seen_prons = set()
+            for pron in sampa_lexicon.pronunciations(vocab_word):
+                # remove joining underscore from SAMPA pronunciation
+                pron = re.sub(r'\s?_\s?', ' ', pron)
 
-                    # avoid duplicates in lexicon!
-                    if not (vocab_word, pron) in seen_pairs:
-                        outf.write('{} {}\n'.format(vocab_word, pron))
-                        seen_pairs.add((vocab_word, pron))
+                # avoid duplicates in lexicon!
+                if pron not in seen_prons:
+                    outf.write('{} {}\n'.format(vocab_word, pron))
+                    seen_prons.add(pron)
 
+            if seen_prons:
+                c += 1
             else:
                 no_pron[vocab_word] += 1
 
@@ -79,25 +88,14 @@ def main():
 
     args = get_args()
 
-    with open(args.sampa_file, 'r', encoding='utf8') as f:
-        sampa_dict = json.load(f)
-
-    # print(len(sampa_dict))
-    # print(sum(len(i) for i in sampa_dict.values()))
-    # convert all keys to lowercase!
-    lowercased = defaultdict(list)
-    for k, v in sampa_dict.items():
-        for p in v:
-            lowercased[k.lower()].append(p)
-    # sampa_dict = {k.lower(): v for k, v in sampa_dict.items()}
-    # print(len(lowercased))
-    # print(sum(len(i) for i in lowercased.values()))
+    # all keys are lowercased in the store!
+    sampa_lexicon = SampaLexicon.load(args.sampa_file, args.index_file)
+
     print('SAMPA pronunication dictionary contains:')
-    print('\t{} normalised forms'.format(len(lowercased)))
-    print('\t{} pronunciation entries'.format(
-        sum(len(i) for i in lowercased.values())))
+    print('\t{} normalised forms'.format(len(sampa_lexicon)))
+    print('\t{} pronunciation entries'.format(sampa_lexicon.num_prons))
 
-    write_lexicon(args.vocabulary, args.outfile, lowercased)
+    write_lexicon(args.vocabulary, args.outfile, sampa_lexicon)
 
 
 if __name__ == '__main__':
@@ -11,11 +11,10 @@ import sys
 import json
 import re
 import argparse
-import unicodedata
 import codecs
 
-# Signs to exclude from the transcriptions (when --add-signs is not specified)
-EXCLUDE_SET = set(["'", '-', '.'])
+from cluster_transcriber import ClusterTranscriber, ProcessUnicodeCompounds
+from cluster_transcriber import EXCLUDE_SET
 
 
 def get_args():
@@ -41,6 +40,11 @@ def get_args():
     parser.add_argument('--output-file', '-o', help='Output lexicon',
                         required=True)
 
+    parser.add_argument('--max-variants', '-x', help='Maximum number of '
+                        'pronunciations generated per word (multi-valued '
+                        'clusters multiply them). By default, all of them',
+                        type=int, default=None)
+
     parser.add_argument('--n2d', '-d', required=False,
                         help='If provided, lexicon is created with a mapping from normalised to Dieth transcription forms. JSON file is expected')
 
@@ -52,58 +56,6 @@ def get_args():
     return args
 
 
-def ProcessUnicodeCompounds(data, map_diacritic=None):
-    """
-    Correctly re-combines compound unicode characters.
-    input:
-        * data (str|list) Input unicode data. String or list.
-        * map_diacritic (None|unicode) Unicode string to map all combining
-          characters to.  Default to original character.
-    returns:
-        * a list of unicode characters, where all compounds have been
-          recombined, either using the original, or the map_diacritic value.
-    """
-    for char in data:
-        if not isinstance(char, unicode):
-            raise TypeError('All chars in data must be '
-                            'valid unicode instances!')
-
-    if map_diacritic != None and \
-       not isinstance(map_diacritic, unicode):
-        raise TypeError('map_diacritic MUST be None '
-                        'or a valid unicode string.')
-
-    # Split into individual characters (not graphemes!)
-    # it is necessary to recombine once, just in case the user
-    # provided a list
-    chars = [char for char in u''.join(data)]
-
-    # Recombine unicode compounds. NOTE: unicodedata.normalize
-    # does NOT cover all examples in the data, so we have to
-    # do this manually.  The compound diacritics always follow
-    # the letter they combine with.
-    chars.reverse()
-    chunk = []
-    tmp_chars = []
-    for char in chars:
-        if unicodedata.combining(char):
-            if map_diacritic:
-                chunk.append(map_diacritic)
-            else:
-                chunk.append(char)
-        else:
-            chunk.append(char)
-            chunk.reverse()
-            tmp_chars.append(u''.join(chunk))
-            chunk = []
-    # After successful recombination we finally have a list
-    # of actual graphemes
-    chars = [char for char in tmp_chars]
-    chars.reverse()
-
-    return chars
-
-
 def read_clusters(input_file):
     """
     Reads the file with the clusters
@@ -251,10 +203,11 @@ def main():
 
     clusters = read_clusters(args.cluster_file)
 
-    max_length_cluster = 0
-    for clust in clusters:
-        if len(clust) > max_length_cluster:
-            max_length_cluster = len(clust)
+    if isinstance(args.map_diacritic, str):
+        args.map_diacritic = args.map_diacritic.decode('utf8')
+
+    transcriber = ClusterTranscriber(clusters, args.map_diacritic,
+                                     max_variants=args.max_variants)
 
     try:
         input_f = open(args.vocabulary, 'r')
@@ -292,16 +245,12 @@ def main():
             # word = word.rstrip()
             word = word.rstrip().decode('utf8')
             # print word
-            if isinstance(args.map_diacritic, str):
-                args.map_diacritic = args.map_diacritic.decode('utf8')
-
             dieth_forms = n2d_map.get(word)
             # print dieth_forms
             if dieth_forms:
                 for form in dieth_forms:
                     # print dieth_forms
-                    transcription = transcribe_simple(
-                        form.lower(), clusters, max_length_cluster, args.map_diacritic)
+                    transcription = transcriber.variants(form.lower())
 
                     # print transcription
                     for multi in transcription:
@@ -326,12 +275,7 @@ def main():
             # for word in input_f:
 
             # word = word.rstrip().decode('utf8')
-            if isinstance(args.map_diacritic, str):
-                args.map_diacritic = args.map_diacritic.decode('utf8')
-
-            transcription = transcribe_simple(word, clusters,
-                                              max_length_cluster,
-                                              args.map_diacritic)
+            transcription = transcriber.variants(word)
 
             for multi in transcription:
                 output_f.write('{0} {1}\n'.format(word.encode('utf8'),
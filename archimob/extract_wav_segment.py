@@ -2,14 +2,27 @@
 
 """@package extract_wav_segment
 Extracts segments from a wavefile taking as input the init and end times
+
+Besides a single segment (-i, -b, -e, -o), it can extract all the segments of
+a Kaldi segments file (-s, -w, -O). In this mode every recording is memory
+mapped once, its segments are written in order of their initial time directly
+from the mapped data, and the recordings are processed in parallel (-j).
+Segments whose output file already exists with the expected size are not
+written again.
 """
 
 import sys
 import os
+import mmap
+import struct
+import multiprocessing
 
 import argparse
 import wave
 
+## Size of the canonical PCM header written by the wave module.
+WAV_HEADER_SIZE = 44
+
 
 def extract_segment(wav_in, init_time, end_time, output_file):
     """
@@ -43,6 +56,149 @@ def extract_segment(wav_in, init_time, end_time, output_file):
     wav_out.close()
 
 
+def read_wav_header(wav_map):
+    """
+    Parses the RIFF header of a PCM wavefile.
+    input:
+        * wav_map (mmap): memory map of the wavefile.
+    returns:
+        * a tuple (nchannels, sampwidth, framerate, data_offset, data_size),
+          where data_offset and data_size give the position of the samples in
+          the file.
+    """
+
+    if wav_map[0:4] != 'RIFF' or wav_map[8:12] != 'WAVE':
+        raise wave.Error('file does not start with RIFF id')
+
+    fmt = None
+    offset = 12
+    while offset + 8 <= len(wav_map):
+        chunk_id = wav_map[offset:offset + 4]
+        chunk_size = struct.unpack('<L', wav_map[offset + 4:offset + 8])[0]
+        offset += 8
+        if chunk_id == 'fmt ':
+            fmt = struct.unpack('<HHLLHH', wav_map[offset:offset + 16])
+        elif chunk_id == 'data':
+            if fmt is None:
+                raise wave.Error('data chunk before fmt chunk')
+            if fmt[0] != 1:
+                raise wave.Error('unknown format: {0}'.format(fmt[0]))
+            data_size = min(chunk_size, len(wav_map) - offset)
+            # nchannels, sampwidth, framerate:
+            return (fmt[1], (fmt[5] + 7) // 8, fmt[2], offset, data_size)
+        # Chunks are word aligned:
+        offset += chunk_size + (chunk_size & 1)
+
+    raise wave.Error('fmt chunk and/or data chunk missing')
+
+
+def wav_header(nchannels, sampwidth, framerate, data_size):
+    """
+    Returns the same PCM header as the wave module writes.
+    """
+
+    return struct.pack('<4sL4s4sLHHLLHH4sL', 'RIFF', 36 + data_size, 'WAVE',
+                       'fmt ', 16, 1, nchannels, framerate,
+                       nchannels * framerate * sampwidth,
+                       nchannels * sampwidth, sampwidth * 8, 'data',
+                       data_size)
+
+
+def extract_segments(input_wav, segments):
+    """
+    Writes several fragments of a wavefile to new wavefiles. The input file is
+    memory mapped once, and the samples of each segment are written directly
+    from the map. The frames of each segment are the same as with
+    extract_segment.
+    input:
+        * input_wav (str): name of the input wavefile.
+        * segments (list): list of (output_file, init_time, end_time).
+    returns:
+        * the number of segments written (existing output files with the
+          expected size are skipped).
+    """
+
+    written = 0
+
+    with open(input_wav, 'rb') as wav_f:
+        wav_map = mmap.mmap(wav_f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        (nchannels, sampwidth, framerate,
+         data_offset, data_size) = read_wav_header(wav_map)
+        frame_size = nchannels * sampwidth
+        nframes = data_size // frame_size
+
+        for output_file, init_time, end_time in sorted(segments,
+                                                       key=lambda x: x[1]):
+
+            read_pos = int(init_time * framerate)
+            if read_pos < 0 or read_pos > nframes:
+                raise wave.Error('position not in range')
+            samples = max(0, min(int(end_time * framerate) - read_pos,
+                                 nframes - read_pos))
+            size = samples * frame_size
+
+            if (os.path.exists(output_file) and
+                os.path.getsize(output_file) == WAV_HEADER_SIZE + size):
+                continue
+
+            start = data_offset + read_pos * frame_size
+            with open(output_file, 'wb') as wav_out:
+                wav_out.write(wav_header(nchannels, sampwidth, framerate,
+                                         size))
+                wav_out.write(buffer(wav_map, start, size))
+            written += 1
+    finally:
+        wav_map.close()
+
+    return written
+
+
+def extract_recording_segments(task):
+    """
+    Wrapper of extract_segments for the worker processes.
+    """
+
+    return extract_segments(*task)
+
+
+def read_segments(segments_file, wav_scp, output_dir):
+    """
+    Reads a Kaldi segments file and the corresponding wav.scp.
+    returns:
+        * a list of (input_wav, segments) for every recording, with the
+          segments in the format expected by extract_segments.
+    """
+
+    recordings = {}
+    with open(wav_scp, 'r') as scp_f:
+        for line in scp_f:
+            fields = line.split(None, 1)
+            if len(fields) == 2:
+                recordings[fields[0]] = fields[1].strip()
+
+    segments = {}
+    with open(segments_file, 'r') as seg_f:
+        for line in seg_f:
+            fields = line.split()
+            if not fields:
+                continue
+            utt_id, rec_id, init_time, end_time = fields[:4]
+            output_file = '{0}.wav'.format(os.path.join(output_dir, utt_id))
+            segments.setdefault(rec_id, []).append((output_file,
+                                                    float(init_time),
+                                                    float(end_time)))
+
+    tasks = []
+    for rec_id in sorted(segments):
+        if rec_id not in recordings:
+            raise IOError('Recording {0} not in {1}'.format(rec_id, wav_scp))
+        tasks.append((recordings[rec_id], segments[rec_id]))
+
+    return tasks
+
+
 def get_args():
     """
     Reads the command line options
@@ -52,19 +208,37 @@ def get_args():
 
     parser = argparse.ArgumentParser(description=example)
 
-    parser.add_argument('--ARGS-wav', '-i', help='ARGS wavefile',
-                        required=True)
+    parser.add_argument('--ARGS-wav', '-i', help='ARGS wavefile')
 
     parser.add_argument('--begin', '-b', help='Initial time, in seconds',
-                        type=float, required=True)
+                        type=float)
 
     parser.add_argument('--end', '-e', help='Final time, in seconds',
-                        type=float, required=True)
+                        type=float)
+
+    parser.add_argument('--output-file', '-o', help='Output file')
+
+    parser.add_argument('--segments', '-s', help='Kaldi segments file, to ' \
+                        'extract all its segments instead of a single one')
+
+    parser.add_argument('--wav-scp', '-w', help='Kaldi wav.scp with the ' \
+                        'recordings of the segments file (plain paths only)')
+
+    parser.add_argument('--output-dir', '-O', help='Output folder for the ' \
+                        'segments')
 
-    parser.add_argument('--output-file', '-o', help='Output file',
-                        required=True)
+    parser.add_argument('--num-jobs', '-j', help='Number of recordings ' \
+                        'processed in parallel', type=int, default=1)
 
-    return parser.parse_args()
+    args = parser.parse_args()
+
+    if args.segments:
+        if not (args.wav_scp and args.output_dir):
+            parser.error('-s requires -w and -O')
+    elif None in (args.ARGS_wav, args.begin, args.end, args.output_file):
+        parser.error('-i, -b, -e and -o are required')
+
+    return args
 
 
 def main():
@@ -74,6 +248,25 @@ def main():
 
     args = get_args()
 
+    if args.segments:
+        tasks = read_segments(args.segments, args.wav_scp, args.output_dir)
+
+        if not os.path.exists(args.output_dir):
+            os.makedirs(args.output_dir)
+
+        if args.num_jobs > 1:
+            pool = multiprocessing.Pool(args.num_jobs)
+            written = sum(pool.imap_unordered(extract_recording_segments,
+                                              tasks))
+            pool.close()
+            pool.join()
+        else:
+            written = sum(map(extract_recording_segments, tasks))
+
+        print 'Written {0} segments of {1} recordings'.format(written,
+                                                              len(tasks))
+        return
+
     if not os.path.exists(args.ARGS_wav):
         print 'Error opening {0}'.format(args.ARGS_wav)
         sys.exit(1)
@@ -11,11 +11,24 @@ input:
             -i ${archimob_files}/archimob_r2/xml_corrected/*.xml \
             -f xml \
             -o ${csv_files}/archimob_r2/archimob_r2.csv
+
+        With -j, the input files are processed in parallel (one file per
+        process), and the csv rows are still written in the input order. With
+        -c, the rows of every input file are kept in a cache folder, together
+        with a manifest of the modification time and md5 of the input files,
+        so that a re-run only processes the files that changed. With -S, no
+        wave chunks are written: the chunks are listed in a Kaldi segments
+        file, next to a wav.scp with the complete recordings.
 """
 
 import sys
 import os
 import re
+import json
+import hashlib
+import itertools
+import multiprocessing
+from StringIO import StringIO
 
 import xml.etree.ElementTree as ET
 
@@ -23,7 +36,7 @@ import argparse
 import wave
 
 from archimob_chunk import ArchiMobChunkEXB, ArchiMobChunkXML
-from extract_wav_segment import extract_segment
+from extract_wav_segment import extract_segments
 
 
 def get_args():
@@ -55,6 +68,19 @@ def get_args():
                         ' chunked wavefiles. If not given, the wavefiles are' \
                         'just ignored', default='')
 
+    parser.add_argument('--num-jobs', '-j', help='Number of input files ' \
+                        'processed in parallel', type=int, default=1)
+
+    parser.add_argument('--cache-dir', '-c', help='Folder to keep the csv ' \
+                        'rows of every input file and the manifest of the ' \
+                        'processed files. If given, unchanged input files ' \
+                        'are not processed again', default='')
+
+    parser.add_argument('--kaldi-segments', '-S', help='Instead of ' \
+                        'extracting the wave chunks, write a Kaldi segments ' \
+                        'file and a wav.scp with the complete recordings to ' \
+                        'the folder given with -O', action='store_true')
+
     args = parser.parse_args()
 
     if bool(args.wav_dir) != bool(args.output_wav_dir):
@@ -303,13 +329,13 @@ def write_chunk_transcriptions(chunk_list, overlap_dict,
         # output_f.write('\n')
 
 
-def extract_wave_chunks(chunk_list, wave_in, output_dir):
+def extract_wave_chunks(chunk_list, input_wav, output_dir):
     """
     Extracts the chunks from the main recording based on the timepoints of
     the chunks list
     input:
         * chunk_list (list): list with the chunks of the transcriptions
-        * wave_in (Wave): wave object, with the complete recordings
+        * input_wav (str): wavefile with the complete recording
           corresponding to the transcriptions.
         * output_dir (str): folder to write the chunked segments to.
     """
@@ -317,12 +343,213 @@ def extract_wave_chunks(chunk_list, wave_in, output_dir):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
+    segments = []
     for chunk in chunk_list:
 
         output_name = '{0}.wav'.format(os.path.join(output_dir, chunk.key))
 
-        extract_segment(wave_in, chunk.beg, chunk.end,
-                        output_name)
+        segments.append((output_name, chunk.beg, chunk.end))
+
+    extract_segments(input_wav, segments)
+
+
+def write_kaldi_segments(chunk_list, recording_id, output_f):
+    """
+    Writes the chunks as lines of a Kaldi segments file, to be used with a
+    wav.scp entry for the complete recording instead of chunked wavefiles.
+    input:
+        * chunk_list (list): list with the chunks of the transcriptions
+        * recording_id (str): identifier of the complete recording.
+        * output_f (file object): file object to write the segments to.
+    """
+
+    for chunk in chunk_list:
+        output_f.write('{0} {1} {2:.3f} {3:.3f}\n'.format(chunk.key,
+                                                          recording_id,
+                                                          chunk.beg,
+                                                          chunk.end))
+
+
+def process_annotation_file(input_file, input_format, wav_dir,
+                            output_wav_dir, kaldi_segments=False):
+    """
+    Processes one XML / EXB file: chunks its transcriptions and, if a folder
+    with the wavefiles is given, extracts the wave chunks.
+    input:
+        * input_file (str): XML / EXB file.
+        * input_format (str): 'xml' or 'exb'.
+        * wav_dir (str): folder with the complete recordings, or ''.
+        * output_wav_dir (str): folder to write the chunked wavefiles to.
+        * kaldi_segments (bool): if True, the chunks are not extracted, but
+          returned as Kaldi segments.
+    returns:
+        * a tuple with the csv rows and the Kaldi segments (empty unless
+          kaldi_segments is True) corresponding to the file.
+    """
+
+    basename = os.path.splitext(os.path.split(input_file)[1])[0]
+
+    output_f = StringIO()
+    segments_f = StringIO()
+
+    # Read the xml tree:
+    xml_tree = ET.parse(input_file)
+    root = xml_tree.getroot()
+
+    if input_format == 'exb':
+
+        # Read the timepoints:
+        time_dict = get_timepoints(root)
+
+        (chunk_list, overlap_dict) = chunk_transcriptions(root, basename,
+                                                          input_format,
+                                                          time_dict=time_dict)
+
+        write_chunk_transcriptions(chunk_list, overlap_dict,
+                                   input_format, output_f)
+
+        if wav_dir:
+            # Finally, extract the waveforms corresponding to the chunks:
+            input_wav = os.path.join(wav_dir, '{0}.wav'.format(basename))
+
+            if not os.path.exists(input_wav):
+                raise IOError('The wavefile {0}, corresponding to {1}, ' \
+                              'does not exist'.format(input_wav, input_file))
+
+            if kaldi_segments:
+                write_kaldi_segments(chunk_list, basename, segments_f)
+            else:
+                try:
+                    extract_wave_chunks(chunk_list, input_wav, output_wav_dir)
+                except wave.Error as err:
+                    raise IOError('Wrong format for input wavefile {0} ' \
+                                  '({1})'.format(input_wav, err))
+
+    elif input_format == 'xml':
+        namespace = root.tag.split('}')[0].strip('{')
+        print namespace
+        (chunk_list, overlap_dict) = chunk_transcriptions(root, basename,
+                                                          input_format,
+                                                          namespace)
+        write_chunk_transcriptions(chunk_list, overlap_dict,
+                                   input_format, output_f)
+
+    return (output_f.getvalue(), segments_f.getvalue())
+
+
+def file_md5(file_name, block_size=1 << 20):
+    """
+    Returns the md5 hex digest of the content of a file.
+    """
+
+    md5 = hashlib.md5()
+    with open(file_name, 'rb') as input_f:
+        for block in iter(lambda: input_f.read(block_size), b''):
+            md5.update(block)
+
+    return md5.hexdigest()
+
+
+def process_task(task):
+    """
+    Wrapper of process_annotation_file for the worker processes. Also returns
+    the md5 of the input file, to be stored in the manifest.
+    """
+
+    input_file = task[0]
+
+    return process_annotation_file(*task) + (file_md5(input_file),)
+
+
+class ChunkCache(object):
+    """
+    Folder with the csv rows (and Kaldi segments) of every processed input
+    file, and a manifest (manifest.json) with the modification time and md5
+    of the input files. The cache is discarded when the processing options
+    change.
+    """
+
+    def __init__(self, cache_dir, options):
+
+        self.cache_dir = cache_dir
+        self.manifest_file = os.path.join(cache_dir, 'manifest.json')
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.manifest = {'options': options, 'files': {}}
+
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r') as input_f:
+                manifest = json.load(input_f)
+            if manifest.get('options') == options:
+                self.manifest = manifest
+
+    def part_file(self, input_file, extension='csv'):
+        """
+        Name of the file with the csv rows (or the segments) of an input file.
+        """
+
+        input_file = os.path.abspath(input_file)
+        basename = os.path.splitext(os.path.split(input_file)[1])[0]
+
+        return os.path.join(self.cache_dir, '{0}-{1}.{2}'.format(
+            basename, hashlib.md5(input_file).hexdigest()[:8], extension))
+
+    def is_current(self, input_file):
+        """
+        Checks whether an input file did not change since it was processed.
+        The md5 is only computed when the modification time changed.
+        """
+
+        entry = self.manifest['files'].get(os.path.abspath(input_file))
+
+        if (entry is None or
+            not os.path.exists(self.part_file(input_file)) or
+            not os.path.exists(self.part_file(input_file, 'segments'))):
+            return False
+
+        mtime = os.path.getmtime(input_file)
+        if entry['mtime'] != mtime:
+            if entry['md5'] != file_md5(input_file):
+                return False
+            entry['mtime'] = mtime
+
+        return True
+
+    def get(self, input_file):
+        """
+        Returns the stored csv rows and segments of an input file.
+        """
+
+        parts = []
+        for extension in ['csv', 'segments']:
+            with open(self.part_file(input_file, extension), 'r') as input_f:
+                parts.append(input_f.read())
+
+        return tuple(parts)
+
+    def put(self, input_file, rows, segments, md5):
+        """
+        Stores the csv rows and segments of a processed input file.
+        """
+
+        for extension, part in [('csv', rows), ('segments', segments)]:
+            with open(self.part_file(input_file, extension), 'w') as output_f:
+                output_f.write(part)
+
+        self.manifest['files'][os.path.abspath(input_file)] = {
+            'mtime': os.path.getmtime(input_file), 'md5': md5}
+
+    def save(self):
+        """
+        Writes the manifest.
+        """
+
+        tmp_file = '{0}.tmp'.format(self.manifest_file)
+        with open(tmp_file, 'w') as output_f:
+            json.dump(self.manifest, output_f, indent=1, sort_keys=True)
+        os.rename(tmp_file, self.manifest_file)
 
 
 def main():
@@ -359,68 +586,75 @@ def main():
                        'anonymity,speech_in_speech,missing_audio,' \
                        'no_relevant_speech\n')
 
-    # Process all the XML / EXB files:
     for input_file in args.input_annotation:
-
-        # print 'Processing {0}'.format(input_file)
-
         if not os.path.exists(input_file):
             sys.stderr.write('The input file {0} does ' \
                              'not exist\n'.format(input_file))
             sys.exit(1)
 
-        basename = os.path.splitext(os.path.split(input_file)[1])[0]
-
-        # Read the xml tree:
-        xml_tree = ET.parse(input_file)
-        root = xml_tree.getroot()
-
-        if args.input_format == 'exb':
-
-            # Read the timepoints:
-            time_dict = get_timepoints(root)
-
-            (chunk_list, overlap_dict) = chunk_transcriptions(root, basename,
-                                                              args.input_format,
-                                                              time_dict=time_dict)
-
-            write_chunk_transcriptions(chunk_list, overlap_dict,
-                                       args.input_format, output_f)
-
-            if args.wav_dir:
-                # Finally, extract the waveforms corresponding to the chunks:
-                input_wav = os.path.join(args.wav_dir,
-                                         '{0}.wav'.format(basename))
-
-                if not os.path.exists(input_wav):
-                    sys.stderr.write('The wavefile {0}, corresponding to {1}, ' \
-                                     'does not exist\n'.format(input_wav,
-                                                               input_file))
-                    sys.exit(1)
-
-
-                # Create the wave object:
-                try:
-                    wave_in = wave.open(input_wav, 'r')
-                except wave.Error as err:
-                    sys.stderr.write('Wrong format for input wavefile {0} ' \
-                                     '({1})\n'.format(input_wav, err))
-                    sys.exit(1)
-
-                extract_wave_chunks(chunk_list, wave_in, args.output_wav_dir)
-
-                wave_in.close()
+    cache = None
+    if args.cache_dir:
+        cache = ChunkCache(args.cache_dir,
+                           {'input_format': args.input_format,
+                            'wav_dir': os.path.abspath(args.wav_dir) if args.wav_dir else '',
+                            'output_wav_dir': os.path.abspath(args.output_wav_dir) if args.output_wav_dir else '',
+                            'kaldi_segments': args.kaldi_segments})
+
+    # Files that did not change since the last run:
+    cached = set()
+    tasks = []
+    for index, input_file in enumerate(args.input_annotation):
+        if cache is not None and cache.is_current(input_file):
+            cached.add(index)
+        else:
+            tasks.append((input_file, args.input_format, args.wav_dir,
+                          args.output_wav_dir, args.kaldi_segments))
+
+    # Process all the remaining XML / EXB files. imap returns the results in
+    # the order of the tasks, so the output does not depend on the number of
+    # jobs:
+    pool = None
+    if args.num_jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(args.num_jobs, len(tasks)))
+        results = pool.imap(process_task, tasks)
+    else:
+        results = itertools.imap(process_task, tasks)
+
+    segments_f = None
+    wav_scp_f = None
+    if args.kaldi_segments and args.wav_dir:
+        segments_f = open(os.path.join(args.output_wav_dir, 'segments'), 'w')
+        wav_scp_f = open(os.path.join(args.output_wav_dir, 'wav.scp'), 'w')
 
-        elif args.input_format == 'xml':
-            namespace = root.tag.split('}')[0].strip('{')
-            print namespace
-            (chunk_list, overlap_dict) = chunk_transcriptions(root, basename,
-                                                              args.input_format,
-                                                              namespace)
-            write_chunk_transcriptions(chunk_list, overlap_dict,
-                                       args.input_format, output_f)
+    try:
+        for index, input_file in enumerate(args.input_annotation):
+            if index in cached:
+                rows, segments = cache.get(input_file)
+            else:
+                rows, segments, md5 = next(results)
+                if cache is not None:
+                    cache.put(input_file, rows, segments, md5)
+            output_f.write(rows)
+
+            if segments_f is not None:
+                basename = os.path.splitext(os.path.split(input_file)[1])[0]
+                segments_f.write(segments)
+                wav_scp_f.write('{0} {1}\n'.format(
+                    basename, os.path.abspath(os.path.join(
+                        args.wav_dir, '{0}.wav'.format(basename)))))
+    except IOError as err:
+        sys.stderr.write('{0}\n'.format(err))
+        sys.exit(1)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if cache is not None:
+            cache.save()
 
     output_f.close()
+    if segments_f is not None:
+        segments_f.close()
+        wav_scp_f.close()
 
 
 if __name__ == '__main__':
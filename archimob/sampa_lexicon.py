@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Compact, memory-mapped store of SAMPA pronunciations, used by
+create_sampa_normalised_lexicon.py instead of the JSON dictionary.
+
+The store is a single binary file built once from the JSON file
+({normalised word: [SAMPA pronunciations]}). Words are lowercased (the
+pronunciations of words differing only in case are concatenated, as before)
+and sorted by their UTF-8 bytes, so they are looked up with a binary search
+directly in the mapped file. Phones are interned: every pronunciation is an
+array of phone ids (the pronunciation split on single spaces, so joining the
+phones gives back the exact string).
+
+Layout (native byte order, every section aligned to 4 bytes):
+    header
+    word_offsets  uint32[num_words + 1]   word k is words[off[k]:off[k+1]]
+    word_prons    uint32[num_words + 1]   pronunciations of word k
+    pron_offsets  uint32[num_prons + 1]   phones of pronunciation p
+    phones        uint16[num_phones]      phone ids
+    words         UTF-8 bytes of the sorted words
+    phone_table   UTF-8 phones, separated by '\\n'
+
+The header stores the size and modification time of the JSON file, and the
+store is rebuilt when they change.
+
+Example call (only prints the size of the store, building it if needed):
+    python3 sampa_lexicon.py -s norm2sampa.json
+"""
+
+import argparse
+import bisect
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections import defaultdict
+
+
+MAGIC = b'SAMPAIDX'
+VERSION = 1
+# magic, version, json size, json mtime (ns), number of words, of
+# pronunciations, of phone ids, of phone types, bytes of the words and bytes
+# of the phone table:
+HEADER = struct.Struct('=8sIqqIIIIII')
+MAX_PHONES = 0x10000
+
+
+def get_args():
+    """
+    Returns the command line arguments
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Builds the binary pronunciation store of a SAMPA JSON '
+                    'file')
+
+    parser.add_argument('--sampa_file', '-s', required=True,
+                        help='JSON file containing dictionary of normalised '
+                             'words and their SAMPA pronunciations')
+
+    parser.add_argument('--index_file', '-i',
+                        help='Output store. Default: the SAMPA file with the '
+                             'extension .idx')
+
+    return parser.parse_args()
+
+
+def index_path(sampa_file):
+    """
+    Default path of the store of a SAMPA JSON file.
+    """
+    return os.path.splitext(sampa_file)[0] + '.idx'
+
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _padding(length):
+    return b'\0' * (-length % 4)
+
+
+class _Words(object):
+    """
+    Sequence view of the sorted words of a store, as UTF-8 bytes (for
+    bisect).
+    """
+
+    def __init__(self, data, offsets, base=0):
+        self.data = data
+        self.offsets = offsets
+        self.base = base
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def blob(self):
+        return self.data[self.base:self.base + self.offsets[len(self)]]
+
+    def __getitem__(self, k):
+        return self.data[self.base + self.offsets[k]:
+                         self.base + self.offsets[k + 1]]
+
+
+class SampaLexicon(object):
+
+    def __init__(self, stamp, word_offsets, word_prons, pron_offsets,
+                 phone_ids, words, phone_table, words_start=0):
+        self.stamp = stamp
+        self.word_offsets = word_offsets
+        self.word_prons = word_prons
+        self.pron_offsets = pron_offsets
+        self.phone_ids = phone_ids
+        self.words = _Words(words, word_offsets, words_start)
+        self.phone_table = phone_table
+
+    @classmethod
+    def from_json(cls, sampa_file):
+        """
+        Build the store (in memory) from a SAMPA JSON file.
+        """
+        with open(sampa_file, 'r', encoding='utf8') as f:
+            sampa_dict = json.load(f)
+
+        # convert all keys to lowercase!
+        lowercased = defaultdict(list)
+        for k, v in sampa_dict.items():
+            if v:
+                lowercased[k.lower()].extend(v)
+        del sampa_dict
+
+        phone2id = {}
+        word_offsets, word_prons = array('I', [0]), array('I', [0])
+        pron_offsets, phone_ids = array('I', [0]), array('H')
+        words = bytearray()
+
+        for key, word in sorted((k.encode('utf8'), k) for k in lowercased):
+            for pron in lowercased.pop(word):
+                for phone in pron.split(' '):
+                    if phone not in phone2id:
+                        if len(phone2id) == MAX_PHONES:
+                            raise ValueError('More than {} different phones '
+                                             'in {}'.format(MAX_PHONES,
+                                                            sampa_file))
+                        phone2id[phone] = len(phone2id)
+                    phone_ids.append(phone2id[phone])
+                pron_offsets.append(len(phone_ids))
+            words += key
+            word_offsets.append(len(words))
+            word_prons.append(len(pron_offsets) - 1)
+
+        return cls(file_stamp(sampa_file), word_offsets, word_prons,
+                   pron_offsets, phone_ids, bytes(words), list(phone2id))
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Map a store written by save().
+        """
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, size, mtime, num_words, num_prons, num_ids,
+         num_phones, words_bytes, table_bytes) = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not a SAMPA pronunciation store'.format(
+                path))
+
+        view = memoryview(data)
+        sections = []
+        start = HEADER.size + len(_padding(HEADER.size))
+        for fmt, count in (('I', num_words + 1), ('I', num_words + 1),
+                           ('I', num_prons + 1), ('H', num_ids)):
+            end = start + count * struct.calcsize(fmt)
+            sections.append(view[start:end].cast(fmt))
+            start = end + len(_padding(end))
+
+        # The words are sliced from the map itself, which returns bytes that
+        # bisect can compare.
+        words_start = start
+        start += words_bytes
+        table = data[start:start + table_bytes].decode('utf8')
+        phone_table = table.split('\n') if num_phones else []
+
+        return cls((size, mtime), *sections, words=data,
+                   phone_table=phone_table, words_start=words_start)
+
+    @classmethod
+    def load(cls, sampa_file, store=None, use_cache=True):
+        """
+        Open the store of a SAMPA JSON file if it is up to date, otherwise
+        build it from the JSON file (and write it).
+        """
+        if store is None:
+            store = index_path(sampa_file)
+
+        if use_cache and os.path.exists(store):
+            try:
+                lexicon = cls.from_file(store)
+                if lexicon.stamp == file_stamp(sampa_file):
+                    return lexicon
+            except (ValueError, struct.error):
+                pass
+
+        lexicon = cls.from_json(sampa_file)
+        if use_cache:
+            try:
+                lexicon.save(store)
+                return cls.from_file(store)
+            except OSError:
+                pass
+
+        return lexicon
+
+    def save(self, path):
+        # Write to a temporary file first, so that concurrent jobs never map a
+        # half written store.
+        table = '\n'.join(self.phone_table).encode('utf8')
+        words = self.words.blob()
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, self.stamp[0], self.stamp[1],
+                                len(self), self.num_prons,
+                                len(self.phone_ids), len(self.phone_table),
+                                len(words), len(table)))
+            f.write(_padding(HEADER.size))
+            for section in (self.word_offsets, self.word_prons,
+                            self.pron_offsets, self.phone_ids):
+                data = bytes(section)
+                f.write(data)
+                f.write(_padding(len(data)))
+            f.write(words)
+            f.write(table)
+        os.replace(tmp, path)
+
+    def __len__(self):
+        """
+        Number of (lowercased) words.
+        """
+        return len(self.word_offsets) - 1
+
+    @property
+    def num_prons(self):
+        return len(self.pron_offsets) - 1
+
+    def find(self, word):
+        """
+        Index of a word in the store, or -1 if it has no pronunciation.
+        """
+        key = word.encode('utf8')
+        k = bisect.bisect_left(self.words, key)
+        if k < len(self) and self.words[k] == key:
+            return k
+        return -1
+
+    def pronunciations(self, word):
+        """
+        Generates the SAMPA pronunciations of a word, in the order of the JSON
+        file.
+        """
+        k = self.find(word)
+        if k < 0:
+            return
+
+        phones = self.phone_table
+        for p in range(self.word_prons[k], self.word_prons[k + 1]):
+            ids = self.phone_ids[self.pron_offsets[p]:self.pron_offsets[p + 1]]
+            yield ' '.join([phones[i] for i in ids])
+
+
+def main():
+
+    args = get_args()
+
+    store = args.index_file or index_path(args.sampa_file)
+    lexicon = SampaLexicon.load(args.sampa_file, store)
+
+    print('{}: {} words, {} pronunciations, {} phones, {} bytes'.format(
+        store, len(lexicon), lexicon.num_prons, len(lexicon.phone_table),
+        os.path.getsize(store)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
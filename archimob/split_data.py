@@ -2,13 +2,24 @@
 # -*- coding: utf-8 -*-
 
 """
-Splits training and test data according to json provided as input
+Splits training and test data according to json provided as input, or into
+speaker-disjoint splits chosen with a stable hash of the speaker ids.
+Several input csv files (v.gr. Archimob r1, r2 and Schawinski) are read in
+one pass, and the rows are written to one csv file per split. Optionally, a
+Kaldi data directory (text, wav.scp, utt2spk, spk2utt) is also written for
+every split.
 Example call:
         python ${scripts_dir}/split_data.py \
             -i ${csv_files}/archimob_r2/archimob_r2.csv \
             -o ${csv_files}/archimob_r2/ \
             --test ${archimob_files}/archimob_r2/meta_info/testset_utterances.json \
             --dev dev_set.json (if available)
+
+        python ${scripts_dir}/split_data.py \
+            -i archimob_r1.csv archimob_r2.csv schawinski.csv \
+            -o ${csv_files}/all/ \
+            --hash-split train=0.8 dev=0.1 test=0.1 --balance-duration \
+            --kaldi-dirs --wav-dir ${wav_dir}
 """
 
 import sys
@@ -16,24 +27,56 @@ import json
 import csv
 import argparse
 import os
+import hashlib
+
+# Extension for the wavefiles (as in create_secondary_files.py):
+WAV_EXTENSION = 'wav'
 
 
 def set_args():
     ap = argparse.ArgumentParser()
     ap.add_argument('--train', required=False, help='JSON file containing utterance ids for training set utterances.')
-    ap.add_argument('--test', required=False, help='JSON file containing utterance ids for test set utterances.')
+    ap.add_argument('-t', '--test', required=False, help='JSON file containing utterance ids for test set utterances.')
     ap.add_argument('--dev', required=False, help='JSON file containing utterance ids for dev set utterances.')
+    ap.add_argument('--split', action='append', default=[], metavar='NAME=JSON',
+                    help='Additional named split, with a JSON file containing its utterance ids. Can be repeated.')
+    ap.add_argument('--rest', default='train',
+                    help='Split receiving the utterances of no JSON split (unless a JSON file is given for it).')
+    ap.add_argument('--hash-split', nargs='+', metavar='NAME=FRACTION',
+                    help='Instead of JSON files, assign every speaker to one of these splits with a stable hash of '
+                         'the speaker id, v.gr. train=0.8 dev=0.1 test=0.1')
+    ap.add_argument('--balance-duration', action='store_true',
+                    help='With --hash-split, assign the speakers so that the duration (or number of utterances, '
+                         'if there is no duration column) of every split matches its fraction. Needs an extra pass '
+                         'over the input.')
+    ap.add_argument('--hash-salt', default='', help='Salt of the speaker hash, to draw a different split.')
+    ap.add_argument('--key-column', default='audio_id',
+                    help='Column matched against the JSON utterance ids.')
+    ap.add_argument('--speaker-column', default='speaker_id', help='Column with the speaker ids.')
+    ap.add_argument('--kaldi-dirs', action='store_true',
+                    help='Also write a Kaldi data directory (text, wav.scp, utt2spk, spk2utt) per split.')
+    ap.add_argument('--wav-dir', help='Folder with the wavefiles, for wav.scp (required with --kaldi-dirs).')
+    ap.add_argument('--text-column', default='transcription', help='Column written to the Kaldi text files.')
     ap.add_argument('-o', '--outpath', required=True, help='Output directory for train directory and test directory.')
-    ap.add_argument('-i', '--input-csv', required=True, help='Input directory containing exmaralda XML')
+    ap.add_argument('-i', '--input-csv', required=True, nargs='+', help='Input csv files')
+
+    args = ap.parse_args()
+
+    if args.hash_split and (args.train or args.test or args.dev or args.split):
+        ap.error('--hash-split cannot be combined with JSON splits')
+    if args.balance_duration and not args.hash_split:
+        ap.error('--balance-duration requires --hash-split')
+    if args.kaldi_dirs and not args.wav_dir:
+        ap.error('--kaldi-dirs requires --wav-dir')
 
-    return ap.parse_args()
+    return args
 
 
 def parse_json(utterance_json_file):
 
-    with open(utterance_json_file, 'r') as inf:
+    with open(utterance_json_file, 'r', encoding='utf8') as inf:
 
-        utterances = json.load(inf, encoding='utf8')
+        utterances = json.load(inf)
 
     if not utterances:
         sys.stderr.write('Problem loading utterances from JSON file.')
@@ -42,110 +85,254 @@ def parse_json(utterance_json_file):
     return set([entry['start'] for entry in utterances['utterances']])
 
 
-def main():
-    args = set_args()
+def parse_assignment(spec):
+    """
+    Splits a NAME=VALUE command line argument.
+    """
 
-    # read in train split data
-    if args.train:
-        train_utterances = parse_json(args.train)
-        sys.stderr.write('Collected {0} utterances from {1}\n'.format(
-            len(train_utterances), args.train))
-    else:
-        train_utterances = set()
+    name, sep, value = spec.partition('=')
+    if not sep or not name or not value:
+        sys.stderr.write('Wrong split specification: {0} (should be NAME=VALUE)\n'.format(spec))
+        sys.exit(1)
 
-    # read in test split data
-    if args.test:
-        test_utterances = parse_json(args.test)
-        sys.stderr.write('Collected {0} utterances from {1}\n'.format(
-            len(test_utterances), args.test))
-    else:
-        test_utterances = set()
+    return name, value
 
-    # read in dev split data
-    if args.dev:
-        dev_utterances = parse_json(args.dev)
-        sys.stderr.write('Collected {0} utterances from {1}\n'.format(
-            len(test_utterances), args.dev))
-    else:
-        dev_utterances = set()
 
-    # establish output csv files
-    if not os.path.exists(args.outpath):
-        os.makedirs(args.outpath)
+def stable_hash(value, salt=''):
+    """
+    Returns a number in [0, 1) which, unlike hash(), is the same in every run.
+    """
 
-    outfiles = []
+    digest = hashlib.md5((salt + value).encode('utf8')).digest()
 
-    train_file = args.outpath+'/'+'train.csv'
-    train_file_handle = open(train_file, 'w', encoding='utf8')
-    train_file_writer = csv.writer(train_file_handle)
-    outfiles.append(train_file_handle)
+    return int.from_bytes(digest[:8], 'big') / 2.0 ** 64
 
-    if args.test:
-        test_file = args.outpath+'/'+'test.csv'
-        test_file_handle = open(test_file, 'w', encoding='utf8')
-        test_file_writer = csv.writer(test_file_handle)
-        outfiles.append(test_file_handle)
 
-    if args.dev:
-        dev_file = args.outpath+'/'+'dev.csv'
-        dev_file_handle = open(dev_file, 'w', encoding='utf8')
-        dev_file_writer = csv.writer(dev_file_handle)
-        outfiles.append(dev_file_handle)
+def read_csv_files(csv_files, columns=None):
+    """
+    Generates the rows of several csv files, in order, with the columns of the
+    first file (or the given columns). Missing columns are left empty.
+    yields:
+        * (columns, row) tuples. The first one has row None.
+    """
 
-    # initialise counter variables for logging
-    train_c = 0
-    test_c = 0
-    dev_c = 0
+    for csv_file in csv_files:
+        with open(csv_file, 'r', encoding='utf8') as input_csv:
+            # no_relevant_speech, transcription, normalized, missing_audio, anonymity,
+            # utt_id, speech_in_speech, audio_id, speaker_id
+            reader = csv.reader(input_csv)
 
-    with open(args.input_csv, 'r', encoding='utf8') as input_csv:
-        # no_relevant_speech, transcription, normalized, missing_audio, anonymity,
-        # utt_id, speech_in_speech, audio_id, speaker_id
-        reader = csv.reader(input_csv)
+            # skip header
+            col_names = next(reader, None)
+            if col_names is None:
+                continue
 
-        # skip header
-        col_names = next(reader)
+            if columns is None:
+                columns = col_names
+                yield columns, None
 
-        # write headers
-        train_file_writer.writerow(col_names)
-        if args.test:
-            test_file_writer.writerow(col_names)
-        if args.dev:
-            dev_file_writer.writerow(col_names)
+            if col_names == columns:
+                for row in reader:
+                    yield columns, row
+            else:
+                index = {name: k for k, name in enumerate(col_names)}
+                positions = [index.get(name) for name in columns]
+                for row in reader:
+                    yield columns, [row[k] if k is not None and k < len(row) else '' for k in positions]
+
+
+def speaker_durations(csv_files, speaker_column):
+    """
+    Returns a dictionary with the total duration of every speaker, or the
+    number of utterances if the csv files have no duration column.
+    """
+
+    durations = {}
+    for columns, row in read_csv_files(csv_files):
+        if row is None:
+            spk_index = columns.index(speaker_column)
+            dur_index = columns.index('duration') if 'duration' in columns else None
+            continue
+        duration = float(row[dur_index] or 0) if dur_index is not None else 1.0
+        durations[row[spk_index]] = durations.get(row[spk_index], 0.0) + duration
+
+    return durations
+
+
+def balance_speakers(durations, fractions, salt=''):
+    """
+    Assigns every speaker to the split which is furthest below its target
+    share of the total duration, longest speakers first (ties broken by the
+    stable hash, so the result does not depend on the input order).
+    """
+
+    total = sum(durations.values())
+    assigned = [0.0] * len(fractions)
+    spk2split = {}
+
+    for spk in sorted(durations, key=lambda s: (-durations[s], stable_hash(s, salt), s)):
+        split = max(range(len(fractions)), key=lambda k: (fractions[k] * total - assigned[k], -k))
+        spk2split[spk] = split
+        assigned[split] += durations[spk]
+
+    return spk2split
+
+
+class SplitWriter(object):
+    """
+    Writes the rows of one split to its csv file, keeping what is needed for
+    its Kaldi data directory.
+    """
+
+    def __init__(self, name, outpath, kaldi=False):
+        self.name = name
+        self.csv_file = os.path.join(outpath, name + '.csv')
+        self.handle = open(self.csv_file, 'w', encoding='utf8')
+        self.writer = csv.writer(self.handle)
+        self.count = 0
+        self.kaldi_dir = os.path.join(outpath, name) if kaldi else None
+        self.entries = []
+
+    def writeheader(self, col_names):
+        self.writer.writerow(col_names)
+
+    def writerow(self, row, utt_id=None, spk_id=None, text=None):
+        self.writer.writerow(row)
+        self.count += 1
+        if self.kaldi_dir:
+            self.entries.append((utt_id, spk_id, text))
+
+    def close(self, wav_dir=None):
+        self.handle.close()
+        if self.kaldi_dir:
+            write_kaldi_dir(self.kaldi_dir, self.entries, wav_dir)
+
+
+def write_kaldi_dir(data_dir, entries, wav_dir):
+    """
+    Writes text, wav.scp, utt2spk and spk2utt (sorted the way Kaldi likes) for
+    a list of (utt_id, spk_id, text) entries. The utterance ids and wav.scp
+    follow create_secondary_files.py.
+    """
+
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+
+    entries = sorted(entries)
+    spk2utt = {}
+
+    with open(os.path.join(data_dir, 'text'), 'w', encoding='utf8') as text_f, \
+            open(os.path.join(data_dir, 'wav.scp'), 'w', encoding='utf8') as wav_f, \
+            open(os.path.join(data_dir, 'utt2spk'), 'w', encoding='utf8') as utt_f:
+        for utt_id, spk_id, text in entries:
+            text_f.write('{0}\t{1}\n'.format(utt_id, text))
+            wav_f.write('{0} {1}.{2}\n'.format(utt_id, os.path.join(wav_dir, utt_id), WAV_EXTENSION))
+            utt_f.write('{0} {1}\n'.format(utt_id, spk_id))
+            spk2utt.setdefault(spk_id, []).append(utt_id)
+
+    with open(os.path.join(data_dir, 'spk2utt'), 'w', encoding='utf8') as spk_f:
+        for spk_id in sorted(spk2utt):
+            spk_f.write('{0} {1}\n'.format(spk_id, ' '.join(spk2utt[spk_id])))
 
-        for row in reader:
-            labelled_row = dict(zip(col_names, row))
-            # row = dict(zip(col_names, row))
-            # print(row['utt_id'])
 
+def main():
+    args = set_args()
 
-            if labelled_row['audio_id'] in test_utterances:
-                test_file_writer.writerow(row)
-                test_c += 1
+    # splits with their utterance ids (None: any utterance), in order of
+    # precedence:
+    json_splits = []
+    if args.test:
+        json_splits.append(('test', args.test))
+    if args.dev:
+        json_splits.append(('dev', args.dev))
+    json_splits.extend(parse_assignment(spec) for spec in args.split)
+    if args.train:
+        json_splits.append(('train', args.train))
 
-            elif args.dev and labelled_row['audio_id'] in dev_utterances:
-                dev_file_writer.writerow(row)
-                dev_c += 1
+    splits = []
+    for name, json_file in json_splits:
+        utterances = parse_json(json_file)
+        sys.stderr.write('Collected {0} utterances from {1}\n'.format(
+            len(utterances), json_file))
+        splits.append((name, utterances))
+
+    if args.hash_split:
+        fractions = [parse_assignment(spec) for spec in args.hash_split]
+        names = [name for name, _ in fractions]
+        try:
+            fractions = [float(value) for _, value in fractions]
+        except ValueError as err:
+            sys.stderr.write('Wrong split fraction ({0})\n'.format(err))
+            sys.exit(1)
+        total = sum(fractions)
+        fractions = [f / total for f in fractions]
+        if args.balance_duration:
+            spk2split = balance_speakers(speaker_durations(args.input_csv, args.speaker_column),
+                                         fractions, args.hash_salt)
+    else:
+        names = [name for name, _ in splits]
+        # if a restriction on training utterances is provided, only add relevant utterances.
+        # if no restriction is given for training utterances, take all of them
+        if args.rest not in names:
+            splits.append((args.rest, None))
+            names.append(args.rest)
+
+    if len(set(names)) != len(names):
+        sys.stderr.write('Repeated split names: {0}\n'.format(' '.join(names)))
+        sys.exit(1)
 
-            else:
-                # if a restriction on training utterances is provided, only add relevant utterances.
-                if len(train_utterances) != 0:
-                    if labelled_row['audio_id'] in train_utterances:
-                        train_file_writer.writerow(row)
-                        train_c += 1
+    # establish output csv files
+    if not os.path.exists(args.outpath):
+        os.makedirs(args.outpath)
 
-                # if no restriction is given for training utterances, take all of them
-                else:
-                    train_file_writer.writerow(row)
-                    train_c += 1
+    writers = [SplitWriter(name, args.outpath, args.kaldi_dirs) for name in names]
+    wav_dir = os.path.abspath(args.wav_dir) if args.wav_dir else None
+
+    # Upper bounds of the hash of the speakers of every split:
+    if args.hash_split and not args.balance_duration:
+        bounds = [sum(fractions[:k + 1]) for k in range(len(fractions))]
+        bounds[-1] = 1.0
+        spk2split = {}
+
+    for col_names, row in read_csv_files(args.input_csv):
+
+        if row is None:
+            # write headers
+            for writer in writers:
+                writer.writeheader(col_names)
+            key_index = col_names.index(args.key_column) if not args.hash_split else None
+            spk_index = col_names.index(args.speaker_column) if args.hash_split or args.kaldi_dirs else None
+            if args.kaldi_dirs:
+                utt_index = col_names.index('utt_id')
+                text_index = col_names.index(args.text_column)
+            continue
+
+        if args.hash_split:
+            spk_id = row[spk_index]
+            if spk_id not in spk2split:
+                # only reached without --balance-duration:
+                position = stable_hash(spk_id, args.hash_salt)
+                spk2split[spk_id] = next(k for k, bound in enumerate(bounds) if position < bound)
+            split = spk2split[spk_id]
+        else:
+            key = row[key_index]
+            split = next((k for k, (_, utterances) in enumerate(splits)
+                          if utterances is None or key in utterances), None)
+            if split is None:
+                continue
+
+        if args.kaldi_dirs:
+            writers[split].writerow(row, row[utt_index].split('.')[0], row[spk_index], row[text_index])
+        else:
+            writers[split].writerow(row)
 
     # close all opened files
-    for f in outfiles:
-        f.close()
+    for writer in writers:
+        writer.close(wav_dir)
 
     # print out number of utterances for logging
-    sys.stderr.write('{} utterances writen to train csv.\n'.format(train_c))
-    sys.stderr.write('{} utterances writen to test csv.\n'.format(test_c))
-    sys.stderr.write('{} utterances writen to dev csv.\n'.format(dev_c))
+    for writer in writers:
+        sys.stderr.write('{} utterances writen to {} csv.\n'.format(writer.count, writer.name))
 
 
 if __name__ == '__main__':
@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
 """
@@ -10,6 +10,11 @@ Example call:
         python ${scripts_dir}/sync_csv_wav.py \
             -i ${csv_files}/archimob_r2/archimob_r2.csv \
             -chw ${archimob_files}/archimob_r2/audio
+
+The folder is read once (os.scandir) into an index, and all the renames and
+moves are computed on that index first, as a plan, which is then executed with
+os.replace in a pool of threads (or only printed, with --dry-run). This
+avoids several metadata requests per csv row on network file systems.
 """
 
 import os
@@ -17,8 +22,15 @@ import os.path
 import shutil
 import argparse
 import csv
+import errno
 import re
-from collections import OrderedDict
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# Folder (relative to the chuncked wav dir) for the audio files with no
+# annotation:
+ORPHAN_DIR = os.path.join('..', 'empty_wavs')
+
 
 def get_args():
     """
@@ -37,6 +49,13 @@ def get_args():
                         'chuncked wavefiles if they already exist but should' \
                         'be renamed', required=True)
 
+    parser.add_argument('--dry-run', '-n', action='store_true',
+                        help='Only print the renames and moves, and the ' \
+                        'statistics, without changing any file')
+
+    parser.add_argument('--num-threads', '-j', type=int, default=8,
+                        help='Number of renames run in parallel')
+
     parser.add_argument('--verbose', required=False, action='store_true')
 
     args = parser.parse_args()
@@ -44,6 +63,148 @@ def get_args():
     return args
 
 
+def scan_directory(directory):
+    """
+    Returns a dictionary with the directory entries of a folder, by name. The
+    size of an entry is only requested when needed (DirEntry caches it).
+    """
+
+    with os.scandir(directory) as entries:
+        return {entry.name: entry for entry in entries}
+
+
+def entry_size(entry):
+    """
+    Size of a directory entry, following symbolic links (as
+    os.path.getsize). Returns None if it can not be read.
+    """
+
+    try:
+        return entry.stat().st_size
+    except OSError:
+        return None
+
+
+def plan_renames(rows, header, index, verbose=False):
+    """
+    Decides the missing_audio value of every row and the renames of the
+    chuncked wavefiles, updating the index as if the renames had already
+    been made (so later rows see the same folder as with renaming one file at
+    a time).
+    input:
+        * rows (list): rows of the csv file. Their missing_audio column is
+          updated in place.
+        * header (list): names of the columns.
+        * index (dict): directory entries by name (see scan_directory).
+    returns:
+        * a list of (source name, target name) renames, in order.
+        * the number of overlappings.
+        * the number of transcriptions without audio.
+    """
+
+    utt_col = header.index('utt_id')
+    audio_col = header.index('audio_id')
+    missing_col = header.index('missing_audio')
+
+    renames = []
+    prev_audio = ''
+    prev_id = ''
+    n_overlap = 0
+    n_transcription_only = 0
+
+    for phrase in rows: # phrase == row in csv file
+
+        current_id = phrase[utt_col]
+        # if not renamed yet
+        current_audio = re.sub('-', '_', phrase[audio_col])
+
+        curr_audio_unrenamed = '{}{}'.format(current_audio, '.wav')
+        target_name = '{}{}'.format(current_id, '.wav')
+        # if has been already renamed
+        curr_audio_renamed = target_name
+
+        if curr_audio_unrenamed in index:
+            if entry_size(index[curr_audio_unrenamed]):
+                phrase[missing_col] = '0'
+                if current_audio != prev_audio:
+                    if curr_audio_unrenamed != target_name:
+                        renames.append((curr_audio_unrenamed, target_name))
+                        index[target_name] = index.pop(curr_audio_unrenamed)
+                else:
+                    n_overlap += 1
+                    if verbose:
+                        print("WARNING: {} and {} refer to the same audio {}.".format(prev_id,current_id,current_audio))
+            else:
+                n_transcription_only += 1
+                phrase[missing_col] = '1'
+                if verbose:
+                    print("WARNING: there is no audio for the fragment {}".format(current_id))
+
+        elif curr_audio_renamed in index:
+            if entry_size(index[curr_audio_renamed]):
+                phrase[missing_col] = '0'
+
+        else:
+            n_transcription_only += 1
+            phrase[missing_col] = '1'
+            if verbose:
+                print("WARNING: there is no audio for the fragment {}".format(current_id))
+
+        prev_audio = current_audio
+        prev_id = current_id
+
+    return renames, n_overlap, n_transcription_only
+
+
+def schedule(renames):
+    """
+    Splits the renames into the ones that touch no file of any other rename
+    (they can run in any order, in parallel) and the rest, which keep their
+    order.
+    """
+
+    uses = {}
+    for source, target in renames:
+        uses[source] = uses.get(source, 0) + 1
+        uses[target] = uses.get(target, 0) + 1
+
+    independent = []
+    ordered = []
+    for source, target in renames:
+        if uses[source] == 1 and uses[target] == 1:
+            independent.append((source, target))
+        else:
+            ordered.append((source, target))
+
+    return independent, ordered
+
+
+def move(source, target):
+    """
+    Atomic rename, or copy and remove if the target is on another device.
+    """
+
+    try:
+        os.replace(source, target)
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+        shutil.move(source, target)
+
+
+def execute(operations, num_threads):
+    """
+    Runs a list of (source path, target path) moves in a pool of threads.
+    """
+
+    if not operations:
+        return
+
+    with ThreadPoolExecutor(max_workers=max(1, num_threads)) as pool:
+        for _ in pool.map(lambda op: move(*op), operations):
+            pass
+
+
 def main():
     """
     Main function of the program
@@ -54,87 +215,69 @@ def main():
     directory = args.chuncked_wav_dir
     input_csvfile = args.input_csv
 
-    annotation_dictionary = []
-
     with open(input_csvfile, 'r') as csvfile:
 
         csv_annotation = csv.reader(csvfile, delimiter=',')
 
         header = next(csv_annotation)
+        rows = list(csv_annotation)
 
-        prev_audio = ''
-        prev_id = ''
-        n_overlap = 0
-        n_transcription_only = 0
-        n_audio_only = 0
-
-        for phrase in csv_annotation: # phrase == row in csv file
-
-            phrase = OrderedDict(zip(header, phrase))
-
-            current_id = phrase['utt_id']
-            # if not renamed yet
-            current_audio = re.sub('-', '_', phrase['audio_id'])
-
-            curr_audio_unrenamed = os.path.join(directory,
-                                    "{}{}".format(current_audio, ".wav"))
-            target_name = os.path.join(directory,
-                                         "{}{}".format(current_id, ".wav"))
-            # if has been already renamed
-            curr_audio_renamed = os.path.join(directory,
-                                              "{}{}".format(current_id,
-                                                            ".wav"))
-
-            if os.path.exists(curr_audio_unrenamed):
-                if os.path.getsize(curr_audio_unrenamed) != 0:
-                    phrase['missing_audio'] = '0'
-                    if current_audio != prev_audio:
-                        os.rename(curr_audio_unrenamed, target_name)
-                    else:
-                        n_overlap += 1
-                        if args.verbose:
-                            print("WARNING: {} and {} refer to the same audio {}.".format(prev_id,current_id,current_audio))
-                else:
-                    n_transcription_only += 1
-                    phrase['missing_audio'] = '1'
-                    if args.verbose:
-                        print("WARNING: there is no audio for the fragment {}".format(current_id))
+    if 'missing_audio' not in header:
+        header.append('missing_audio')
+        for phrase in rows:
+            phrase.append('')
 
-            elif os.path.exists(curr_audio_renamed):
-                if os.path.getsize(curr_audio_renamed) != 0:
-                    phrase['missing_audio'] = '0'
+    index = scan_directory(directory)
 
-            else:
-                n_transcription_only += 1
-                phrase['missing_audio'] = '1'
-                if args.verbose:
-                    print("WARNING: there is no audio for the fragment {}".format(current_id))
+    renames, n_overlap, n_transcription_only = plan_renames(rows, header,
+                                                            index,
+                                                            args.verbose)
+
+    orphans = []
+    for wav_file in index:
+        if wav_file.startswith("d"):
+            if args.verbose:
+                print("WARNING: audio file {} has no corresponding annotation".format(wav_file))
+            orphans.append(wav_file)
+    n_audio_only = len(orphans)
+
+    orphan_dir = os.path.join(directory, ORPHAN_DIR)
+    independent, ordered = schedule(renames)
+    renames = [(os.path.join(directory, source), os.path.join(directory, target))
+               for source, target in ordered + independent]
+    moves = [(os.path.join(directory, wav_file), os.path.join(orphan_dir, wav_file))
+             for wav_file in orphans]
+
+    if args.dry_run:
+        for source, target in renames + moves:
+            print('mv {} {}'.format(source, target))
+    else:
+        for source, target in renames[:len(ordered)]:
+            move(source, target)
+        execute(renames[len(ordered):], args.num_threads)
 
-            prev_audio = current_audio
-            prev_id = current_id
-            annotation_dictionary.append(phrase)
+        if moves and not os.path.exists(orphan_dir):
+            os.makedirs(orphan_dir)
+        execute(moves, args.num_threads)
 
-        for wav_file in os.listdir(directory):
-            if wav_file.startswith("d"):
-                n_audio_only += 1
-                if args.verbose:
-                    print("WARNING: audio file {} has no corresponding annotation".format(wav_file))
-                if not os.path.exists(os.path.join(directory, "../empty_wavs")):
-                    os.makedirs(os.path.join(directory, "../empty_wavs"))
-                shutil.copyfile(os.path.join(directory, wav_file),
-                                os.path.join(directory, "../empty_wavs/", wav_file))
-                os.remove(os.path.join(directory, wav_file))
+    print("\nINFO:\n")
+    print("{} renames{}\n".format(len(renames), ' (dry run)' if args.dry_run else ''))
+    print("{} overlappings\n".format(n_overlap))
+    print("{} transcriptions do not have corresponding audio files\n".format(n_transcription_only))
+    print("{} audio files do not have corresponding transcriptions\n".format(n_audio_only))
 
-        print("\nINFO:\n")
-        print("{} overlappings\n".format(n_overlap))
-        print("{} transcriptions do not have corresponding audio files\n".format(n_transcription_only))
-        print("{} audio files do not have corresponding transcriptions\n".format(n_audio_only))
+    if args.dry_run:
+        return
 
-    with open(input_csvfile, 'w') as csvfile_out:
-        writer = csv.DictWriter(csvfile_out, annotation_dictionary[0].keys())
-        writer.writeheader()
-        writer.writerows(annotation_dictionary)
+    # Write to a temporary file first, so that the input csv is never left
+    # half written:
+    tmp_csvfile = '{}.{}.tmp'.format(input_csvfile, os.getpid())
+    with open(tmp_csvfile, 'w') as csvfile_out:
+        writer = csv.writer(csvfile_out)
+        writer.writerow(header)
+        writer.writerows(rows)
+    os.replace(tmp_csvfile, input_csvfile)
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+Compare the vectorised edit distance of edit_distance.py with the original
+list-of-lists implementation on random long utterances: the operation counts
+have to be identical, and the run times of both are printed.
+Example call:
+python3 evaluation/benchmark_edit_distance.py --length 200 --utterances 50
+"""
+
+
+import argparse
+import random
+import time
+from collections import Counter, defaultdict
+
+from edit_distance import opcodes, count_opcodes
+from flex_mapping import DiethIndex
+
+
+def set_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--length', type=int, default=200,
+                        help='Number of words of each reference utterance.')
+    parser.add_argument('--utterances', type=int, default=50,
+                        help='Number of utterances to score.')
+    parser.add_argument('--vocab', type=int, default=100,
+                        help='Size of the random vocabulary.')
+    parser.add_argument('--seed', type=int, default=0)
+
+    return parser.parse_args()
+
+
+def legacy_opcodes(source, target, n2d_map=None, d2n_map=None):
+    """
+    The original implementation from compute_flexwer.py.
+    """
+    n = len(source)
+    m = len(target)
+    d = [[None for _ in range(m + 1)] for _ in range(n + 1)]
+    d[0][0] = 0
+    for i in range(1, n + 1):
+        d[i][0] = d[i - 1][0] + 1
+    for j in range(1, m + 1):
+        d[0][j] = d[0][j - 1] + 1
+
+    for i in range(1, n + 1):
+        for j in range(1, m + 1):
+            if not d2n_map:
+                sub = 1 if source[i - 1] != target[j - 1] else 0
+            else:
+                dieth_forms = set()
+                for f in d2n_map[target[j - 1]]:
+                    for dieth_form in n2d_map[f]:
+                        dieth_forms.add(dieth_form)
+                sub = 1 if source[i - 1] not in dieth_forms else 0
+            d[i][j] = min(d[i - 1][j] + 1, d[i][j - 1] + 1,
+                          d[i - 1][j - 1] + sub)
+
+    i, j = n, m
+    steps = []
+    while i > 0 and j > 0:
+        cheapest_step = min(d[i - 1][j - 1], d[i][j - 1], d[i - 1][j])
+        if cheapest_step == d[i - 1][j - 1]:
+            steps.insert(0, 'E' if d[i - 1][j - 1] == d[i][j] else 'S')
+            i -= 1
+            j -= 1
+        elif cheapest_step == d[i][j - 1]:
+            steps.insert(0, 'I')
+            j -= 1
+        else:
+            steps.insert(0, 'D')
+            i -= 1
+    steps[0:0] = ['D'] * i + ['I'] * j
+
+    return steps
+
+
+def random_mapping(vocab):
+    """
+    Random norm2dieth mapping in which some Dieth forms share normalisations.
+    """
+    n2d_map = defaultdict(list)
+    for w in vocab:
+        for _ in range(random.randint(1, 2)):
+            n2d_map['n{}'.format(random.randrange(len(vocab) // 2))].append(w)
+    d2n_map = defaultdict(set)
+    for k, v in n2d_map.items():
+        for w in v:
+            d2n_map[w].add(k)
+
+    return dict(n2d_map), d2n_map
+
+
+def perturb(words, vocab):
+    """
+    Hypothesis with random substitutions, insertions and deletions.
+    """
+    hyp = []
+    for w in words:
+        r = random.random()
+        if r < 0.1:
+            continue
+        elif r < 0.3:
+            hyp.append(random.choice(vocab))
+        else:
+            hyp.append(w)
+        if random.random() < 0.1:
+            hyp.append(random.choice(vocab))
+
+    return hyp
+
+
+def timed(function, pairs, *maps):
+    start = time.time()
+    results = [Counter(function(ref, hyp, *maps)) for ref, hyp in pairs]
+
+    return results, time.time() - start
+
+
+def main():
+    args = set_args()
+    random.seed(args.seed)
+
+    vocab = ['w{}'.format(i) for i in range(args.vocab)]
+    n2d_map, d2n_map = random_mapping(vocab)
+    pairs = []
+    for _ in range(args.utterances):
+        ref = [random.choice(vocab) for _ in range(args.length)]
+        pairs.append((ref, perturb(ref, vocab)))
+
+    mapping = DiethIndex.from_mapping(n2d_map)
+
+    for name, maps, index in (('WER', (), ()),
+                              ('FLEXWER', (n2d_map, d2n_map), (mapping,))):
+        legacy, legacy_time = timed(legacy_opcodes, pairs, *maps)
+        full, full_time = timed(opcodes, pairs, *index)
+        counts, counts_time = timed(count_opcodes, pairs, *index)
+        assert legacy == full == counts
+        print('{}\t{}'.format(name, dict(sum(legacy, Counter()))))
+        print('  legacy:        {:.3f}s'.format(legacy_time))
+        print('  opcodes:       {:.3f}s'.format(full_time))
+        print('  count_opcodes: {:.3f}s'.format(counts_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -10,12 +10,17 @@ python3 my_scripts/compute_flexwer.py -r /decode/scoring_kaldi/test_filt.txt -h
 
 
 import sys
-from collections import Counter, defaultdict
+import os
+import io
+import subprocess
+from collections import Counter
 import argparse
 import re
-import json
 import random
 
+from edit_distance import opcodes, count_opcodes
+from flex_mapping import DiethIndex
+
 
 def set_args():
     parser = argparse.ArgumentParser()
@@ -39,6 +44,74 @@ def normalise_line(line):
     return line.strip()
 
 
+def _is_sorted(path):
+    previous = None
+    with open(path, 'r', encoding='utf8') as f:
+        for line in f:
+            fields = line.split(None, 1)
+            if not fields:
+                continue
+            if previous is not None and fields[0] < previous:
+                return False
+            previous = fields[0]
+    return True
+
+
+def read_utterances(path):
+    """
+    Stream (utterance ID, tuple of words) from a Kaldi text file, in sorted order of utterance ID.
+    Files which are not sorted (e.g. concatenated decoding jobs) are piped through 'LC_ALL=C sort', so memory use stays bounded.
+    """
+    if _is_sorted(path):
+        f = open(path, 'r', encoding='utf8')
+        proc = None
+    else:
+        env = dict(os.environ, LC_ALL='C')
+        proc = subprocess.Popen(['sort', '-k1,1', path], stdout=subprocess.PIPE, env=env)
+        f = io.TextIOWrapper(proc.stdout, encoding='utf8')
+
+    with f:
+        for line in f:
+            # One split replaces the key stripping and whitespace normalisation.
+            words = line.split()
+            if words:
+                yield words[0], tuple(words[1:])
+
+    if proc is not None and proc.wait() != 0:
+        raise RuntimeError('Could not sort {}'.format(path))
+
+
+def join_utterances(refs, hyps):
+    """
+    Merge-join two streams of (utterance ID, words) sorted by utterance ID.
+    Yields (utterance ID, reference words, hypothesis words); an utterance missing on one side gets None for that side.
+    """
+    refs, hyps = iter(refs), iter(hyps)
+    ref, hyp = next(refs, None), next(hyps, None)
+    while ref is not None or hyp is not None:
+        if hyp is None or (ref is not None and ref[0] < hyp[0]):
+            yield ref[0], ref[1], None
+            ref = next(refs, None)
+        elif ref is None or hyp[0] < ref[0]:
+            yield hyp[0], None, hyp[1]
+            hyp = next(hyps, None)
+        else:
+            yield ref[0], ref[1], hyp[1]
+            ref, hyp = next(refs, None), next(hyps, None)
+
+
+def report_unmatched(hyp_path, missing, extra, max_ids=10):
+    """
+    Warn about utterances without hypothesis (scored as deletions) or without reference (scored as insertions).
+    """
+    for ids, what in ((missing, 'without hypothesis, scored as deletions'),
+                      (extra, 'without reference, scored as insertions')):
+        if ids:
+            print('WARNING: {}: {} utterances {}: {}{}'.format(
+                hyp_path, len(ids), what, ' '.join(ids[:max_ids]),
+                ' ...' if len(ids) > max_ids else ''), file=sys.stderr)
+
+
 def align_pretty(source, target, outfile=sys.stdout):
     """
     Pretty-print the alignment of two sequences of strings.
@@ -72,133 +145,44 @@ def align_pretty(source, target, outfile=sys.stdout):
         print(*line, file=outfile)
 
 
-def opcodes(source, target, n2d_map=None, d2n_map=None):
+def get_mappings(n2d_map_file, verbose=0, use_cache=True):
     """
-    Get a list of edit operations for converting source into target.
-    source=reference, target=hypothesis
+    Loads the norm2dieth mapping as an integer index over the Dieth word forms (see flex_mapping.py), which makes checking whether a substitution is free an integer comparison.
+    The index is cached in a binary file next to the JSON mapping.
     """
-    n = len(source)
-    m = len(target)
-    # Initisalise matrix with values None.
-    d = [[None for _ in range(m + 1)] for _ in range(n + 1)]
-
-    d[0][0] = 0
-
-    # Fill in first collumn.
-    for i in range(1, n + 1):
-        d[i][0] = d[i - 1][0] + 1
+    mapping = DiethIndex.load(n2d_map_file, use_cache=use_cache)
 
-    # Fill in first row.
-    for j in range(1, m + 1):
-        d[0][j] = d[0][j - 1] + 1
-
-    # Fill in matrix
-    for i in range(1, n + 1):
-        for j in range(1, m + 1):
-
-            if not d2n_map:
-                d[i][j] = min(
-                    d[i - 1][j] + 1,  # del
-                    d[i][j - 1] + 1,  # ins
-                    d[i - 1][j - 1] + (1 if source[i - 1] !=
-                                       target[j - 1] else 0)  # sub
-                )
-
-            else:
-                norm_forms = d2n_map[target[j - 1]]
-
-                dieth_forms = set()
-                for f in norm_forms:
-                    for dieth_form in n2d_map[f]:
-                        dieth_forms.add(dieth_form)
-
-                d[i][j] = min(
-                    d[i - 1][j] + 1,  # del
-                    d[i][j - 1] + 1,  # ins
-                    d[i - 1][j - 1] + (1 if source[i - 1]
-                                       not in dieth_forms else 0)  # sub
-                )
-
-    # Get list of operations from backtrace function.
-    return backtrace(d)
-
-
-def backtrace(d):
-    i = len(d) - 1
-    j = len(d[0]) - 1
-    steps = []
-    # While not in the top left cell, calculate the cheapest step and when found move to that cell and insert operation to steps list.
-    while i > 0 and j > 0:
-        cheapest_step = min(d[i - 1][j - 1], d[i][j - 1], d[i - 1][j])
-
-        if cheapest_step == d[i - 1][j - 1]:
-            if d[i - 1][j - 1] == d[i][j]:
-                steps.insert(0, "E")  # cell to upper left is equal
-                i -= 1
-                j -= 1
-                continue
-
-            else:
-                steps.insert(0, "S")  # cell to upper left is cheapest via sub
-                i -= 1
-                j -= 1
-                continue
-
-        # Cell to left is min
-        elif cheapest_step == d[i][j - 1]:
-            steps.insert(0, "I")
-            j -= 1
-            continue
-
-        # Cell above is min
-        elif cheapest_step == d[i-1][j]:
-            steps.insert(0, "D")
-            i -= 1
-            continue
+    if verbose >= 3:
+        print('\nDIETH-TO-NORM mapping sample:')
+        sample_keys = random.sample(mapping.words, min(10, len(mapping.words)))
+        for k in sample_keys:
+            print('{}\t{}'.format(k, mapping.norm_forms(k)))
 
-    # Moving up (no cell to the left)
-    if i > 0 and j == 0:
-        for i in reversed(range(i)):
-            steps.insert(0, "D")
-            i -= 1
+        multiple_values = len(mapping.multi_sets)
 
-    # Moving left (no cell above)
-    if i == 0 and j > 0:
-        for j in reversed(range(j)):
-            steps.insert(0, "I")
-            j -= 1
+        print('\nWARNING: {} Dieth transcriptions have multiple corresponding normalised transcriptions.\n'.format(
+            multiple_values))
 
-    return steps
+    return mapping
 
 
-def get_mappings(n2d_map_file, verbose=0):
+def format_score(total_ops, hyp_path):
     """
-    Converts norm2dieth mapping to dieth2norm mapping, which speeds up searches for Dieth transcription word forms produced in decoding.
+    Kaldi-like score line for the operation counts of a hypothesis file.
     """
-    d2n_map = defaultdict(set)
-    with open(n2d_map_file, 'r', encoding='utf8') as f:
-        n2d_map = json.load(f)
-        for k, v in n2d_map.items():
-            for w in v:
-                d2n_map[w].add(k)
-
-    if verbose >= 3:
-        print('\nNORM-TO-DIETH mapping sample:')
-        sample_keys = random.sample(list(n2d_map), 10)
-        for k in sample_keys:
-            print('{}\t{}'.format(k, n2d_map[k]))
-
-        print('\nDIETH-TO-NORM mapping sample:')
-        sample_keys = random.sample(list(d2n_map), 10)
-        for k in sample_keys:
-            print('{}\t{}'.format(k, d2n_map[k]))
-
-        multiple_values = sum([1 for v in d2n_map.values() if len(v) > 1])
+    op_count = total_ops['D'] + total_ops['S'] + total_ops['I']
 
-        print('\nWARNING: {} Dieth transcriptions have multiple corresponding normalised transcriptions.\n'.format(
-            multiple_values))
+    error_rate = (op_count) / sum(total_ops.values())*100
 
-    return n2d_map, d2n_map
+    return '%{} {:.2f} [ {} / {}, {} ins, {} del, {} sub ] {}'.format('FLEXWER',
+                                                                     error_rate,
+                                                                     op_count,
+                                                                     sum(total_ops.values()),
+                                                                     total_ops['I'],
+                                                                     total_ops['D'],
+                                                                     total_ops['S'],
+                                                                     hyp_path
+                                                                     )
 
 
 def main(args=None):
@@ -207,70 +191,36 @@ def main(args=None):
     if use_args is True:
 
         if args.n2d_mapping:
-            n2d_map, d2n_map = get_mappings(args.n2d_mapping)
+            mapping = get_mappings(args.n2d_mapping)
         else:
-            n2d_map, d2n_map = None, None
+            mapping = None
 
         total_ops = Counter()
 
-        with open(args.ref, 'r', encoding='utf8') as r_file, open(args.hyp, 'r', encoding='utf8') as h_file:
-            all_refs = sorted(r_file.readlines())
-            all_hyps = sorted(h_file.readlines())
-
-            try:
-                assert len(all_refs) == len(all_hyps)
-            except AssertionError:
-                print(len(all_refs))
-                print(len(all_hyps))
-
-            for i in range(len(all_refs)):
-                ref = normalise_line(all_refs[i].strip())
-                hyp = normalise_line(all_hyps[i].strip())
-
-                if n2d_map and d2n_map:
-                        ops = opcodes(ref.split(), hyp.split(), n2d_map, d2n_map)
-                else:
-                    ops = opcodes(ref.split(), hyp.split())
-
-                if args.verbose:
-                    ops = Counter(ops)
-                    line_error = (ops['D'] + ops['S'] +
-                                  ops['I']) / sum(ops.values())
-                    print('{} || {} || {:.2f}%'.format(ref, hyp, line_error*100))
-
-                total_ops += Counter(ops)
-
-        op_count = total_ops['D'] + total_ops['S'] + total_ops['I']
+        missing, extra = [], []
+
+        for key, ref, hyp in join_utterances(read_utterances(args.ref), read_utterances(args.hyp)):
+            if hyp is None:
+                missing.append(key)
+                hyp = ()
+            elif ref is None:
+                extra.append(key)
+                ref = ()
+
+            if args.verbose:
+                ops = Counter(opcodes(ref, hyp, mapping))
+                line_error = (ops['D'] + ops['S'] +
+                              ops['I']) / sum(ops.values())
+                print('{} || {} || {:.2f}%'.format(' '.join(ref), ' '.join(hyp), line_error*100))
+            else:
+                # Counts only: no backtrace matrix is stored.
+                ops = count_opcodes(ref, hyp, mapping)
 
-        error_rate = (op_count) / sum(total_ops.values())*100
+            total_ops += ops
 
-        if args.n2d_mapping:
-            final_flexwer = '%{} {:.2f} [ {} / {}, {} ins, {} del, {} sub ] {}'.format('FLEXWER',
-                                                                            error_rate,
-                                                                            op_count,
-                                                                            sum(total_ops.values(
-                                                                            )),
-                                                                            total_ops['I'],
-                                                                            total_ops['D'],
-                                                                            total_ops['S'],
-                                                                            args.hyp
-                                                                            )
-            # print(final_flexwer)
-            return final_flexwer
+        report_unmatched(args.hyp, missing, extra)
 
-        else:
-            final_wer = '%{} {:.2f} [ {} / {}, {} ins, {} del, {} sub ] {}'.format('FLEXWER',
-                                                                             error_rate,
-                                                                             op_count,
-                                                                             sum(total_ops.values(
-                                                                             )),
-                                                                             total_ops['I'],
-                                                                             total_ops['D'],
-                                                                             total_ops['S'],
-                                                                             args.hyp
-                                                                             )
-            # print(final_wer)
-            return final_wer
+        return format_score(total_ops, args.hyp)
 
     else:
         ref_path = "/Users/inigma/Documents/UZH_Master/MasterThesis/results/phon_recog/nnet_discr/scoring_kaldi/test_filt.txt"
@@ -281,9 +231,9 @@ def main(args=None):
         verbose = False
 
         if n2d_mapping:
-            n2d_map, d2n_map = get_mappings(n2d_mapping)
+            mapping = get_mappings(n2d_mapping)
         else:
-            n2d_map, d2n_map = None, None
+            mapping = None
 
         total_ops = Counter()
 
@@ -300,18 +250,15 @@ def main(args=None):
                 ref = normalise_line(all_refs[i].strip())
                 hyp = normalise_line(all_hyps[i].strip())
 
-                if n2d_map and d2n_map:
-                    ops = opcodes(ref.split(), hyp.split(), n2d_map, d2n_map)
-                else:
-                    ops = opcodes(ref.split(), hyp.split())
-
                 if verbose:
-                    ops = Counter(ops)
+                    ops = Counter(opcodes(ref.split(), hyp.split(), mapping))
                     line_error = (ops['D'] + ops['S'] +
                                   ops['I']) / sum(ops.values())
                     print('{} || {} || {:.2f}%'.format(ref, hyp, line_error*100))
+                else:
+                    ops = count_opcodes(ref.split(), hyp.split(), mapping)
 
-                total_ops += Counter(ops)
+                total_ops += ops
 
         op_count = total_ops['D'] + total_ops['S'] + total_ops['I']
 
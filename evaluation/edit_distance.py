@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+Vectorised Levenshtein alignment shared by the (flexible) WER scorers.
+
+The distance matrix is filled one row at a time with NumPy: the deletion and
+substitution candidates of a row are computed in one go and the insertion
+chain along the row is resolved with a running minimum, so there is no Python
+loop over the hypothesis words.
+
+Ties are broken exactly like the original list-of-lists backtrace (looking back
+from the last cell: substitution/equal first, then insertion, then deletion),
+so the E/S/I/D counts are identical to the ones of the old implementation.
+
+Two entry points are provided:
+  - opcodes(): full list of operations, backtraced from a uint8 direction
+    matrix (one byte per cell instead of a Python int).
+  - count_opcodes(): counts only. The number of insertions on the backtrace
+    path is propagated forward together with the distances, so only two rows
+    are kept in memory.
+"""
+
+
+from collections import Counter
+
+import numpy as np
+
+
+# Codes stored in the direction matrix.
+EQUAL, SUB, INS, DEL = 0, 1, 2, 3
+OPS = ('E', 'S', 'I', 'D')
+
+
+def encode(source, target, mapping=None):
+    """
+    Map both word sequences to integer ids and return (ref_ids, hyp_ids, table).
+
+    Without a mapping, both sequences share one vocabulary and a substitution
+    is free iff the ids are equal (table is None). With a norm2dieth mapping
+    (a flex_mapping.DiethIndex), table[r, h] holds the substitution cost (0 or
+    1) of reference word id r against hypothesis word id h, computed once per
+    pair of distinct words.
+    """
+    if mapping is None:
+        vocab = {}
+        ref_ids = np.array([vocab.setdefault(w, len(vocab)) for w in source],
+                           dtype=np.int64)
+        hyp_ids = np.array([vocab.setdefault(w, len(vocab)) for w in target],
+                           dtype=np.int64)
+        return ref_ids, hyp_ids, None
+
+    ref_vocab, hyp_vocab = {}, {}
+    ref_ids = np.array([ref_vocab.setdefault(w, len(ref_vocab)) for w in source],
+                       dtype=np.int64)
+    hyp_ids = np.array([hyp_vocab.setdefault(w, len(hyp_vocab)) for w in target],
+                       dtype=np.int64)
+    table = mapping.substitution_costs(list(ref_vocab), list(hyp_vocab))
+
+    return ref_ids, hyp_ids, table
+
+
+def _rows(ref_ids, hyp_ids, table=None):
+    """
+    Generate, for every reference position i (1-based), the row d[i] of the
+    distance matrix and the code of the cheapest step back from each of its
+    cells (column 0 excluded).
+    """
+    m = len(hyp_ids)
+    steps = np.arange(m + 1)
+    prev = steps.copy()
+
+    for i in range(1, len(ref_ids) + 1):
+        if table is None:
+            cost = (hyp_ids != ref_ids[i - 1]).astype(np.int64)
+        else:
+            cost = table[ref_ids[i - 1], hyp_ids]
+
+        # Candidates not depending on the current row: deletion and substitution.
+        cur = np.empty(m + 1, dtype=np.int64)
+        cur[0] = i
+        np.minimum(prev[1:] + 1, prev[:-1] + cost, out=cur[1:])
+        # Insertions: d[i][j] = min_k (t[k] + j - k), i.e. a running minimum.
+        cur = np.minimum.accumulate(cur - steps) + steps
+
+        # Same decision as the original backtrace, vectorised over the row.
+        diag, left, up = prev[:-1], cur[:-1], prev[1:]
+        cheapest = np.minimum(np.minimum(diag, left), up)
+        codes = np.where(cheapest == diag,
+                         np.where(diag == cur[1:], EQUAL, SUB),
+                         np.where(cheapest == left, INS, DEL))
+
+        yield cur, codes
+        prev = cur
+
+
+def backtrace(directions):
+    """
+    Follow a direction matrix from the last cell back to the first one and
+    return the operations in order.
+    """
+    i, j = directions.shape[0] - 1, directions.shape[1] - 1
+    steps = []
+    while i > 0 and j > 0:
+        code = directions[i, j]
+        steps.append(OPS[code])
+        if code != INS:
+            i -= 1
+        if code != DEL:
+            j -= 1
+
+    # Moving up (no cell to the left) or left (no cell above).
+    steps.extend('D' * i)
+    steps.extend('I' * j)
+    steps.reverse()
+
+    return steps
+
+
+def opcodes(source, target, mapping=None):
+    """
+    Get a list of edit operations for converting source into target.
+    source=reference, target=hypothesis
+    """
+    ref_ids, hyp_ids, table = encode(source, target, mapping)
+    directions = np.empty((len(ref_ids) + 1, len(hyp_ids) + 1), dtype=np.uint8)
+    directions[0, :] = INS
+    directions[:, 0] = DEL
+
+    for i, (_, codes) in enumerate(_rows(ref_ids, hyp_ids, table), 1):
+        directions[i, 1:] = codes
+
+    return backtrace(directions)
+
+
+def count_opcodes(source, target, mapping=None):
+    """
+    Get the number of E/S/I/D operations on the path opcodes() would return,
+    without storing the direction matrix.
+
+    Only the number of insertions on the path to every cell of the current
+    row is propagated: every path to d[n][m] consumes the n reference and
+    the m hypothesis words, so E + S + D = n, E + S + I = m and
+    S + I + D = d[n][m], which gives the other three counts.
+    """
+    ref_ids, hyp_ids, table = encode(source, target, mapping)
+    n, m = len(ref_ids), len(hyp_ids)
+    columns = np.arange(m + 1)
+
+    distance = m
+    insertions = columns.copy()
+    for i, (cur, codes) in enumerate(_rows(ref_ids, hyp_ids, table), 1):
+        base = np.empty(m + 1, dtype=np.int64)
+        base[0] = 0
+        base[1:] = np.where(codes <= SUB, insertions[:-1], insertions[1:])
+
+        # A run of insertions continues from the closest cell on its left
+        # which was reached from the previous row.
+        anchor = np.where(np.concatenate(([True], codes != INS)), columns, 0)
+        anchor = np.maximum.accumulate(anchor)
+        insertions = base[anchor] + columns - anchor
+        distance = cur[m]
+
+    ins = int(insertions[m])
+    dels = ins + n - m
+    subs = int(distance) - ins - dels
+    counts = (n - subs - dels, subs, ins, dels)
+
+    return Counter({op: c for op, c in zip(OPS, counts) if c})
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+Integer index over a norm2dieth mapping, used by the flexible WER.
+
+A substitution of the reference word r by the hypothesis word h is free if
+r is one of the Dieth forms of a normalisation of h, i.e. if r and h share a
+normalised form. Every normalised form gets an integer id, and every Dieth
+word is given a class:
+  - class >= 0: the id of its only normalised form. Two such words are
+    interchangeable iff their classes are equal.
+  - class < 0: the word has several normalised forms; -class - 1 is its row
+    in a table of norm id sets, and the test is a set intersection.
+Words which are not in the mapping never substitute for free, not even for
+themselves (as with the original dieth2norm lookups).
+
+The index is cached in a binary .npz file next to the JSON file, so repeated
+scoring runs skip parsing and inverting the JSON mapping. The cache stores the
+size and modification time of the JSON file and is rebuilt when they change.
+"""
+
+
+import json
+import os
+from collections import defaultdict
+
+import numpy as np
+
+
+UNMAPPED = np.iinfo(np.int32).min
+
+
+def _join(words):
+    return np.frombuffer('\n'.join(words).encode('utf8'), dtype=np.uint8)
+
+
+def _split(blob, count):
+    if count == 0:
+        return []
+    return blob.tobytes().decode('utf8').split('\n')
+
+
+def cache_path(n2d_map_file):
+    """
+    Path of the binary cache of a norm2dieth JSON file.
+    """
+    return os.path.splitext(n2d_map_file)[0] + '.idx.npz'
+
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+class DiethIndex(object):
+
+    def __init__(self, words, norms, classes, multi_indptr, multi_ids):
+        self.words = words
+        self.norms = norms
+        self.classes = classes
+        self.multi_indptr = multi_indptr
+        self.multi_ids = multi_ids
+
+        self.word2class = dict(zip(words, classes.tolist()))
+        self.multi_sets = [frozenset(multi_ids[multi_indptr[k]:multi_indptr[k + 1]].tolist())
+                           for k in range(len(multi_indptr) - 1)]
+
+    @classmethod
+    def from_mapping(cls, n2d_map):
+        """
+        Build the index from a {normalised form: [Dieth forms]} dictionary.
+        """
+        norms = list(n2d_map)
+        d2n_ids = defaultdict(set)
+        for norm_id, norm in enumerate(norms):
+            for w in n2d_map[norm]:
+                d2n_ids[w].add(norm_id)
+
+        words = list(d2n_ids)
+        classes = np.empty(len(words), dtype=np.int32)
+        multi_indptr, multi_ids = [0], []
+        for k, w in enumerate(words):
+            ids = d2n_ids[w]
+            if len(ids) == 1:
+                classes[k] = next(iter(ids))
+            else:
+                classes[k] = -len(multi_indptr)
+                multi_ids.extend(sorted(ids))
+                multi_indptr.append(len(multi_ids))
+
+        return cls(words, norms, classes,
+                   np.array(multi_indptr, dtype=np.int32),
+                   np.array(multi_ids, dtype=np.int32))
+
+    @classmethod
+    def load(cls, n2d_map_file, use_cache=True):
+        """
+        Load the index of a norm2dieth JSON file, from its binary cache if it
+        is up to date, otherwise from the JSON file (and write the cache).
+        """
+        cache = cache_path(n2d_map_file)
+        stamp = file_stamp(n2d_map_file)
+
+        if use_cache and os.path.exists(cache):
+            with np.load(cache) as data:
+                if np.array_equal(data['stamp'], stamp):
+                    classes = data['classes']
+                    return cls(_split(data['words'], len(classes)),
+                               _split(data['norms'], int(data['num_norms'])),
+                               classes, data['multi_indptr'], data['multi_ids'])
+
+        with open(n2d_map_file, 'r', encoding='utf8') as f:
+            index = cls.from_mapping(json.load(f))
+
+        if use_cache:
+            try:
+                index.save(cache, stamp)
+            except OSError:
+                pass
+
+        return index
+
+    def save(self, cache, stamp):
+        # Write to a temporary file first, so that concurrent scoring jobs
+        # never read a half written cache.
+        tmp = '{}.{}.tmp.npz'.format(cache[:-len('.npz')], os.getpid())
+        np.savez(tmp, stamp=stamp, words=_join(self.words),
+                 norms=_join(self.norms), num_norms=len(self.norms),
+                 classes=self.classes, multi_indptr=self.multi_indptr,
+                 multi_ids=self.multi_ids)
+        os.replace(tmp, cache)
+
+    def norm_forms(self, word):
+        """
+        Normalised forms of a Dieth word.
+        """
+        c = self.word2class.get(word, UNMAPPED)
+        if c == UNMAPPED:
+            return []
+        elif c >= 0:
+            return [self.norms[c]]
+        return [self.norms[i] for i in sorted(self.multi_sets[-c - 1])]
+
+    def substitution_costs(self, ref_words, hyp_words):
+        """
+        Return a (len(ref_words), len(hyp_words)) matrix holding 0 where the
+        substitution of the reference word by the hypothesis word is free and
+        1 otherwise.
+        """
+        ref_classes = np.array([self.word2class.get(w, UNMAPPED) for w in ref_words],
+                               dtype=np.int64)
+        hyp_classes = np.array([self.word2class.get(w, UNMAPPED) for w in hyp_words],
+                               dtype=np.int64)
+
+        # Words with a single normalisation: integer comparison.
+        costs = (ref_classes[:, None] != hyp_classes[None, :]).astype(np.int64)
+        costs[ref_classes < 0, :] = 1
+
+        # Words with several normalisations: set lookups, only for their
+        # rows and columns.
+        for r in np.flatnonzero((ref_classes < 0) & (ref_classes != UNMAPPED)):
+            ids = self.multi_sets[-ref_classes[r] - 1]
+            for h, c in enumerate(hyp_classes.tolist()):
+                if c >= 0:
+                    costs[r, h] = c not in ids
+                elif c != UNMAPPED:
+                    costs[r, h] = ids.isdisjoint(self.multi_sets[-c - 1])
+        for h in np.flatnonzero((hyp_classes < 0) & (hyp_classes != UNMAPPED)):
+            ids = self.multi_sets[-hyp_classes[h] - 1]
+            for r, c in enumerate(ref_classes.tolist()):
+                if c >= 0:
+                    costs[r, h] = c not in ids
+
+        return costs
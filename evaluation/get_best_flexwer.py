@@ -4,6 +4,9 @@
 '''
 Run:
 get_best_flexwer.py -dir /Users/inigma/Documents/UZH_Master/MasterThesis/results/phon_recog/nnet_discr/ -m /Users/inigma/Documents/UZH_Master/MasterThesis/KALDI/kaldi_wrk_dir/data/corpus_data/norm2dieth.json
+
+Sweep mode (reference and mapping loaded once, all LMWT x WIP files scored in one process pool):
+get_best_flexwer.py -dir /Users/inigma/Documents/UZH_Master/MasterThesis/results/phon_recog/nnet_discr/ -m /Users/inigma/Documents/UZH_Master/MasterThesis/KALDI/kaldi_wrk_dir/data/corpus_data/norm2dieth.json --sweep --nj 8 --format json
 '''
 
 
@@ -12,8 +15,15 @@ import argparse
 from pathlib import Path
 import re
 import time
-from collections import defaultdict
+import json
+from collections import defaultdict, Counter
+from multiprocessing import Pool
+
+import numpy as np
+
 from compute_flexwer import set_args as set_flex_args, main as flexwer
+from compute_flexwer import get_mappings, read_utterances, join_utterances, report_unmatched, format_score
+from edit_distance import count_opcodes, OPS
 
 
 content = re.compile(r'%FLEXWER (\d+\.?\d+) (\[.*\])')
@@ -35,6 +45,12 @@ def set_args():
                         default=17)
     parser.add_argument('-m', '--n2d_mapping', required=False,
                         help='If provided, flexible WER is calculated based on forms found in mapping.')
+    parser.add_argument('--sweep', required=False, action='store_true',
+                        help='if provided, all hypothesis files are scored in one pass and the grid is written as one table.')
+    parser.add_argument('--nj', required=False, type=int, default=os.cpu_count(),
+                        help='Number of processes used in sweep mode.')
+    parser.add_argument('--format', required=False, choices=['tsv', 'json'], default='tsv',
+                        help='Format of the score table written in sweep mode.')
 
     return parser.parse_args()
 
@@ -51,8 +67,111 @@ def extract_score_from_flex(file):
             return (float(m.group(1)), m.group(2))
 
 
+def hypothesis_files(decode_dir, wips, min_lmwt, max_lmwt):
+    """
+    List (wip, lmwt, path) of the hypothesis files of a decoding directory.
+    """
+    hyp_files = []
+    for wip in wips:
+        penalty_dir = Path(decode_dir) / Path('scoring_kaldi/penalty_{}'.format(wip))
+        for hyp_path in sorted(penalty_dir.iterdir()):
+            if hyp_path.name.endswith('.txt') and not hyp_path.name.endswith('chars.txt'):
+                lmwt = int(hyp_path.stem)
+                if min_lmwt <= lmwt <= max_lmwt:
+                    hyp_files.append((wip, lmwt, hyp_path))
+
+    return sorted(hyp_files, key=lambda x: (x[0], x[1]))
+
+
+_mapping = None
+
+
+def _init_worker(n2d_mapping):
+    global _mapping
+    _mapping = get_mappings(n2d_mapping) if n2d_mapping else None
+
+
+def _count_pair(pair):
+    ref, hyp = pair
+    ops = count_opcodes(ref, hyp, _mapping)
+    return [ops[op] for op in OPS]
+
+
+def sweep(args):
+    """
+    Score all hypothesis files of the LMWT x WIP grid in one invocation.
+    The reference and the mapping are loaded once, and every distinct
+    (reference, hypothesis) pair is aligned only once, since neighbouring
+    grid points mostly produce the same hypotheses.
+    """
+    ref_path = Path(args.dir) / Path('scoring_kaldi/test_filt.txt')
+    all_refs = list(read_utterances(str(ref_path)))
+
+    if args.n2d_mapping:
+        # Build the binary cache of the mapping before the workers load it.
+        get_mappings(args.n2d_mapping)
+
+    pairs = {}
+    grid = []
+    for wip, lmwt, hyp_path in hypothesis_files(args.dir, args.wip, args.min_lmwt, args.max_lmwt):
+        ids = []
+        missing, extra = [], []
+        for key, ref, hyp in join_utterances(all_refs, read_utterances(str(hyp_path))):
+            if hyp is None:
+                missing.append(key)
+                hyp = ()
+            elif ref is None:
+                extra.append(key)
+                ref = ()
+            ids.append(pairs.setdefault((ref, hyp), len(pairs)))
+        report_unmatched(hyp_path, missing, extra)
+        grid.append((wip, lmwt, hyp_path, np.array(ids, dtype=np.int64)))
+
+    print('Aligning {} distinct utterance pairs for {} hypothesis files.'.format(len(pairs), len(grid)))
+    with Pool(args.nj, _init_worker, (args.n2d_mapping,)) as pool:
+        counts = pool.map(_count_pair, pairs, chunksize=max(1, len(pairs) // (args.nj * 16)))
+    counts = np.array(counts, dtype=np.int64).reshape(-1, len(OPS))
+
+    results = []
+    for wip, lmwt, hyp_path, ids in grid:
+        total_ops = Counter(dict(zip(OPS, counts[ids].sum(axis=0).tolist())))
+        errors = total_ops['D'] + total_ops['S'] + total_ops['I']
+        results.append({'wip': wip, 'lmwt': lmwt,
+                        'error_rate': errors / sum(total_ops.values()) * 100,
+                        'errors': errors, 'total': sum(total_ops.values()),
+                        'ins': total_ops['I'], 'del': total_ops['D'], 'sub': total_ops['S'],
+                        'hyp': str(hyp_path), 'score': format_score(total_ops, hyp_path)})
+
+    best = min(results, key=lambda x: x['error_rate'])
+
+    name = 'flexwer' if args.n2d_mapping else 'ourwer'
+    table = Path(args.dir) / Path('scoring_kaldi/{}_grid.{}'.format(name, args.format))
+    with open(str(table), 'w', encoding='utf8') as outf:
+        if args.format == 'json':
+            json.dump({'grid': results, 'best': best}, outf, indent=2)
+            outf.write('\n')
+        else:
+            columns = ['wip', 'lmwt', 'error_rate', 'errors', 'total', 'ins', 'del', 'sub', 'hyp']
+            outf.write('\t'.join(columns) + '\n')
+            for r in results:
+                r = dict(r, error_rate='{:.2f}'.format(r['error_rate']))
+                outf.write('\t'.join(str(r[c]) for c in columns) + '\n')
+
+    # Same summary file as the per-file mode.
+    outfile = Path(args.dir) / Path('scoring_kaldi/best_{}'.format(name))
+    with open(str(outfile), 'w', encoding='utf8') as outf:
+        outf.write(best['score'].replace('%FLEXWER', '%' + name.upper(), 1) + '\n')
+
+    print(best['score'])
+    print("Done in {}".format(time.time() - start))
+
+
 def main():
     args = set_args()
+    if args.sweep:
+        sweep(args)
+        return
+
     flex_parser = set_flex_args()
 
     ref_path = Path(args.dir) / Path('scoring_kaldi/test_filt.txt')
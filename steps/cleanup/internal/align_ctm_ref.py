@@ -16,6 +16,8 @@ import argparse
 import logging
 import sys
 
+import numpy as np
+
 sys.path.insert(0, 'steps')
 import libs.common as common_lib
 
@@ -76,6 +78,16 @@ def get_args():
                         from the normal Smith-Waterman alignment, where the
                         traceback will be from the maximum score.""")
 
+    parser.add_argument("--band-width", type=int, default=0,
+                        help="""If > 0, only align each reference word with
+                        the hypothesis words within this distance of the
+                        position expected from the CTM times (or from the
+                        position of the word, for text hypotheses). This
+                        reduces the time and memory from quadratic to
+                        linear, but is only appropriate if the reference and
+                        the hypothesis cover approximately the same speech.
+                        0 means no band.""")
+
     parser.add_argument("--debug-only", type=str, default="false",
                         choices=["true", "false"],
                         help="Run test functions only")
@@ -179,9 +191,110 @@ def read_ctm(ctm_file, file_and_channel2reco=None):
     ctm_file.close()
 
 
+# Back-pointers of the alignment (see smith_waterman_alignment())
+_BP_NONE = 0    # Start of the alignment; points to (0, 0)
+_BP_DIAG = 1    # Substitution or correct
+_BP_DEL = 2
+_BP_INS = 3
+
+
+class MatchScore(object):
+    """Similarity score function that only depends on whether the two words
+    are equal. smith_waterman_alignment() computes it for a whole row of
+    the score matrix at once."""
+
+    def __init__(self, correct_score, substitution_score):
+        self.correct_score = correct_score
+        self.substitution_score = substitution_score
+
+    def __call__(self, x, y):
+        if x == y:
+            return self.correct_score
+        return self.substitution_score
+
+
+class _SimilarityRows(object):
+    """Computes the similarity scores of a reference word with a range of
+    hypothesis words as an array. Any similarity function other than a
+    MatchScore is evaluated once per pair of distinct words."""
+
+    def __init__(self, ref, hyp, similarity_score_function):
+        hyp_vocab = {}
+        self.hyp_ids = np.array(
+            [hyp_vocab.setdefault(x, len(hyp_vocab)) for x in hyp],
+            dtype=np.int64)
+        self.function = similarity_score_function
+
+        if isinstance(similarity_score_function, MatchScore):
+            # Id of every reference word in the hypothesis vocabulary
+            self.ref_ids = [hyp_vocab.get(x, -1) for x in ref]
+            self.table = None
+            scores = np.array([similarity_score_function.correct_score,
+                               similarity_score_function.substitution_score])
+        else:
+            ref_vocab = {}
+            self.ref_ids = [ref_vocab.setdefault(x, len(ref_vocab))
+                            for x in ref]
+            self.table = np.array(
+                [[similarity_score_function(x, y) for y in hyp_vocab]
+                 for x in ref_vocab]).reshape(len(ref_vocab), len(hyp_vocab))
+            scores = self.table
+        self.integral = scores.dtype.kind in 'iub'
+
+    def get(self, ref_index, hyp_start, hyp_end):
+        """Returns the scores of ref[ref_index] with hyp[hyp_start:hyp_end].
+        """
+        hyp_ids = self.hyp_ids[hyp_start:hyp_end]
+        if self.table is None:
+            return np.where(hyp_ids == self.ref_ids[ref_index],
+                            self.function.correct_score,
+                            self.function.substitution_score)
+        return self.table[self.ref_ids[ref_index], hyp_ids]
+
+
+def get_band(ref_len, hyp_len, band_width, hyp_times=None):
+    """Returns a band (lo, hi) for smith_waterman_alignment() with the first
+    and the last hypothesis index allowed for every reference index.
+
+    The hypothesis word expected to align with each reference word is found
+    by assuming that the reference is spoken at a constant rate over the
+    time of the hypothesis, given by the start time of every hypothesis
+    word (or its position, if hyp_times is not given). The band includes
+    band_width hypothesis words on either side of it. This is only
+    appropriate if the reference and the hypothesis cover approximately the
+    same speech.
+    """
+    if hyp_times is None or hyp_len == 0:
+        hyp_times = np.arange(hyp_len, dtype=np.float64)
+    hyp_times = np.maximum.accumulate(np.asarray(hyp_times,
+                                                 dtype=np.float64))
+
+    # Position in the reference of every hypothesis index 0 ... hyp_len
+    span = hyp_times[-1] - hyp_times[0] if hyp_len > 0 else 0.0
+    if span > 0:
+        positions = np.concatenate(
+            [[0.0], (hyp_times - hyp_times[0]) / span * ref_len])
+    else:
+        positions = np.linspace(0.0, ref_len, hyp_len + 1)
+    centers = np.interp(np.arange(ref_len + 1), positions,
+                        np.arange(hyp_len + 1))
+
+    lo = np.clip(np.floor(centers - band_width), 0, hyp_len).astype(np.int64)
+    hi = np.clip(np.ceil(centers + band_width), 0, hyp_len).astype(np.int64)
+    lo[0] = 0
+    hi[-1] = hyp_len
+    # Make sure that every cell of the band can be reached from the
+    # previous reference index.
+    lo = np.maximum.accumulate(lo)
+    hi = np.maximum.accumulate(hi)
+    hi[:-1] = np.maximum(hi[:-1], lo[1:] - 1)
+    return lo, hi
+
+
 def smith_waterman_alignment(ref, hyp, similarity_score_function,
                              del_score, ins_score,
-                             eps_symbol="<eps>", align_full_hyp=True):
+                             eps_symbol="<eps>", align_full_hyp=True,
+                             band=None):
     """Does Smith-Waterman alignment of reference sequence and hypothesis
     sequence.
     This is a special case of the Smith-Waterman alignment that assumes that
@@ -196,6 +309,12 @@ def smith_waterman_alignment(ref, hyp, similarity_score_function,
     sub-sequence of the hypothesis that best matches with a
     sub-sequence of the reference.
 
+    The score matrix is computed one reference word at a time, with array
+    operations over the hypothesis words, keeping only the previous row
+    of scores; the back-pointers are stored in a uint8 matrix.
+    If band = (lo, hi) is given (see get_band()), only the hypothesis
+    indexes lo[i] ... hi[i] are considered for the reference index i.
+
     Returns a list of tuples where each tuple has the format:
         (ref_word, hyp_word, ref_word_from_index, hyp_word_from_index,
          ref_word_to_index, hyp_word_to_index)
@@ -205,89 +324,159 @@ def smith_waterman_alignment(ref, hyp, similarity_score_function,
     ref_len = len(ref)
     hyp_len = len(hyp)
 
-    bp = [[] for x in range(ref_len+1)]
+    if band is None:
+        lo = np.zeros(ref_len + 1, dtype=np.int64)
+        hi = np.full(ref_len + 1, hyp_len, dtype=np.int64)
+    else:
+        lo, hi = [np.asarray(x, dtype=np.int64) for x in band]
+        assert len(lo) == ref_len + 1 and len(hi) == ref_len + 1
+        assert lo[0] == 0
+
+    similarity = _SimilarityRows(ref, hyp, similarity_score_function)
+    integral = (similarity.integral and isinstance(del_score, int)
+                and isinstance(ins_score, int))
+    dtype = np.int64 if integral else np.float64
 
-    # Score matrix of size (ref_len + 1) x (hyp_len + 1)
+    # Score matrix of size (ref_len + 1) x (hyp_len + 1), of which only the
+    # previous row is kept.
     # The index m, n in this matrix corresponds to the score
     # of the best matching sub-sequence pair between reference and hypothesis
     # ending with the reference word ref[m-1] and hypothesis word hyp[n-1].
     # If align_full_hyp is True, then the hypothesis sub-sequence is from
     # the 0th word i.e. hyp[0].
-    H = [[] for x in range(ref_len+1)]
-
-    for ref_index in range(ref_len+1):
-        if align_full_hyp:
-            H[ref_index] = [-(hyp_len+2) for x in range(hyp_len+1)]
-            H[ref_index][0] = 0
-        else:
-            H[ref_index] = [0 for x in range(hyp_len+1)]
-        bp[ref_index] = [(0, 0) for x in range(hyp_len+1)]
-
-        if align_full_hyp and ref_index == 0:
-            for hyp_index in range(1, hyp_len+1):
-                H[0][hyp_index] = H[0][hyp_index-1] + ins_score
-                bp[ref_index][hyp_index] = (ref_index, hyp_index-1)
-                logger.debug(
-                    "({0},{1}) -> ({2},{3}): {4}"
-                    "".format(ref_index, hyp_index-1, ref_index, hyp_index,
-                              H[ref_index][hyp_index]))
+    # bp[m, n - lo[m]] is the back-pointer of the cell m, n.
+    bp = np.zeros([ref_len + 1, int((hi - lo).max()) + 1], dtype=np.uint8)
+
+    # Initial score of a cell, which is kept if no predecessor improves it
+    init_score = -(hyp_len + 2) if align_full_hyp else 0
+    # Score of the cells outside the band
+    if not align_full_hyp:
+        outside_score = 0
+    elif integral:
+        outside_score = -(1 << 60)
+    else:
+        outside_score = -float("inf")
+
+    def window(row, row_lo, start, end):
+        """Scores of the cells start ... end-1 of a row."""
+        values = np.full(end - start, outside_score, dtype=dtype)
+        a = max(start, row_lo)
+        b = min(end, row_lo + len(row))
+        if a < b:
+            values[a - start:b - start] = row[a - row_lo:b - row_lo]
+        return values
+
+    if align_full_hyp:
+        row = np.zeros(hi[0] + 1, dtype=dtype)
+        row[1:] = ins_score
+        row = np.cumsum(row)
+        bp[0, 1:hi[0] + 1] = _BP_INS
+    else:
+        row = np.zeros(hi[0] + 1, dtype=dtype)
+    row_lo = 0
+    all_rows = [(row_lo, row)]
 
     max_score = -float("inf")
     max_score_element = (0, 0)
 
     for ref_index in range(1, ref_len+1):     # Reference
-        for hyp_index in range(1, hyp_len+1):     # Hypothesis
-            sub_or_ok = (H[ref_index-1][hyp_index-1]
-                         + similarity_score_function(ref[ref_index-1],
-                                                     hyp[hyp_index-1]))
-
-            if ((not align_full_hyp and sub_or_ok > 0)
-                    or (align_full_hyp
-                        and sub_or_ok >= H[ref_index][hyp_index])):
-                H[ref_index][hyp_index] = sub_or_ok
-                bp[ref_index][hyp_index] = (ref_index-1, hyp_index-1)
-                logger.debug(
-                    "({0},{1}) -> ({2},{3}): {4} ({5},{6})"
-                    "".format(ref_index-1, hyp_index-1, ref_index, hyp_index,
-                              H[ref_index][hyp_index],
-                              ref[ref_index-1], hyp[hyp_index-1]))
-
-            if H[ref_index-1][hyp_index] + del_score > H[ref_index][hyp_index]:
-                H[ref_index][hyp_index] = H[ref_index-1][hyp_index] + del_score
-                bp[ref_index][hyp_index] = (ref_index-1, hyp_index)
-                logger.debug(
-                    "({0},{1}) -> ({2},{3}): {4}"
-                    "".format(ref_index-1, hyp_index, ref_index, hyp_index,
-                              H[ref_index][hyp_index]))
-
-            if H[ref_index][hyp_index-1] + ins_score > H[ref_index][hyp_index]:
-                H[ref_index][hyp_index] = H[ref_index][hyp_index-1] + ins_score
-                bp[ref_index][hyp_index] = (ref_index, hyp_index-1)
-                logger.debug(
-                    "({0},{1}) -> ({2},{3}): {4}"
-                    "".format(ref_index, hyp_index-1, ref_index, hyp_index,
-                              H[ref_index][hyp_index]))
-
-            #if hyp_index == hyp_len and H[ref_index][hyp_index] >= max_score:
-            if ((not align_full_hyp or hyp_index == hyp_len)
-                    and H[ref_index][hyp_index] >= max_score):
-                max_score = H[ref_index][hyp_index]
-                max_score_element = (ref_index, hyp_index)
+        start = max(lo[ref_index], 1)
+        end = hi[ref_index] + 1
+        # Scores for the hypothesis indexes start ... end - 1, as in the
+        # inner loop of the standard implementation.
+        scores = np.full(end - start, init_score, dtype=dtype)
+        back_pointers = np.zeros(end - start, dtype=np.uint8)
+
+        sub_or_ok = (window(row, row_lo, start - 1, end - 1)
+                     + similarity.get(ref_index - 1, start - 1, end - 1))
+        if align_full_hyp:
+            take = sub_or_ok >= scores
+        else:
+            take = sub_or_ok > 0
+        scores[take] = sub_or_ok[take]
+        back_pointers[take] = _BP_DIAG
+
+        deletion = window(row, row_lo, start, end) + del_score
+        take = deletion > scores
+        scores[take] = deletion[take]
+        back_pointers[take] = _BP_DEL
+
+        # H[m, n] = max(scores[n], H[m, n-1] + ins_score) for all n.
+        if lo[ref_index] == 0:
+            left = 0    # The cell (m, 0) has the score 0
+        else:
+            left = outside_score
+        if integral:
+            offsets = np.arange(1, end - start + 1) * ins_score
+            new_scores = np.maximum.accumulate(
+                np.concatenate([[left], scores - offsets]))[1:] + offsets
+        else:
+            new_scores = scores.copy()
+            for i in range(len(scores)):
+                if left + ins_score > new_scores[i]:
+                    new_scores[i] = left + ins_score
+                left = new_scores[i]
+        back_pointers[new_scores > scores] = _BP_INS
+        scores = new_scores
+
+        if lo[ref_index] == 0:
+            row = np.concatenate([np.zeros(1, dtype=dtype), scores])
+        else:
+            row = scores
+        row_lo = lo[ref_index]
+        bp[ref_index, start - row_lo:end - row_lo] = back_pointers
+        if verbose_level > 2:
+            all_rows.append((row_lo, row))
+
+        if len(scores) == 0:
+            continue
+        if align_full_hyp:
+            if hyp_len > 0 and end - 1 == hyp_len and scores[-1] >= max_score:
+                max_score = scores[-1]
+                max_score_element = (ref_index, hyp_len)
+        else:
+            row_max = scores.max()
+            if row_max >= max_score:
+                max_score = row_max
+                max_score_element = (
+                    ref_index,
+                    start + len(scores) - 1 - int(np.argmax(scores[::-1])))
+
+    if max_score != -float("inf"):
+        max_score = max_score.item()
+
+    def back_pointer(ref_index, hyp_index):
+        j = hyp_index - lo[ref_index]
+        if 0 <= j <= hi[ref_index] - lo[ref_index]:
+            direction = bp[ref_index, j]
+        else:
+            direction = _BP_NONE
+        if direction == _BP_DIAG:
+            return ref_index - 1, hyp_index - 1
+        if direction == _BP_DEL:
+            return ref_index - 1, hyp_index
+        if direction == _BP_INS:
+            return ref_index, hyp_index - 1
+        return 0, 0
 
     ref_index, hyp_index = max_score_element
     score = max_score
     logger.debug("Alignment score: %s for (%d, %d)",
                  score, ref_index, hyp_index)
 
+    # In the Smith-Waterman alignment (align_full_hyp = False) the scores
+    # are never negative, so the traceback only ends at the start of the
+    # alignment.
     while ((not align_full_hyp and score >= 0)
            or (align_full_hyp and hyp_index > 0)):
         try:
-            prev_ref_index, prev_hyp_index = bp[ref_index][hyp_index]
+            prev_ref_index, prev_hyp_index = back_pointer(ref_index,
+                                                          hyp_index)
 
             if ((prev_ref_index, prev_hyp_index) == (ref_index, hyp_index)
                     or (prev_ref_index, prev_hyp_index) == (0, 0)):
                 ref_index, hyp_index = (prev_ref_index, prev_hyp_index)
-                score = H[ref_index][hyp_index]
+                score = 0
                 break
 
             if (ref_index == prev_ref_index + 1
@@ -315,7 +504,6 @@ def smith_waterman_alignment(ref, hyp, similarity_score_function,
                 raise RuntimeError
 
             ref_index, hyp_index = (prev_ref_index, prev_hyp_index)
-            score = H[ref_index][hyp_index]
         except Exception:
             logger.error("Unexpected entry (%d,%d) -> (%d,%d), %s, %s",
                          prev_ref_index, prev_hyp_index, ref_index, hyp_index,
@@ -327,19 +515,18 @@ def smith_waterman_alignment(ref, hyp, similarity_score_function,
     output.reverse()
 
     if verbose_level > 2:
-        for ref_index in range(ref_len+1):
-            for hyp_index in range(hyp_len+1):
-                print ("{0} ".format(H[ref_index][hyp_index]), end='',
-                       file=sys.stderr)
+        for row_lo, row in all_rows:
+            for value in window(row, row_lo, 0, hyp_len + 1).tolist():
+                print ("{0} ".format(value), end='', file=sys.stderr)
             print ("", file=sys.stderr)
 
-    logger.debug("Aligned output:")
-    logger.debug("  -  ".join(["({0},{1})".format(x[4], x[5])
-                               for x in output]))
-    logger.debug("REF: ")
-    logger.debug("    ".join(str(x[0]) for x in output))
-    logger.debug("HYP:")
-    logger.debug("    ".join(str(x[1]) for x in output))
+        logger.debug("Aligned output:")
+        logger.debug("  -  ".join(["({0},{1})".format(x[4], x[5])
+                                   for x in output]))
+        logger.debug("REF: ")
+        logger.debug("    ".join(str(x[0]) for x in output))
+        logger.debug("HYP:")
+        logger.debug("    ".join(str(x[1]) for x in output))
 
     return (output, max_score)
 
@@ -508,10 +695,8 @@ def run(args):
         test_alignment(args.align_full_hyp)
         raise SystemExit("Exiting since --debug-only was true")
 
-    def similarity_score_function(x, y):
-        if x == y:
-            return args.correct_score
-        return -args.substitution_penalty
+    similarity_score_function = MatchScore(args.correct_score,
+                                           -args.substitution_penalty)
 
     del_score = -args.deletion_penalty
     ins_score = -args.insertion_penalty
@@ -563,13 +748,20 @@ def run(args):
             if args.reco2file_and_channel is None:
                 reco2file_and_channel[reco] = (reco, "1")
 
+            band = None
+            if args.band_width > 0:
+                band = get_band(
+                    len(ref_text), len(hyp_array), args.band_width,
+                    hyp_times=([x[0] for x in hyp_lines[reco]]
+                               if args.hyp_format == "CTM" else None))
+
             logger.debug("Running Smith-Waterman alignment for %s", reco)
 
             output, score = smith_waterman_alignment(
                 ref_text, hyp_array, eps_symbol=args.eps_symbol,
                 similarity_score_function=similarity_score_function,
                 del_score=del_score, ins_score=ins_score,
-                align_full_hyp=args.align_full_hyp)
+                align_full_hyp=args.align_full_hyp, band=band)
 
             if args.hyp_format == "CTM":
                 ctm_edits = get_ctm_edits(output, hyp_lines[reco],
@@ -61,10 +61,14 @@ def _get_args():
                         choices=["true", "false"],
                         help="If true, the stats are accumulated over all the "
                         "documents and a single tf-idf-file is written out.")
+    parser.add_argument("--binary", type=str, default="false",
+                        choices=["true", "false"],
+                        help="If true, the TF-IDF objects are written in "
+                        "binary format, which is much faster to read.")
     parser.add_argument("docs", type=argparse.FileType('r'),
                         help="Input documents in kaldi text format i.e. "
                         "<document-id> <text>")
-    parser.add_argument("tf_idf_file", type=argparse.FileType('w'),
+    parser.add_argument("tf_idf_file", type=str,
                         help="Output tf-idf for each (t,d) pair in the "
                         "input documents written in the format "
                         "<terms> <document-id> <tf-idf>")
@@ -75,6 +79,13 @@ def _get_args():
         raise ValueError("--tf-normalization-factor must be in [0,1)")
 
     args.accumulate_over_docs = bool(args.accumulate_over_docs == "true")
+    args.binary = bool(args.binary == "true")
+
+    if args.tf_idf_file == "-":
+        args.tf_idf_file = sys.stdout.buffer if args.binary else sys.stdout
+    else:
+        args.tf_idf_file = open(args.tf_idf_file,
+                                'wb' if args.binary else 'w')
 
     if not args.accumulate_over_docs and args.input_idf_stats is None:
         raise TypeError(
@@ -99,13 +110,16 @@ def _run(args):
 
         if not args.accumulate_over_docs:
             # Write the document-id and the corresponding tf-idf values.
-            print (doc, file=args.tf_idf_file, end=' ')
+            if args.binary:
+                args.tf_idf_file.write((doc + ' ').encode('utf-8'))
+            else:
+                print (doc, file=args.tf_idf_file, end=' ')
             tf_idf.write_tfidf_from_stats(
                 tf_stats, idf_stats, args.tf_idf_file,
                 tf_weighting_scheme=args.tf_weighting_scheme,
                 idf_weighting_scheme=args.idf_weighting_scheme,
                 tf_normalization_factor=args.tf_normalization_factor,
-                expected_document_id=doc)
+                expected_document_id=doc, binary=args.binary)
             tf_stats = tf_idf.TFStats()
         num_done += 1
 
@@ -122,7 +136,8 @@ def _run(args):
             tf_stats, idf_stats, args.tf_idf_file,
             tf_weighting_scheme=args.tf_weighting_scheme,
             idf_weighting_scheme=args.idf_weighting_scheme,
-            tf_normalization_factor=args.tf_normalization_factor)
+            tf_normalization_factor=args.tf_normalization_factor,
+            binary=args.binary)
 
     if num_done == 0:
         raise RuntimeError("Could not compute TF-IDF for any query documents")
@@ -11,15 +11,13 @@ import math
 from collections import defaultdict
 
 import io
-sys.stdout = io.TextIOWrapper(sys.stdout.buffer,encoding="utf8")
-sys.stderr = io.TextIOWrapper(sys.stderr.buffer,encoding="utf8")
-sys.stdin = io.TextIOWrapper(sys.stdin.buffer,encoding="utf8")
 
 parser = argparse.ArgumentParser(description="""
 This script creates a biased language model suitable for alignment and
 data-cleanup purposes.   It reads (possibly multiple) lines of integerized text
 from the input and writes a text-form FST of a backoff language model to
-the standard output, to be piped into fstcompile.""")
+the standard output, to be piped into fstcompile.  It can also be imported
+(see MakeBiasedLm()), as it is by make_biased_lms.py.""")
 
 parser.add_argument("--word-disambig-symbol", type = int, required = True,
                     help = "Integer corresponding to the disambiguation "
@@ -45,12 +43,6 @@ parser.add_argument("--discounting-constant", type = float, default = 0.3,
 parser.add_argument("--verbose", type = int, default = 0,
                     choices=[0,1,2,3,4,5], help = "Verbose level")
 
-args = parser.parse_args()
-
-if args.verbose >= 1:
-    print(' '.join(sys.argv), file = sys.stderr)
-
-
 
 
 class NgramCounts(object):
@@ -111,15 +103,13 @@ class NgramCounts(object):
             history = tuple(words[history_start:n])
             self.AddCount(history, predicted_word, 1.0)
 
-    def AddRawCountsFromStandardInput(self):
+    # 'lines' is an iterable of lines of integerized text, e.g. sys.stdin.
+    def AddRawCountsFromLines(self, lines, verbose = 0):
         lines_processed = 0
-        while True:
-            line = sys.stdin.readline()
-            if line == '':
-                break
+        for line in lines:
             self.AddRawCountsFromLine(line)
             lines_processed += 1
-        if lines_processed == 0 or args.verbose > 0:
+        if lines_processed == 0 or verbose > 0:
             print("make_one_biased_lm.py: processed {0} lines of input".format(
                     lines_processed), file = sys.stderr)
 
@@ -202,29 +192,14 @@ class NgramCounts(object):
         print('total count = {0}, excluding discount = {1}'.format(
                 total, total_excluding_backoff), file = sys.stderr)
 
-    def AddTopWords(self, top_words_file):
+    # 'top_words' is a list of (word-index, prob) pairs, as returned
+    # by ReadTopWords().
+    def AddTopWords(self, top_words):
         empty_history = ()
         word_to_count = self.counts[0][empty_history]
         total = sum(word_to_count.values())
-        try:
-            f = open(top_words_file, mode='r', encoding='utf-8')
-        except:
-            sys.exit("make_one_biased_lm.py: error opening top-words file: "
-                     "--top-words=" + top_words_file)
-        while True:
-            line = f.readline()
-            if line == '':
-                break
-            try:
-                [ word_index, prob ] = line.split()
-                word_index = int(word_index)
-                prob = float(prob)
-                assert word_index > 0 and prob > 0.0
-                word_to_count[word_index] += prob * total
-            except Exception as e:
-                sys.exit("make_one_biased_lm.py: could not make sense of the "
-                         "line '{0}' in op-words file: {1} ".format(line, str(e)))
-        f.close()
+        for word_index, prob in top_words:
+            word_to_count[word_index] += prob * total
 
 
     def GetTotalCountMap(self):
@@ -257,8 +232,11 @@ class NgramCounts(object):
             prob += backoff_prob * prob_in_backoff
         return prob
 
-    # This function prints the estimated language model as an FST.
-    def PrintAsFst(self, word_disambig_symbol):
+    # This function prints the estimated language model as an FST, to 'file'
+    # (by default the standard output).
+    def PrintAsFst(self, word_disambig_symbol, file = None):
+        if file is None:
+            file = sys.stdout
         # n is the history-length (== order + 1).  We iterate over the
         # history-length in the order 1, 0, 2, 3, and then iterate over the
         # histories of each order in sorted order.  Putting order 1 first
@@ -288,33 +266,80 @@ class NgramCounts(object):
                             next_hist = next_hist[1:]
                         next_fst_state = hist_to_state[next_hist]
                         print(this_fst_state, next_fst_state, word, word,
-                              this_cost)
+                              this_cost, file = file)
                     elif word == self.eos_symbol:
                         # print final-prob for this state.
-                        print(this_fst_state, this_cost)
+                        print(this_fst_state, this_cost, file = file)
                     else:
                         assert word == self.backoff_symbol
                         backoff_fst_state = hist_to_state[hist[1:len(hist)]]
                         print(this_fst_state, backoff_fst_state,
-                              word_disambig_symbol, 0, this_cost)
-
-
-ngram_counts = NgramCounts(args.ngram_order)
-ngram_counts.AddRawCountsFromStandardInput()
-
-if args.verbose >= 3:
-    ngram_counts.Print("Raw counts:")
-ngram_counts.CompletelyDiscountLowCountStates(args.min_lm_state_count)
-if args.verbose >= 3:
-    ngram_counts.Print("Counts after discounting low-count states:")
-ngram_counts.ApplyBackoff(args.discounting_constant)
-if args.verbose >= 3:
-    ngram_counts.Print("Counts after applying Kneser-Ney discounting:")
-if args.top_words != None:
-    ngram_counts.AddTopWords(args.top_words)
+                              word_disambig_symbol, 0, this_cost, file = file)
+
+
+
+# This function reads the --top-words file, and returns a list of
+# (word-index, prob) pairs, in the order of the file.
+def ReadTopWords(top_words_file):
+    top_words = []
+    try:
+        f = open(top_words_file, mode='r', encoding='utf-8')
+    except:
+        sys.exit("make_one_biased_lm.py: error opening top-words file: "
+                 "--top-words=" + top_words_file)
+    while True:
+        line = f.readline()
+        if line == '':
+            break
+        try:
+            [ word_index, prob ] = line.split()
+            word_index = int(word_index)
+            prob = float(prob)
+            assert word_index > 0 and prob > 0.0
+            top_words.append((word_index, prob))
+        except Exception as e:
+            sys.exit("make_one_biased_lm.py: could not make sense of the "
+                     "line '{0}' in op-words file: {1} ".format(line, str(e)))
+    f.close()
+    return top_words
+
+
+# This function estimates the biased LM of 'lines' (an iterable of lines of
+# integerized text), with the options in 'args' (as parsed by 'parser' above),
+# and returns it as an NgramCounts object.  'top_words' is the list returned
+# by ReadTopWords(), or None.
+def MakeBiasedLm(lines, args, top_words = None):
+    ngram_counts = NgramCounts(args.ngram_order)
+    ngram_counts.AddRawCountsFromLines(lines, args.verbose)
+
     if args.verbose >= 3:
-        ngram_counts.Print("Counts after applying top-n-words")
-ngram_counts.PrintAsFst(args.word_disambig_symbol)
+        ngram_counts.Print("Raw counts:")
+    ngram_counts.CompletelyDiscountLowCountStates(args.min_lm_state_count)
+    if args.verbose >= 3:
+        ngram_counts.Print("Counts after discounting low-count states:")
+    ngram_counts.ApplyBackoff(args.discounting_constant)
+    if args.verbose >= 3:
+        ngram_counts.Print("Counts after applying Kneser-Ney discounting:")
+    if top_words != None:
+        ngram_counts.AddTopWords(top_words)
+        if args.verbose >= 3:
+            ngram_counts.Print("Counts after applying top-n-words")
+    return ngram_counts
+
+
+if __name__ == "__main__":
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer,encoding="utf8")
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer,encoding="utf8")
+    sys.stdin = io.TextIOWrapper(sys.stdin.buffer,encoding="utf8")
+
+    args = parser.parse_args()
+
+    if args.verbose >= 1:
+        print(' '.join(sys.argv), file = sys.stderr)
+
+    top_words = ReadTopWords(args.top_words) if args.top_words != None else None
+    ngram_counts = MakeBiasedLm(sys.stdin, args, top_words)
+    ngram_counts.PrintAsFst(args.word_disambig_symbol)
 
 
 # test comand:
@@ -79,7 +79,11 @@ foo1-2 doc1,0,0.2 doc2,1,1 doc3,0.2,0
 
 from __future__ import print_function
 import argparse
+import itertools
 import logging
+import multiprocessing
+
+import numpy as np
 
 import tf_idf
 
@@ -124,6 +128,14 @@ def get_args():
                         from the neighboring documents is added to the
                         retrieved document.""")
 
+    parser.add_argument("--num-jobs", type=int, default=1,
+                        help="""Number of processes retrieving documents
+                        in parallel. The sources of all the queries are
+                        then loaded first, and shared by the processes.""")
+    parser.add_argument("--batch-size", type=int, default=100,
+                        help="Number of queries given to a process at a "
+                        "time")
+
     parser.add_argument("--source-text-id2doc-ids",
                         type=argparse.FileType('r'), required=True,
                         help="""A mapping from the source text to a list of
@@ -139,12 +151,13 @@ def get_args():
                         required=True,
                         help="""An SCP file for the TF-IDF for source
                         documents indexed by the source-text-id.""")
-    parser.add_argument("--query-tfidf", type=argparse.FileType('r'),
+    parser.add_argument("--query-tfidf", type=argparse.FileType('rb'),
                         required=True,
                         help="""Archive of TF-IDF objects for query documents
                         indexed by the query-id.
                         The format is
                         query-id <TFIDF> ... </TFIDF>
+                        The TF-IDF objects can be in text or binary format.
                         """)
     parser.add_argument("--relevant-docs", type=argparse.FileType('w'),
                         required=True,
@@ -235,6 +248,145 @@ def get_document_ids(source_docs, indexes):
     return doc_ids
 
 
+class SourceIndex(object):
+    """The TF-IDF of the source documents in a file, with its term index
+    (the inverted index, see tf_idf.TFIDF.term_index()) and the position of
+    every document in the list of documents of the source texts."""
+
+    def __init__(self, file_name):
+        self.tfidf = tf_idf.TFIDF()
+        with open(file_name, 'rb') as f:
+            self.tfidf.read(f)
+        self.tfidf.term_index()
+        self.positions = {}
+
+    def add_source_text(self, source_text_id, source_doc_ids):
+        if source_text_id in self.positions:
+            return
+        positions = np.full(len(self.tfidf.docs), -1, dtype=np.int64)
+        doc_ids = self.tfidf.docs.lookup(source_doc_ids)
+        known = doc_ids >= 0
+        positions[doc_ids[known]] = np.flatnonzero(known)
+        self.positions[source_text_id] = positions
+
+    def get_scores(self, query_id, query_tfidf, source_text_id,
+                   source_doc_ids):
+        """Returns the similarity scores of the query with the documents
+        source_doc_ids of the source text. Only the documents sharing at
+        least one term with the query are scored; the score of the rest is
+        0."""
+        self.add_source_text(source_text_id, source_doc_ids)
+        _, doc_ids, candidate_scores = query_tfidf.compute_candidate_scores(
+            self.tfidf, query_id=query_id)
+
+        positions = self.positions[source_text_id][doc_ids]
+        keep = positions >= 0
+        scores = np.zeros(len(source_doc_ids))
+        scores[positions[keep]] = candidate_scores[keep]
+        return scores
+
+
+def retrieve_docs(args, query_id, source_doc_ids, scores):
+    """Returns the output line with the documents retrieved for a query,
+    given the scores of the documents source_doc_ids."""
+    if args.verbose > 2:
+        for doc_id, score in zip(source_doc_ids, scores):
+            logger.debug("Score, {query}: {0} {1} {2}".format(
+                query_id, doc_id, score, query=query_id))
+
+    best_index = int(np.argmax(scores))
+    best_doc_id = source_doc_ids[best_index]
+    best_score = scores[best_index]
+
+    best_indexes = {}
+
+    if args.num_neighbors_to_search == 0:
+        best_indexes[best_index] = (1, 1)
+        if best_index > 0:
+            best_indexes[best_index - 1] = (0, args.partial_doc_fraction)
+        if best_index < len(source_doc_ids) - 1:
+            best_indexes[best_index + 1] = (args.partial_doc_fraction, 0)
+    else:
+        excluded_indexes = set()
+        for index in range(
+                max(best_index - args.num_neighbors_to_search, 0),
+                min(best_index + args.num_neighbors_to_search + 1,
+                    len(source_doc_ids))):
+            if scores[index] >= args.neighbor_tfidf_threshold * best_score:
+                best_indexes[index] = (1, 1)    # Type 2
+                if index > 0 and index - 1 in excluded_indexes:
+                    try:
+                        # Type 1 and 3
+                        start_frac, end_frac = best_indexes[index - 1]
+                        assert end_frac == 0
+                        best_indexes[index - 1] = (
+                            start_frac, args.partial_doc_fraction)
+                    except KeyError:
+                        # Type 1
+                        best_indexes[index - 1] = (
+                            0, args.partial_doc_fraction)
+            else:
+                excluded_indexes.add(index)
+                if index > 0 and index - 1 not in excluded_indexes:
+                    # Type 3
+                    best_indexes[index] = (args.partial_doc_fraction, 0)
+
+    best_docs = get_document_ids(source_doc_ids, best_indexes)
+
+    assert len(best_docs) > 0, (
+        "Did not get best docs for query {0}\n"
+        "Scores: {1}\n"
+        "Source docs: {2}\n"
+        "Best index: {best_index}, score: {best_score}\n".format(
+            query_id, scores, source_doc_ids,
+            best_index=best_index, best_score=best_score))
+    assert (best_doc_id, 1.0, 1.0) in best_docs
+
+    return "{0} {1}".format(query_id, " ".join(
+        ["%s,%.2f,%.2f" % x for x in best_docs]))
+
+
+def _init_worker(worker_args):
+    global _worker_args
+    _worker_args = worker_args
+
+
+def _retrieve_task(queries):
+    """Retrieves the documents for a batch of (query-id, TF-IDF) and
+    returns the output lines."""
+    (args, query_id2source_text_id, source_text_id2doc_ids,
+     source_text_id2tfidf, sources) = _worker_args
+
+    lines = []
+    for query_id, query_tfidf in queries:
+        # The source text from which a document is to be retrieved for the
+        # input query
+        source_text_id = query_id2source_text_id[query_id]
+        source_file = source_text_id2tfidf[source_text_id]
+        if source_file not in sources:
+            # Only the last source is kept when loading on demand.
+            sources.clear()
+            sources[source_file] = SourceIndex(source_file)
+
+        # The source documents corresponding to the source text.
+        # This is set of documents which will be searched over for the query.
+        source_doc_ids = source_text_id2doc_ids[source_text_id]
+
+        scores = sources[source_file].get_scores(
+            query_id, query_tfidf, source_text_id, source_doc_ids)
+        lines.append(retrieve_docs(args, query_id, source_doc_ids, scores))
+    return lines
+
+
+def batches(iterable, batch_size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
 def run(args):
     """The main function that does all the processing.
     Takes as argument the Namespace object obtained from _get_args().
@@ -247,92 +399,48 @@ def run(args):
     source_text_id2tfidf = read_map(args.source_text_id2tfidf,
                                     num_values_per_key=1)
 
-    num_queries = 0
-    prev_source_text_id = ""
-    for query_id, query_tfidf in tf_idf.read_tfidf_ark(args.query_tfidf):
-        num_queries += 1
-
-        # The source text from which a document is to be retrieved for the
-        # input query
-        source_text_id = query_id2source_text_id[query_id]
-
-        if prev_source_text_id != source_text_id:
-            source_tfidf = tf_idf.TFIDF()
-            source_tfidf.read(
-                open(source_text_id2tfidf[source_text_id]))
-            prev_source_text_id = source_text_id
+    queries = tf_idf.read_tfidf_ark(args.query_tfidf)
+    sources = {}
+    if args.num_jobs > 1:
+        # The sources needed by the queries are loaded (and indexed) before
+        # starting the workers, which share them.
+        queries = list(queries)
+        for query_id, _ in queries:
+            source_text_id = query_id2source_text_id[query_id]
+            source_file = source_text_id2tfidf[source_text_id]
+            if source_file not in sources:
+                sources[source_file] = SourceIndex(source_file)
+            sources[source_file].add_source_text(
+                source_text_id, source_text_id2doc_ids[source_text_id])
+
+    # Only the options (not the open files) are given to the workers.
+    options = argparse.Namespace(
+        verbose=args.verbose,
+        num_neighbors_to_search=args.num_neighbors_to_search,
+        neighbor_tfidf_threshold=args.neighbor_tfidf_threshold,
+        partial_doc_fraction=args.partial_doc_fraction)
+    worker_args = (options, query_id2source_text_id, source_text_id2doc_ids,
+                   source_text_id2tfidf, sources)
+    tasks = batches(queries, args.batch_size)
+    if args.num_jobs > 1:
+        pool = multiprocessing.Pool(args.num_jobs, _init_worker,
+                                    (worker_args,))
+        results = pool.imap(_retrieve_task, tasks)
+    else:
+        pool = None
+        _init_worker(worker_args)
+        results = (_retrieve_task(task) for task in tasks)
 
-        # The source documents corresponding to the source text.
-        # This is set of documents which will be searched over for the query.
-        source_doc_ids = source_text_id2doc_ids[source_text_id]
-
-        scores = query_tfidf.compute_similarity_scores(
-            source_tfidf, source_docs=source_doc_ids, query_id=query_id)
-
-        assert len(scores) > 0, (
-            "Did not get scores for query {0}".format(query_id))
-
-        if args.verbose > 2:
-            for tup, score in scores.items():
-                logger.debug("Score, {num}: {0} {1} {2}".format(
-                    tup[0], tup[1], score, num=num_queries))
-
-        best_index, best_doc_id = max(
-            enumerate(source_doc_ids), key=lambda x: scores[(query_id, x[1])])
-        best_score = scores[(query_id, best_doc_id)]
-
-        assert source_doc_ids[best_index] == best_doc_id
-        assert best_score == max([scores[(query_id, x)]
-                                  for x in source_doc_ids])
-
-        best_indexes = {}
-
-        if args.num_neighbors_to_search == 0:
-            best_indexes[best_index] = (1, 1)
-            if best_index > 0:
-                best_indexes[best_index - 1] = (0, args.partial_doc_fraction)
-            if best_index < len(source_doc_ids) - 1:
-                best_indexes[best_index + 1] = (args.partial_doc_fraction, 0)
-        else:
-            excluded_indexes = set()
-            for index in range(
-                    max(best_index - args.num_neighbors_to_search, 0),
-                    min(best_index + args.num_neighbors_to_search + 1,
-                        len(source_doc_ids))):
-                if (scores[(query_id, source_doc_ids[index])]
-                        >= args.neighbor_tfidf_threshold * best_score):
-                    best_indexes[index] = (1, 1)    # Type 2
-                    if index > 0 and index - 1 in excluded_indexes:
-                        try:
-                            # Type 1 and 3
-                            start_frac, end_frac = best_indexes[index - 1]
-                            assert end_frac == 0
-                            best_indexes[index - 1] = (
-                                start_frac, args.partial_doc_fraction)
-                        except KeyError:
-                            # Type 1
-                            best_indexes[index - 1] = (
-                                0, args.partial_doc_fraction)
-                else:
-                    excluded_indexes.add(index)
-                    if index > 0 and index - 1 not in excluded_indexes:
-                        # Type 3
-                        best_indexes[index] = (args.partial_doc_fraction, 0)
-
-        best_docs = get_document_ids(source_doc_ids, best_indexes)
-
-        assert len(best_docs) > 0, (
-            "Did not get best docs for query {0}\n"
-            "Scores: {1}\n"
-            "Source docs: {2}\n"
-            "Best index: {best_index}, score: {best_score}\n".format(
-                query_id, scores, source_doc_ids,
-                best_index=best_index, best_score=best_score))
-        assert (best_doc_id, 1.0, 1.0) in best_docs
-
-        print ("{0} {1}".format(query_id, " ".join(
-            ["%s,%.2f,%.2f" % x for x in best_docs])),
-               file=args.relevant_docs)
+    num_queries = 0
+    try:
+        for lines in results:
+            for line in lines:
+                print (line, file=args.relevant_docs)
+            num_queries += len(lines)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     if num_queries == 0:
         raise RuntimeError("Failed to retrieve any document.")
@@ -7,8 +7,9 @@
 
 from __future__ import print_function
 from __future__ import division
-import sys, operator, argparse, os
-from collections import defaultdict
+import sys, operator, argparse, os, io, itertools, multiprocessing
+from array import array
+from collections import defaultdict, deque
 
 # This script reads 'ctm-edits' file format that is produced by get_ctm_edits.py
 # and modified by modify_ctm_edits.py and taint_ctm_edits.py Its function is to
@@ -95,6 +96,11 @@ parser.add_argument("--word-stats-out", type = str,
                     "reference word does not make it into a segment.  It can help reveal words "
                     "that have problematic pronunciations or are associated with "
                     "transcription errors.")
+parser.add_argument("--num-jobs", type = int, default = 1,
+                    help = "Number of processes segmenting utterances in parallel. "
+                    "The outputs are written in the order of the input.")
+parser.add_argument("--batch-size", type = int, default = 100,
+                    help = "Number of utterances given to a process at a time.")
 
 
 parser.add_argument("non_scored_words_in", metavar = "<non-scored-words-file>",
@@ -111,14 +117,44 @@ parser.add_argument("segments_out", metavar = "<segments-out>",
                     "but instead of <recording-id>, the second field is the old utterance-id, i.e "
                     "<new-utterance-id> <old-utterance-id> <start-time> <end-time>")
 
-args = parser.parse_args()
-
 
 
 
 def IsTainted(split_line_of_utt):
     return len(split_line_of_utt) > 8 and split_line_of_utt[8] == 'tainted'
 
+# This class holds the ctm-edits lines of one utterance.  The split lines are
+# kept as they were read (they are only needed for the --ctm-edits-out
+# output), and the fields that the segmentation looks at are converted once
+# and stored column-wise: the start times, durations and end times as arrays of
+# doubles, the hyp-words, ref-words and edit types as tuples and the 'tainted'
+# flags as bytes.  Objects of class Segment all refer to the same
+# CtmEditsLines object and only store a range of line indexes.
+class CtmEditsLines(object):
+    def __init__(self, split_lines_of_utt):
+        self.split_lines = split_lines_of_utt
+        # all lines have at least the 8 fields up to the edit type.
+        columns = list(zip(*split_lines_of_utt))
+        self.start_times = array('d', map(float, columns[2]))
+        self.durations = array('d', map(float, columns[3]))
+        self.end_times = array('d', map(operator.add, self.start_times,
+                                        self.durations))
+        self.hyp_words = columns[4]
+        self.ref_words = columns[6]
+        self.edits = columns[7]
+        self.tainted = bytearray([ IsTainted(x) for x in split_lines_of_utt ])
+        # the number of times each line was marked 'do-not-include-in-text' by
+        # Segment.MergeWithSegment().
+        self.excluded = bytearray(len(split_lines_of_utt))
+
+    def __len__(self):
+        return len(self.split_lines)
+
+    # Returns the fields of line i for the --ctm-edits-out output, including
+    # any 'do-not-include-in-text' marks.
+    def OutputFields(self, i):
+        return self.split_lines[i] + [ 'do-not-include-in-text' ] * self.excluded[i]
+
 # This function returns a list of pairs (start-index, end-index) representing
 # the cores of segments (so if a pair is (s, e), then the core of a segment
 # would span (s, s+1, ... e-1).
@@ -133,27 +169,27 @@ def IsTainted(split_line_of_utt):
 # or 'cor' that is not tainted.  Contiguous regions of 'true' in the resulting
 # boolean array will then become the cores of prototype segments, and we'll add
 # any adjacent tainted words (or parts of them).
-def ComputeSegmentCores(split_lines_of_utt):
-    num_lines = len(split_lines_of_utt)
-    line_is_in_segment_core = [ False] * num_lines
-    for i in range(num_lines):
-        if split_lines_of_utt[i][7] == 'cor' and \
-            split_lines_of_utt[i][4] == split_lines_of_utt[i][6]:
-            line_is_in_segment_core[i] = True
+# 'lines' is of type CtmEditsLines.
+def ComputeSegmentCores(lines):
+    num_lines = len(lines)
+    edits = lines.edits
+    line_is_in_segment_core = [ edits[i] == 'cor' and
+                                lines.hyp_words[i] == lines.ref_words[i]
+                                for i in range(num_lines) ]
 
     # extend each proto-segment forwards as far as we can:
     for i in range(1, num_lines):
         if line_is_in_segment_core[i-1] and not line_is_in_segment_core[i]:
-            edit_type = split_lines_of_utt[i][7]
-            if not IsTainted(split_lines_of_utt[i]) and \
+            edit_type = edits[i]
+            if not lines.tainted[i] and \
                 (edit_type == 'cor' or edit_type == 'sil' or edit_type == 'fix'):
                 line_is_in_segment_core[i] = True
 
     # extend each proto-segment backwards as far as we can:
     for i in reversed(range(0, num_lines - 1)):
         if line_is_in_segment_core[i+1] and not line_is_in_segment_core[i]:
-            edit_type = split_lines_of_utt[i][7]
-            if not IsTainted(split_lines_of_utt[i]) and \
+            edit_type = edits[i]
+            if not lines.tainted[i] and \
                (edit_type == 'cor' or edit_type == 'sil' or edit_type == 'fix'):
                 line_is_in_segment_core[i] = True
 
@@ -174,8 +210,10 @@ def ComputeSegmentCores(split_lines_of_utt):
     return segment_ranges
 
 class Segment(object):
-    def __init__(self, split_lines_of_utt, start_index, end_index, debug_str = None):
-        self.split_lines_of_utt = split_lines_of_utt
+    def __init__(self, lines, start_index, end_index, debug_str = None):
+        # 'lines' is the CtmEditsLines object for the utterance; it is shared
+        # by all the segments of the utterance.
+        self.lines = lines
         # start_index is the index of the first line that appears in this
         # segment, and end_index is one past the last line.  This does not
         # include unk-padding.
@@ -212,7 +250,7 @@ class Segment(object):
     # real word, we want to add some kind of padding.
     def PossiblyAddTaintedLines(self):
         global non_scored_words
-        split_lines_of_utt = self.split_lines_of_utt
+        lines = self.lines
         # we're iterating over the segment (start, end)
         for b in [False, True]:
             if b:
@@ -221,17 +259,17 @@ class Segment(object):
             else:
                 boundary_index = self.start_index
                 adjacent_index = self.start_index - 1
-            if adjacent_index >= 0 and adjacent_index < len(split_lines_of_utt):
+            if adjacent_index >= 0 and adjacent_index < len(lines):
                 # only consider merging the adjacent word into the segment if we're not
                 # at a segment boundary.
-                adjacent_line_is_tainted = IsTainted(split_lines_of_utt[adjacent_index])
+                adjacent_line_is_tainted = lines.tainted[adjacent_index]
                 # if the adjacent line wasn't tainted, then there must have been
                 # another stronger reason why we didn't include it in the core
                 # of the segment (probably that it was an ins, del or sub), so
                 # there is no point considering it.
                 if adjacent_line_is_tainted:
-                    boundary_edit_type = split_lines_of_utt[boundary_index][7]
-                    boundary_hyp_word = split_lines_of_utt[boundary_index][7]
+                    boundary_edit_type = lines.edits[boundary_index]
+                    boundary_hyp_word = lines.edits[boundary_index]
                     # we only add the tainted line to the segment if the word at
                     # the boundary was a non-silence word that was correctly
                     # decoded and not fixed [see modify_ctm_edits.py.]
@@ -255,16 +293,16 @@ class Segment(object):
         # make sure the segment hasn't been processed more than we expect.
         assert self.start_unk_padding == 0.0 and self.end_unk_padding == 0.0 and \
               self.start_keep_proportion == 1.0 and self.end_keep_proportion == 1.0
+        lines = self.lines
         segments = []  # the answer
         cur_start_index = self.start_index
         cur_start_is_split = False
         # only consider splitting at non-boundary lines.  [we'd just truncate
         # the boundary lines.]
         for index_to_split_at in range(cur_start_index + 1, self.end_index - 1):
-            this_split_line = self.split_lines_of_utt[index_to_split_at]
-            this_duration = float(this_split_line[3])
-            this_edit_type = this_split_line[7]
-            this_ref_word = this_split_line[6]
+            this_duration = lines.durations[index_to_split_at]
+            this_edit_type = lines.edits[index_to_split_at]
+            this_ref_word = lines.ref_words[index_to_split_at]
             if (this_edit_type == 'sil' and this_duration > args.max_internal_silence_length) or \
                (this_ref_word in non_scored_words and this_duration > args.max_internal_non_scored_length):
                 # We split this segment at this index, dividing the word in two
@@ -272,7 +310,7 @@ class Segment(object):
                 # truncated.]
                 # Note: we use 'index_to_split_at + 1' because the Segment constructor
                 # takes an 'end-index' which is interpreted as one past the end.
-                new_segment = Segment(self.split_lines_of_utt, cur_start_index,
+                new_segment = Segment(lines, cur_start_index,
                                       index_to_split_at + 1, self.debug_str)
                 if cur_start_is_split:
                     new_segment.start_keep_proportion = 0.5
@@ -284,7 +322,7 @@ class Segment(object):
             segments.append(self)
         else:
             # We did split.  Add the very last segment.
-            new_segment = Segment(self.split_lines_of_utt, cur_start_index,
+            new_segment = Segment(lines, cur_start_index,
                                   self.end_index, self.debug_str)
             assert cur_start_is_split
             new_segment.start_keep_proportion = 0.5
@@ -303,11 +341,10 @@ class Segment(object):
                 this_index = self.start_index
             else:
                 this_index = self.end_index - 1
-            this_split_line = self.split_lines_of_utt[this_index]
             truncated_duration = None
-            this_duration = float(this_split_line[3])
-            this_edit = this_split_line[7]
-            this_ref_word = this_split_line[6]
+            this_duration = self.lines.durations[this_index]
+            this_edit = self.lines.edits[this_index]
+            this_ref_word = self.lines.ref_words[this_index]
             if this_edit == 'sil' and \
                this_duration > args.max_edge_silence_length:
                 truncated_duration = args.max_edge_silence_length
@@ -338,9 +375,9 @@ class Segment(object):
             return  # Nothing to do.
         orig_start_keep_proportion = self.start_keep_proportion
         orig_end_keep_proportion = self.end_keep_proportion
-        if not IsTainted(self.split_lines_of_utt[self.start_index]):
+        if not self.lines.tainted[self.start_index]:
             self.start_keep_proportion = 1.0
-        if not IsTainted(self.split_lines_of_utt[self.end_index - 1]):
+        if not self.lines.tainted[self.end_index - 1]:
             self.end_keep_proportion = 1.0
         length_with_relaxed_boundaries = self.Length()
         if length_with_relaxed_boundaries <= length_cutoff:
@@ -384,10 +421,9 @@ class Segment(object):
                 this_index = self.start_index
             else:
                 this_index = self.end_index - 1
-            this_split_line = self.split_lines_of_utt[this_index]
-            this_start_time = float(this_split_line[2])
-            this_ref_word = this_split_line[6]
-            this_edit = this_split_line[7]
+            this_start_time = self.lines.start_times[this_index]
+            this_ref_word = self.lines.ref_words[this_index]
+            this_edit = self.lines.edits[this_index]
             if this_edit == 'cor' and not this_ref_word in non_scored_words:
                 # we can consider adding unk-padding.
                 if b: # start of utterance.
@@ -403,9 +439,8 @@ class Segment(object):
                         unk_padding = 0.0
                     self.start_unk_padding = unk_padding
                 else: # end of utterance.
-                    this_end_time = this_start_time + float(this_split_line[3])
-                    last_line = self.split_lines_of_utt[-1]
-                    utterance_end_time = float(last_line[2]) + float(last_line[3])
+                    this_end_time = self.lines.end_times[this_index]
+                    utterance_end_time = self.lines.end_times[-1]
                     max_allowable_padding = utterance_end_time - this_end_time
                     assert max_allowable_padding > -0.01
                     unk_padding = args.unk_padding
@@ -432,7 +467,7 @@ class Segment(object):
     def MergeWithSegment(self, other):
         assert self.EndTime() >= other.StartTime() and \
                self.StartTime() < other.EndTime() and \
-               self.split_lines_of_utt is other.split_lines_of_utt
+               self.lines is other.lines
         orig_self_end_index = self.end_index
         self.debug_str = "({0}/merged-with/{1})".format(self.debug_str, other.debug_str)
         # everything that relates to the end of this segment gets copied
@@ -450,23 +485,22 @@ class Segment(object):
         # as 'discard-this-word'.
         first_index_of_overlap = min(orig_self_end_index - 1, other.start_index)
         last_index_of_overlap = max(orig_self_end_index - 1, other.start_index)
+        edits = self.lines.edits
         num_deleted_words = 0
         for i in range(first_index_of_overlap, last_index_of_overlap + 1):
-            edit_type = self.split_lines_of_utt[i][7]
+            edit_type = edits[i]
             if edit_type == 'del':
                 num_deleted_words += 1
         if num_deleted_words > args.max_deleted_words_kept_when_merging:
             for i in range(first_index_of_overlap, last_index_of_overlap + 1):
-                if self.split_lines_of_utt[i][7] == 'del':
-                    self.split_lines_of_utt[i].append('do-not-include-in-text')
+                if edits[i] == 'del':
+                    self.lines.excluded[i] += 1
 
     # Returns the start time of the utterance (within the enclosing utterance)
     # This is before any rounding.
     def StartTime(self):
-        first_line = self.split_lines_of_utt[self.start_index]
-        first_line_start = float(first_line[2])
-        first_line_duration = float(first_line[3])
-        first_line_end = first_line_start + first_line_duration
+        first_line_duration = self.lines.durations[self.start_index]
+        first_line_end = self.lines.end_times[self.start_index]
         return first_line_end - self.start_unk_padding \
               - (first_line_duration * self.start_keep_proportion)
 
@@ -479,22 +513,28 @@ class Segment(object):
 
     # Returns the start time of the utterance (within the enclosing utterance)
     def EndTime(self):
-        last_line = self.split_lines_of_utt[self.end_index - 1]
-        last_line_start = float(last_line[2])
-        last_line_duration = float(last_line[3])
+        last_line_start = self.lines.start_times[self.end_index - 1]
+        last_line_duration = self.lines.durations[self.end_index - 1]
         return last_line_start + (last_line_duration * self.end_keep_proportion) \
              + self.end_unk_padding
 
-    # Returns the segment length in seconds.
+    # Returns the segment length in seconds.  This is EndTime() - StartTime(),
+    # written out because it is called for every segment at every stage.
     def Length(self):
-        return self.EndTime() - self.StartTime()
+        lines = self.lines
+        start_index = self.start_index
+        end_index = self.end_index - 1
+        return (lines.start_times[end_index] +
+                (lines.durations[end_index] * self.end_keep_proportion) +
+                self.end_unk_padding) - \
+               (lines.end_times[start_index] - self.start_unk_padding -
+                (lines.durations[start_index] * self.start_keep_proportion))
 
     def IsWholeUtterance(self):
         # returns true if this segment corresponds to the whole utterance that
         # it's a part of (i.e. its start/end time are zero and the end-time of
         # the last segment.
-        last_line_of_utt = self.split_lines_of_utt[-1]
-        last_line_end_time = float(last_line_of_utt[2]) + float(last_line_of_utt[3])
+        last_line_end_time = self.lines.end_times[-1]
         return abs(self.StartTime() - 0.0) < 0.001 and \
                abs(self.EndTime() - last_line_end_time) < 0.001
 
@@ -506,13 +546,11 @@ class Segment(object):
         # the utterance must contain other lines, so double-counting is not a
         # problem.
         junk_duration = self.start_unk_padding + self.end_unk_padding
-        first_split_line = self.split_lines_of_utt[self.start_index]
-        if IsTainted(first_split_line):
-            first_duration = float(first_split_line[3])
+        if self.lines.tainted[self.start_index]:
+            first_duration = self.lines.durations[self.start_index]
             junk_duration += first_duration * self.start_keep_proportion
-        last_split_line = self.split_lines_of_utt[self.end_index - 1]
-        if IsTainted(last_split_line):
-            last_duration = float(last_split_line[3])
+        if self.lines.tainted[self.end_index - 1]:
+            last_duration = self.lines.durations[self.end_index - 1]
             junk_duration += last_duration * self.end_keep_proportion
         return junk_duration / self.Length()
 
@@ -524,10 +562,10 @@ class Segment(object):
     # segment or non-tainted non-scored-word segment in the
     # utterance.  See also TruncateEndForJunkProportion
     def PossiblyTruncateStartForJunkProportion(self):
+        lines = self.lines
         begin_junk_duration = self.start_unk_padding
-        first_split_line = self.split_lines_of_utt[self.start_index]
-        if IsTainted(first_split_line):
-            first_duration = float(first_split_line[3])
+        if lines.tainted[self.start_index]:
+            first_duration = lines.durations[self.start_index]
             begin_junk_duration += first_duration * self.start_keep_proportion
         if begin_junk_duration == 0.0:
             # nothing to do.
@@ -536,19 +574,18 @@ class Segment(object):
         candidate_start_index = None
         # the following iterates over all lines internal to the utterance.
         for i in range(self.start_index + 1, self.end_index - 1):
-            this_split_line = self.split_lines_of_utt[i]
-            this_edit_type = this_split_line[7]
-            this_ref_word = this_split_line[6]
+            this_edit_type = lines.edits[i]
+            this_ref_word = lines.ref_words[i]
             # We'll consider splitting on silence and on non-scored words.
             # (i.e. making the silence or non-scored word the left boundary of
             # the new utterance and discarding the piece to the left of that).
             if ((this_edit_type == 'sil'
                  or (this_edit_type == 'cor'
                      and this_ref_word in non_scored_words))
-                and (float(this_split_line[3])
+                and (lines.durations[i]
                      > args.min_split_point_duration)):
                 candidate_start_index = i
-                candidate_start_time = float(this_split_line[2])
+                candidate_start_time = lines.start_times[i]
                 break  # Consider only the first potential truncation.
         if candidate_start_index is None:
             return  # Nothing to do as there is no place to split.
@@ -565,10 +602,10 @@ class Segment(object):
     # This is like PossiblyTruncateStartForJunkProportion(), but
     # acts on the end of the segment; see comments there.
     def PossiblyTruncateEndForJunkProportion(self):
+        lines = self.lines
         end_junk_duration = self.end_unk_padding
-        last_split_line = self.split_lines_of_utt[self.end_index - 1]
-        if IsTainted(last_split_line):
-            last_duration = float(last_split_line[3])
+        if lines.tainted[self.end_index - 1]:
+            last_duration = lines.durations[self.end_index - 1]
             end_junk_duration += last_duration * self.end_keep_proportion
         if end_junk_duration == 0.0:
             # nothing to do.
@@ -578,19 +615,18 @@ class Segment(object):
         # the following iterates over all lines internal to the utterance
         # (starting from the end).
         for i in reversed(range(self.start_index + 1, self.end_index - 1)):
-            this_split_line = self.split_lines_of_utt[i]
-            this_edit_type = this_split_line[7]
-            this_ref_word = this_split_line[6]
+            this_edit_type = lines.edits[i]
+            this_ref_word = lines.ref_words[i]
             # We'll consider splitting on silence and on non-scored words.
             # (i.e. making the silence or non-scored word the right boundary of
             # the new utterance and discarding the piece to the right of that).
             if ((this_edit_type == 'sil'
                  or (this_edit_type == 'cor'
                      and this_ref_word in non_scored_words))
-                and (float(this_split_line[3])
+                and (lines.durations[i]
                      > args.min_split_point_duration)):
                 candidate_end_index = i + 1  # note: end-indexes are one past the last.
-                candidate_end_time = float(this_split_line[2]) + float(this_split_line[3])
+                candidate_end_time = lines.end_times[i]
                 break  # Consider only the latest potential truncation.
         if candidate_end_index is None:
             return  # Nothing to do as there is no place to split.
@@ -610,11 +646,11 @@ class Segment(object):
     # realized as unk.  This becomes a filter on keeping segments.
     def ContainsAtLeastOneScoredNonOovWord(self):
         global non_scored_words
+        lines = self.lines
         for i in range(self.start_index, self.end_index):
-            this_split_line = self.split_lines_of_utt[i]
-            this_hyp_word = this_split_line[4]
-            this_ref_word = this_split_line[6]
-            this_edit = this_split_line[7]
+            this_hyp_word = lines.hyp_words[i]
+            this_ref_word = lines.ref_words[i]
+            this_edit = lines.edits[i]
             if this_edit == 'cor' and not this_ref_word in non_scored_words \
                and this_ref_word == this_hyp_word:
                 return True
@@ -626,88 +662,163 @@ class Segment(object):
         text_array = []
         if self.start_unk_padding != 0.0:
             text_array.append(oov_symbol)
+        ref_words = self.lines.ref_words
+        excluded = self.lines.excluded
         for i in range(self.start_index, self.end_index):
-            this_split_line = self.split_lines_of_utt[i]
-            this_edit = this_split_line[7]
-            this_ref_word = this_split_line[6]
-            if this_ref_word != '<eps>' and this_split_line[-1] != 'do-not-include-in-text':
+            this_ref_word = ref_words[i]
+            if this_ref_word != '<eps>' and not excluded[i]:
                 text_array.append(this_ref_word)
         if self.end_unk_padding != 0.0:
             text_array.append(oov_symbol)
         return ' '.join(text_array)
 
 
-# Here, 'text' will be something that indicates the stage of processing,
-# e.g. 'Stage 0: segment cores', 'Stage 1: add tainted lines',
-#, etc.
-def AccumulateSegmentStats(segment_list, text):
-    global segment_total_length, num_segments
-    for segment in segment_list:
-        num_segments[text] += 1
-        segment_total_length[text] += segment.Length()
-
-def PrintSegmentStats():
-    global segment_total_length, num_segments, \
-       num_utterances, num_utterances_without_segments, \
-       total_length_of_utterances
-
-    print('Number of utterances is %d, of which %.2f%% had no segments after '
-          'all processing; total length of data in original utterances (in seconds) '
-          'was %d' % (num_utterances,
-                      num_utterances_without_segments * 100.0 / num_utterances,
-                      total_length_of_utterances),
-          file = sys.stderr)
-
-
-    keys = sorted(segment_total_length.keys())
-    for i in range(len(keys)):
-        key = keys[i]
-        if i > 0:
-            delta_percentage = '[%+.2f%%]' % ((segment_total_length[key] - segment_total_length[keys[i-1]])
-                                              * 100.0 / total_length_of_utterances)
-        print('At %s, num-segments is %d, total length %.2f%% of original total %s' % (
-                key, num_segments[key],
-                segment_total_length[key] * 100.0 / total_length_of_utterances,
-                delta_percentage if i > 0 else ''),
+# This class accumulates the statistics that are printed at the end.  Each
+# batch of utterances is processed with its own SegmentationStats object (see
+# ProcessUtterances()), and these are summed in the order of the input by
+# Add().
+class SegmentationStats(object):
+    def __init__(self):
+        # segment_total_length and num_segments are maps from
+        # 'stage' strings; see AccumulateSegmentStats for details.
+        self.segment_total_length = defaultdict(int)
+        self.num_segments = defaultdict(int)
+        # word_count_pair is a map from a string (the word) to
+        # a list [total-count, count-not-within-segments]
+        self.word_count_pair = {}
+        self.num_utterances = 0
+        self.num_utterances_without_segments = 0
+        self.total_length_of_utterances = 0
+
+    def Add(self, other):
+        for key, value in other.segment_total_length.items():
+            self.segment_total_length[key] += value
+        for key, value in other.num_segments.items():
+            self.num_segments[key] += value
+        for word, other_pair in other.word_count_pair.items():
+            pair = self.word_count_pair.setdefault(word, [0, 0])
+            pair[0] += other_pair[0]
+            pair[1] += other_pair[1]
+        self.num_utterances += other.num_utterances
+        self.num_utterances_without_segments += other.num_utterances_without_segments
+        self.total_length_of_utterances += other.total_length_of_utterances
+
+    # Here, 'text' will be something that indicates the stage of processing,
+    # e.g. 'Stage 0: segment cores', 'Stage 1: add tainted lines',
+    #, etc.
+    def AccumulateSegmentStats(self, segment_list, text):
+        if len(segment_list) == 0:
+            return
+        total_length = self.segment_total_length[text]
+        for segment in segment_list:
+            total_length += segment.Length()
+        self.num_segments[text] += len(segment_list)
+        self.segment_total_length[text] = total_length
+
+    def PrintSegmentStats(self):
+        print('Number of utterances is %d, of which %.2f%% had no segments after '
+              'all processing; total length of data in original utterances (in seconds) '
+              'was %d' % (self.num_utterances,
+                          self.num_utterances_without_segments * 100.0 / self.num_utterances,
+                          self.total_length_of_utterances),
+              file = sys.stderr)
+
+        segment_total_length = self.segment_total_length
+        total_length_of_utterances = self.total_length_of_utterances
+        keys = sorted(segment_total_length.keys())
+        for i in range(len(keys)):
+            key = keys[i]
+            if i > 0:
+                delta_percentage = '[%+.2f%%]' % ((segment_total_length[key] - segment_total_length[keys[i-1]])
+                                                  * 100.0 / total_length_of_utterances)
+            print('At %s, num-segments is %d, total length %.2f%% of original total %s' % (
+                    key, self.num_segments[key],
+                    segment_total_length[key] * 100.0 / total_length_of_utterances,
+                    delta_percentage if i > 0 else ''),
+                  file = sys.stderr)
+
+    # This accumulates word-level stats about, for each reference word, with what
+    # probability it will end up in the core of a segment.  Words with low
+    # probabilities of being in segments will generally be associated with some kind
+    # of error (there is a higher probability of having a wrong lexicon entry).
+    def AccWordStatsForUtterance(self, lines, segments_for_utterance):
+        word_count_pair = self.word_count_pair
+        line_is_in_segment = [ False ] * len(lines)
+        for segment in segments_for_utterance:
+            for i in range(segment.start_index, segment.end_index):
+                line_is_in_segment[i] = True
+        for this_ref_word, in_segment in zip(lines.ref_words, line_is_in_segment):
+            if this_ref_word != '<eps>':
+                pair = word_count_pair.get(this_ref_word)
+                if pair is None:
+                    pair = word_count_pair[this_ref_word] = [0, 0]
+                pair[0] += 1
+                if not in_segment:
+                    pair[1] += 1
+
+    def PrintWordStats(self, word_stats_out):
+        try:
+            f = open(word_stats_out, 'w', encoding='utf-8')
+        except:
+            sys.exit("segment_ctm_edits.py: error opening word-stats file --word-stats-out={0} "
+                     "for writing".format(word_stats_out))
+        # Sort from most to least problematic.  We want to give more prominence to
+        # words that are most frequently not in segments, but also to high-count
+        # words.  Define badness = pair[1] / pair[0], and total_count = pair[0],
+        # where 'pair' is a value of word_count_pair.  We'll reverse sort on
+        # badness^3 * total_count = pair[1]^3 / pair[0]^2.
+        for key, pair in sorted(self.word_count_pair.items(),
+                          key = lambda item: (item[1][1] ** 3) * 1.0 / (item[1][0] ** 2),
+                          reverse = True):
+            badness = pair[1] * 1.0 / pair[0]
+            total_count = pair[0]
+            print(key, badness, total_count, file = f)
+        try:
+            f.close()
+        except:
+            sys.exit("segment_ctm_edits.py: error closing file --word-stats-out={0} "
+                     "(full disk?)".format(word_stats_out))
+        print("segment_ctm_edits.py: please see the file {0} for word-level statistics "
+              "saying how frequently each word was excluded for a segment; format is "
+              "<word> <proportion-of-time-excluded> <total-count>.  Particularly "
+              "problematic words appear near the top of the file.".format(word_stats_out),
               file = sys.stderr)
 
 # This function creates the segments for an utterance as a list
 # of class Segment.
 # It returns a 2-tuple (list-of-segments, list-of-deleted-segments)
 # where the deleted segments are only useful for diagnostic printing.
-# Note: split_lines_of_utt is a list of lists, one per line, each containing the
-# sequence of fields.
-def GetSegmentsForUtterance(split_lines_of_utt):
-    global num_utterances, num_utterances_without_segments, total_length_of_utterances
+# Note: 'lines' is of type CtmEditsLines; the statistics are accumulated in
+# 'stats', of type SegmentationStats.
+def GetSegmentsForUtterance(lines, stats):
+    stats.num_utterances += 1
 
-    num_utterances += 1
+    segment_ranges = ComputeSegmentCores(lines)
 
-    segment_ranges = ComputeSegmentCores(split_lines_of_utt)
+    utterance_end_time = lines.end_times[-1]
+    stats.total_length_of_utterances += utterance_end_time
 
-    utterance_end_time = float(split_lines_of_utt[-1][2]) + float(split_lines_of_utt[-1][3])
-    total_length_of_utterances += utterance_end_time
-
-    segments = [ Segment(split_lines_of_utt, x[0], x[1])
+    segments = [ Segment(lines, x[0], x[1])
                  for x in segment_ranges ]
 
-    AccumulateSegmentStats(segments, 'stage  0 [segment cores]')
+    stats.AccumulateSegmentStats(segments, 'stage  0 [segment cores]')
     for segment in segments:
         segment.PossiblyAddTaintedLines()
-    AccumulateSegmentStats(segments, 'stage  1 [add tainted lines]')
+    stats.AccumulateSegmentStats(segments, 'stage  1 [add tainted lines]')
     new_segments = []
     for s in segments:
         new_segments += s.PossiblySplitSegment()
     segments = new_segments
-    AccumulateSegmentStats(segments, 'stage  2 [split segments]')
+    stats.AccumulateSegmentStats(segments, 'stage  2 [split segments]')
     for s in segments:
         s.PossiblyTruncateBoundaries()
-    AccumulateSegmentStats(segments, 'stage  3 [truncate boundaries]')
+    stats.AccumulateSegmentStats(segments, 'stage  3 [truncate boundaries]')
     for s in segments:
         s.RelaxBoundaryTruncation()
-    AccumulateSegmentStats(segments, 'stage  4 [relax boundary truncation]')
+    stats.AccumulateSegmentStats(segments, 'stage  4 [relax boundary truncation]')
     for s in segments:
         s.PossiblyAddUnkPadding()
-    AccumulateSegmentStats(segments, 'stage  5 [unk-padding]')
+    stats.AccumulateSegmentStats(segments, 'stage  5 [unk-padding]')
 
     deleted_segments = []
     new_segments = []
@@ -719,7 +830,7 @@ def GetSegmentsForUtterance(split_lines_of_utt):
         else:
             new_segments.append(s)
     segments = new_segments
-    AccumulateSegmentStats(segments, 'stage  6 [remove new segments under --min-new-segment-length')
+    stats.AccumulateSegmentStats(segments, 'stage  6 [remove new segments under --min-new-segment-length')
 
     new_segments = []
     for s in segments:
@@ -730,15 +841,15 @@ def GetSegmentsForUtterance(split_lines_of_utt):
         else:
             new_segments.append(s)
     segments = new_segments
-    AccumulateSegmentStats(segments, 'stage  7 [remove segments under --min-segment-length')
+    stats.AccumulateSegmentStats(segments, 'stage  7 [remove segments under --min-segment-length')
 
     for s in segments:
         s.PossiblyTruncateStartForJunkProportion()
-    AccumulateSegmentStats(segments, 'stage  8 [truncate segment-starts for --max-junk-proportion')
+    stats.AccumulateSegmentStats(segments, 'stage  8 [truncate segment-starts for --max-junk-proportion')
 
     for s in segments:
         s.PossiblyTruncateEndForJunkProportion()
-    AccumulateSegmentStats(segments, 'stage  9 [truncate segment-ends for --max-junk-proportion')
+    stats.AccumulateSegmentStats(segments, 'stage  9 [truncate segment-ends for --max-junk-proportion')
 
     new_segments = []
     for s in segments:
@@ -749,7 +860,7 @@ def GetSegmentsForUtterance(split_lines_of_utt):
             deleted_segments.append(s)
 
     segments = new_segments
-    AccumulateSegmentStats(segments, 'stage 10 [remove segments without scored,non-OOV words]')
+    stats.AccumulateSegmentStats(segments, 'stage 10 [remove segments without scored,non-OOV words]')
 
     new_segments = []
     for s in segments:
@@ -761,7 +872,7 @@ def GetSegmentsForUtterance(split_lines_of_utt):
             deleted_segments.append(s)
 
     segments = new_segments
-    AccumulateSegmentStats(segments, 'stage 11 [remove segments with junk exceeding --max-junk-proportion]')
+    stats.AccumulateSegmentStats(segments, 'stage 11 [remove segments with junk exceeding --max-junk-proportion]')
 
     new_segments = []
     if len(segments) > 0:
@@ -772,7 +883,7 @@ def GetSegmentsForUtterance(split_lines_of_utt):
             else:
                 new_segments.append(segments[i])
     segments = new_segments
-    AccumulateSegmentStats(segments, 'stage 12 [merge overlapping or touching segments]')
+    stats.AccumulateSegmentStats(segments, 'stage 12 [merge overlapping or touching segments]')
 
     for i in range(len(segments) - 1):
         if segments[i].EndTime() > segments[i+1].StartTime():
@@ -780,7 +891,7 @@ def GetSegmentsForUtterance(split_lines_of_utt):
             segments[i+1].debug_str += ",overlaps-previous-segment"
 
     if len(segments) == 0:
-        num_utterances_without_segments += 1
+        stats.num_utterances_without_segments += 1
 
     return (segments, deleted_segments)
 
@@ -832,9 +943,9 @@ def WriteSegmentsForUtterance(text_output_handle, segments_output_handle,
 
 
 
-# Note, this is destrutive of 'segments_for_utterance', but it won't matter.
+# Note: 'lines' is of type CtmEditsLines; it is not modified.
 def PrintDebugInfoForUtterance(ctm_edits_out_handle,
-                               split_lines_of_cur_utterance,
+                               lines,
                                segments_for_utterance,
                                deleted_segments_for_utterance):
     # info_to_print will be list of 2-tuples (time, 'start-segment-n'|'end-segment-n')
@@ -857,72 +968,100 @@ def PrintDebugInfoForUtterance(ctm_edits_out_handle,
 
     info_to_print = sorted(info_to_print)
 
-    for i in range(len(split_lines_of_cur_utterance)):
-        split_line=split_lines_of_cur_utterance[i]
-        split_line[0] += '[{}]'.format(i)    # add an index like [0], [1], to
-                                             # the utterance-id so we can easily
-                                             # look up segment indexes.
-        start_time = float(split_line[2])
-        end_time = start_time + float(split_line[3])
-        split_line_copy = list(split_line)
-        while len(info_to_print) > 0 and info_to_print[0][0] <= end_time:
-            (segment_start, string) = info_to_print[0]
-            # shift the first element off of info_to_print.
-            info_to_print = info_to_print[1:]
+    next_info = 0
+    for i in range(len(lines)):
+        split_line_copy = lines.OutputFields(i)
+        split_line_copy[0] += '[{}]'.format(i)   # add an index like [0], [1], to
+                                                 # the utterance-id so we can easily
+                                                 # look up segment indexes.
+        end_time = lines.end_times[i]
+        while next_info < len(info_to_print) and info_to_print[next_info][0] <= end_time:
+            (segment_start, string) = info_to_print[next_info]
+            next_info += 1
             # add a field like 'start-segment1[...]=3.21' to what we're about to print.
             split_line_copy.append(string + "=" + TimeToString(segment_start, args.frame_length))
         print(' '.join(split_line_copy), file = ctm_edits_out_handle)
 
-# This accumulates word-level stats about, for each reference word, with what
-# probability it will end up in the core of a segment.  Words with low
-# probabilities of being in segments will generally be associated with some kind
-# of error (there is a higher probability of having a wrong lexicon entry).
-def AccWordStatsForUtterance(split_lines_of_utt,
-                             segments_for_utterance):
-    # word_count_pair is a map from a string (the word) to
-    # a list [total-count, count-not-within-segments]
-    global word_count_pair
-    line_is_in_segment = [ False ] * len(split_lines_of_utt)
-    for segment in segments_for_utterance:
-        for i in range(segment.start_index, segment.end_index):
-            line_is_in_segment[i] = True
-    for i in range(len(split_lines_of_utt)):
-        this_ref_word = split_lines_of_utt[i][6]
-        if this_ref_word != '<eps>':
-            word_count_pair[this_ref_word][0] += 1
-            if not line_is_in_segment[i]:
-                word_count_pair[this_ref_word][1] += 1
-
-def PrintWordStats(word_stats_out):
-    try:
-        f = open(word_stats_out, 'w', encoding='utf-8')
-    except:
-        sys.exit("segment_ctm_edits.py: error opening word-stats file --word-stats-out={0} "
-                 "for writing".format(word_stats_out))
-    global word_count_pair
-    # Sort from most to least problematic.  We want to give more prominence to
-    # words that are most frequently not in segments, but also to high-count
-    # words.  Define badness = pair[1] / pair[0], and total_count = pair[0],
-    # where 'pair' is a value of word_count_pair.  We'll reverse sort on
-    # badness^3 * total_count = pair[1]^3 / pair[0]^2.
-    for key, pair in sorted(word_count_pair.items(),
-                      key = lambda item: (item[1][1] ** 3) * 1.0 / (item[1][0] ** 2),
-                      reverse = True):
-        badness = pair[1] * 1.0 / pair[0]
-        total_count = pair[0]
-        print(key, badness, total_count, file = f)
-    try:
-        f.close()
-    except:
-        sys.exit("segment_ctm_edits.py: error closing file --word-stats-out={0} "
-                 "(full disk?)".format(word_stats_out))
-    print("segment_ctm_edits.py: please see the file {0} for word-level statistics "
-          "saying how frequently each word was excluded for a segment; format is "
-          "<word> <proportion-of-time-excluded> <total-count>.  Particularly "
-          "problematic words appear near the top of the file.".format(word_stats_out),
-          file = sys.stderr)
-
+# This generator reads the ctm-edits input and yields a 2-tuple
+# (utterance-id, split-lines-of-utterance) for each utterance, where the split
+# lines are a list of lists, one per line, each containing the sequence of
+# fields.  The lines of an utterance must be contiguous in the input.
+def ReadUtterances(f_in):
+    first_line = f_in.readline()
+    if first_line == '':
+        sys.exit("segment_ctm_edits.py: empty input")
+    split_pending_line = first_line.split()
+    if len(split_pending_line) == 0:
+        sys.exit("segment_ctm_edits.py: bad input line " + first_line)
+    cur_utterance = split_pending_line[0]
+    split_lines_of_cur_utterance = [ split_pending_line ]
+    for line in f_in:
+        split_line = line.split()
+        if len(split_line) == 0:
+            sys.exit("segment_ctm_edits.py: got an empty or whitespace input line")
+        if split_line[0] != cur_utterance:
+            yield (cur_utterance, split_lines_of_cur_utterance)
+            cur_utterance = split_line[0]
+            split_lines_of_cur_utterance = []
+        split_lines_of_cur_utterance.append(split_line)
+    yield (cur_utterance, split_lines_of_cur_utterance)
 
+# This generator groups the items of 'iterable' into lists of up to
+# 'batch_size' items.
+def Batches(iterable, batch_size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+def InitWorker(worker_args):
+    global args, non_scored_words, oov_symbol
+    (args, non_scored_words, oov_symbol) = worker_args
+
+# This function segments a batch of utterances, as yielded by Batches(), and
+# returns a 4-tuple (text-output, segments-output, ctm-edits-output, stats),
+# where the outputs are strings with the lines for the batch (ctm-edits-output
+# is empty if --ctm-edits-out was not given) and stats is a SegmentationStats
+# object for the batch.
+def ProcessUtterances(utterances):
+    text_output_handle = io.StringIO()
+    segments_output_handle = io.StringIO()
+    ctm_edits_output_handle = io.StringIO()
+    stats = SegmentationStats()
+    for utterance, split_lines_of_utt in utterances:
+        lines = CtmEditsLines(split_lines_of_utt)
+        (segments_for_utterance,
+         deleted_segments_for_utterance) = GetSegmentsForUtterance(lines, stats)
+        stats.AccWordStatsForUtterance(lines, segments_for_utterance)
+        WriteSegmentsForUtterance(text_output_handle, segments_output_handle,
+                                  utterance, segments_for_utterance)
+        if args.ctm_edits_out != None:
+            PrintDebugInfoForUtterance(ctm_edits_output_handle,
+                                       lines,
+                                       segments_for_utterance,
+                                       deleted_segments_for_utterance)
+    return (text_output_handle.getvalue(), segments_output_handle.getvalue(),
+            ctm_edits_output_handle.getvalue(), stats)
+
+# This is like pool.imap(function, tasks), but it only reads as many tasks as
+# it needs to keep 'max_pending' of them in the pool, so the input is read
+# while the results are being written instead of all at once.  The results are
+# yielded in the order of the tasks.
+def ImapBounded(pool, function, tasks, max_pending):
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(function, (task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+# This function reads the ctm-edits input, segments the utterances (in
+# --num-jobs processes, each given --batch-size utterances at a time) and
+# writes the outputs in the order of the input.  It returns the
+# SegmentationStats summed over all the utterances.
 def ProcessData():
     try:
         f_in = open(args.ctm_edits_in, encoding='utf-8')
@@ -946,42 +1085,28 @@ def ProcessData():
             sys.exit("segment_ctm_edits.py: error opening ctm-edits output "
                      "file {0}".format(args.ctm_edits_out))
 
-    # Most of what we're doing in the lines below is splitting the input lines
-    # and grouping them per utterance, before giving them to ProcessUtterance()
-    # and then printing the modified lines.
-    first_line = f_in.readline()
-    if first_line == '':
-        sys.exit("segment_ctm_edits.py: empty input")
-    split_pending_line = first_line.split()
-    if len(split_pending_line) == 0:
-        sys.exit("segment_ctm_edits.py: bad input line " + first_line)
-    cur_utterance = split_pending_line[0]
-    split_lines_of_cur_utterance = []
+    tasks = Batches(ReadUtterances(f_in), args.batch_size)
+    if args.num_jobs > 1:
+        pool = multiprocessing.Pool(args.num_jobs, InitWorker,
+                                    ((args, non_scored_words, oov_symbol),))
+        results = ImapBounded(pool, ProcessUtterances, tasks, 2 * args.num_jobs)
+    else:
+        pool = None
+        results = (ProcessUtterances(task) for task in tasks)
 
-    while True:
-        if len(split_pending_line) == 0 or split_pending_line[0] != cur_utterance:
-            (segments_for_utterance,
-             deleted_segments_for_utterance) = GetSegmentsForUtterance(split_lines_of_cur_utterance)
-            AccWordStatsForUtterance(split_lines_of_cur_utterance, segments_for_utterance)
-            WriteSegmentsForUtterance(text_output_handle, segments_output_handle,
-                                      cur_utterance, segments_for_utterance)
+    stats = SegmentationStats()
+    try:
+        for (text, segments, ctm_edits, batch_stats) in results:
+            text_output_handle.write(text)
+            segments_output_handle.write(segments)
             if args.ctm_edits_out != None:
-                PrintDebugInfoForUtterance(ctm_edits_output_handle,
-                                           split_lines_of_cur_utterance,
-                                           segments_for_utterance,
-                                           deleted_segments_for_utterance)
-            split_lines_of_cur_utterance = []
-            if len(split_pending_line) == 0:
-                break
-            else:
-                cur_utterance = split_pending_line[0]
-
-        split_lines_of_cur_utterance.append(split_pending_line)
-        next_line = f_in.readline()
-        split_pending_line = next_line.split()
-        if len(split_pending_line) == 0:
-            if next_line != '':
-                sys.exit("segment_ctm_edits.py: got an empty or whitespace input line")
+                ctm_edits_output_handle.write(ctm_edits)
+            stats.Add(batch_stats)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    f_in.close()
     try:
         text_output_handle.close()
         segments_output_handle.close()
@@ -990,10 +1115,11 @@ def ProcessData():
     except:
         sys.exit("segment_ctm_edits.py: error closing one or more outputs "
                  "(broken pipe or full disk?)")
+    return stats
 
 
 def ReadNonScoredWords(non_scored_words_file):
-    global non_scored_words
+    non_scored_words = set()
     try:
         f = open(non_scored_words_file, encoding='utf-8')
     except:
@@ -1006,45 +1132,39 @@ def ReadNonScoredWords(non_scored_words_file):
                      "file {0}: {1}".format(non_scored_words_file, line))
         non_scored_words.add(a[0])
     f.close()
+    return non_scored_words
 
 
+# The code below only runs when this is the main program, and not in the
+# worker processes (which get args, non_scored_words and oov_symbol from
+# InitWorker()).
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.num_jobs < 1 or args.batch_size < 1:
+        sys.exit("segment_ctm_edits.py: --num-jobs and --batch-size must be "
+                 "at least 1.")
 
+    non_scored_words = ReadNonScoredWords(args.non_scored_words_in)
 
-non_scored_words = set()
-ReadNonScoredWords(args.non_scored_words_in)
-
-oov_symbol = None
-if args.oov_symbol_file != None:
-    try:
-        with open(args.oov_symbol_file, encoding='utf-8') as f:
-            line = f.readline()
-            assert len(line.split()) == 1
-            oov_symbol = line.split()[0]
-            assert f.readline() == ''
-    except Exception as e:
-        sys.exit("segment_ctm_edits.py: error reading file --oov-symbol-file=" +
-                 args.oov_symbol_file + ", error is: " + str(e))
-elif args.unk_padding != 0.0:
-    sys.exit("segment_ctm_edits.py: if the --unk-padding option is nonzero (which "
-             "it is by default, the --oov-symbol-file option must be supplied.")
-
-# segment_total_length and num_segments are maps from
-# 'stage' strings; see AccumulateSegmentStats for details.
-segment_total_length = defaultdict(int)
-num_segments = defaultdict(int)
-# the lambda expression below is an anonymous function that takes no arguments
-# and returns the new list [0, 0].
-word_count_pair = defaultdict(lambda: [0, 0])
-num_utterances = 0
-num_utterances_without_segments = 0
-total_length_of_utterances = 0
-
-
-ProcessData()
-PrintSegmentStats()
-if args.word_stats_out != None:
-    PrintWordStats(args.word_stats_out)
-if args.ctm_edits_out != None:
-    print("segment_ctm_edits.py: detailed utterance-level debug information "
-          "is in " + args.ctm_edits_out, file = sys.stderr)
-
+    oov_symbol = None
+    if args.oov_symbol_file != None:
+        try:
+            with open(args.oov_symbol_file, encoding='utf-8') as f:
+                line = f.readline()
+                assert len(line.split()) == 1
+                oov_symbol = line.split()[0]
+                assert f.readline() == ''
+        except Exception as e:
+            sys.exit("segment_ctm_edits.py: error reading file --oov-symbol-file=" +
+                     args.oov_symbol_file + ", error is: " + str(e))
+    elif args.unk_padding != 0.0:
+        sys.exit("segment_ctm_edits.py: if the --unk-padding option is nonzero (which "
+                 "it is by default, the --oov-symbol-file option must be supplied.")
+
+    stats = ProcessData()
+    stats.PrintSegmentStats()
+    if args.word_stats_out != None:
+        stats.PrintWordStats(args.word_stats_out)
+    if args.ctm_edits_out != None:
+        print("segment_ctm_edits.py: detailed utterance-level debug information "
+              "is in " + args.ctm_edits_out, file = sys.stderr)
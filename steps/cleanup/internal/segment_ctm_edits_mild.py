@@ -8,10 +8,15 @@ from __future__ import print_function
 from __future__ import division
 import argparse
 import copy
+import io
+import itertools
 import logging
 import heapq
+import multiprocessing
+import operator
 import sys
-from collections import defaultdict
+from array import array
+from collections import defaultdict, deque
 
 """
 This script reads 'ctm-edits' file format that is produced by align_ctm_ref.py
@@ -206,6 +211,13 @@ def get_args():
                         does not make it into a segment.  It can help reveal
                         words that have problematic pronunciations or are
                         associated with transcription errors.""")
+    parser.add_argument("--num-jobs", type=int, default=1,
+                        help="""Number of processes segmenting utterances in
+                        parallel. The outputs are written in the order of
+                        the input.""")
+    parser.add_argument("--batch-size", type=int, default=100,
+                        help="Number of utterances given to a process at a "
+                        "time")
 
     parser.add_argument("non_scored_words_in",
                         metavar="<non-scored-words-file>",
@@ -235,6 +247,9 @@ def get_args():
 
     args = parser.parse_args()
 
+    if args.num_jobs < 1 or args.batch_size < 1:
+        raise ValueError("--num-jobs and --batch-size must be at least 1")
+
     if args.verbose > 2:
         _global_handler.setLevel(logging.DEBUG)
         _global_logger.setLevel(logging.DEBUG)
@@ -247,14 +262,52 @@ def is_tainted(split_line_of_utt):
     return len(split_line_of_utt) > 8 and split_line_of_utt[8] == 'tainted'
 
 
-def compute_segment_cores(split_lines_of_utt):
+class CtmEditsLines(object):
+    """The ctm-edits lines of one utterance.
+
+    The split lines are kept as they were read (they are only needed for the
+    --ctm-edits-out output and for debugging), and the fields that the
+    segmentation looks at are converted once and stored column-wise: the start
+    times, durations and end times as arrays of doubles, the hyp-words,
+    ref-words and edit types as tuples and the 'tainted' flags as bytes.
+    All the Segment objects of an utterance refer to the same CtmEditsLines
+    object and only store a range of line indexes.
+    """
+
+    def __init__(self, split_lines_of_utt):
+        self.split_lines = split_lines_of_utt
+        # all lines have at least the 8 fields up to the edit type.
+        columns = list(zip(*split_lines_of_utt))
+        self.start_times = array('d', map(float, columns[2]))
+        self.durations = array('d', map(float, columns[3]))
+        self.end_times = array('d', map(operator.add, self.start_times,
+                                        self.durations))
+        self.hyp_words = columns[4]
+        self.ref_words = columns[6]
+        self.edits = columns[7]
+        self.tainted = bytearray([is_tainted(x) for x in split_lines_of_utt])
+        # the number of times each line was marked 'do-not-include-in-text'
+        # by Segment.merge_with_segment().
+        self.excluded = bytearray(len(split_lines_of_utt))
+
+    def __len__(self):
+        return len(self.split_lines)
+
+    def output_fields(self, i):
+        """Returns the fields of line i for the --ctm-edits-out output,
+        including any 'do-not-include-in-text' marks."""
+        return (self.split_lines[i]
+                + ['do-not-include-in-text'] * self.excluded[i])
+
+
+def compute_segment_cores(lines):
     """
     This function returns a list of pairs (start-index, end-index) representing
     the cores of segments (so if a pair is (s, e), then the core of a segment
     would span (s, s+1, ... e-1).
 
-    The argument 'split_lines_of_utt' is list of lines from a ctm-edits file
-    corresponding to a single utterance.
+    The argument 'lines' is the CtmEditsLines object with the lines from a
+    ctm-edits file corresponding to a single utterance.
 
     By the 'core of a segment', we mean a sequence of ctm-edits lines including
     at least one 'cor' line and a contiguous sequence of other lines of the
@@ -268,19 +321,18 @@ def compute_segment_cores(split_lines_of_utt):
     in the resulting boolean array will then become the cores of prototype
     segments, and we'll add any adjacent tainted words (or parts of them).
     """
-    num_lines = len(split_lines_of_utt)
-    line_is_in_segment_core = [False] * num_lines
+    num_lines = len(lines)
+    edits = lines.edits
     # include only the correct lines
-    for i in range(num_lines):
-        if (split_lines_of_utt[i][7] == 'cor'
-                and split_lines_of_utt[i][4] == split_lines_of_utt[i][6]):
-            line_is_in_segment_core[i] = True
+    line_is_in_segment_core = [
+        edits[i] == 'cor' and lines.hyp_words[i] == lines.ref_words[i]
+        for i in range(num_lines)]
 
     # extend each proto-segment forwards as far as we can:
     for i in range(1, num_lines):
         if line_is_in_segment_core[i - 1] and not line_is_in_segment_core[i]:
-            edit_type = split_lines_of_utt[i][7]
-            if (not is_tainted(split_lines_of_utt[i])
+            edit_type = edits[i]
+            if (not lines.tainted[i]
                     and (edit_type == 'cor' or edit_type == 'sil'
                          or edit_type == 'fix')):
                 line_is_in_segment_core[i] = True
@@ -288,8 +340,8 @@ def compute_segment_cores(split_lines_of_utt):
     # extend each proto-segment backwards as far as we can:
     for i in reversed(range(0, num_lines - 1)):
         if line_is_in_segment_core[i + 1] and not line_is_in_segment_core[i]:
-            edit_type = split_lines_of_utt[i][7]
-            if (not is_tainted(split_lines_of_utt[i])
+            edit_type = edits[i]
+            if (not lines.tainted[i]
                     and (edit_type == 'cor' or edit_type == 'sil'
                          or edit_type == 'fix')):
                 line_is_in_segment_core[i] = True
@@ -410,10 +462,12 @@ class SegmentStats(object):
 class Segment(object):
     """Class to store segments."""
 
-    def __init__(self, split_lines_of_utt, start_index, end_index,
+    def __init__(self, lines, start_index, end_index,
                  debug_str=None, compute_segment_stats=False,
                  segment_stats=None):
-        self.split_lines_of_utt = split_lines_of_utt
+        # 'lines' is the CtmEditsLines object of the utterance; it is shared
+        # by all the segments of the utterance.
+        self.lines = lines
 
         # start_index is the index of the first line that appears in this
         # segment, and end_index is one past the last line.  This does not
@@ -456,7 +510,7 @@ class Segment(object):
             self.stats = segment_stats
 
     def copy(self, copy_stats=True):
-        segment = Segment(self.split_lines_of_utt, self.start_index,
+        segment = Segment(self.lines, self.start_index,
                           self.end_index, debug_str=self.debug_str,
                           segment_stats=(None if not copy_stats
                                          else copy.deepcopy(self.stats)))
@@ -475,8 +529,9 @@ class Segment(object):
         This is typically called just before merging segments.
         """
         self.stats = SegmentStats()
+        lines = self.lines
         for i in range(self.start_index, self.end_index):
-            this_duration = float(self.split_lines_of_utt[i][3])
+            this_duration = lines.durations[i]
             assert self.start_keep_proportion == 1.0
             assert self.end_keep_proportion == 1.0
             # TODO(vimal): Decide if keep proportion must be applied
@@ -489,25 +544,23 @@ class Segment(object):
                 assert self.start_keep_proportion == self.end_keep_proportion
 
             try:
-                if self.split_lines_of_utt[i][7] not in ['cor', 'fix', 'sil']:
+                if lines.edits[i] not in ['cor', 'fix', 'sil']:
                     # TODO(vimal): The commented part below is is apparently
                     # not true in modify_ctm_edits.py.
                     # Need to check this or change comments there.
-                    # assert (self.split_lines_of_utt[i][6]
+                    # assert (lines.ref_words[i]
                     #         not in non_scored_words)
-                    assert not is_tainted(self.split_lines_of_utt[i])
+                    assert not lines.tainted[i]
                     self.stats.num_incorrect_words += 1
                     self.stats.incorrect_words_length += this_duration
-                if self.split_lines_of_utt[i][7] == 'sil':
+                if lines.edits[i] == 'sil':
                     self.stats.silence_length += this_duration
                 else:
-                    if (self.split_lines_of_utt[i][6]
-                            not in non_scored_words()):
+                    if lines.ref_words[i] not in non_scored_words():
                         self.stats.num_words += 1
-                if (is_tainted(self.split_lines_of_utt[i])
-                        and self.split_lines_of_utt[i][7] not in 'sil'
-                        and (self.split_lines_of_utt[i][6]
-                             not in non_scored_words())):
+                if (lines.tainted[i]
+                        and lines.edits[i] not in 'sil'
+                        and lines.ref_words[i] not in non_scored_words()):
                     # If ref_word is not a non-scored word, this would be
                     # counted as an incorrect word.
                     self.stats.num_tainted_words += 1
@@ -515,7 +568,7 @@ class Segment(object):
             except Exception:
                 _global_logger.error(
                     "Something went wrong when computing stats at "
-                    "ctm line %s", self.split_lines_of_utt[i])
+                    "ctm line %s", lines.split_lines[i])
                 raise
         self.stats.total_length = self.length()
 
@@ -541,7 +594,7 @@ class Segment(object):
         that we probably don't want to start or end the segment right at the
         boundary of a real word, we want to add some kind of padding.
         """
-        split_lines_of_utt = self.split_lines_of_utt
+        lines = self.lines
         # we're iterating over the segment (start, end)
         for b in [False, True]:
             if b:
@@ -551,18 +604,17 @@ class Segment(object):
                 boundary_index = self.start_index
                 adjacent_index = self.start_index - 1
             if (adjacent_index >= 0
-                    and adjacent_index < len(split_lines_of_utt)):
+                    and adjacent_index < len(lines)):
                 # only consider merging the adjacent word into the segment if
                 # we're not at the boundary of the utterance.
-                adjacent_line_is_tainted = is_tainted(
-                    split_lines_of_utt[adjacent_index])
+                adjacent_line_is_tainted = lines.tainted[adjacent_index]
                 # if the adjacent line wasn't tainted, then there must have
                 # been another stronger reason why we didn't include it in the
                 # core of the segment (probably that it was an ins, del or
                 # sub), so there is no point considering it.
                 if adjacent_line_is_tainted:
-                    boundary_edit_type = split_lines_of_utt[boundary_index][7]
-                    boundary_ref_word = split_lines_of_utt[boundary_index][6]
+                    boundary_edit_type = lines.edits[boundary_index]
+                    boundary_ref_word = lines.ref_words[boundary_index]
                     # Even if the edit_type is 'cor', it is possible that
                     # column 4 (hyp_word) is not the same as column 6
                     # (ref_word) because the ref_word is an OOV and the
@@ -605,12 +657,12 @@ class Segment(object):
         cur_start_is_split = False
         # only consider splitting at non-boundary lines.  [we'd just truncate
         # the boundary lines.]
+        lines = self.lines
         for index_to_split_at in range(cur_start_index + 1,
                                        self.end_index - 1):
-            this_split_line = self.split_lines_of_utt[index_to_split_at]
-            this_duration = float(this_split_line[3])
-            this_edit_type = this_split_line[7]
-            this_ref_word = this_split_line[6]
+            this_duration = lines.durations[index_to_split_at]
+            this_edit_type = lines.edits[index_to_split_at]
+            this_ref_word = lines.ref_words[index_to_split_at]
             if ((this_edit_type == 'sil' and
                  this_duration > max_internal_silence_length)
                     or (this_ref_word in non_scored_words()
@@ -622,7 +674,7 @@ class Segment(object):
                 # Note: we use 'index_to_split_at + 1' because the Segment
                 # constructor takes an 'end-index' which is interpreted as one
                 # past the end.
-                new_segment = Segment(self.split_lines_of_utt, cur_start_index,
+                new_segment = Segment(lines, cur_start_index,
                                       index_to_split_at + 1,
                                       debug_str=self.debug_str)
                 if cur_start_is_split:
@@ -635,7 +687,7 @@ class Segment(object):
             segments.append(self)
         else:
             # We did split.  Add the very last segment.
-            new_segment = Segment(self.split_lines_of_utt, cur_start_index,
+            new_segment = Segment(lines, cur_start_index,
                                   self.end_index,
                                   debug_str=self.debug_str)
             assert cur_start_is_split
@@ -672,13 +724,13 @@ class Segment(object):
         split_indexes = []
         # only consider splitting at non-boundary lines.  [we'd just truncate
         # the boundary lines.]
+        lines = self.lines
         for index_to_split_at in range(cur_start_index + 1,
                                        self.end_index - 1):
-            this_split_line = self.split_lines_of_utt[index_to_split_at]
-            this_duration = float(this_split_line[3])
-            this_edit_type = this_split_line[7]
-            this_ref_word = this_split_line[6]
-            this_is_tainted = is_tainted(this_split_line)
+            this_duration = lines.durations[index_to_split_at]
+            this_edit_type = lines.edits[index_to_split_at]
+            this_ref_word = lines.ref_words[index_to_split_at]
+            this_is_tainted = bool(lines.tainted[index_to_split_at])
             if (this_edit_type == 'sil'
                     and this_duration > min_silence_length_to_split):
                 split_indexes.append((index_to_split_at, this_duration,
@@ -722,13 +774,13 @@ class Segment(object):
                 # constructor takes an 'end-index' which is interpreted as one
                 # past the end.
                 new_segment = Segment(
-                    self.split_lines_of_utt, segment.start_index,
+                    lines, segment.start_index,
                     index_to_split_at + 1, debug_str=self.debug_str)
                 new_segment.end_keep_proportion = 0.5
                 new_segments.append(new_segment)
 
                 new_segment = Segment(
-                    self.split_lines_of_utt, index_to_split_at,
+                    lines, index_to_split_at,
                     segment.end_index, debug_str=self.debug_str)
                 new_segment.start_keep_proportion = 0.5
                 new_segments.append(new_segment)
@@ -756,17 +808,16 @@ class Segment(object):
                 while True:
                     index_to_split_at = next(
                         (i for i in range(cur_start_index, segment.end_index)
-                         if (float(self.split_lines_of_utt[i][2])
+                         if (lines.start_times[i]
                              >= cur_start + max_segment_length)))
 
                     new_segment = Segment(
-                        self.split_lines_of_utt, cur_start_index,
+                        lines, cur_start_index,
                         index_to_split_at)
                     new_segments.append(new_segment)
 
                     cur_start_index = index_to_split_at
-                    cur_start = float(
-                        self.split_lines_of_utt[cur_start_index][2])
+                    cur_start = lines.start_times[cur_start_index]
                     index_to_split_at = None
 
                     if (segment.end_time() - cur_start
@@ -779,7 +830,7 @@ class Segment(object):
                         "start time > %.2f", cur_start_index,
                         segment.end_index, cur_start + max_segment_length)
                 new_segment = Segment(
-                    self.split_lines_of_utt, cur_start_index,
+                    lines, cur_start_index,
                     segment.end_index)
                 new_segments.append(new_segment)
                 break
@@ -805,11 +856,10 @@ class Segment(object):
                 this_index = self.start_index
             else:
                 this_index = self.end_index - 1
-            this_split_line = self.split_lines_of_utt[this_index]
             truncated_duration = None
-            this_duration = float(this_split_line[3])
-            this_edit = this_split_line[7]
-            this_ref_word = this_split_line[6]
+            this_duration = self.lines.durations[this_index]
+            this_edit = self.lines.edits[this_index]
+            this_ref_word = self.lines.ref_words[this_index]
             if (this_edit == 'sil'
                     and this_duration > max_edge_silence_length):
                 truncated_duration = max_edge_silence_length
@@ -845,9 +895,9 @@ class Segment(object):
             return  # Nothing to do.
         orig_start_keep_proportion = self.start_keep_proportion
         orig_end_keep_proportion = self.end_keep_proportion
-        if not is_tainted(self.split_lines_of_utt[self.start_index]):
+        if not self.lines.tainted[self.start_index]:
             self.start_keep_proportion = 1.0
-        if not is_tainted(self.split_lines_of_utt[self.end_index - 1]):
+        if not self.lines.tainted[self.end_index - 1]:
             self.end_keep_proportion = 1.0
         length_with_relaxed_boundaries = self.length()
         if length_with_relaxed_boundaries <= length_cutoff:
@@ -899,10 +949,9 @@ class Segment(object):
                 this_index = self.start_index
             else:
                 this_index = self.end_index - 1
-            this_split_line = self.split_lines_of_utt[this_index]
-            this_start_time = float(this_split_line[2])
-            this_ref_word = this_split_line[6]
-            this_edit = this_split_line[7]
+            this_start_time = self.lines.start_times[this_index]
+            this_ref_word = self.lines.ref_words[this_index]
+            this_edit = self.lines.edits[this_index]
             if this_edit == 'cor' and this_ref_word not in non_scored_words():
                 # we can consider adding unk-padding.
                 if b:   # start of utterance.
@@ -919,10 +968,8 @@ class Segment(object):
                         unk_padding = 0.0
                     self.start_unk_padding = unk_padding
                 else:   # end of utterance.
-                    this_end_time = this_start_time + float(this_split_line[3])
-                    last_line = self.split_lines_of_utt[-1]
-                    utterance_end_time = (float(last_line[2])
-                                          + float(last_line[3]))
+                    this_end_time = self.lines.end_times[this_index]
+                    utterance_end_time = self.lines.end_times[-1]
                     max_allowable_padding = utterance_end_time - this_end_time
                     assert max_allowable_padding > -0.01
                     unk_padding = max_unk_padding
@@ -942,13 +989,11 @@ class Segment(object):
         utterance).
         This is before any rounding.
         """
-        if self.start_index == len(self.split_lines_of_utt):
-            assert self.end_index == len(self.split_lines_of_utt)
+        if self.start_index == len(self.lines):
+            assert self.end_index == len(self.lines)
             return self.end_time()
-        first_line = self.split_lines_of_utt[self.start_index]
-        first_line_start = float(first_line[2])
-        first_line_duration = float(first_line[3])
-        first_line_end = first_line_start + first_line_duration
+        first_line_duration = self.lines.durations[self.start_index]
+        first_line_end = self.lines.end_times[self.start_index]
         return (first_line_end - self.start_unk_padding
                 - (first_line_duration * self.start_keep_proportion))
 
@@ -981,9 +1026,8 @@ class Segment(object):
         if self.end_index == 0:
             assert self.start_index == 0
             return self.start_time()
-        last_line = self.split_lines_of_utt[self.end_index - 1]
-        last_line_start = float(last_line[2])
-        last_line_duration = float(last_line[3])
+        last_line_start = self.lines.start_times[self.end_index - 1]
+        last_line_duration = self.lines.durations[self.end_index - 1]
         return (last_line_start
                 + (last_line_duration * self.end_keep_proportion)
                 + self.end_unk_padding)
@@ -996,9 +1040,7 @@ class Segment(object):
         """returns true if this segment corresponds to the whole utterance that
         it's a part of (i.e. its start/end time are zero and the end-time of
         the last segment."""
-        last_line_of_utt = self.split_lines_of_utt[-1]
-        last_line_end_time = (float(last_line_of_utt[2])
-                              + float(last_line_of_utt[3]))
+        last_line_end_time = self.lines.end_times[-1]
         return (abs(self.start_time() - 0.0) < 0.001
                 and abs(self.end_time() - last_line_end_time) < 0.001)
 
@@ -1011,13 +1053,11 @@ class Segment(object):
         # the utterance must contain other lines, so double-counting is not a
         # problem.
         junk_duration = self.start_unk_padding + self.end_unk_padding
-        first_split_line = self.split_lines_of_utt[self.start_index]
-        if is_tainted(first_split_line):
-            first_duration = float(first_split_line[3])
+        if self.lines.tainted[self.start_index]:
+            first_duration = self.lines.durations[self.start_index]
             junk_duration += first_duration * self.start_keep_proportion
-        last_split_line = self.split_lines_of_utt[self.end_index - 1]
-        if is_tainted(last_split_line):
-            last_duration = float(last_split_line[3])
+        if self.lines.tainted[self.end_index - 1]:
+            last_duration = self.lines.durations[self.end_index - 1]
             junk_duration += last_duration * self.end_keep_proportion
         return junk_duration / self.length()
 
@@ -1037,7 +1077,7 @@ class Segment(object):
         try:
             assert self.end_index <= other.start_index + 1
             assert self.start_time() < other.end_time()
-            assert self.split_lines_of_utt is other.split_lines_of_utt
+            assert self.lines is other.lines
         except AssertionError:
             _global_logger.error("self: %s", self)
             _global_logger.error("other: %s", other)
@@ -1052,7 +1092,7 @@ class Segment(object):
 
         if self.end_index == other.start_index + 1:
             overlapping_segment = Segment(
-                self.split_lines_of_utt, other.start_index,
+                self.lines, other.start_index,
                 self.end_index, compute_segment_stats=True)
             self.stats.combine(overlapping_segment.stats, scale=-1)
 
@@ -1088,7 +1128,7 @@ class Segment(object):
         try:
             assert self.end_time() >= other.start_time()
             assert self.start_time() < other.end_time()
-            assert self.split_lines_of_utt is other.split_lines_of_utt
+            assert self.lines is other.lines
         except AssertionError:
             _global_logger.error("self: %s", self)
             _global_logger.error("other: %s", other)
@@ -1132,31 +1172,31 @@ class Segment(object):
                 first_index_of_overlap = orig_self_end_index
                 last_index_of_overlap = other.start_index - 1
                 segment = Segment(
-                    self.split_lines_of_utt, orig_self_end_index,
+                    self.lines, orig_self_end_index,
                     other.start_index, compute_segment_stats=True)
                 self.stats.combine(segment.stats)
             else:
                 first_index_of_overlap = other.start_index
                 last_index_of_overlap = orig_self_end_index - 1
 
+            edits = self.lines.edits
             num_deleted_words = 0
             for i in range(first_index_of_overlap, last_index_of_overlap + 1):
-                edit_type = self.split_lines_of_utt[i][7]
+                edit_type = edits[i]
                 if edit_type == 'del':
                     num_deleted_words += 1
             if num_deleted_words > max_deleted_words:
                 for i in range(first_index_of_overlap,
                                last_index_of_overlap + 1):
-                    if self.split_lines_of_utt[i][7] == 'del':
-                        self.split_lines_of_utt[i].append(
-                            'do-not-include-in-text')
+                    if edits[i] == 'del':
+                        self.lines.excluded[i] += 1
         except:
             _global_logger.error(
                 "first-index-of-overlap = %d", first_index_of_overlap)
             _global_logger.error(
                 "last-index-of-overlap = %d", last_index_of_overlap)
             _global_logger.error("line = %d = %s", i,
-                                 self.split_lines_of_utt[i])
+                                 self.lines.output_fields(i))
             raise
         _global_logger.debug("After merging %s", self)
 
@@ -1166,11 +1206,11 @@ class Segment(object):
         that's a scored word (not a non-scored word) and not an OOV word that's
         realized as unk.  This becomes a filter on keeping segments.
         """
+        lines = self.lines
         for i in range(self.start_index, self.end_index):
-            this_split_line = self.split_lines_of_utt[i]
-            this_hyp_word = this_split_line[4]
-            this_ref_word = this_split_line[6]
-            this_edit = this_split_line[7]
+            this_hyp_word = lines.hyp_words[i]
+            this_ref_word = lines.ref_words[i]
+            this_edit = lines.edits[i]
             if (this_edit == 'cor' and this_ref_word not in non_scored_words()
                     and this_ref_word == this_hyp_word):
                 return True
@@ -1181,11 +1221,11 @@ class Segment(object):
         text_array = []
         if self.start_unk_padding != 0.0:
             text_array.append(oov_symbol)
+        ref_words = self.lines.ref_words
+        excluded = self.lines.excluded
         for i in range(self.start_index, self.end_index):
-            this_split_line = self.split_lines_of_utt[i]
-            this_ref_word = this_split_line[6]
-            if (this_ref_word != eps_symbol
-                    and this_split_line[-1] != 'do-not-include-in-text'):
+            this_ref_word = ref_words[i]
+            if this_ref_word != eps_symbol and not excluded[i]:
                 text_array.append(this_ref_word)
         if self.end_unk_padding != 0.0:
             text_array.append(oov_symbol)
@@ -1203,14 +1243,14 @@ class SegmentsMerger(object):
                           as the newly created segments
         between_segments - stores the inter-segment "segments"
                            for the initial segments
-        split_lines_of_utt - a reference to the CTM lines
+        lines - a reference to the CtmEditsLines of the utterance
     """
 
     def __init__(self, segments):
         self.segments = segments
 
         try:
-            self.split_lines_of_utt = segments[0].split_lines_of_utt
+            self.lines = segments[0].lines
         except IndexError as e:
             _global_logger.error("No input segments found!")
             raise e
@@ -1220,7 +1260,7 @@ class SegmentsMerger(object):
 
         if segments[0].start_index > 0:
             self.between_segments[0] = Segment(
-                self.split_lines_of_utt, 0, segments[0].start_index,
+                self.lines, 0, segments[0].start_index,
                 compute_segment_stats=True)
 
         for i, x in enumerate(segments):
@@ -1229,13 +1269,13 @@ class SegmentsMerger(object):
 
             if i > 0 and segments[i].start_index > segments[i - 1].end_index:
                 self.between_segments[i] = Segment(
-                    self.split_lines_of_utt, segments[i - 1].end_index,
+                    self.lines, segments[i - 1].end_index,
                     segments[i].start_index, compute_segment_stats=True)
 
-        if segments[-1].end_index < len(self.split_lines_of_utt):
+        if segments[-1].end_index < len(self.lines):
             self.between_segments[-1] = Segment(
-                self.split_lines_of_utt, segments[-1].end_index,
-                len(self.split_lines_of_utt), compute_segment_stats=True)
+                self.lines, segments[-1].end_index,
+                len(self.lines), compute_segment_stats=True)
 
     def _get_merged_cluster(self, cluster1, cluster2, rejected_clusters=None,
                             max_intersegment_incorrect_words_length=1):
@@ -1499,24 +1539,22 @@ def merge_segments(segments, args):
     return segments
 
 
-def get_segments_for_utterance(split_lines_of_utt, args, utterance_stats):
+def get_segments_for_utterance(lines, args, utterance_stats):
     """
     This function creates the segments for an utterance as a list
     of class Segment.
     It returns a 2-tuple (list-of-segments, list-of-deleted-segments)
     where the deleted segments are only useful for diagnostic printing.
-    Note: split_lines_of_utt is a list of lists, one per line, each containing
-    the sequence of fields.
+    Note: 'lines' is the CtmEditsLines object of the utterance.
     """
     utterance_stats.num_utterances += 1
 
-    segment_ranges = compute_segment_cores(split_lines_of_utt)
+    segment_ranges = compute_segment_cores(lines)
 
-    utterance_end_time = (float(split_lines_of_utt[-1][2])
-                          + float(split_lines_of_utt[-1][3]))
+    utterance_end_time = lines.end_times[-1]
     utterance_stats.total_length_of_utterances += utterance_end_time
 
-    segments = [Segment(split_lines_of_utt, x[0], x[1])
+    segments = [Segment(lines, x[0], x[1])
                 for x in segment_ranges]
 
     utterance_stats.accumulate_segment_stats(
@@ -1529,7 +1567,7 @@ def get_segments_for_utterance(split_lines_of_utt, args, utterance_stats):
         print("Stage 0 [segment cores]:", file=sys.stderr)
         segments_copy = [x.copy() for x in segments]
         print_debug_info_for_utterance(sys.stderr,
-                                       copy.deepcopy(split_lines_of_utt),
+                                       lines,
                                        segments_copy, [])
 
     for segment in segments:
@@ -1544,7 +1582,7 @@ def get_segments_for_utterance(split_lines_of_utt, args, utterance_stats):
         print("Stage 1 [add tainted lines]:", file=sys.stderr)
         segments_copy = [x.copy() for x in segments]
         print_debug_info_for_utterance(sys.stderr,
-                                       copy.deepcopy(split_lines_of_utt),
+                                       lines,
                                        segments_copy, [])
 
     segments = merge_segments(segments, args)
@@ -1558,7 +1596,7 @@ def get_segments_for_utterance(split_lines_of_utt, args, utterance_stats):
         print("Stage 2 [merge segments]:", file=sys.stderr)
         segments_copy = [x.copy() for x in segments]
         print_debug_info_for_utterance(sys.stderr,
-                                       copy.deepcopy(split_lines_of_utt),
+                                       lines,
                                        segments_copy, [])
 
     new_segments = []
@@ -1578,7 +1616,7 @@ def get_segments_for_utterance(split_lines_of_utt, args, utterance_stats):
         print("Stage 3 [split segments]:", file=sys.stderr)
         segments_copy = [x.copy() for x in segments]
         print_debug_info_for_utterance(sys.stderr,
-                                       copy.deepcopy(split_lines_of_utt),
+                                       lines,
                                        segments_copy, [])
 
     new_segments = []
@@ -1600,7 +1638,7 @@ def get_segments_for_utterance(split_lines_of_utt, args, utterance_stats):
         print("Stage 4 [split long segments]:", file=sys.stderr)
         segments_copy = [x.copy() for x in segments]
         print_debug_info_for_utterance(sys.stderr,
-                                       copy.deepcopy(split_lines_of_utt),
+                                       lines,
                                        segments_copy, [])
 
     for s in segments:
@@ -1617,7 +1655,7 @@ def get_segments_for_utterance(split_lines_of_utt, args, utterance_stats):
         print("Stage 5 [truncate boundaries]:", file=sys.stderr)
         segments_copy = [x.copy() for x in segments]
         print_debug_info_for_utterance(sys.stderr,
-                                       copy.deepcopy(split_lines_of_utt),
+                                       lines,
                                        segments_copy, [])
 
     for s in segments:
@@ -1634,7 +1672,7 @@ def get_segments_for_utterance(split_lines_of_utt, args, utterance_stats):
         print("Stage 6 [relax boundary truncation]:", file=sys.stderr)
         segments_copy = [x.copy() for x in segments]
         print_debug_info_for_utterance(sys.stderr,
-                                       copy.deepcopy(split_lines_of_utt),
+                                       lines,
                                        segments_copy, [])
 
     for s in segments:
@@ -1650,7 +1688,7 @@ def get_segments_for_utterance(split_lines_of_utt, args, utterance_stats):
         print("Stage 7 [unk-padding]:", file=sys.stderr)
         segments_copy = [x.copy() for x in segments]
         print_debug_info_for_utterance(sys.stderr,
-                                       copy.deepcopy(split_lines_of_utt),
+                                       lines,
                                        segments_copy, [])
 
     deleted_segments = []
@@ -1677,7 +1715,7 @@ def get_segments_for_utterance(split_lines_of_utt, args, utterance_stats):
               "--min-new-segment-length]:", file=sys.stderr)
         segments_copy = [x.copy() for x in segments]
         print_debug_info_for_utterance(sys.stderr,
-                                       copy.deepcopy(split_lines_of_utt),
+                                       lines,
                                        segments_copy, [])
 
     new_segments = []
@@ -1701,7 +1739,7 @@ def get_segments_for_utterance(split_lines_of_utt, args, utterance_stats):
               "--min-segment-length]:", file=sys.stderr)
         segments_copy = [x.copy() for x in segments]
         print_debug_info_for_utterance(sys.stderr,
-                                       copy.deepcopy(split_lines_of_utt),
+                                       lines,
                                        segments_copy, [])
 
     new_segments = []
@@ -1724,7 +1762,7 @@ def get_segments_for_utterance(split_lines_of_utt, args, utterance_stats):
               "", file=sys.stderr)
         segments_copy = [x.copy() for x in segments]
         print_debug_info_for_utterance(sys.stderr,
-                                       copy.deepcopy(split_lines_of_utt),
+                                       lines,
                                        segments_copy, [])
 
     for i in range(len(segments) - 1):
@@ -1790,9 +1828,8 @@ def write_segments_for_utterance(text_output_handle, segments_output_handle,
               file=segments_output_handle)
 
 
-# Note, this is destrutive of 'segments_for_utterance', but it won't matter.
 def print_debug_info_for_utterance(ctm_edits_out_handle,
-                                   split_lines_of_cur_utterance,
+                                   lines,
                                    segments_for_utterance,
                                    deleted_segments_for_utterance,
                                    frame_length=0.01):
@@ -1818,17 +1855,17 @@ def print_debug_info_for_utterance(ctm_edits_out_handle,
 
     info_to_print = sorted(info_to_print)
 
-    for i, split_line in enumerate(split_lines_of_cur_utterance):
+    next_info = 0
+    for i in range(len(lines)):
+        split_line_copy = lines.output_fields(i)
         # add an index like [0], [1], to the utterance-id so we can easily look
         # up segment indexes.
-        split_line[0] += '[{0}]'.format(i)
-        start_time = float(split_line[2])
-        end_time = start_time + float(split_line[3])
-        split_line_copy = list(split_line)
-        while len(info_to_print) > 0 and info_to_print[0][0] <= end_time:
-            (segment_start, string) = info_to_print[0]
-            # shift the first element off of info_to_print.
-            info_to_print = info_to_print[1:]
+        split_line_copy[0] += '[{0}]'.format(i)
+        end_time = lines.end_times[i]
+        while (next_info < len(info_to_print)
+               and info_to_print[next_info][0] <= end_time):
+            (segment_start, string) = info_to_print[next_info]
+            next_info += 1
             # add a field like 'start-segment1[...]=3.21' to what we're about
             # to print.
             split_line_copy.append(
@@ -1846,23 +1883,30 @@ class WordStats(object):
     wrong lexicon entry).
     """
     def __init__(self):
-        self.word_count_pair = defaultdict(lambda: [0, 0])
-
-    def accumulate_for_utterance(self, split_lines_of_utt,
-                                 segments_for_utterance,
-                                 eps_symbol="<eps>"):
         # word_count_pair is a map from a string (the word) to
         # a list [total-count, count-not-within-segments]
-        line_is_in_segment = [False] * len(split_lines_of_utt)
+        self.word_count_pair = {}
+
+    def accumulate_for_utterance(self, lines, segments_for_utterance,
+                                 eps_symbol="<eps>"):
+        line_is_in_segment = [False] * len(lines)
         for segment in segments_for_utterance:
             for i in range(segment.start_index, segment.end_index):
                 line_is_in_segment[i] = True
-        for i, split_line in enumerate(split_lines_of_utt):
-            this_ref_word = split_line[6]
+        for this_ref_word, in_segment in zip(lines.ref_words,
+                                             line_is_in_segment):
             if this_ref_word != eps_symbol:
-                self.word_count_pair[this_ref_word][0] += 1
-                if not line_is_in_segment[i]:
-                    self.word_count_pair[this_ref_word][1] += 1
+                pair = self.word_count_pair.setdefault(this_ref_word, [0, 0])
+                pair[0] += 1
+                if not in_segment:
+                    pair[1] += 1
+
+    def add(self, other):
+        """Adds the counts in another WordStats object to this one."""
+        for word, other_pair in other.word_count_pair.items():
+            pair = self.word_count_pair.setdefault(word, [0, 0])
+            pair[0] += other_pair[0]
+            pair[1] += other_pair[1]
 
     def print(self, word_stats_out):
         # Sort from most to least problematic.  We want to give more prominence
@@ -1893,59 +1937,140 @@ class WordStats(object):
             of the file.""", word_stats_out.name)
 
 
-def process_data(args, oov_symbol, utterance_stats, word_stats):
+def read_utterances(ctm_edits_in):
     """
-    Most of what we're doing in the lines below is splitting the input lines
-    and grouping them per utterance, before giving them to
-    get_segments_for_utterance() and then printing the modified lines.
+    This generator reads the ctm-edits input and yields a tuple
+    (utterance-id, split-lines-of-utterance) for each utterance, where the
+    split lines are a list of lists, one per line, each containing the
+    sequence of fields.  The lines of an utterance must be contiguous in the
+    input.
     """
-    first_line = args.ctm_edits_in.readline()
+    first_line = ctm_edits_in.readline()
     if first_line == '':
         sys.exit("segment_ctm_edits.py: empty input")
     split_pending_line = first_line.split()
     if len(split_pending_line) == 0:
         sys.exit("segment_ctm_edits.py: bad input line " + first_line)
     cur_utterance = split_pending_line[0]
-    split_lines_of_cur_utterance = []
-
+    split_lines_of_cur_utterance = [split_pending_line]
+    for line in ctm_edits_in:
+        split_line = line.split()
+        if len(split_line) == 0:
+            sys.exit("segment_ctm_edits.py: got an "
+                     "empty or whitespace input line")
+        if split_line[0] != cur_utterance:
+            yield (cur_utterance, split_lines_of_cur_utterance)
+            cur_utterance = split_line[0]
+            split_lines_of_cur_utterance = []
+        split_lines_of_cur_utterance.append(split_line)
+    yield (cur_utterance, split_lines_of_cur_utterance)
+
+
+def batches(iterable, batch_size):
+    iterator = iter(iterable)
     while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def imap_bounded(pool, function, tasks, max_pending):
+    """Like pool.imap(function, tasks), but only reads as many tasks as are
+    needed to keep 'max_pending' of them in the pool, so that the input is
+    read while the results are being written instead of all at once.
+    The results are yielded in the order of the tasks."""
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(function, (task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _init_worker(worker_args):
+    global _global_non_scored_words, _worker_args
+    _global_non_scored_words = worker_args[0]
+    _worker_args = worker_args[1:]
+
+
+def _segment_task(utterances):
+    """Segments a batch of (utterance-id, split-lines) tuples and returns the
+    text, segments and ctm-edits output for the batch as strings, together
+    with the UtteranceStats and WordStats of the batch."""
+    args, oov_symbol, write_ctm_edits = _worker_args
+
+    text_out = io.StringIO()
+    segments_out = io.StringIO()
+    ctm_edits_out = io.StringIO()
+    utterance_stats = UtteranceStats()
+    word_stats = WordStats()
+    for utterance, split_lines_of_utt in utterances:
         try:
-            if (len(split_pending_line) == 0
-                    or split_pending_line[0] != cur_utterance):
-                # Read one whole utterance. Now process it.
-                (segments_for_utterance,
-                 deleted_segments_for_utterance) = get_segments_for_utterance(
-                     split_lines_of_cur_utterance, args=args,
-                     utterance_stats=utterance_stats)
-                word_stats.accumulate_for_utterance(
-                    split_lines_of_cur_utterance, segments_for_utterance)
-                write_segments_for_utterance(
-                    args.text_out, args.segments_out, cur_utterance,
-                    segments_for_utterance, oov_symbol=oov_symbol,
+            lines = CtmEditsLines(split_lines_of_utt)
+            (segments_for_utterance,
+             deleted_segments_for_utterance) = get_segments_for_utterance(
+                 lines, args=args, utterance_stats=utterance_stats)
+            word_stats.accumulate_for_utterance(
+                lines, segments_for_utterance)
+            write_segments_for_utterance(
+                text_out, segments_out, utterance,
+                segments_for_utterance, oov_symbol=oov_symbol,
+                frame_length=args.frame_length)
+            if write_ctm_edits:
+                print_debug_info_for_utterance(
+                    ctm_edits_out, lines,
+                    segments_for_utterance, deleted_segments_for_utterance,
                     frame_length=args.frame_length)
-                if args.ctm_edits_out is not None:
-                    print_debug_info_for_utterance(
-                        args.ctm_edits_out, split_lines_of_cur_utterance,
-                        segments_for_utterance, deleted_segments_for_utterance,
-                        frame_length=args.frame_length)
-
-                split_lines_of_cur_utterance = []
-                if len(split_pending_line) == 0:
-                    break
-                else:
-                    cur_utterance = split_pending_line[0]
-
-            split_lines_of_cur_utterance.append(split_pending_line)
-            next_line = args.ctm_edits_in.readline()
-            split_pending_line = next_line.split()
-            if len(split_pending_line) == 0:
-                if next_line != '':
-                    sys.exit("segment_ctm_edits.py: got an "
-                             "empty or whitespace input line")
         except Exception:
             _global_logger.error(
-                "Error with utterance %s", cur_utterance)
+                "Error with utterance %s", utterance)
             raise
+    return (text_out.getvalue(), segments_out.getvalue(),
+            ctm_edits_out.getvalue(), utterance_stats, word_stats)
+
+
+def process_data(args, oov_symbol, utterance_stats, word_stats):
+    """
+    Most of what we're doing in the lines below is splitting the input lines
+    and grouping them per utterance (see read_utterances()), before giving
+    them, --batch-size utterances at a time, to --num-jobs processes that run
+    get_segments_for_utterance() on them.  The modified lines are printed in
+    the order of the input, and the stats of the batches are added to
+    'utterance_stats' and 'word_stats'.
+    """
+    # Only the options (not the open files) are given to the workers.
+    options = argparse.Namespace(**dict(
+        (key, value) for key, value in vars(args).items()
+        if not hasattr(value, 'close')))
+    worker_args = (non_scored_words(), options, oov_symbol,
+                   args.ctm_edits_out is not None)
+
+    tasks = batches(read_utterances(args.ctm_edits_in), args.batch_size)
+    if args.num_jobs > 1:
+        pool = multiprocessing.Pool(args.num_jobs, _init_worker,
+                                    (worker_args,))
+        results = imap_bounded(pool, _segment_task, tasks,
+                               2 * args.num_jobs)
+    else:
+        pool = None
+        _init_worker(worker_args)
+        results = (_segment_task(task) for task in tasks)
+
+    try:
+        for (text, segments, ctm_edits,
+             batch_utterance_stats, batch_word_stats) in results:
+            args.text_out.write(text)
+            args.segments_out.write(segments)
+            if args.ctm_edits_out is not None:
+                args.ctm_edits_out.write(ctm_edits)
+            utterance_stats.add(batch_utterance_stats)
+            word_stats.add(batch_word_stats)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
 
 def read_non_scored_words(non_scored_words_file):
@@ -1972,6 +2097,17 @@ class UtteranceStats(object):
         self.num_utterances_without_segments = 0
         self.total_length_of_utterances = 0
 
+    def add(self, other):
+        """Adds the stats in another UtteranceStats object to this one."""
+        for key, value in other.segment_total_length.items():
+            self.segment_total_length[key] += value
+        for key, value in other.num_segments.items():
+            self.num_segments[key] += value
+        self.num_utterances += other.num_utterances
+        self.num_utterances_without_segments += (
+            other.num_utterances_without_segments)
+        self.total_length_of_utterances += other.total_length_of_utterances
+
     def accumulate_segment_stats(self, segment_list, text):
         """
         Here, 'text' will be something that indicates the stage of processing,
@@ -3,6 +3,21 @@
 
 """This module contains structures to accumulate, store and use stats
 for Term-frequency and Inverse-document-frequency values.
+
+Terms (n-grams, as tuples of words) and documents are mapped to integer ids
+by a Vocabulary. The TF-IDF values are stored as sparse arrays of
+(term-id, document-id, value) entries, from which a CSR index by term (an
+inverted index) is built when needed, so that the similarity scores of a
+query are computed with a single sparse product.
+
+TFIDF objects can be written in text format
+    <TFIDF>
+    <ngram-order> <term-1> ... <term-n> <document-id> <tf-idf>
+    ...
+    </TFIDF>
+or in a compact binary format, which is detected automatically when reading:
+    \\0B<TFIDF> <header> <terms> <documents> <term-ids> <doc-ids> <values>
+    </TFIDF>
 """
 
 from __future__ import print_function
@@ -10,21 +25,69 @@ from __future__ import division
 import logging
 import math
 import re
+import struct
 import sys
 
+import numpy as np
+
 sys.path.insert(0, 'steps')
 
 logger = logging.getLogger('__name__')
 logger.addHandler(logging.NullHandler())
 
+# Number of terms, number of documents, number of entries and the sizes in
+# bytes of the terms and the documents:
+_BINARY_HEADER = struct.Struct('<iiiqq')
+
+
+class Vocabulary(object):
+    """Maps items (terms or document-ids) to consecutive integer ids, in the
+    order in which they are first seen."""
+
+    def __init__(self, items=None):
+        self.ids = {}
+        self.items = []
+        if items is not None:
+            for item in items:
+                self.index(item)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.ids
+
+    def index(self, item):
+        """Returns the id of the item, adding it if it is new."""
+        item_id = self.ids.get(item)
+        if item_id is None:
+            item_id = len(self.items)
+            self.ids[item] = item_id
+            self.items.append(item)
+        return item_id
+
+    def get(self, item, default=-1):
+        return self.ids.get(item, default)
+
+    def lookup(self, items):
+        """Returns an array with the ids of the items (-1 for the ones that
+        are not in the vocabulary)."""
+        return np.array([self.ids.get(item, -1) for item in items],
+                        dtype=np.int64)
+
 
 class IDFStats(object):
     """Stores stats for computing inverse-document-frequencies.
     """
     def __init__(self):
-        self.num_docs_for_term = {}
+        self.vocab = Vocabulary()
+        self.counts = []    # Number of docs for each term-id
         self.num_docs = 0
 
+    @property
+    def num_docs_for_term(self):
+        return dict(zip(self.vocab.items, self.counts))
+
     def get_inverse_document_frequency(self, term, weighting_scheme="log"):
         """Get IDF for a term.
 
@@ -39,8 +102,9 @@ class IDFStats(object):
         log-smoothed : idf(t,D) = log(1 + N / n(t))
         probabilistic: idf(t,D) = log((N - n(t)) / n(t))
         """
-        n_t = float(self.num_docs_for_term.get(term, 0))
-        num_terms = len(self.num_docs_for_term)
+        term_id = self.vocab.get(term)
+        n_t = float(self.counts[term_id] if term_id >= 0 else 0)
+        num_terms = len(self.vocab)
 
         if num_terms == 0:
             raise RuntimeError("No IDF stats have been accumulated.")
@@ -51,13 +115,18 @@ class IDFStats(object):
             return math.log(float(self.num_docs) / (1.0 + n_t))
         if weighting_scheme == "log-smoothed":
             return math.log(1.0 + float(self.num_docs) / (1.0 + n_t))
-        if weighting_scheme == "probabilitic":
+        if weighting_scheme == "probabilistic":
             return math.log((self.num_docs - n_t - 1) / (1.0 + n_t))
+        raise KeyError("Unknown idf-weighting-scheme {0}".format(
+            weighting_scheme))
 
     def accumulate(self, term):
         """Adds one count to the number of docs containing the term "term".
         """
-        self.num_docs_for_term[term] = self.num_docs_for_term.get(term, 0) + 1
+        term_id = self.vocab.index(term)
+        if term_id == len(self.counts):
+            self.counts.append(0)
+        self.counts[term_id] += 1
         if len(term) == 1:
             self.num_docs += 1
 
@@ -66,7 +135,7 @@ class IDFStats(object):
         <term-1> <term-2> ... <term-N> <num-docs>
         for n-gram (<term-1>, ... <term-N>)
         """
-        for term, num in self.num_docs_for_term.items():
+        for term, num in zip(self.vocab.items, self.counts):
             if num == 0:
                 continue
             assert isinstance(term, tuple)
@@ -78,21 +147,54 @@ class IDFStats(object):
         for line in file_handle:
             parts = line.strip().split()
             term = tuple(parts[0:-1])
-            self.num_docs_for_term[term] = float(parts[-1])
+            term_id = self.vocab.index(term)
+            if term_id == len(self.counts):
+                self.counts.append(0)
+            self.counts[term_id] = float(parts[-1])
             if len(term) == 1:
                 self.num_docs += 1
 
-        if len(self.num_docs_for_term) == 0:
+        if len(self.vocab) == 0:
             raise RuntimeError("Read no IDF stats.")
 
 
 class TFStats(object):
     """Store stats for TF-IDF computation.
-    A separate object of IDFStats is stored within this object.
+    The raw counts are stored per document, indexed by term-id.
     """
     def __init__(self):
-        self.raw_counts = {}
-        self.max_counts_for_term = {}
+        self.vocab = Vocabulary()
+        self.docs = Vocabulary()
+        self.raw_counts = []    # For each doc-id, {term-id: count}
+        self.max_counts_for_term = []   # Indexed by term-id
+
+    def __len__(self):
+        """Returns the number of (term, doc) pairs."""
+        return sum(len(counts) for counts in self.raw_counts)
+
+    def _counts_for_doc(self, doc):
+        doc_id = self.docs.index(doc)
+        if doc_id == len(self.raw_counts):
+            self.raw_counts.append({})
+        return self.raw_counts[doc_id]
+
+    def _raw_count(self, term, doc):
+        term_id = self.vocab.get(term)
+        doc_id = self.docs.get(doc)
+        if term_id < 0 or doc_id < 0:
+            return None
+        return self.raw_counts[doc_id].get(term_id)
+
+    def _max_count(self, term_id):
+        if term_id < len(self.max_counts_for_term):
+            return self.max_counts_for_term[term_id]
+        return 0
+
+    def _update_max_count(self, term_id, counts):
+        while len(self.max_counts_for_term) <= term_id:
+            self.max_counts_for_term.append(0)
+        if counts > self.max_counts_for_term[term_id]:
+            self.max_counts_for_term[term_id] = counts
 
     def get_term_frequency(self, term, doc, weighting_scheme="raw",
                            normalization_factor=0.5):
@@ -105,55 +207,66 @@ class TFStats(object):
         log    : tf(t,d) = 1 + log(f(t,d))
         normalized : tf(t,d) = K + (1-K) * f(t,d) / max{f(t',d): t' in d}
         """
+        counts = self._raw_count(term, doc)
+        term_id = self.vocab.get(term)
+        return self._term_frequency(counts, term_id, weighting_scheme,
+                                    normalization_factor)
+
+    def _term_frequency(self, counts, term_id, weighting_scheme,
+                        normalization_factor):
         if weighting_scheme == "binary":
-            return 1 if (term, doc) in self.raw_counts else 0
+            return 1 if counts is not None else 0
         if weighting_scheme == "raw":
-            return self.raw_counts.get((term, doc), 0)
+            return counts if counts is not None else 0
         if weighting_scheme == "log":
-            if (term, doc) in self.raw_counts:
-                return 1 + math.log(self.raw_counts[(term, doc)])
+            if counts is not None:
+                return 1 + math.log(counts)
             return 0
         if weighting_scheme == "normalized":
             return (normalization_factor
                     + (1 - normalization_factor)
-                    * self.raw_counts.get((term, doc), 0)
-                    / (1.0 + self.max_counts_for_term.get(term, 0)))
+                    * (counts if counts is not None else 0)
+                    / (1.0 + self._max_count(term_id)))
         raise KeyError("Unknown tf-weighting-scheme {0}".format(
             weighting_scheme))
 
+    def entries(self):
+        """Generates (term-id, doc-id, counts) for all the (term, doc) pairs.
+        """
+        for doc_id, counts in enumerate(self.raw_counts):
+            for term_id, count in counts.items():
+                yield term_id, doc_id, count
+
     def accumulate(self, doc, text, ngram_order):
         """Accumulate raw stats from a document for upto the specified
         ngram-order."""
+        raw_counts = self._counts_for_doc(doc)
         for n in range(1, ngram_order + 1):
             for i in range(len(text)):
-                term = tuple(text[i:(i+n)])
-                self.raw_counts.setdefault((term, doc), 0)
-                self.raw_counts[(term, doc)] += 1
+                term_id = self.vocab.index(tuple(text[i:(i+n)]))
+                raw_counts[term_id] = raw_counts.get(term_id, 0) + 1
 
     def compute_term_stats(self, idf_stats=None):
         """Compute the maximum counts for each term over all the documents
         based on the stored raw counts."""
-        if len(self.raw_counts) == 0:
+        if len(self) == 0:
             raise RuntimeError("No (term, doc) found in tf-stats.")
-        for tup, counts in self.raw_counts.items():
-            term = tup[0]
-
-            if counts > self.max_counts_for_term.get(term, 0):
-                self.max_counts_for_term[term] = counts
+        for term_id, _, counts in self.entries():
+            self._update_max_count(term_id, counts)
 
             if idf_stats is not None:
-                idf_stats.accumulate(term)
+                idf_stats.accumulate(self.vocab.items[term_id])
 
     def __str__(self):
         """Returns a string with all the stats in the following format:
         <n-gram order> <term-1> <term-2> ... <term-n> <document-id> <counts>
         """
         lines = []
-        for tup, counts in self.raw_counts.items():
-            term, doc = tup
+        for term_id, doc_id, counts in self.entries():
+            term = self.vocab.items[term_id]
             lines.append("{order} {term} {doc} {counts}".format(
                 order=len(term), term=" ".join(term),
-                doc=doc, counts=counts))
+                doc=self.docs.items[doc_id], counts=counts))
         return "\n".join(lines)
 
     def read(self, file_handle, ngram_order=None, idf_stats=None):
@@ -164,7 +277,7 @@ class TFStats(object):
         """
         for line in file_handle:
             parts = line.strip().split()
-            order = parts[0]
+            order = int(parts[0])
             assert len(parts) - 3 == order
             if ngram_order is not None and order > ngram_order:
                 continue
@@ -172,111 +285,250 @@ class TFStats(object):
             doc = parts[-2]
             counts = float(parts[-1])
 
-            self.raw_counts[(term, doc)] = counts
-
-            if counts > self.max_counts_for_term.get(term, 0):
-                self.max_counts_for_term[term] = counts
+            term_id = self.vocab.index(term)
+            self._counts_for_doc(doc)[term_id] = counts
+            self._update_max_count(term_id, counts)
 
             if idf_stats is not None:
                 idf_stats.accumulate(term)
 
-        if len(self.raw_counts) == 0:
+        if len(self) == 0:
             raise RuntimeError("Read no TF stats.")
 
+    def get_tfidf_values(self, idf_stats, tf_weighting_scheme="raw",
+                         idf_weighting_scheme="log",
+                         tf_normalization_factor=0.5):
+        """Returns the lists of term-ids, doc-ids and TF-IDF values of all the
+        (term, doc) pairs. The IDF is computed only once per term."""
+        idf_values = {}
+        term_ids, doc_ids, values = [], [], []
+        for term_id, doc_id, counts in self.entries():
+            idf_value = idf_values.get(term_id)
+            if idf_value is None:
+                idf_value = idf_stats.get_inverse_document_frequency(
+                    self.vocab.items[term_id],
+                    weighting_scheme=idf_weighting_scheme)
+                idf_values[term_id] = idf_value
+            tf_value = self._term_frequency(
+                counts, term_id, tf_weighting_scheme, tf_normalization_factor)
+
+            term_ids.append(term_id)
+            doc_ids.append(doc_id)
+            values.append(tf_value * idf_value)
+        return term_ids, doc_ids, values
+
 
 class TFIDF(object):
     """Class to store TF-IDF values for term-document pairs.
 
     Parameters:
-        tf_idf - A dictionary of TF-IDF values indexed by (term, document)
-                 tuple as key
+        terms - Vocabulary of the terms
+        docs - Vocabulary of the document-ids
+        term_ids, doc_ids, values - Arrays with the TF-IDF value of every
+                                    (term, document) pair
     """
 
-    def __init__(self):
-        self.tf_idf = {}
+    def __init__(self, terms=None, docs=None, term_ids=None, doc_ids=None,
+                 values=None):
+        self.terms = terms if terms is not None else Vocabulary()
+        self.docs = docs if docs is not None else Vocabulary()
+        self.term_ids = np.asarray(
+            term_ids if term_ids is not None else [], dtype=np.int64)
+        self.doc_ids = np.asarray(
+            doc_ids if doc_ids is not None else [], dtype=np.int64)
+        self.values = np.asarray(
+            values if values is not None else [], dtype=np.float64)
+        self._term_index = None
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def tf_idf(self):
+        """A dictionary of TF-IDF values indexed by (term, document)."""
+        return dict(zip(
+            zip([self.terms.items[i] for i in self.term_ids.tolist()],
+                [self.docs.items[i] for i in self.doc_ids.tolist()]),
+            self.values.tolist()))
+
+    def term_index(self):
+        """Returns the CSR index by term (indptr, doc_ids, values): the
+        entries of the term with id t are at indptr[t]:indptr[t+1], in the
+        order in which they were stored."""
+        if self._term_index is None:
+            order = np.argsort(self.term_ids, kind='stable')
+            indptr = np.zeros(len(self.terms) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self.term_ids, minlength=len(self.terms)),
+                      out=indptr[1:])
+            self._term_index = (indptr, self.doc_ids[order],
+                                self.values[order])
+        return self._term_index
 
     def get_value(self, term, doc):
         """Returns TF-IDF value for (term, doc) tuple if it exists.
-        Otherwise returns 0.
+        Otherwise raises KeyError.
         """
-        return self.tf_idf[(term, doc)]
-
-    def compute_similarity_scores(self, source_tfidf, source_docs=None,
+        term_id = self.terms.get(term)
+        doc_id = self.docs.get(doc)
+        if term_id >= 0 and doc_id >= 0:
+            indptr, doc_ids, values = self.term_index()
+            found = np.flatnonzero(
+                doc_ids[indptr[term_id]:indptr[term_id + 1]] == doc_id)
+            if len(found) > 0:
+                return float(values[indptr[term_id] + found[0]])
+        raise KeyError((term, doc))
+
+    def _check_query_id(self, query_id):
+        if query_id is None:
+            return
+        for doc in self.docs.items:
+            if doc != query_id:
+                raise RuntimeError(
+                    "TF-IDF contains document {0}, which is "
+                    "not the required query {1}. \n"
+                    "Something wrong in how this TF-IDF object "
+                    "was created or a bug in the "
+                    "calling script.".format(doc, query_id))
+
+    def compute_candidate_scores(self, source_tfidf, query_id=None):
+        """Computes TF-IDF similarity score between the query documents
+        contained in this object and only the source documents in the
+        source_tfidf object that share at least one term with them (the
+        candidates), found with the term index of source_tfidf. The
+        similarity with any other source document is 0.
+
+        The scores are the sums of the products of the TF-IDF values of the
+        common terms, added in the order of the query terms.
+
+        Returns arrays (query_doc_ids, source_doc_ids, scores) with the ids
+        (in this object and in source_tfidf) of the candidate pairs and
+        their scores.
+        """
+        self._check_query_id(query_id)
+
+        # Source term-id of every query term
+        query_terms = source_tfidf.terms.lookup(self.terms.items)
+        indptr, src_doc_ids, src_values = source_tfidf.term_index()
+        src_term_ids = query_terms[self.term_ids]
+        present = src_term_ids >= 0
+        entries = np.flatnonzero(present)
+        src_term_ids = src_term_ids[present]
+
+        # Expand every query entry to the source entries of its term.
+        starts = indptr[src_term_ids]
+        lengths = indptr[src_term_ids + 1] - starts
+        query_entries = np.repeat(entries, lengths)
+        positions = (np.arange(lengths.sum())
+                     - np.repeat(np.cumsum(lengths) - lengths, lengths)
+                     + np.repeat(starts, lengths))
+
+        num_sources = max(len(source_tfidf.docs), 1)
+        candidates, inverse = np.unique(
+            self.doc_ids[query_entries] * num_sources
+            + src_doc_ids[positions], return_inverse=True)
+        scores = np.bincount(
+            inverse.ravel(),
+            weights=src_values[positions] * self.values[query_entries],
+            minlength=len(candidates))
+
+        return candidates // num_sources, candidates % num_sources, scores
+
+    def compute_similarity_matrix(self, source_tfidf, source_docs=None,
                                   do_length_normalization=False,
                                   query_id=None):
-        """Computes TF-IDF similarity score between each pair of query
-        document contained in this object and the source documents
-        in the source_tfidf object.
+        """Computes TF-IDF similarity score between each query document
+        contained in this object and the source documents in the
+        source_tfidf object, as the product of the sparse matrices
+        query x terms and terms x source (see compute_candidate_scores()).
 
         Arguments:
             source_docs - If provided, the similarity scores are computed
                           for only the source documents contained in
-                          source_docs.
-            use_average - If True, then the similarity scores is
-                          normalized by the length of query. This is usually
-                          not required when the scores are only utilized
-                          for ranking the source documents.
+                          source_docs (and in this order). Otherwise, for
+                          all the documents in source_tfidf.
+            do_length_normalization - If True, then the similarity scores
+                          are normalized by the length of query.
             query_id - If provided, check that this tf_idf object
                        contains values only for document with id 'query_id'
 
-        Returns a dictionary
-            { (query_document_id, source_document_id): similarity_score }
+        Returns (query_docs, source_docs, scores), where scores is a matrix
+        of size len(query_docs) x len(source_docs).
         """
-        num_terms_per_doc = {}
-        similarity_scores = {}
+        query_doc_ids, src_doc_ids, candidate_scores = (
+            self.compute_candidate_scores(source_tfidf, query_id=query_id))
+
+        # Column of each document of source_tfidf (-1 if it is not searched)
+        if source_docs is None:
+            source_docs = source_tfidf.docs.items
+            columns = np.arange(len(source_docs))
+        else:
+            columns = np.full(len(source_tfidf.docs), -1, dtype=np.int64)
+            source_doc_ids = source_tfidf.docs.lookup(source_docs)
+            known = source_doc_ids >= 0
+            columns[source_doc_ids[known]] = np.flatnonzero(known)
+        num_queries = len(self.docs)
 
-        for tup, value in self.tf_idf.items():
-            term, doc = tup
-            num_terms_per_doc[doc] = num_terms_per_doc.get(doc, 0) + 1
-
-            if query_id is not None and doc != query_id:
-                raise RuntimeError("TF-IDF contains document {0}, which is "
-                                   "not the required query {1}. \n"
-                                   "Something wrong in how this TF-IDF object "
-                                   "was created or a bug in the "
-                                   "calling script.".format(
-                                       doc, query_id))
-
-            if source_docs is not None:
-                for src_doc in source_docs:
-                    try:
-                        src_value = source_tfidf.get_value(term, src_doc)
-                    except KeyError:
-                        logger.debug(
-                            "Could not find ({term}, {src}) in "
-                            "source_tfidf. "
-                            "Choosing a tf-idf value of 0.".format(
-                                term=term, src=src_doc))
-                        src_value = 0
-
-                    similarity_scores[(doc, src_doc)] = (
-                        similarity_scores.get((doc, src_doc), 0)
-                        + src_value * value)
-            else:
-                for src_tup, src_value in source_tfidf.tf_idf.items():
-                    similarity_scores[(doc, src_doc)] = (
-                        similarity_scores.get((doc, src_doc), 0)
-                        + src_value * value)
+        cols = columns[src_doc_ids]
+        keep = cols >= 0
+        scores = np.zeros([num_queries, len(source_docs)])
+        scores[query_doc_ids[keep], cols[keep]] = candidate_scores[keep]
 
         if do_length_normalization:
-            for doc_pair, value in similarity_scores.items():
-                doc, src_doc = doc_pair
-                similarity_scores[(doc, src_doc)] = value / num_terms_per_doc[doc]
+            num_terms_per_doc = np.bincount(self.doc_ids,
+                                            minlength=num_queries)
+            scores /= np.maximum(num_terms_per_doc, 1)[:, np.newaxis]
 
         if logger.isEnabledFor(logging.DEBUG):
-            for doc, count in num_terms_per_doc.items():
+            for doc, count in zip(self.docs.items, np.bincount(
+                    self.doc_ids, minlength=num_queries).tolist()):
                 logger.debug(
                     'Seen {0} terms in query document {1}'.format(count, doc))
 
+        return self.docs.items, list(source_docs), scores
+
+    def compute_similarity_scores(self, source_tfidf, source_docs=None,
+                                  do_length_normalization=False,
+                                  query_id=None):
+        """Computes TF-IDF similarity score between each pair of query
+        document contained in this object and the source documents
+        in the source_tfidf object.
+        See compute_similarity_matrix() for the arguments.
+
+        Returns a dictionary
+            { (query_document_id, source_document_id): similarity_score }
+        """
+        query_docs, source_docs, scores = self.compute_similarity_matrix(
+            source_tfidf, source_docs=source_docs,
+            do_length_normalization=do_length_normalization,
+            query_id=query_id)
+
+        similarity_scores = {}
+        for doc, row in zip(query_docs, scores.tolist()):
+            for src_doc, score in zip(source_docs, row):
+                similarity_scores[(doc, src_doc)] = score
         return similarity_scores
 
     def read(self, tf_idf_file):
-        """Loads TFIDF object from file."""
+        """Loads TFIDF object from file, in text or binary format. The file
+        can be opened in text or in binary mode (only binary for the binary
+        format)."""
 
-        if len(self.tf_idf) != 0:
+        if len(self) != 0:
             raise RuntimeError("TD-IDF object is not empty.")
+
+        start = tf_idf_file.read(2)
+        if start == b'\0B':
+            self._read_binary(tf_idf_file)
+            return
+        line = start + tf_idf_file.readline()
+        if isinstance(line, bytes):
+            self._read_text(tf_idf_file, line.decode('utf-8'),
+                            lambda: tf_idf_file.readline().decode('utf-8'))
+        else:
+            self._read_text(tf_idf_file, line, tf_idf_file.readline)
+
+    def _read_text(self, tf_idf_file, line, readline):
         seen_footer = False
-        line = tf_idf_file.readline()
         parts = line.strip().split()
         if re.search('^<TFIDF>', line) is None:
             raise TypeError(
@@ -288,7 +540,9 @@ class TFIDF(object):
             line = " ".join(parts[1:])
         else:
             # Nothing in this line. Read the next lines.
-            line = tf_idf_file.readline()
+            line = readline()
+
+        term_ids, doc_ids, values = [], [], []
         while line:
             parts = line.strip().split()
             if re.search('</TFIDF>', line):
@@ -304,43 +558,139 @@ class TFIDF(object):
                                 "{0}".format(line))
 
             order = int(parts[0])
-            term = tuple(parts[1:(order + 1)])
-            doc = parts[-2]
-            tfidf = float(parts[-1])
-
-            entry = (term, doc)
-            if entry in self.tf_idf:
-                raise RuntimeError("Duplicate entry {0} found while reading "
-                                   "TFIDF object.".format(entry))
-            self.tf_idf[entry] = tfidf
+            term_ids.append(self.terms.index(tuple(parts[1:(order + 1)])))
+            doc_ids.append(self.docs.index(parts[-2]))
+            values.append(float(parts[-1]))
 
-            line = tf_idf_file.readline()
+            line = readline()
         if not seen_footer:
             raise TypeError(
                 "Did not see footer </TFIDF> "
                 "in TFIDF object; got {0}".format(line))
 
-        if len(self.tf_idf) == 0:
+        if len(values) == 0:
             raise RuntimeError(
                 "Read no TF-IDF values from file {0}".format(tf_idf_file.name))
 
-    def write(self, tf_idf_file):
-        """Writes TFIDF object to file."""
+        self._set_entries(term_ids, doc_ids, values)
+
+    def _set_entries(self, term_ids, doc_ids, values):
+        self.term_ids = np.array(term_ids, dtype=np.int64)
+        self.doc_ids = np.array(doc_ids, dtype=np.int64)
+        self.values = np.array(values, dtype=np.float64)
+        self._term_index = None
+
+        pairs = self.term_ids * max(len(self.docs), 1) + self.doc_ids
+        unique_pairs, first, counts = np.unique(pairs, return_index=True,
+                                                return_counts=True)
+        if len(unique_pairs) != len(pairs):
+            i = first[np.flatnonzero(counts > 1)[0]]
+            entry = (self.terms.items[self.term_ids[i]],
+                     self.docs.items[self.doc_ids[i]])
+            raise RuntimeError("Duplicate entry {0} found while reading "
+                               "TFIDF object.".format(entry))
+
+    def _read_binary(self, tf_idf_file):
+        token = tf_idf_file.read(8)
+        if token != b'<TFIDF> ':
+            raise TypeError("Invalid format of binary TD-IDF object. "
+                            "Missing header <TFIDF>; got {0}".format(token))
+        (num_terms, num_docs, num_entries, terms_bytes,
+         docs_bytes) = _BINARY_HEADER.unpack(
+             _read_bytes(tf_idf_file, _BINARY_HEADER.size))
+
+        terms = _read_bytes(tf_idf_file, terms_bytes).decode('utf-8')
+        docs = _read_bytes(tf_idf_file, docs_bytes).decode('utf-8')
+        self.terms = Vocabulary(
+            tuple(term.split(' ')) for term in terms.split('\n')[:num_terms])
+        self.docs = Vocabulary(docs.split('\n')[:num_docs])
+
+        term_ids = np.frombuffer(
+            _read_bytes(tf_idf_file, 4 * num_entries), dtype='<i4')
+        doc_ids = np.frombuffer(
+            _read_bytes(tf_idf_file, 4 * num_entries), dtype='<i4')
+        values = np.frombuffer(
+            _read_bytes(tf_idf_file, 8 * num_entries), dtype='<f8')
+        token = _read_bytes(tf_idf_file, 9)
+        if token != b'</TFIDF> ':
+            raise TypeError("Did not see footer </TFIDF> "
+                            "in TFIDF object; got {0}".format(token))
+        if num_entries == 0:
+            raise RuntimeError(
+                "Read no TF-IDF values from file {0}".format(
+                    getattr(tf_idf_file, 'name', tf_idf_file)))
+
+        self.term_ids = term_ids.astype(np.int64)
+        self.doc_ids = doc_ids.astype(np.int64)
+        self.values = values.astype(np.float64)
+        self._term_index = None
+
+    def write(self, tf_idf_file, binary=False):
+        """Writes TFIDF object to file. The binary format requires a file
+        opened in binary mode."""
+
+        if binary:
+            self._write_binary(tf_idf_file)
+            return
 
         print ("<TFIDF>", file=tf_idf_file)
-        for tup, value in self.tf_idf.items():
-            term, doc = tup
+        for term_id, doc_id, value in zip(self.term_ids.tolist(),
+                                          self.doc_ids.tolist(),
+                                          self.values.tolist()):
+            term = self.terms.items[term_id]
             print("{order} {term} {doc} {tfidf}".format(
                 order=len(term), term=" ".join(term),
-                doc=doc, tfidf=value),
+                doc=self.docs.items[doc_id], tfidf=value),
                   file=tf_idf_file)
         print ("</TFIDF>", file=tf_idf_file)
 
+    def _write_binary(self, tf_idf_file):
+        terms = "\n".join(" ".join(term)
+                          for term in self.terms.items).encode('utf-8')
+        docs = "\n".join(self.docs.items).encode('utf-8')
+        tf_idf_file.write(b'\0B<TFIDF> ')
+        tf_idf_file.write(_BINARY_HEADER.pack(
+            len(self.terms), len(self.docs), len(self), len(terms),
+            len(docs)))
+        tf_idf_file.write(terms)
+        tf_idf_file.write(docs)
+        tf_idf_file.write(self.term_ids.astype('<i4').tobytes())
+        tf_idf_file.write(self.doc_ids.astype('<i4').tobytes())
+        tf_idf_file.write(self.values.astype('<f8').tobytes())
+        tf_idf_file.write(b'</TFIDF> ')
+
+
+def _read_bytes(file_handle, size):
+    data = file_handle.read(size)
+    if len(data) != size:
+        raise TypeError("Unexpected end of file in TFIDF object; "
+                        "expected {0} bytes, got {1}".format(size, len(data)))
+    return data
+
+
+def top_k(scores, k):
+    """Returns the indexes of the k largest scores, from the best to the
+    worst. Ties are broken in favour of the lower index, as max() does.
+    Uses a partial sort (argpartition), so that only the k best scores are
+    sorted."""
+    scores = np.asarray(scores)
+    num_scores = len(scores)
+    if k <= 0 or num_scores == 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < num_scores:
+        kth = scores[np.argpartition(-scores, k - 1)[k - 1]]
+        better = np.flatnonzero(scores > kth)
+        ties = np.flatnonzero(scores == kth)[:k - len(better)]
+        indexes = np.concatenate([better, ties])
+    else:
+        indexes = np.arange(num_scores)
+    return indexes[np.lexsort((indexes, -scores[indexes]))]
+
 
 def write_tfidf_from_stats(
         tf_stats, idf_stats, tf_idf_file, tf_weighting_scheme="raw",
         idf_weighting_scheme="log", tf_normalization_factor=0.5,
-        expected_document_id=None):
+        expected_document_id=None, binary=False):
     """Writes TF-IDF values to file args.tf_idf_file.
     The format used is
     <ngram-order> <term> <document> <tfidf>.
@@ -356,35 +706,39 @@ def write_tfidf_from_stats(
         tf_normalization_factor - See doc_string in TFStats class
         document_id - If provided, checks that the TFStats object contains
                       stats only for this document_id.
+        binary - If True, writes the TFIDF object in binary format
     """
-    if len(tf_stats.raw_counts) == 0:
+    if len(tf_stats) == 0:
         raise RuntimeError("Supplied tf-stats object is empty.")
 
     if idf_stats.num_docs == 0:
         raise RuntimeError("Supplied idf-stats object is empty.")
 
-    print ("<TFIDF>", file=tf_idf_file)
-    for tup in tf_stats.raw_counts:
-        term, doc = tup
-
-        if expected_document_id is not None and doc != expected_document_id:
-            raise RuntimeError("TFStats object contains stats with "
-                               "document {0}, "
-                               "which is not the specified "
-                               "document {1}.".format(doc,
-                                                      expected_document_id))
-
-        tf_value = tf_stats.get_term_frequency(
-            term, doc,
-            weighting_scheme=tf_weighting_scheme,
-            normalization_factor=tf_normalization_factor)
-
-        idf_value = idf_stats.get_inverse_document_frequency(
-            term, weighting_scheme=idf_weighting_scheme)
+    if expected_document_id is not None:
+        for doc in tf_stats.docs.items:
+            if doc != expected_document_id:
+                raise RuntimeError("TFStats object contains stats with "
+                                   "document {0}, "
+                                   "which is not the specified "
+                                   "document {1}.".format(
+                                       doc, expected_document_id))
+
+    term_ids, doc_ids, values = tf_stats.get_tfidf_values(
+        idf_stats, tf_weighting_scheme=tf_weighting_scheme,
+        idf_weighting_scheme=idf_weighting_scheme,
+        tf_normalization_factor=tf_normalization_factor)
+
+    if binary:
+        TFIDF(tf_stats.vocab, tf_stats.docs, term_ids, doc_ids,
+              values).write(tf_idf_file, binary=True)
+        return
 
+    print ("<TFIDF>", file=tf_idf_file)
+    for term_id, doc_id, value in zip(term_ids, doc_ids, values):
+        term = tf_stats.vocab.items[term_id]
         print("{order} {term} {doc} {tfidf}".format(
             order=len(term), term=" ".join(term),
-            doc=doc, tfidf=tf_value * idf_value),
+            doc=tf_stats.docs.items[doc_id], tfidf=value),
               file=tf_idf_file)
     print ("</TFIDF>", file=tf_idf_file)
 
@@ -392,13 +746,15 @@ def write_tfidf_from_stats(
 def read_key(fd):
   """ [str] = read_key(fd)
    Read the utterance-key from the opened ark/stream descriptor 'fd'.
+   'fd' can be opened in text or in binary mode.
   """
-  str = ''
+  chars = []
   while 1:
     char = fd.read(1)
-    if char == '' : break
-    if char == ' ' : break
-    str += char
+    if char == '' or char == b'' : break
+    if char == ' ' or char == b' ' : break
+    chars.append(char)
+  str = b''.join(chars).decode('utf-8') if chars and isinstance(chars[0], bytes) else ''.join(chars)
   str = str.strip()
   if str == '': return None # end of file,
   return str
@@ -3,14 +3,17 @@
 from __future__ import print_function
 import sys
 import argparse
+import collections
 import math
-import subprocess
+import multiprocessing
+import os
+import shlex
 from collections import defaultdict
 
 import io
-sys.stdout = io.TextIOWrapper(sys.stdout.buffer,encoding="utf8")
-sys.stderr = io.TextIOWrapper(sys.stderr.buffer,encoding="utf8")
-sys.stdin = io.TextIOWrapper(sys.stdin.buffer,encoding="utf8")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "internal"))
+import make_one_biased_lm
 
 parser = argparse.ArgumentParser(description="""
 This script is a wrapper for make_one_biased_lm.py that reads a Kaldi archive
@@ -18,7 +21,9 @@ of (integerized) text data from the standard input and writes a Kaldi archive of
 backoff-language-model FSTs to the standard-output.  It takes care of
 grouping utterances to respect the --min-words-per-graph option.  It writes
 the graphs to the standard output and also outputs a map from input utterance-ids
-to the per-group utterance-ids that index the output graphs.""")
+to the per-group utterance-ids that index the output graphs.  The LMs are
+built in-process (see MakeBiasedLm() in make_one_biased_lm.py), optionally by
+a pool of --num-jobs processes; the graphs are written in the input order.""")
 
 parser.add_argument("--lm-opts", type = str, default = "",
                     help = "Options to pass in to make_one_biased_lm.py (which "
@@ -27,24 +32,29 @@ parser.add_argument("--min-words-per-graph", type = int, default = 100,
                     help = "Minimum number of words per utterance group; this program "
                     "will try to arrange the input utterances into groups such that each "
                     "one has at least this many words in total.")
+parser.add_argument("--num-jobs", type = int, default = 1,
+                    help = "Number of processes that build the LMs of the groups.")
 parser.add_argument("utterance_map", type = str,
                     help = "Filename to which a map from input utterances to grouped "
                     "utterances, is written")
 
-args = parser.parse_args()
-
 
+# The parsed --lm-opts and the contents of its --top-words file, which are read
+# once and passed to each process of the pool by SetLmOptions().
+lm_args = None
+top_words = None
 
-try:
-    utterance_map_file = open(args.utterance_map, "w", encoding="utf-8")
-except:
-    sys.exit("make_biased_lms.py: error opening {0} to write utterance map".format(
-            args.utterance_map))
+def SetLmOptions(this_lm_args, this_top_words):
+    global lm_args, top_words
+    lm_args = this_lm_args
+    top_words = this_top_words
 
 # This processes one group of input lines; 'group_of_lines' is
 # an array of lines of input integerized text, e.g.
-# [ 'utt1 67 89 432', 'utt2 89 48 62' ]
-def ProcessGroupOfLines(group_of_lines):
+# [ 'utt1 67 89 432', 'utt2 89 48 62' ].  It writes <utt> <utt-group> to
+# utterance_map_file for each line, and returns (group utterance-id, the
+# lines with the utterance-ids removed).
+def GetGroupOfLines(group_of_lines, utterance_map_file):
     num_lines = len(group_of_lines)
     try:
         first_utterance_id = group_of_lines[0].split()[0]
@@ -52,53 +62,99 @@ def ProcessGroupOfLines(group_of_lines):
         sys.exit("make_biased_lms.py: empty input line")
 
     group_utterance_id = '{0}-group-of-{1}'.format(first_utterance_id, num_lines)
-    # print the group utterance-id to the stdout; it forms the name in
-    # the text-form archive.
-    print(group_utterance_id)
-    sys.stdout.flush()
+    lm_lines = []
+    for line in group_of_lines:
+        a = line.split()
+        if len(a) == 0:
+            sys.exit("make_biased_lms.py: empty input line")
+        utterance_id = a[0]
+        # print <utt> <utt-group> to utterance-map file
+        print(utterance_id, group_utterance_id, file = utterance_map_file)
+        lm_lines.append(' '.join(a[1:]) + '\n') # get rid of utterance id.
+    return group_utterance_id, lm_lines
+
+# This returns the groups of input lines from 'input_file', as returned by
+# GetGroupOfLines(), grouped to respect --min-words-per-graph.
+def GetGroupsOfLines(input_file, min_words_per_graph, utterance_map_file):
+    num_words_this_group = 0
+    this_group_of_lines = []  # An array of strings, one per line
+
+    while True:
+        line = input_file.readline();
+        num_words_this_group += len(line.split())
+        if line != '':
+            this_group_of_lines.append(line)
+        if num_words_this_group >= min_words_per_graph or \
+            (line == '' and len(this_group_of_lines) != 0):
+            yield GetGroupOfLines(this_group_of_lines, utterance_map_file)
+            num_words_this_group = 0
+            this_group_of_lines = []
+        if line == '':
+            break
+
+# This returns the text-form FST of the biased LM of a group, preceded by
+# the group utterance-id and followed by a blank line, which terminates the
+# FST in the Kaldi fst-archive format.
+def ProcessGroupOfLines(group):
+    group_utterance_id, lm_lines = group
+    fst = io.StringIO()
+    print(group_utterance_id, file = fst)
+    try:
+        ngram_counts = make_one_biased_lm.MakeBiasedLm(lm_lines, lm_args, top_words)
+        ngram_counts.PrintAsFst(lm_args.word_disambig_symbol, fst)
+    except SystemExit as e:
+        # sys.exit() in a process of the pool would not be noticed by the pool.
+        raise Exception("make_biased_lms.py: error creating the LM of {0}: {1}".format(
+                group_utterance_id, e))
+    print("", file = fst)
+    return fst.getvalue()
+
+
+if __name__ == "__main__":
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer,encoding="utf8")
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer,encoding="utf8")
+    sys.stdin = io.TextIOWrapper(sys.stdin.buffer,encoding="utf8")
+
+    args = parser.parse_args()
 
     try:
-        command = "steps/cleanup/internal/make_one_biased_lm.py " + args.lm_opts
-        p = subprocess.Popen(command, shell = True, stdin = subprocess.PIPE,
-                             stdout = sys.stdout, stderr = sys.stderr)
-        for line in group_of_lines:
-            a = line.split()
-            if len(a) == 0:
-                sys.exit("make_biased_lms.py: empty input line")
-            utterance_id = a[0]
-            # print <utt> <utt-group> to utterance-map file
-            print(utterance_id, group_utterance_id, file = utterance_map_file)
-            rest_of_line = ' '.join(a[1:]) + '\n' # get rid of utterance id.
-            p.stdin.write(rest_of_line.encode('utf-8'))
-        p.stdin.close()
-        assert p.wait() == 0
-    except Exception:
-        sys.stderr.write(
-            "make_biased_lms.py: error calling subprocess, command was: " +
-            command)
-        raise
-    # Print a blank line; this terminates the FST in the Kaldi fst-archive
-    # format.
-    print("")
-    sys.stdout.flush()
-
-
-
-num_words_this_group = 0
-this_group_of_lines = []  # An array of strings, one per line
-
-while True:
-    line = sys.stdin.readline();
-    num_words_this_group += len(line.split())
-    if line != '':
-        this_group_of_lines.append(line)
-    if num_words_this_group >= args.min_words_per_graph or \
-        (line == '' and len(this_group_of_lines) != 0):
-        ProcessGroupOfLines(this_group_of_lines)
-        num_words_this_group = 0
-        this_group_of_lines = []
-    if line == '':
-        break
+        utterance_map_file = open(args.utterance_map, "w", encoding="utf-8")
+    except:
+        sys.exit("make_biased_lms.py: error opening {0} to write utterance map".format(
+                args.utterance_map))
+
+    make_one_biased_lm.parser.prog = "make_one_biased_lm.py"
+    this_lm_args = make_one_biased_lm.parser.parse_args(shlex.split(args.lm_opts))
+    this_top_words = None
+    if this_lm_args.top_words != None:
+        this_top_words = make_one_biased_lm.ReadTopWords(this_lm_args.top_words)
+    SetLmOptions(this_lm_args, this_top_words)
+
+    groups = GetGroupsOfLines(sys.stdin, args.min_words_per_graph, utterance_map_file)
+    if args.num_jobs > 1:
+        # The groups are read here and handed to the pool as we go; the FSTs
+        # are written in the order of the input, keeping at most a few groups
+        # per process in flight.
+        pool = multiprocessing.Pool(args.num_jobs, SetLmOptions,
+                                    (this_lm_args, this_top_words))
+        try:
+            pending = collections.deque()
+            for group in groups:
+                pending.append(pool.apply_async(ProcessGroupOfLines, (group,)))
+                if len(pending) >= 4 * args.num_jobs:
+                    sys.stdout.write(pending.popleft().get())
+                    sys.stdout.flush()
+            while len(pending) > 0:
+                sys.stdout.write(pending.popleft().get())
+                sys.stdout.flush()
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for group in groups:
+            sys.stdout.write(ProcessGroupOfLines(group))
+            sys.stdout.flush()
+    utterance_map_file.close()
 
 
 # test comand [to be run from ../..]
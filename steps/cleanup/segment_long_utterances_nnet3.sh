@@ -385,14 +385,15 @@ if [ $stage -le 8 ]; then
       --tf-weighting-scheme="raw" \
       --idf-weighting-scheme="log" \
       --input-idf-stats=$dir/docs/idf_stats.txt \
-      $sdir/docs.JOB.txt $sdir/src_tf_idf.JOB.txt
+      --binary=true \
+      $sdir/docs.JOB.txt $sdir/src_tf_idf.JOB.bin
 
   sdir=$dir/docs/split$nj
   # Make $sdir an absolute pathname.
   sdir=`perl -e '($dir,$pwd)= @ARGV; if($dir!~m:^/:) { $dir = "$pwd/$dir"; } print $dir; ' $sdir ${PWD}`
 
   for n in `seq $nj`; do
-    awk -v f="$sdir/src_tf_idf.$n.txt" '{print $1" "f}' \
+    awk -v f="$sdir/src_tf_idf.$n.bin" '{print $1" "f}' \
       $sdir/text2doc.$n
   done | perl -ane 'BEGIN { %tfidfs = (); }
   {
@@ -432,8 +433,8 @@ if [ $stage -le 10 ]; then
       --tf-weighting-scheme="normalized" \
       --idf-weighting-scheme="log" \
       --input-idf-stats=$dir/docs/idf_stats.txt \
-      --accumulate-over-docs=false \
-      - $sdir/query_tf_idf.JOB.ark.txt
+      --accumulate-over-docs=false --binary=true \
+      - $sdir/query_tf_idf.JOB.ark
 
   # The relevant documents can be found using TF-IDF similarity and nearby
   # documents can also be picked for the Smith-Waterman alignment stage.
@@ -461,7 +462,7 @@ if [ $stage -le 10 ]; then
   # is the document-ids for the retrieved documents.
   $cmd JOB=1:$nj $dir/log/retrieve_similar_docs.JOB.log \
     steps/cleanup/internal/retrieve_similar_docs.py \
-      --query-tfidf=$dir/query_docs/split$nj/query_tf_idf.JOB.ark.txt \
+      --query-tfidf=$dir/query_docs/split$nj/query_tf_idf.JOB.ark \
       --source-text-id2tfidf=$dir/docs/source2tf_idf.scp \
       --source-text-id2doc-ids=$dir/docs/text2doc \
       --query-id2source-text-id=$dir/new2orig_utt \
@@ -17,6 +17,7 @@ from reverberate_data_dir import parse_file_to_dict
 from reverberate_data_dir import write_dict_to_file
 import libs.common as common_lib
 data_lib = imp.load_source('dml', 'steps/data/data_dir_manipulation_lib.py')
+augment_lib = imp.load_source('augmentation_lib', 'steps/data/augmentation_lib.py')
 
 def get_args():
     parser = argparse.ArgumentParser(description="Augment the data directory with additive noises. "
@@ -60,6 +61,14 @@ def get_args():
                         help="Background noise data directory")
     parser.add_argument("--fg-noise-dir", type=str, dest="fg_noise_dir",
                         help="Foreground noise data directory")
+    parser.add_argument("--wav-output-dir", type=str, dest="wav_output_dir", default=None,
+                        help="If specified, the augmented recordings are computed in-process (with NumPy) and "
+                        "written as wav files to this directory, and the output wav.scp points to them instead "
+                        "of containing wav-reverberate commands, so that the augmentation is not redone each "
+                        "time the data is read")
+    parser.add_argument("--nj", type=int, dest="nj", default=4,
+                        help="Number of parallel processes used to write the recordings if "
+                        "--wav-output-dir is specified")
     parser.add_argument("input_dir", help="Input data directory")
     parser.add_argument("output_dir", help="Output data directory")
 
@@ -88,6 +97,8 @@ def check_args(args):
         raise Exception("--fg-interval must be 0 or greater")
     if args.bg_noise_dir is None and args.fg_noise_dir is None:
         raise Exception("Either --fg-noise-dir or --bg-noise-dir must be specified")
+    if args.nj <= 0:
+        raise Exception("--nj must be positive")
     return args
 
 def get_noise_list(noise_wav_scp_filename):
@@ -110,6 +121,7 @@ def augment_wav(utt, wav, dur, fg_snr_opts, bg_snr_opts, fg_noise_utts, \
     tot_noise_dur = 0
     snrs=[]
     noises=[]
+    noise_descriptors=[]
     start_times=[]
 
     # Now handle the background noises
@@ -123,6 +135,7 @@ def augment_wav(utt, wav, dur, fg_snr_opts, bg_snr_opts, fg_noise_utts, \
             snrs.append(snr)
             start_times.append(0)
             noises.append(noise)
+            noise_descriptors.append({'input': noise_wavs[noise_utt], 'duration': dur})
 
     # Now handle the foreground noises
     if len(fg_noise_utts) > 0:
@@ -135,6 +148,7 @@ def augment_wav(utt, wav, dur, fg_snr_opts, bg_snr_opts, fg_noise_utts, \
             start_times.append(tot_noise_dur)
             tot_noise_dur += noise_dur + interval
             noises.append(noise)
+            noise_descriptors.append(noise)
 
     start_times_str = "--start-times='" + ",".join([str(i) for i in start_times]) + "'"
     snrs_str = "--snrs='" + ",".join([str(i) for i in snrs]) + "'"
@@ -148,7 +162,12 @@ def augment_wav(utt, wav, dur, fg_snr_opts, bg_snr_opts, fg_noise_utts, \
     else:
         new_wav = wav + " wav-reverberate --shift-output=true " + noises_str + " " \
             + start_times_str + " " + snrs_str + " - - |"
-    return new_wav
+
+    # The same augmentation, as a reverberation descriptor for
+    # steps/data/augmentation_lib.py
+    reverberation_descriptor = {'input': wav, 'additive_signals': noise_descriptors,
+                                'start_times': start_times, 'snrs': snrs}
+    return new_wav, reverberation_descriptor
 
 def get_new_id(utt, utt_modifier_type, utt_modifier):
     """ This function generates a new id from the input id
@@ -233,6 +252,7 @@ def main():
     random.seed(args.random_seed)
     new_utt2wav = {}
     new_utt2spk = {}
+    reverberation_descriptors = {}
 
     # Augment each line in the wav file
     for line in wav_scp_file:
@@ -240,17 +260,24 @@ def main():
         utt = toks[0]
         wav = " ".join(toks[1:])
         dur = reco2dur[utt]
-        new_wav = augment_wav(utt, wav, dur, fg_snrs, bg_snrs, fg_noise_utts,
-            bg_noise_utts, noise_wavs, noise_reco2dur, args.fg_interval,
-            num_bg_noises)
+        new_wav, reverberation_descriptor = augment_wav(utt, wav, dur, fg_snrs,
+            bg_snrs, fg_noise_utts, bg_noise_utts, noise_wavs, noise_reco2dur,
+            args.fg_interval, num_bg_noises)
 
         new_utt = get_new_id(utt, args.utt_modifier_type, args.utt_modifier)
 
         new_utt2wav[new_utt] = new_wav
+        reverberation_descriptors[new_utt] = reverberation_descriptor
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
+    if args.wav_output_dir is not None:
+        print("Writing {0} augmented recordings to {1}".format(
+            len(reverberation_descriptors), args.wav_output_dir))
+        new_utt2wav.update(augment_lib.write_augmented_recordings(
+            reverberation_descriptors, args.wav_output_dir, args.nj))
+
     write_dict_to_file(new_utt2wav, output_dir + "/wav.scp")
     copy_file_if_exists(input_dir + "/reco2dur", output_dir + "/reco2dur",
                                 args.utt_modifier_type, args.utt_modifier)
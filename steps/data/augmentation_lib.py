@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# Apache 2.0
+#
+# This module applies the augmentations of steps/data/reverberate_data_dir.py
+# and steps/data/augment_data_dir.py in-process, with NumPy, instead of
+# writing them to wav.scp as chains of wav-reverberate pipe commands.  It
+# follows what the binary wav-reverberate does (see featbin/wav-reverberate.cc
+# in Kaldi): RIR convolution, addition of noises scaled to a given SNR relative
+# to the early-reverberation energy of the speech, normalization of the output
+# power, shifting by the peak of the RIR and extension to a given duration.
+#
+# An augmentation is described by a "reverberation descriptor", a dict with
+# the fields (all but 'input' optional):
+#   'input': the rxfilename of the recording (a file, or a "command |")
+#   'impulse_response': the rxfilename of the RIR, or None
+#   'additive_signals': a list of the noises to add; each is either an
+#       rxfilename or itself a reverberation descriptor (as for noises that
+#       go through wav-reverberate in the pipe commands)
+#   'start_times', 'snrs': the start time (in seconds) and SNR (in dB) of each
+#       additive signal
+#   'duration': if > 0, the output is trimmed or repeated to this many seconds
+#   'shift_output': if true (the default), the output is shifted by the
+#       position of the peak of the RIR, so it keeps the length of the input.
+# The decoded noises and RIRs, and the FFTs of the RIRs, are kept in
+# per-process LRU caches, as the same few files are used for many recordings.
+
+import functools
+import math
+import multiprocessing
+import os
+import struct
+import subprocess
+
+import numpy as np
+
+# The number of decoded noise waveforms and of RIR FFTs kept by each process.
+noise_cache_size = 64
+rir_cache_size = 256
+
+
+def read_wave_bytes(rxfilename):
+    """ This function returns the contents of a wave rxfilename, which is either
+        a file name or a piped command ending in "|"
+    """
+    rxfilename = rxfilename.strip()
+    if rxfilename.endswith("|"):
+        p = subprocess.Popen(rxfilename[:-1], shell = True, stdout = subprocess.PIPE)
+        data = p.stdout.read()
+        p.stdout.close()
+        if p.wait() != 0:
+            raise Exception("Command {0} exited with status {1}".format(rxfilename, p.returncode))
+        return data
+    if len(rxfilename.split()) != 1:
+        raise Exception("Unsupported wave rxfilename {0}".format(rxfilename))
+    with open(rxfilename, "rb") as f:
+        return f.read()
+
+
+def parse_wave(data, name = ""):
+    """ This function parses the contents of a 16-bit PCM RIFF wave file (the
+        format that Kaldi supports) and returns (sampling frequency, samples),
+        where samples is a float32 matrix with one row per channel, in the range
+        of int16 as in Kaldi. Like Kaldi, it reads to the end of the data if
+        the size of the data chunk is not known (as when sox writes to a pipe).
+    """
+    if len(data) < 12 or data[0:4] != b"RIFF" or data[8:12] != b"WAVE":
+        raise Exception("{0}: expected a RIFF/WAVE file".format(name))
+    pos = 12
+    samp_freq = None
+    num_channels = None
+    while pos + 8 <= len(data):
+        chunk_id = data[pos:pos + 4]
+        chunk_size = struct.unpack("<I", data[pos + 4:pos + 8])[0]
+        pos += 8
+        if chunk_id == b"fmt ":
+            (format_tag, num_channels, samp_freq, _, block_align,
+             bits_per_sample) = struct.unpack("<HHIIHH", data[pos:pos + 16])
+            if format_tag not in (1, 0xFFFE) or bits_per_sample != 16:
+                raise Exception("{0}: only 16-bit PCM wave files are supported".format(name))
+        elif chunk_id == b"data":
+            if num_channels is None:
+                raise Exception("{0}: data chunk before fmt chunk".format(name))
+            end = len(data) if chunk_size in (0, 0xFFFFFFFF) else min(pos + chunk_size, len(data))
+            end -= (end - pos) % (2 * num_channels)
+            samples = np.frombuffer(data, dtype = "<i2", count = (end - pos) // 2, offset = pos)
+            return samp_freq, samples.reshape(-1, num_channels).T.astype(np.float32)
+        pos += chunk_size + (chunk_size & 1)
+    raise Exception("{0}: no data chunk found".format(name))
+
+
+def read_wave(rxfilename, channel = 0):
+    """ This function reads one channel of a wave rxfilename and returns
+        (sampling frequency, samples as a float64 vector)
+    """
+    samp_freq, samples = parse_wave(read_wave_bytes(rxfilename), rxfilename)
+    if channel >= samples.shape[0]:
+        raise Exception("{0}: no channel {1}".format(rxfilename, channel))
+    return samp_freq, samples[channel].astype(np.float64)
+
+
+def write_wave(file_name, samp_freq, samples):
+    """ This function writes a vector of samples (in the range of int16) as a
+        mono 16-bit PCM wave file. As in Kaldi, the samples are truncated to
+        integers and clipped.
+    """
+    data = quantize(samples).astype("<i2").tobytes()
+    with open(file_name, "wb") as f:
+        f.write(b"RIFF" + struct.pack("<I", 36 + len(data)) + b"WAVE")
+        f.write(b"fmt " + struct.pack("<IHHIIHH", 16, 1, 1, int(samp_freq),
+                                      int(samp_freq) * 2, 2, 16))
+        f.write(b"data" + struct.pack("<I", len(data)))
+        f.write(data)
+
+
+def quantize(samples):
+    """ This function converts samples to the values they would have after
+        being written to a 16-bit wave file and read back
+    """
+    return np.clip(np.trunc(samples), -32768, 32767)
+
+
+@functools.lru_cache(maxsize = noise_cache_size)
+def read_noise(rxfilename):
+    """ Cached version of read_wave(), for noises. """
+    samp_freq, samples = read_wave(rxfilename)
+    samples.flags.writeable = False
+    return samp_freq, samples
+
+
+@functools.lru_cache(maxsize = rir_cache_size)
+def read_rir(rxfilename):
+    """ This function reads a RIR, scaled to the range [-1, 1] as in
+        wav-reverberate, and returns (sampling frequency, RIR, peak index)
+    """
+    samp_freq, rir = read_wave(rxfilename)
+    rir /= 1 << 15
+    rir.flags.writeable = False
+    return samp_freq, rir, int(np.argmax(rir))
+
+
+def fft_length_for_filter(filter_length):
+    # a power of two at least 4 times the length of the filter, so that most
+    # of each block of the overlap-add convolution is signal.
+    return 1 << (4 * filter_length - 1).bit_length()
+
+
+@functools.lru_cache(maxsize = rir_cache_size)
+def rir_fft(rxfilename, early = False):
+    """ This function returns the FFT of the RIR rxfilename (or if early ==
+        True, of its early part, from 1ms before to 50ms after the peak, which
+        is used to compute the early reverberation energy), and the length of
+        the filter
+    """
+    samp_freq, rir, peak_index = read_rir(rxfilename)
+    if early:
+        start = max(int(peak_index - 0.001 * samp_freq), 0)
+        end = min(int(peak_index + 0.05 * samp_freq), len(rir))
+        rir = rir[start:end]
+    fft = np.fft.rfft(rir, fft_length_for_filter(len(rir)))
+    fft.flags.writeable = False
+    return fft, len(rir)
+
+
+def fft_convolve(filter_fft, filter_length, signal):
+    """ This function convolves signal with a filter given by its FFT, by
+        overlap-add, and returns the full convolution (of length
+        len(signal) + filter_length - 1)
+    """
+    fft_length = 2 * (len(filter_fft) - 1)
+    block_length = fft_length - filter_length + 1
+    output_length = len(signal) + filter_length - 1
+    num_blocks = (len(signal) + block_length - 1) // block_length
+    blocks = np.zeros((num_blocks, block_length))
+    blocks.reshape(-1)[:len(signal)] = signal
+    # each row of the block outputs has length block_length + filter_length - 1
+    # == fft_length; its tail overlaps with the start of the next block.
+    block_outputs = np.fft.irfft(np.fft.rfft(blocks, fft_length) * filter_fft, fft_length)
+    output = np.zeros((num_blocks + 1) * block_length)
+    output[:num_blocks * block_length] = block_outputs[:, :block_length].reshape(-1)
+    tails = np.zeros((num_blocks, block_length))
+    tails[:, :filter_length - 1] = block_outputs[:, block_length:]
+    output[block_length:] += tails.reshape(-1)
+    return output[:output_length]
+
+
+def power(signal):
+    return np.dot(signal, signal) / len(signal) if len(signal) > 0 else 0.0
+
+
+def add_vectors_with_offset(signal, offset, output):
+    # adds signal to output, starting at sample offset, without extending output
+    add_length = min(len(output) - offset, len(signal))
+    if add_length > 0:
+        output[offset:offset + add_length] += signal[:add_length]
+
+
+def apply_reverberation(descriptor, is_noise = False):
+    """ This function computes the signal described by a reverberation
+        descriptor (see the top of this file), as wav-reverberate would, and
+        returns (sampling frequency, samples)
+    """
+    if not isinstance(descriptor, dict):
+        # a noise that is added as it is.
+        return read_noise(descriptor)
+    if is_noise:
+        samp_freq, signal = read_noise(descriptor['input'])
+    else:
+        samp_freq, signal = read_wave(descriptor['input'])
+    signal = np.array(signal)
+    num_samp_input = len(signal)
+    power_before_reverb = power(signal)
+    early_energy = power_before_reverb
+    shift_index = 0
+    impulse_response = descriptor.get('impulse_response')
+    shift_output = descriptor.get('shift_output', True)
+    if impulse_response is not None:
+        rir_samp_freq, rir, peak_index = read_rir(impulse_response)
+        if rir_samp_freq != samp_freq:
+            raise Exception("Sampling frequency of the RIR {0} ({1}) does not match that of "
+                            "{2} ({3})".format(impulse_response, rir_samp_freq,
+                                               descriptor['input'], samp_freq))
+        early_energy = power(fft_convolve(*rir_fft(impulse_response, early = True),
+                                          signal = signal))
+        signal = fft_convolve(*rir_fft(impulse_response), signal = signal)
+        if shift_output:
+            shift_index = peak_index
+
+    additive_signals = descriptor.get('additive_signals', [])
+    for noise_descriptor, snr, start_time in zip(additive_signals,
+                                                 descriptor.get('snrs', []),
+                                                 descriptor.get('start_times', [])):
+        _, noise = apply_reverberation(noise_descriptor, is_noise = True)
+        if isinstance(noise_descriptor, dict):
+            # in the pipe commands the noise went through a wave file.
+            noise = quantize(noise)
+        noise_power = power(noise)
+        if noise_power == 0.0:
+            continue
+        scale = math.sqrt(10 ** (-float(snr) / 10) * early_energy / noise_power)
+        add_vectors_with_offset(scale * noise, int(float(start_time) * samp_freq), signal)
+
+    if impulse_response is not None or len(additive_signals) > 0:
+        power_after_reverb = power(signal)
+        if power_after_reverb > 0.0:
+            signal *= math.sqrt(power_before_reverb / power_after_reverb)
+
+    duration = descriptor.get('duration')
+    if duration is not None and float(duration) > 0:
+        num_samp_output = int(samp_freq * float(duration))
+    elif shift_output:
+        num_samp_output = num_samp_input
+    else:
+        num_samp_output = len(signal)
+    if num_samp_output <= num_samp_input:
+        # trim the signal from the start
+        return samp_freq, signal[shift_index:shift_index + num_samp_output]
+    # repeat the signal to fill up the duration
+    num_repeats = (num_samp_output + len(signal) - 1) // len(signal)
+    return samp_freq, np.tile(signal, num_repeats)[:num_samp_output]
+
+
+def _write_one_recording(job):
+    recording_id, descriptor, file_name = job
+    samp_freq, samples = apply_reverberation(descriptor)
+    write_wave(file_name, samp_freq, samples)
+    return recording_id, file_name
+
+
+def write_augmented_recordings(descriptors, wav_dir, num_jobs = 1):
+    """ This function computes the recordings described by descriptors, a
+        dictionary from recording-id to reverberation descriptor, and writes
+        them as <wav_dir>/<recording-id>.wav, using num_jobs processes.
+        It returns a dictionary from recording-id to the wave file written.
+    """
+    if not os.path.exists(wav_dir):
+        os.makedirs(wav_dir)
+    wav_dir = os.path.abspath(wav_dir)
+    jobs = [(recording_id, descriptors[recording_id],
+             os.path.join(wav_dir, recording_id + ".wav"))
+            for recording_id in sorted(descriptors.keys())]
+    if num_jobs > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(num_jobs)
+        try:
+            results = pool.imap_unordered(_write_one_recording, jobs, chunksize = 4)
+            wav_files = dict(results)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        wav_files = dict(_write_one_recording(job) for job in jobs)
+    return wav_files
@@ -8,6 +8,7 @@
 import argparse, shlex, glob, math, os, random, sys, warnings, copy, imp, ast
 
 data_lib = imp.load_source('dml', 'steps/data/data_dir_manipulation_lib.py')
+augment_lib = imp.load_source('augmentation_lib', 'steps/data/augmentation_lib.py')
 
 def get_args():
     # we add required arguments as named arguments for readability
@@ -71,6 +72,12 @@ def get_args():
                         "the RIRs/noises will be resampled to the rate of the source data.")
     parser.add_argument("--include-original-data", type=str, help="If true, the output data includes one copy of the original data",
                          choices=['true', 'false'], default = "false")
+    parser.add_argument("--wav-output-dir", type=str, default = None,
+                        help="If specified, the reverberated recordings are computed in-process (with NumPy) and written as "
+                        "wav files to this directory, and the output wav.scp points to them instead of containing "
+                        "wav-reverberate commands, so that the augmentation is not redone each time the data is read")
+    parser.add_argument("--nj", type=int, default = 4,
+                        help="Number of parallel processes used to write the recordings if --wav-output-dir is specified")
     parser.add_argument("input_dir",
                         help="Input data directory")
     parser.add_argument("output_dir",
@@ -113,6 +120,9 @@ def check_args(args):
     if args.source_sampling_rate is not None and args.source_sampling_rate <= 0:
         raise Exception("--source-sampling-rate cannot be non-positive")
 
+    if args.nj <= 0:
+        raise Exception("--nj must be positive")
+
     return args
 
 
@@ -223,10 +233,15 @@ def add_point_source_noise(noise_addition_descriptor,  # descriptor to store the
                 noise_rvb_command = """wav-reverberate --impulse-response="{0}" --duration={1}""".format(noise_rir.rir_rspecifier, speech_dur)
                 noise_addition_descriptor['start_times'].append(0)
                 noise_addition_descriptor['snrs'].append(next(background_snrs))
+                noise_addition_descriptor['noise_descriptors'].append({'input': noise.noise_rspecifier,
+                                                                       'impulse_response': noise_rir.rir_rspecifier,
+                                                                       'duration': speech_dur})
             else:
                 noise_rvb_command = """wav-reverberate --impulse-response="{0}" """.format(noise_rir.rir_rspecifier)
                 noise_addition_descriptor['start_times'].append(round(random.random() * speech_dur, 2))
                 noise_addition_descriptor['snrs'].append(next(foreground_snrs))
+                noise_addition_descriptor['noise_descriptors'].append({'input': noise.noise_rspecifier,
+                                                                       'impulse_response': noise_rir.rir_rspecifier})
 
             # check if the rspecifier is a pipe or not
             if len(noise.noise_rspecifier.split()) == 1:
@@ -250,10 +265,14 @@ def generate_reverberation_opts(room_dict,  # the room dictionary, please refer
                               ):
     """ This function randomly decides whether to reverberate, and sample a RIR if it does
         It also decides whether to add the appropriate noises
-        This function return the string of options to the binary wav-reverberate
+        This function return the string of options to the binary wav-reverberate,
+        and the same options as a reverberation descriptor (without the input)
+        for steps/data/augmentation_lib.py
     """
     reverberate_opts = ""
+    reverberation_descriptor = {'impulse_response': None}
     noise_addition_descriptor = {'noise_io': [],
+                                 'noise_descriptors': [],
                                  'start_times': [],
                                  'snrs': []}
     # Randomly select the room
@@ -264,6 +283,7 @@ def generate_reverberation_opts(room_dict,  # the room dictionary, please refer
     if random.random() < speech_rvb_probability:
         # pick the RIR to reverberate the speech
         reverberate_opts += """--impulse-response="{0}" """.format(speech_rir.rir_rspecifier)
+        reverberation_descriptor['impulse_response'] = speech_rir.rir_rspecifier
 
     rir_iso_noise_list = []
     if speech_rir.room_id in iso_noise_dict:
@@ -277,6 +297,8 @@ def generate_reverberation_opts(room_dict,  # the room dictionary, please refer
             noise_addition_descriptor['noise_io'].append("wav-reverberate --duration={1} {0} - |".format(isotropic_noise.noise_rspecifier, speech_dur))
         else:
             noise_addition_descriptor['noise_io'].append("{0} wav-reverberate --duration={1} - - |".format(isotropic_noise.noise_rspecifier, speech_dur))
+        noise_addition_descriptor['noise_descriptors'].append({'input': isotropic_noise.noise_rspecifier,
+                                                               'duration': speech_dur})
         noise_addition_descriptor['start_times'].append(0)
         noise_addition_descriptor['snrs'].append(next(background_snrs))
 
@@ -292,12 +314,16 @@ def generate_reverberation_opts(room_dict,  # the room dictionary, please refer
 
     assert len(noise_addition_descriptor['noise_io']) == len(noise_addition_descriptor['start_times'])
     assert len(noise_addition_descriptor['noise_io']) == len(noise_addition_descriptor['snrs'])
+    assert len(noise_addition_descriptor['noise_io']) == len(noise_addition_descriptor['noise_descriptors'])
     if len(noise_addition_descriptor['noise_io']) > 0:
         reverberate_opts += "--additive-signals='{0}' ".format(','.join(noise_addition_descriptor['noise_io']))
         reverberate_opts += "--start-times='{0}' ".format(','.join([str(x) for x in noise_addition_descriptor['start_times']]))
         reverberate_opts += "--snrs='{0}' ".format(','.join([str(x) for x in noise_addition_descriptor['snrs']]))
+    reverberation_descriptor['additive_signals'] = noise_addition_descriptor['noise_descriptors']
+    reverberation_descriptor['start_times'] = noise_addition_descriptor['start_times']
+    reverberation_descriptor['snrs'] = noise_addition_descriptor['snrs']
 
-    return reverberate_opts
+    return reverberate_opts, reverberation_descriptor
 
 def get_new_id(id, prefix=None, copy=0):
     """ This function generates a new id from the input id
@@ -327,16 +353,22 @@ def generate_reverberated_wav_scp(wav_scp,  # a dictionary whose values are the
                                shift_output, # option whether to shift the output waveform
                                isotropic_noise_addition_probability, # Probability of adding isotropic noises
                                pointsource_noise_addition_probability, # Probability of adding point-source noises
-                               max_noises_per_minute # maximum number of point-source noises that can be added to a recording according to its duration
+                               max_noises_per_minute, # maximum number of point-source noises that can be added to a recording according to its duration
+                               wav_output_dir = None, # if not None, directory to write the corrupted recordings to
+                               num_jobs = 1 # number of processes used to write the corrupted recordings
                                ):
     """ This is the main function to generate pipeline command for the corruption
         The generic command of wav-reverberate will be like:
         wav-reverberate --duration=t --impulse-response=rir.wav
         --additive-signals='noise1.wav,noise2.wav' --snrs='snr1,snr2' --start-times='s1,s2' input.wav output.wav
+        If wav_output_dir is specified, the same corruption is instead done in-process
+        by steps/data/augmentation_lib.py, and the wav.scp points to the wav files written.
+        The random choices are the same in both cases.
     """
     foreground_snrs = list_cyclic_iterator(foreground_snr_array)
     background_snrs = list_cyclic_iterator(background_snr_array)
     corrupted_wav_scp = {}
+    reverberation_descriptors = {}
     keys = sorted(wav_scp.keys())
     if include_original:
         start_index = 0
@@ -352,7 +384,7 @@ def generate_reverberated_wav_scp(wav_scp,  # a dictionary whose values are the
             speech_dur = durations[recording_id]
             max_noises_recording = math.floor(max_noises_per_minute * speech_dur / 60)
 
-            reverberate_opts = generate_reverberation_opts(room_dict,  # the room dictionary, please refer to make_room_dict() for the format
+            reverberate_opts, reverberation_descriptor = generate_reverberation_opts(room_dict,  # the room dictionary, please refer to make_room_dict() for the format
                                                          pointsource_noise_list, # the point source noise list
                                                          iso_noise_dict, # the isotropic noise dictionary
                                                          foreground_snrs, # the SNR for adding the foreground noises
@@ -372,7 +404,15 @@ def generate_reverberated_wav_scp(wav_scp,  # a dictionary whose values are the
 
             new_recording_id = get_new_id(recording_id, prefix, i)
             corrupted_wav_scp[new_recording_id] = wav_corrupted_pipe
-
+            if wav_output_dir is not None and not (reverberate_opts == "" or i == 0):
+                reverberation_descriptor['input'] = wav_scp[recording_id]
+                reverberation_descriptor['shift_output'] = (shift_output == "true")
+                reverberation_descriptors[new_recording_id] = reverberation_descriptor
+
+    if len(reverberation_descriptors) > 0:
+        print("Writing {0} reverberated recordings to {1}".format(len(reverberation_descriptors), wav_output_dir))
+        corrupted_wav_scp.update(augment_lib.write_augmented_recordings(reverberation_descriptors,
+                                                                        wav_output_dir, num_jobs))
     write_dict_to_file(corrupted_wav_scp, output_dir + "/wav.scp")
 
 
@@ -412,7 +452,9 @@ def create_reverberated_copy(input_dir,
                            shift_output, # option whether to shift the output waveform
                            isotropic_noise_addition_probability, # Probability of adding isotropic noises
                            pointsource_noise_addition_probability, # Probability of adding point-source noises
-                           max_noises_per_minute  # maximum number of point-source noises that can be added to a recording according to its duration
+                           max_noises_per_minute,  # maximum number of point-source noises that can be added to a recording according to its duration
+                           wav_output_dir = None, # if not None, directory to write the corrupted recordings to
+                           num_jobs = 1 # number of processes used to write the corrupted recordings
                            ):
     """ This function creates multiple copies of the necessary files,
         e.g. utt2spk, wav.scp ...
@@ -430,7 +472,8 @@ def create_reverberated_copy(input_dir,
     generate_reverberated_wav_scp(wav_scp, durations, output_dir, room_dict, pointsource_noise_list, iso_noise_dict,
                foreground_snr_array, background_snr_array, num_replicas, include_original, prefix,
                speech_rvb_probability, shift_output, isotropic_noise_addition_probability,
-               pointsource_noise_addition_probability, max_noises_per_minute)
+               pointsource_noise_addition_probability, max_noises_per_minute,
+               wav_output_dir, num_jobs)
 
     add_prefix_to_fields(input_dir + "/utt2spk", output_dir + "/utt2spk", num_replicas, include_original, prefix, field = [0,1])
     data_lib.RunKaldiCommand("utils/utt2spk_to_spk2utt.pl <{output_dir}/utt2spk >{output_dir}/spk2utt"
@@ -672,7 +715,9 @@ def main():
                            shift_output = args.shift_output,
                            isotropic_noise_addition_probability = args.isotropic_noise_addition_probability,
                            pointsource_noise_addition_probability = args.pointsource_noise_addition_probability,
-                           max_noises_per_minute = args.max_noises_per_minute)
+                           max_noises_per_minute = args.max_noises_per_minute,
+                           wav_output_dir = args.wav_output_dir,
+                           num_jobs = args.nj)
 
 
     data_lib.RunKaldiCommand("utils/validate_data_dir.sh --no-feats --no-text {output_dir}"
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+# Apache 2.0
+
+""" Compares SelectPronsGreedy() of select_prons_greedy.py with the previous
+implementation, which ran the EM over the arc-stats dictionaries one
+occurrence and pron at a time, on a synthetic lexicon-learning setup
+(reference, G2P and phonetic-decoding lexicons and an arc-stats file with
+--num-arc-stats-lines lines).  Both have to learn the same lexicon, and the
+time taken by each of them is printed.
+
+e.g.: python3 steps/dict/benchmark_select_prons_greedy.py \
+          --num-arc-stats-lines 100000 --num-jobs 4
+"""
+
+from __future__ import print_function
+from collections import defaultdict
+import argparse
+import io
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from select_prons_greedy import ReadArcStats, SelectPronsGreedy
+
+
+def GetArgs():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the greedy pronunciation selection")
+    parser.add_argument("--num-arc-stats-lines", type = int, default = 100000,
+                        help="Approximate number of lines of the synthetic arc-stats")
+    parser.add_argument("--num-words", type = int, default = 2000,
+                        help="Number of synthetic words")
+    parser.add_argument("--alpha", type = str, default = "0.1,0.2,0.4",
+                        help="As for select_prons_greedy.py")
+    parser.add_argument("--beta", type = str, default = "10,20,30",
+                        help="As for select_prons_greedy.py")
+    parser.add_argument("--delta", type = float, default = 0.0000001,
+                        help="As for select_prons_greedy.py")
+    parser.add_argument("--num-jobs", type = int, default = 4,
+                        help="Number of processes for SelectPronsGreedy()")
+    parser.add_argument("--skip-legacy", action = "store_true",
+                        help="Do not run the previous implementation")
+    parser.add_argument("--seed", type = int, default = 0,
+                        help="Random seed")
+    args = parser.parse_args()
+    args.alpha = [ float(a) for a in args.alpha.split(',') ]
+    args.alpha = [ a if a > 0 else -1e-3 for a in args.alpha ]
+    args.beta = [ float(b) for b in args.beta.split(',') ]
+    return args
+
+
+def RandomPron(phones):
+    return ' '.join(random.choice(phones) for i in range(random.randint(2, 6)))
+
+
+def GetSyntheticData(args):
+    # Each word has prons from one to three sources; most of the acoustic evidence
+    # of an occurrence goes to one "true" pron, and the rest to other candidates
+    # or to prons which are not candidates.
+    phones = [ "p{0}".format(i) for i in range(40) ]
+    ref_lexicon = defaultdict(set)
+    g2p_lexicon = defaultdict(set)
+    pd_lexicon = defaultdict(set)
+    candidates = {}
+    for w in range(args.num_words):
+        word = "word{0}".format(w)
+        prons = set(RandomPron(phones) for i in range(random.randint(2, 8)))
+        for pron in prons:
+            random.choice([ref_lexicon, g2p_lexicon, pd_lexicon])[word].add(pron)
+        candidates[word] = sorted(prons)
+    # Zipf-like word frequencies.
+    weights = [ 1.0 / (w + 1) for w in range(args.num_words) ]
+    scale = args.num_arc_stats_lines / 1.8 / sum(weights)
+    lines = []
+    for w in range(args.num_words):
+        word = "word{0}".format(w)
+        prons = candidates[word]
+        true_prons = prons[:random.randint(1, 2)]
+        for occ in range(max(1, int(weights[w] * scale))):
+            utt = "utt{0}".format(random.randint(0, 100000))
+            start_frame = random.randint(0, 1000)
+            stats = {}
+            remaining = 1.0
+            for pron in [ random.choice(true_prons) ] + random.sample(prons, random.randint(0, 2)):
+                count = random.uniform(0.5, 1.0) * remaining
+                stats[pron] = stats.get(pron, 0.0) + count
+                remaining -= count
+            if random.random() < 0.2:
+                stats[RandomPron(phones)] = remaining
+            for pron, count in stats.items():
+                lines.append("{0} {1} {2} {3:.4f} {4}\n".format(word, utt, start_frame, count, pron))
+    return ref_lexicon, g2p_lexicon, pd_lexicon, lines
+
+
+# The previous implementation of OneEMIter() and SelectPronsGreedy() (without
+# the diagnostic output).
+def LegacyOneEMIter(args, word, stats, prons, pron_probs):
+    prob_acc = [0.0 for i in range(len(prons[word]))]
+    s = sum(pron_probs)
+    for i in range(len(pron_probs)):
+        pron_probs[i] = pron_probs[i] / s
+    log_like = 0.0
+    for (utt, start_frame) in stats[word]:
+        prob = []
+        soft_counts = []
+        for i in range(len(prons[word])):
+            phones = prons[word][i]
+            soft_count = stats[word][(utt, start_frame)].get(phones, 0)
+            if soft_count < args.delta:
+                soft_count = args.delta
+            soft_counts.append(soft_count)
+        prob = [i[0] * i[1] for i in zip(soft_counts, pron_probs)]
+        for i in range(len(prons[word])):
+            prob_acc[i] += prob[i] / sum(prob)
+        log_like += math.log(sum(prob))
+    pron_probs = [1.0 / float(len(stats[word])) * p for p in prob_acc]
+    log_like = 1.0 / float(len(stats[word])) * log_like
+    return pron_probs, log_like
+
+
+def LegacySelectPronsGreedy(args, stats, counts, ref_lexicon, g2p_lexicon, pd_lexicon):
+    prons = defaultdict(list)
+    src = {}
+    learned_lexicon = defaultdict(set)
+    for lexicon in ref_lexicon, g2p_lexicon, pd_lexicon:
+        for word in lexicon:
+            for pron in lexicon[word]:
+                prons[word].append(pron)
+    for word in prons:
+        for pron in prons[word]:
+            if word in pd_lexicon and pron in pd_lexicon[word]:
+                src[(word, pron)] = 'P'
+            if word in g2p_lexicon and pron in g2p_lexicon[word]:
+                src[(word, pron)] = 'G'
+            if word in ref_lexicon and pron in ref_lexicon[word]:
+                src[(word, pron)] = 'R'
+    for word in prons:
+        if word not in stats:
+            continue
+        n = len(prons[word])
+        pron_probs = [1/float(n) for i in range(n)]
+        active_indexes = set(range(len(prons[word])))
+        deleted_prons = []
+        while len(active_indexes) > 1:
+            log_like = 1.0
+            log_like_last = -1.0
+            while abs(log_like - log_like_last) > 1e-7:
+                log_like_last = log_like
+                pron_probs, log_like = LegacyOneEMIter(args, word, stats, prons, pron_probs)
+            candidates_to_delete = []
+            for i in active_indexes:
+                pron_probs_mod = [p for p in pron_probs]
+                pron_probs_mod[i] = 0.0
+                for j in range(len(pron_probs_mod)):
+                    if j in active_indexes and j != i:
+                        pron_probs_mod[j] += 0.01
+                pron_probs_mod = [s / sum(pron_probs_mod) for s in pron_probs_mod]
+                log_like2 = 1.0
+                log_like2_last = -1.0
+                while abs(log_like2 - log_like2_last) > 0.001 :
+                    log_like2_last = log_like2
+                    pron_probs_mod, log_like2 = LegacyOneEMIter(args, word, stats,
+                                                                prons, pron_probs_mod)
+                loss = log_like - log_like2
+                thr = -math.log(args.delta)
+                source = src[(word, prons[word][i])]
+                k = {'P': 0, 'G': 1, 'R': 2}[source]
+                thr *= args.alpha[k]
+                loss *= float(len(stats[word])) / (float(len(stats[word])) + args.beta[k])
+                if loss - thr < 0:
+                   candidates_to_delete.append((loss-thr, i))
+            if len(candidates_to_delete) == 0:
+                break
+            candidates_to_delete_sorted = sorted(candidates_to_delete,
+                                                 key=lambda candidates_to_delete: candidates_to_delete[0])
+            deleted_candidate = candidates_to_delete_sorted[0]
+            active_indexes.remove(deleted_candidate[1])
+            pron_probs[deleted_candidate[1]] = 0.0
+            for i in range(len(pron_probs)):
+                if i in active_indexes:
+                    pron_probs[i] += 0.01
+            pron_probs = [s / sum(pron_probs) for s in pron_probs]
+            deleted_prons.append(deleted_candidate[1])
+        for i in range(len(prons[word])):
+            if i not in deleted_prons:
+                learned_lexicon[word].add(prons[word][i])
+    return learned_lexicon
+
+
+def Main():
+    args = GetArgs()
+    random.seed(args.seed)
+    ref_lexicon, g2p_lexicon, pd_lexicon, lines = GetSyntheticData(args)
+    stats, _ = ReadArcStats(io.StringIO(u''.join(lines)))
+    counts = dict((word, len(stats[word])) for word in stats)
+    print("{0} arc-stats lines, {1} words, {2} candidate prons".format(
+        len(lines), len(stats), sum(len(prons) for lexicon in (ref_lexicon, g2p_lexicon, pd_lexicon)
+                                    for prons in lexicon.values())))
+
+    times = {}
+    for num_jobs in sorted(set([1, args.num_jobs])):
+        args.num_jobs = num_jobs
+        start_time = time.time()
+        learned_lexicon = SelectPronsGreedy(args, stats, counts, ref_lexicon, g2p_lexicon, pd_lexicon)
+        times[num_jobs] = time.time() - start_time
+        print("SelectPronsGreedy with {0} job(s): {1:.2f} seconds, {2} prons learned".format(
+            num_jobs, times[num_jobs], sum(len(prons) for prons in learned_lexicon.values())))
+
+    if not args.skip_legacy:
+        start_time = time.time()
+        legacy_lexicon = LegacySelectPronsGreedy(args, stats, counts,
+                                                 ref_lexicon, g2p_lexicon, pd_lexicon)
+        legacy_time = time.time() - start_time
+        print("previous SelectPronsGreedy: {0:.2f} seconds (speedup: {1:.1f}x with 1 job, "
+              "{2:.1f}x with {3} jobs)".format(legacy_time, legacy_time / times[1],
+                                               legacy_time / times[args.num_jobs], args.num_jobs))
+        if dict(legacy_lexicon) != dict(learned_lexicon):
+            sys.exit("benchmark_select_prons_greedy.py: the implementations "
+                     "learned different lexicons")
+
+
+if __name__ == "__main__":
+    Main()
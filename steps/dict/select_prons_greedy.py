@@ -6,9 +6,13 @@
 from __future__ import print_function
 from collections import defaultdict
 import argparse
+import functools
+import multiprocessing
 import sys
 import math
 
+import numpy as np
+
 def GetArgs():
     parser = argparse.ArgumentParser(
         description = "Use a greedy framework to select pronunciation candidates"
@@ -38,6 +42,8 @@ def GetArgs():
                         help = "Floor value of the pronunciation posterior statistics."
                         "The valid range is (0, 0.01),"
                         "See Section 3 in the paper for details.")
+    parser.add_argument("--num-jobs", type = int, default = 1,
+                        help = "Number of processes over which the words are distributed.")
     parser.add_argument("silence_phones_file", metavar = "<silphone-file>", type = str,
                         help = "File containing a list of silence phones.")
     parser.add_argument("arc_stats_file", metavar = "<arc-stats-file>", type = str,
@@ -79,7 +85,7 @@ def CheckArgs(args):
     args.learned_lexicon_handle = open(args.learned_lexicon, "w")
     
     alpha = args.alpha.strip().split(',')
-    if len(alpha) is not 3:
+    if len(alpha) != 3:
         raise Exception('Invalid alpha ', args.alpha)
     for i in range(0,3):
         if float(alpha[i]) < 0 or float(alpha[i]) > 1:
@@ -99,7 +105,7 @@ def CheckArgs(args):
     print("[alpha_{pd}, alpha_{g2p}, alpha_{ref}] is: ", args.alpha)
     exit
     beta = args.beta.strip().split(',')
-    if len(beta) is not 3:
+    if len(beta) != 3:
         raise Exception('Invalid beta ', args.beta)
     for i in range(0,3):
         if float(beta[i]) < 0 or float(beta[i]) > 100:
@@ -113,6 +119,9 @@ def CheckArgs(args):
                         '(0, 0.01).')
     print("delta is: ", args.delta)
 
+    if args.num_jobs < 1:
+        raise Exception('num-jobs ', args.num_jobs, ' is invalid, it must be positive.')
+
     return args
 
 def ReadArcStats(arc_stats_file_handle):
@@ -173,7 +182,7 @@ def FilterPhoneticDecodingLexicon(args, pd_lexicon):
     for line in args.silence_phones_file_handle:
         silphones.add(line.strip())
     rejected_candidates = set()
-    for word, prons in pd_lexicon.iteritems():
+    for word, prons in pd_lexicon.items():
         for pron in prons:
             for phone in pron.split():
                 if phone in silphones:
@@ -183,32 +192,159 @@ def FilterPhoneticDecodingLexicon(args, pd_lexicon):
         pd_lexicon[word].remove(pron)
     return pd_lexicon
 
-# One iteration of Expectation-Maximization computation (Eq. 3-4 in the paper).
-def OneEMIter(args, word, stats, prons, pron_probs, debug=False):
-    prob_acc = [0.0 for i in range(len(prons[word]))]
-    s = sum(pron_probs)
-    for i in range(len(pron_probs)):
-        pron_probs[i] = pron_probs[i] / s
-    log_like = 0.0
-    for (utt, start_frame) in stats[word]:
-        prob = []
-        soft_counts = []
-        for i in range(len(prons[word])):
-            phones = prons[word][i]
-            soft_count = stats[word][(utt, start_frame)].get(phones, 0)
-            if soft_count < args.delta: 
-                soft_count = args.delta
-            soft_counts.append(soft_count)
-        prob = [i[0] * i[1] for i in zip(soft_counts, pron_probs)]
-        for i in range(len(prons[word])):
-            prob_acc[i] += prob[i] / sum(prob)
-        log_like += math.log(sum(prob))
-    pron_probs = [1.0 / float(len(stats[word])) * p for p in prob_acc]
-    log_like = 1.0 / float(len(stats[word])) * log_like
-    if debug:
-        print("Log_like of the word: ", log_like, "pron probs: ", pron_probs)
+# Puts the acoustic evidence of a word into a matrix with one row per occurrence
+# (utt, start_frame) and one column per candidate pron, floored at delta.
+def GetSoftCounts(word_stats, word_prons, delta):
+    columns = defaultdict(list)
+    for j, pron in enumerate(word_prons):
+        columns[pron].append(j)
+    soft_counts = np.zeros((len(word_stats), len(word_prons)))
+    for row, occurrence in enumerate(word_stats.values()):
+        for phones, count in occurrence.items():
+            for j in columns.get(phones, []):
+                soft_counts[row, j] = count
+    return np.maximum(soft_counts, delta)
+
+# One iteration of Expectation-Maximization computation (Eq. 3-4 in the paper),
+# for each row of pron_probs at once: with the soft counts as a matrix, the
+# per-occurrence likelihoods and the expected pron counts are two matrix products.
+def OneEMIter(soft_counts, pron_probs):
+    num_occ = float(soft_counts.shape[0])
+    pron_probs = pron_probs / pron_probs.sum(axis=1, keepdims=True)
+    likes = np.dot(soft_counts, pron_probs.T) # [occurrence, row]
+    pron_probs = 1.0 / num_occ * (pron_probs * np.dot((1.0 / likes).T, soft_counts))
+    log_like = 1.0 / num_occ * np.log(likes).sum(axis=0)
     return pron_probs, log_like
 
+# Runs EM from each row of pron_probs until the change of the avg. log-likelihood
+# of that row is within tolerance; rows which have converged are left alone.
+# Returns the estimated pron_probs, log-likelihoods and numbers of iterations of
+# all rows, and the pron_probs after the first iteration.
+def RunEM(soft_counts, pron_probs, tolerance):
+    pron_probs = np.array(pron_probs, dtype=np.float64, ndmin=2)
+    num_rows = pron_probs.shape[0]
+    log_like = np.ones(num_rows)
+    log_like_last = -np.ones(num_rows)
+    num_iters = np.zeros(num_rows, dtype=int)
+    first_iter_probs = None
+    rows = np.arange(num_rows)
+    while len(rows) > 0:
+        log_like_last[rows] = log_like[rows]
+        pron_probs[rows], log_like[rows] = OneEMIter(soft_counts, pron_probs[rows])
+        num_iters[rows] += 1
+        if first_iter_probs is None:
+            first_iter_probs = pron_probs.copy()
+        rows = np.nonzero(np.abs(log_like - log_like_last) > tolerance)[0]
+    return pron_probs, log_like, num_iters, first_iter_probs
+
+# Runs the greedy pron selection (Alg. 1 in the paper) for one word, and returns
+# (word, the selected prons). job is (word, candidate prons, their sources, soft counts).
+def SelectPronsOfWord(alpha, beta, delta, job, dianostic_info=False):
+    word, word_prons, sources, soft_counts = job
+    num_occ = float(soft_counts.shape[0])
+    n = len(word_prons)
+    pron_probs = np.full(n, 1/float(n))
+    if dianostic_info:
+        print("pronunciations of word '{}': {}".format(word, word_prons))
+    active_indexes = set(range(n))
+
+    deleted_prons = [] # indexes of prons to be deleted
+    soft_counts_normalized = None
+    while len(active_indexes) > 1:
+        pron_probs, log_like, num_iters, first_iter_probs = RunEM(soft_counts, pron_probs, 1e-7)
+        pron_probs, log_like, num_iters = pron_probs[0], log_like[0], num_iters[0]
+        if soft_counts_normalized is None: # the first iteration
+            soft_counts_normalized = first_iter_probs[0]
+            if dianostic_info:
+                print("Avg.(over all egs) soft counts: {}".format(soft_counts_normalized))
+        if dianostic_info:
+            print("\n Log_like after {} iters of EM: {}, estimated pron_probs: {} \n".format(
+                    num_iters, log_like, pron_probs))
+        candidates_to_delete = []
+
+        # The EMs with each active pron removed in turn are run together, one row
+        # per pron, each starting from the current estimate.
+        indexes = sorted(active_indexes)
+        pron_probs_mod = np.tile(pron_probs, (len(indexes), 1))
+        pron_probs_mod[:, indexes] += 0.01
+        pron_probs_mod[np.arange(len(indexes)), indexes] = 0.0
+        pron_probs_mod /= pron_probs_mod.sum(axis=1, keepdims=True)
+        # Running EM until convengence
+        _, log_like2, num_iters2, _ = RunEM(soft_counts, pron_probs_mod, 0.001)
+
+        log_delta = math.log(delta)
+        for row, i in enumerate(indexes):
+            loss_abs = log_like - log_like2[row] # absolute likelihood loss before normalization
+            # (supposed to be positive, but could be negative near zero because of numerical precision limit).
+            thr = -log_delta
+            loss = loss_abs
+            source = sources[i]
+            if dianostic_info:
+                print("\n set the pron_prob of '{}' whose source is {}, to zero results in {}"
+                " loss in avg. log-likelihood; Num. iters until converging:{}. ".format(
+                  word_prons[i], source, loss, num_iters2[row]))
+            # Compute quality score q_b = loss_abs * / (M_w + beta_s(b)) + alpha_s(b) * log_delta
+            # See Sec. 4.3 and Alg. 1 in the paper.
+            if source == 'P':
+               thr *= alpha[0]
+               loss *= num_occ / (num_occ + beta[0])
+            if source == 'G':
+               thr *= alpha[1]
+               loss *= num_occ / (num_occ + beta[1])
+            if source == 'R':
+               thr *= alpha[2]
+               loss *= num_occ / (num_occ + beta[2])
+            if loss - thr < 0: # loss - thr here is just q_b
+               if dianostic_info:
+                   print("Smoothed log-like loss {} is smaller than threshold {} so that the quality"
+                         "score {} is negative, adding the pron to the list of candidates to delete"
+                         ". ".format(loss, thr, loss-thr))
+               candidates_to_delete.append((loss-thr, i))
+        if len(candidates_to_delete) == 0:
+            break
+        candidates_to_delete_sorted = sorted(candidates_to_delete,
+                                             key=lambda candidates_to_delete: candidates_to_delete[0])
+
+        deleted_candidate = candidates_to_delete_sorted[0]
+        active_indexes.remove(deleted_candidate[1])
+        pron_probs[deleted_candidate[1]] = 0.0
+        pron_probs[sorted(active_indexes)] += 0.01
+        pron_probs /= pron_probs.sum()
+        source = sources[deleted_candidate[1]]
+        pron = word_prons[deleted_candidate[1]]
+        soft_count = soft_counts_normalized[deleted_candidate[1]]
+        quality_score = deleted_candidate[0]
+        # This part of diagnostic info provides hints to the user on how to adjust the parameters.
+        if dianostic_info:
+            print("removed pron {}, from source {} with quality score {:.5f}".format(
+                    pron, source, quality_score))
+            if (source == 'P' and soft_count > 0.7 and num_occ > 5):
+                print("WARNING: alpha_{pd} or beta_{pd} may be too large!"
+                      "    For the word '{}' whose count is {}, the candidate "
+                      "    pronunciation from phonetic decoding '{}' with normalized "
+                      "    soft count {} (out of 1) is rejected. It shouldn't have been"
+                      "    rejected if alpha_{pd} is smaller than {}".format(
+                        word, int(num_occ), pron, soft_count, -loss / log_delta,
+                        -alpha[0] * num_occ + (objf_change + beta[0])),
+                        file=sys.stderr)
+                if loss_abs > thr:
+                    print("    or beta_{pd} is smaller than {}".format(
+                            (loss_abs / thr - 1) * num_occ), file=sys.stderr)
+            if (source == 'G' and soft_count > 0.7 and num_occ > 5):
+                print("WARNING: alpha_{g2p} or beta_{g2p} may be too large!"
+                      "    For the word '{}' whose count is {}, the candidate "
+                      "    pronunciation from G2P '{}' with normalized "
+                      "    soft count {} (out of 1) is rejected. It shouldn't have been"
+                      "    rejected if alpha_{g2p} is smaller than {} ".format(
+                        word, int(num_occ), pron, soft_count, -loss / log_delta,
+                        -alpha[1] * num_occ + (objf_change + beta[1])),
+                      file=sys.stderr)
+                if loss_abs > thr:
+                    print("    or beta_{g2p} is smaller than {}.".format((
+                            loss_abs / thr - 1) * num_occ), file=sys.stderr)
+        deleted_prons.append(deleted_candidate[1])
+    return word, [word_prons[i] for i in range(n) if i not in deleted_prons]
+
 def SelectPronsGreedy(args, stats, counts, ref_lexicon, g2p_lexicon, pd_lexicon, dianostic_info=False):
     prons = defaultdict(list) # Put all possible prons from three source lexicons into this dictionary
     src = {} # Source of each (word, pron) pair: 'P' = phonetic-decoding, 'G' = G2P, 'R' = reference
@@ -225,132 +361,28 @@ def SelectPronsGreedy(args, stats, counts, ref_lexicon, g2p_lexicon, pd_lexicon,
                 src[(word, pron)] = 'G'
             if word in ref_lexicon and pron in ref_lexicon[word]:
                 src[(word, pron)] = 'R'
-   
-    for word in prons:
-        if word not in stats:
-            continue
-        n = len(prons[word])
-        pron_probs = [1/float(n) for i in range(n)]
-        if dianostic_info:
-            print("pronunciations of word '{}': {}".format(word, prons[word]))
-        active_indexes = set(range(len(prons[word])))
-       
-        deleted_prons = [] # indexes of prons to be deleted
-        soft_counts_normalized = []
-        while len(active_indexes) > 1:
-            log_like = 1.0
-            log_like_last = -1.0
-            num_iters = 0
-            while abs(log_like - log_like_last) > 1e-7:
-                num_iters += 1
-                log_like_last = log_like
-                pron_probs, log_like = OneEMIter(args, word, stats, prons, pron_probs, False)
-                if log_like_last == 1.0 and len(soft_counts_normalized) == 0: # the first iteration
-                    soft_counts_normalized = pron_probs
-                    if dianostic_info: 
-                        print("Avg.(over all egs) soft counts: {}".format(soft_counts_normalized))
-            if dianostic_info:
-                print("\n Log_like after {} iters of EM: {}, estimated pron_probs: {} \n".format(
-                        num_iters, log_like, pron_probs))
-            candidates_to_delete = []
-            
-            for i in active_indexes:
-                pron_probs_mod = [p for p in pron_probs]
-                pron_probs_mod[i] = 0.0
-                for j in range(len(pron_probs_mod)):
-                    if j in active_indexes and j != i:
-                        pron_probs_mod[j] += 0.01
-                pron_probs_mod = [s / sum(pron_probs_mod) for s in pron_probs_mod]
-                log_like2 = 1.0
-                log_like2_last = -1.0
-                num_iters2 = 0
-                # Running EM until convengence
-                while abs(log_like2 - log_like2_last) > 0.001 :
-                    num_iters2 += 1
-                    log_like2_last = log_like2
-                    pron_probs_mod, log_like2 = OneEMIter(args, word, stats,
-                                                          prons, pron_probs_mod, False)
-                
-                loss_abs = log_like - log_like2 # absolute likelihood loss before normalization
-                # (supposed to be positive, but could be negative near zero because of numerical precision limit).
-                log_delta = math.log(args.delta)
-                thr = -log_delta
-                loss = loss_abs
-                source = src[(word, prons[word][i])]
-                if dianostic_info:
-                    print("\n set the pron_prob of '{}' whose source is {}, to zero results in {}"
-                    " loss in avg. log-likelihood; Num. iters until converging:{}. ".format(
-                      prons[word][i], source, loss, num_iters2))
-                # Compute quality score q_b = loss_abs * / (M_w + beta_s(b)) + alpha_s(b) * log_delta
-                # See Sec. 4.3 and Alg. 1 in the paper.
-                if source == 'P':
-                   thr *= args.alpha[0]
-                   loss *= float(len(stats[word])) / (float(len(stats[word])) + args.beta[0])
-                if source == 'G':
-                   thr *= args.alpha[1]
-                   loss *= float(len(stats[word])) / (float(len(stats[word])) + args.beta[1])
-                if source == 'R':
-                   thr *= args.alpha[2]
-                   loss *= float(len(stats[word])) / (float(len(stats[word])) + args.beta[2])
-                if loss - thr < 0: # loss - thr here is just q_b
-                   if dianostic_info:
-                       print("Smoothed log-like loss {} is smaller than threshold {} so that the quality"
-                             "score {} is negative, adding the pron to the list of candidates to delete"
-                             ". ".format(loss, thr, loss-thr))
-                   candidates_to_delete.append((loss-thr, i))
-            if len(candidates_to_delete) == 0:
-                break
-            candidates_to_delete_sorted = sorted(candidates_to_delete, 
-                                                 key=lambda candidates_to_delete: candidates_to_delete[0])
-
-            deleted_candidate = candidates_to_delete_sorted[0]
-            active_indexes.remove(deleted_candidate[1])
-            pron_probs[deleted_candidate[1]] = 0.0
-            for i in range(len(pron_probs)):
-                if i in active_indexes:
-                    pron_probs[i] += 0.01
-            pron_probs = [s / sum(pron_probs) for s in pron_probs]
-            source = src[(word, prons[word][deleted_candidate[1]])]
-            pron = prons[word][deleted_candidate[1]]
-            soft_count = soft_counts_normalized[deleted_candidate[1]]
-            quality_score = deleted_candidate[0]
-            # This part of diagnostic info provides hints to the user on how to adjust the parameters.
-            if dianostic_info:
-                print("removed pron {}, from source {} with quality score {:.5f}".format(
-                        pron, source, quality_score)) 
-                if (source == 'P' and soft_count > 0.7 and len(stats[word]) > 5):
-                    print("WARNING: alpha_{pd} or beta_{pd} may be too large!"
-                          "    For the word '{}' whose count is {}, the candidate "
-                          "    pronunciation from phonetic decoding '{}' with normalized "
-                          "    soft count {} (out of 1) is rejected. It shouldn't have been"
-                          "    rejected if alpha_{pd} is smaller than {}".format(
-                            word, len(stats[word]), pron, soft_count, -loss / log_delta, 
-                            -args.alpha[0] * len(stats[word]) + (objf_change + args.beta[0])),
-                            file=sys.stderr)
-                    if loss_abs > thr:
-                        print("    or beta_{pd} is smaller than {}".format(
-                                (loss_abs / thr - 1) * len(stats[word])), file=sys.stderr)
-                if (source == 'G' and soft_count > 0.7 and len(stats[word]) > 5):
-                    print("WARNING: alpha_{g2p} or beta_{g2p} may be too large!"
-                          "    For the word '{}' whose count is {}, the candidate "
-                          "    pronunciation from G2P '{}' with normalized "
-                          "    soft count {} (out of 1) is rejected. It shouldn't have been"
-                          "    rejected if alpha_{g2p} is smaller than {} ".format(
-                            word, len(stats[word]), pron, soft_count, -loss / log_delta, 
-                            -args.alpha[1] * len(stats[word]) + (objf_change + args.beta[1])),
-                          file=sys.stderr)
-                    if loss_abs > thr:
-                        print("    or beta_{g2p} is smaller than {}.".format((
-                                loss_abs / thr - 1) * len(stats[word])), file=sys.stderr)
-            deleted_prons.append(deleted_candidate[1])
-        for i in range(len(prons[word])):
-            if i not in deleted_prons:
-                learned_lexicon[word].add(prons[word][i])
+
+    jobs = ((word, prons[word], [src[(word, pron)] for pron in prons[word]],
+             GetSoftCounts(stats[word], prons[word], args.delta))
+            for word in prons if word in stats)
+    select_prons = functools.partial(SelectPronsOfWord, args.alpha, args.beta, args.delta,
+                                     dianostic_info=dianostic_info)
+    if args.num_jobs > 1:
+        pool = multiprocessing.Pool(args.num_jobs)
+        try:
+            for word, word_prons in pool.imap(select_prons, jobs, chunksize=16):
+                learned_lexicon[word].update(word_prons)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for word, word_prons in map(select_prons, jobs):
+            learned_lexicon[word].update(word_prons)
 
     return learned_lexicon
 
 def WriteLearnedLexicon(learned_lexicon, file_handle):
-    for word, prons in learned_lexicon.iteritems():
+    for word, prons in learned_lexicon.items():
         for pron in prons:
             print('{0} {1}'.format(word, pron), file=file_handle)
     file_handle.close()
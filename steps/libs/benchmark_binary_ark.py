@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+# Apache 2.0
+
+""" Compares reading a feature archive with the text functions of
+libs/common.py (as the segmentation scripts did, after
+"copy-feats --binary=false") with the binary reader read_ark(), and prints
+the throughput of both and the projected time for a 10 GB archive.
+
+Without --ark, a synthetic archive of --size-mb megabytes is generated.
+With --ark and copy-feats on the PATH, the text version is produced by
+copy-feats itself.
+
+e.g.: python3 steps/libs/benchmark_binary_ark.py --ark data/train/data/raw_mfcc_train.1.ark
+"""
+
+from __future__ import print_function
+from __future__ import division
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import libs.common as common_lib
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the binary Kaldi archive reader")
+    parser.add_argument("--ark", type=str, default=None,
+                        help="Binary archive of float matrices to read")
+    parser.add_argument("--size-mb", type=int, default=100,
+                        help="Size of the synthetic archive, without --ark")
+    parser.add_argument("--dim", type=int, default=40,
+                        help="Feature dimension of the synthetic archive")
+    parser.add_argument("--frames", type=int, default=500,
+                        help="Frames per utterance of the synthetic archive")
+    return parser.parse_args()
+
+
+def make_archive(path, size_mb, dim, frames):
+    rng = np.random.RandomState(0)
+    num_utts = max(1, size_mb * 1024 * 1024 // (4 * dim * frames))
+    with open(path, 'wb') as f:
+        for i in range(num_utts):
+            common_lib.write_binary_object(
+                f, rng.randn(frames, dim).astype(np.float32),
+                key='utt-{0:07d}'.format(i))
+
+
+def make_text_archive(ark, text_ark):
+    if _have('copy-feats'):
+        common_lib.execute_command(
+            "copy-feats --binary=false ark:{0} ark,t:{1}".format(ark, text_ark))
+        return
+    # Same layout as copy-feats ("key  [").
+    with open(text_ark, 'w') as f:
+        for key, mat in common_lib.read_ark(ark):
+            f.write(key + ' ')
+            common_lib.write_matrix_ascii(f, mat)
+
+
+def _have(program):
+    return any(os.access(os.path.join(d, program), os.X_OK)
+               for d in os.environ.get('PATH', '').split(os.pathsep))
+
+
+def timed(function):
+    start = time.time()
+    result = function()
+    return result, time.time() - start
+
+
+def main():
+    args = get_args()
+    tmp_dir = tempfile.mkdtemp()
+    ark = args.ark
+    if ark is None:
+        ark = os.path.join(tmp_dir, 'feats.ark')
+        make_archive(ark, args.size_mb, args.dim, args.frames)
+    text_ark = os.path.join(tmp_dir, 'feats.txt.ark')
+    make_text_archive(ark, text_ark)
+
+    text, text_time = timed(lambda: [
+        (key, np.array(mat, dtype=np.float32))
+        for key, mat in common_lib.read_mat_ark(text_ark)])
+    binary, binary_time = timed(lambda: list(common_lib.read_ark(ark)))
+
+    assert [key for key, _ in text] == [key for key, _ in binary]
+    for (_, text_mat), (_, mat) in zip(text, binary):
+        assert np.allclose(text_mat, mat, atol=1e-5)
+
+    size = os.path.getsize(ark)
+    scale = 10 * 1024 ** 3 / size
+    print("{0} matrices, {1:.1f} MB binary, {2:.1f} MB text".format(
+        len(binary), size / 1024 ** 2, os.path.getsize(text_ark) / 1024 ** 2))
+    for name, seconds in (('text (read_mat_ark)', text_time),
+                          ('binary (read_ark)', binary_time)):
+        print("  {0:20s} {1:8.2f}s {2:9.1f} MB/s   10 GB: {3:8.1f}s".format(
+            name, seconds, size / 1024 ** 2 / seconds, seconds * scale))
+    print("  speedup: {0:.1f}x".format(text_time / binary_time))
+
+    for f in os.listdir(tmp_dir):
+        os.remove(os.path.join(tmp_dir, f))
+    os.rmdir(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,10 +15,18 @@ import argparse
 import logging
 import math
 import os
+import re
+import struct
 import subprocess
 import sys
 import threading
 
+try:
+    import numpy as np
+except ImportError:
+    # Only needed by the binary archive functions below.
+    np = None
+
 try:
     import thread as thread_module
 except:
@@ -112,17 +120,21 @@ class smart_open(object):
 
     e.g.: with smart_open(filename, 'w') as fh:
             print ("foo", file=fh)
+
+    The modes "rb" and "wb" give the binary streams (for binary Kaldi
+    archives, see read_ark() and write_binary_object()).
     """
     def __init__(self, filename, mode="r"):
         self.filename = filename
         self.mode = mode
-        assert self.mode == "w" or self.mode == "r"
+        assert self.mode in ("w", "r", "wb", "rb")
 
     def __enter__(self):
-        if self.filename == "-" and self.mode == "w":
-            self.file_handle = sys.stdout
-        elif self.filename == "-" and self.mode == "r":
-            self.file_handle = sys.stdin
+        if self.filename == "-":
+            std = sys.stdout if self.mode.startswith("w") else sys.stdin
+            if self.mode.endswith("b"):
+                std = getattr(std, 'buffer', std)
+            self.file_handle = std
         else:
             self.file_handle = open(self.filename, self.mode)
         return self.file_handle
@@ -474,6 +486,384 @@ def read_mat_ark(file_or_fd):
             fd.close()
 
 
+# Binary Kaldi objects.
+#
+# The functions below read and write Kaldi archives in binary format (as
+# written without ",t" / --binary=false) directly into NumPy arrays, so that
+# the callers do not need to pipe everything through
+# "copy-feats --binary=false". Text-format objects are still accepted by the
+# readers, and the text functions above are kept as they are.
+#
+# Supported objects: float/double matrices (FM/DM) and vectors (FV/DV),
+# compressed matrices (CM, CM2, CM3; decoded to float32) and int32 vectors
+# (e.g. alignments).
+
+_WHITESPACE = b' \t\n\r'
+_WHITESPACE_REGEX = re.compile(b'[ \t\n\r]')
+_BINARY_DTYPES = {'FM': '<f4', 'DM': '<f8', 'FV': '<f4', 'DV': '<f8'}
+_INT32_VECTOR_DTYPE = [('size', 'i1'), ('value', '<i4')]
+_RANGE_REGEX = re.compile(r'^(.*)\[([^\]]*)\]$')
+
+
+def _check_numpy():
+    if np is None:
+        raise ImportError("NumPy is needed to read or write binary Kaldi "
+                          "objects")
+
+
+def _open_binary(file_or_fd, mode):
+    """ Returns (fd, opened): a binary file object for a file name, '-'
+    (stdin/stdout) or an already opened file object, and whether it was
+    opened here (and has to be closed by the caller). """
+    if not isinstance(file_or_fd, str):
+        return getattr(file_or_fd, 'buffer', file_or_fd), False
+    if file_or_fd == '-':
+        std = sys.stdin if mode == 'rb' else sys.stdout
+        return getattr(std, 'buffer', std), False
+    return open(file_or_fd, mode), True
+
+
+def _read_exactly(fd, num_bytes):
+    """ Reads num_bytes from fd into a (writable) bytearray. """
+    data = bytearray(num_bytes)
+    view = memoryview(data)
+    position = 0
+    while position < num_bytes:
+        count = fd.readinto(view[position:])
+        if not count:
+            raise IOError("Unexpected end of file reading a Kaldi object "
+                          "({0} of {1} bytes)".format(position, num_bytes))
+        position += count
+    return data
+
+
+def read_token(fd):
+    """ Reads a whitespace-delimited token (e.g. an utterance-key or a
+    binary type token like "FM") from a binary stream, consuming the
+    whitespace character after it. Returns None at end of file.
+    Unlike read_key(), it scans the stream buffer instead of reading one
+    character at a time, when the stream supports peek().
+    """
+    if not hasattr(fd, 'peek'):
+        chars = []
+        while True:
+            char = fd.read(1)
+            if not char:
+                break
+            if char in _WHITESPACE:
+                if chars:
+                    break
+                continue
+            chars.append(char)
+        token = b''.join(chars)
+        return token.decode('utf-8') if token else None
+
+    chunks = []
+    while True:
+        buf = fd.peek(256)
+        if not buf:
+            break
+        if not chunks:
+            # Skip leading whitespace (v.gr. newlines between text objects).
+            stripped = buf.lstrip(_WHITESPACE)
+            if len(stripped) < len(buf):
+                fd.read(len(buf) - len(stripped))
+                continue
+        match = _WHITESPACE_REGEX.search(buf)
+        if match is None:
+            chunks.append(fd.read(len(buf)))
+            continue
+        chunks.append(fd.read(match.start()))
+        fd.read(1)
+        break
+    token = b''.join(chunks)
+    return token.decode('utf-8') if token else None
+
+
+def _read_int32(fd):
+    size, value = struct.unpack('<bi', bytes(_read_exactly(fd, 5)))
+    if size != 4:
+        raise ValueError("Expected a 4-byte integer in Kaldi object, got "
+                         "size {0}".format(size))
+    return value
+
+
+def _uncompress(token, fd):
+    """ Decodes a CompressedMatrix (after its token) as a float32 matrix,
+    with the same arithmetic as Kaldi's CompressedMatrix::CopyToMat. """
+    min_value, value_range, num_rows, num_cols = struct.unpack(
+        '<ffii', bytes(_read_exactly(fd, 16)))
+    min_value, value_range = np.float32(min_value), np.float32(value_range)
+
+    if token == 'CM':
+        # Four uint16 percentiles per column, then one byte per element,
+        # stored column by column.
+        headers = np.frombuffer(_read_exactly(fd, 8 * num_cols),
+                                dtype='<u2').reshape(num_cols, 4)
+        data = np.frombuffer(_read_exactly(fd, num_rows * num_cols),
+                             dtype=np.uint8).reshape(num_cols, num_rows)
+        percentiles = (min_value + value_range * np.float32(1.52590218966964e-05)
+                       * headers.astype(np.float32))
+        p0, p25, p75, p100 = [percentiles[:, k:k + 1] for k in range(4)]
+        values = data.astype(np.float32)
+        mat = np.where(
+            data <= 64, p0 + (p25 - p0) * values * np.float32(1 / 64.0),
+            np.where(data <= 192,
+                     p25 + (p75 - p25) * (values - 64) * np.float32(1 / 128.0),
+                     p75 + (p100 - p75) * (values - 192) * np.float32(1 / 63.0)))
+        return np.ascontiguousarray(mat.T, dtype=np.float32)
+
+    if token == 'CM2':
+        data = np.frombuffer(_read_exactly(fd, 2 * num_rows * num_cols),
+                             dtype='<u2')
+        increment = np.float32(value_range * (1.0 / 65535.0))
+    else:
+        data = np.frombuffer(_read_exactly(fd, num_rows * num_cols),
+                             dtype=np.uint8)
+        increment = np.float32(value_range * (1.0 / 255.0))
+    mat = min_value + increment * data.astype(np.float32)
+    return mat.reshape(num_rows, num_cols)
+
+
+def read_binary_object(fd):
+    """ Reads a binary Kaldi object (after its "\\0B" header) from fd and
+    returns it as a NumPy array: 2-d for matrices, 1-d for vectors, int32
+    for integer vectors. """
+    _check_numpy()
+    if hasattr(fd, 'peek'):
+        prefix = b''
+        is_int_vector = fd.peek(1)[:1] == b'\x04'
+    else:
+        prefix = fd.read(1)
+        is_int_vector = prefix == b'\x04'
+
+    if is_int_vector:
+        # Integer vector: no token, size and then (size, value) pairs.
+        if not prefix:
+            fd.read(1)
+        size = struct.unpack('<i', bytes(_read_exactly(fd, 4)))[0]
+        data = _read_exactly(fd, 5 * size)
+        return np.frombuffer(data, dtype=_INT32_VECTOR_DTYPE)['value'].astype(
+            np.int32)
+
+    token = prefix.decode('utf-8') + (read_token(fd) or '')
+    if token in ('FM', 'DM'):
+        num_rows = _read_int32(fd)
+        num_cols = _read_int32(fd)
+        dtype = np.dtype(_BINARY_DTYPES[token])
+        data = _read_exactly(fd, num_rows * num_cols * dtype.itemsize)
+        return np.frombuffer(data, dtype=dtype).reshape(num_rows, num_cols)
+    if token in ('FV', 'DV'):
+        dim = _read_int32(fd)
+        dtype = np.dtype(_BINARY_DTYPES[token])
+        return np.frombuffer(_read_exactly(fd, dim * dtype.itemsize),
+                             dtype=dtype)
+    if token in ('CM', 'CM2', 'CM3'):
+        return _uncompress(token, fd)
+
+    raise ValueError("Unsupported binary Kaldi object type {0}".format(token))
+
+
+def _read_text_object(fd, prefix=b''):
+    """ Reads a matrix ("[\\n rows ]") or a vector ("[ values ]") in text
+    format from a binary stream. The values are parsed as float64, like
+    read_matrix_ascii() does. """
+    rows = []
+    line = prefix + fd.readline()
+    fields = line.split()
+    if not fields or fields[0] != b'[':
+        raise ValueError("Kaldi object has incorrect format: "
+                         "{0}".format(line[:100]))
+    fields = fields[1:]
+    is_vector = bool(fields)
+    while True:
+        if fields and fields[-1] == b']':
+            if fields[:-1]:
+                rows.append(fields[:-1])
+            break
+        if fields:
+            rows.append(fields)
+        line = fd.readline()
+        if not line:
+            raise ValueError("Kaldi object has incorrect format; got EOF "
+                             "before the end of the object")
+        fields = line.split()
+
+    if is_vector:
+        return np.array(rows[0] if rows else [], dtype=np.float64)
+    return np.array(rows, dtype=np.float64).reshape(len(rows), -1)
+
+
+def read_kaldi_object(fd):
+    """ Reads the Kaldi object at the current position of the binary stream
+    fd, in binary or in text format, into a NumPy array. """
+    _check_numpy()
+    if hasattr(fd, 'peek'):
+        header = fd.peek(2)[:2]
+        if header == b'\0B':
+            fd.read(2)
+            return read_binary_object(fd)
+        return _read_text_object(fd)
+
+    header = fd.read(2)
+    if header == b'\0B':
+        return read_binary_object(fd)
+    return _read_text_object(fd, header)
+
+
+def read_ark(file_or_fd):
+    """ Reads a Kaldi archive, in binary or text format, and yields
+    (key, NumPy array) pairs.
+    The input can be a file name, '-' for stdin or an opened file object.
+
+    Example usage:
+    mat_dict = { key: mat for key, mat in read_ark(file) }
+    """
+    fd, opened = _open_binary(file_or_fd, 'rb')
+    try:
+        key = read_token(fd)
+        while key:
+            yield key, read_kaldi_object(fd)
+            key = read_token(fd)
+    finally:
+        if opened:
+            fd.close()
+
+
+def _parse_range(range_spec):
+    """ Converts a Kaldi range "[r1:r2]" or "[r1:r2,c1:c2]" (inclusive
+    ends, empty for all) to a tuple of slices. """
+    slices = []
+    for part in range_spec.split(','):
+        part = part.strip()
+        if part in ('', ':'):
+            slices.append(slice(None))
+        else:
+            first, last = part.split(':')
+            slices.append(slice(int(first), int(last) + 1))
+    return tuple(slices)
+
+
+def read_rxfilename(rxfilename, handles=None):
+    """ Reads the object of an rxfilename, as found in scp files:
+    "file.ark:offset" (random access with seek), "file" (a single object),
+    or "command |", optionally followed by a row/column range
+    "[r1:r2,c1:c2]".
+    handles: optional dictionary of open files, reused between calls (see
+    read_scp()).
+    """
+    _check_numpy()
+    rxfilename = rxfilename.strip()
+    ranges = None
+    match = _RANGE_REGEX.match(rxfilename)
+    if match is not None:
+        rxfilename, ranges = match.group(1), _parse_range(match.group(2))
+
+    if rxfilename.endswith('|'):
+        p = subprocess.Popen(rxfilename[:-1], shell=True,
+                             stdout=subprocess.PIPE)
+        try:
+            obj = read_kaldi_object(p.stdout)
+        finally:
+            p.stdout.close()
+            p.wait()
+        if p.returncode != 0:
+            raise RuntimeError("Command {0} exited with status "
+                               "{1}".format(rxfilename, p.returncode))
+    else:
+        path, offset = rxfilename, None
+        parts = rxfilename.rsplit(':', 1)
+        if len(parts) == 2 and parts[1].isdigit():
+            path, offset = parts[0], int(parts[1])
+
+        if handles is not None and path in handles:
+            fd = handles[path]
+        else:
+            fd = open(path, 'rb')
+            if handles is not None:
+                handles[path] = fd
+        try:
+            fd.seek(offset or 0)
+            obj = read_kaldi_object(fd)
+        finally:
+            if handles is None:
+                fd.close()
+
+    if ranges is not None:
+        obj = obj[ranges]
+    return obj
+
+
+def read_scp(file_or_fd):
+    """ Reads the objects of a Kaldi scp file, in order, and yields
+    (key, NumPy array) pairs. Archives are opened once and accessed by
+    seeking to the offsets of the scp file. """
+    fd, opened = _open_binary(file_or_fd, 'rb')
+    handles = {}
+    try:
+        for line in fd:
+            parts = line.decode('utf-8').strip().split(None, 1)
+            if not parts:
+                continue
+            if len(parts) != 2:
+                raise ValueError("Could not parse line {0} in scp "
+                                 "file".format(line))
+            yield parts[0], read_rxfilename(parts[1], handles)
+    finally:
+        for handle in handles.values():
+            handle.close()
+        if opened:
+            fd.close()
+
+
+def write_binary_object(file_or_fd, obj, key=None):
+    """ Writes a NumPy array (or list of lists, or np.matrix) in binary Kaldi
+    format: float32/float64 2-d arrays as FM/DM matrices, 1-d arrays as
+    FV/DV vectors and integer 1-d arrays as int32 vectors. Other floating
+    types are written as float32.
+    If key is provided, the object is written to an archive with the 'key'
+    as the index field.
+    Returns the offset of the object in the file (as needed for an scp
+    file), or None if the destination is not seekable.
+    """
+    _check_numpy()
+    fd, opened = _open_binary(file_or_fd, 'wb')
+    try:
+        if key is not None:
+            fd.write(key.encode('utf-8') + b' ')
+        try:
+            offset = fd.tell()
+        except (IOError, OSError):
+            offset = None
+
+        obj = np.asarray(obj)
+        fd.write(b'\0B')
+        if obj.ndim == 1 and np.issubdtype(obj.dtype, np.integer):
+            data = np.empty(len(obj), dtype=_INT32_VECTOR_DTYPE)
+            data['size'] = 4
+            data['value'] = obj
+            fd.write(struct.pack('<bi', 4, len(obj)))
+            fd.write(data.tobytes())
+        elif obj.ndim in (1, 2):
+            double = obj.dtype == np.float64
+            dtype = '<f8' if double else '<f4'
+            if obj.ndim == 2:
+                fd.write(b'DM ' if double else b'FM ')
+                fd.write(struct.pack('<bibi', 4, obj.shape[0],
+                                     4, obj.shape[1]))
+            else:
+                fd.write(b'DV ' if double else b'FV ')
+                fd.write(struct.pack('<bi', 4, obj.shape[0]))
+            fd.write(np.ascontiguousarray(obj, dtype=dtype).tobytes())
+        else:
+            raise ValueError("Only vectors and matrices can be written, got "
+                             "an array of shape {0}".format(obj.shape))
+    finally:
+        if opened:
+            fd.close()
+    return offset
+
+
 def force_symlink(file1, file2):
     import errno
     try:
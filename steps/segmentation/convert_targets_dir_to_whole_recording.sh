@@ -20,6 +20,7 @@
 # combined using the weights in steps/segmentation/merge_targets_dirs.sh
 
 nj=4
+num_threads=1   # recordings merged in parallel within each job
 cmd=run.pl
 default_targets=   # vector of default targets in text format
 
@@ -105,9 +106,10 @@ dir=`perl -e '($dir,$pwd)= @ARGV; if($dir!~m:^/:) { $dir = "$pwd/$dir"; } print
 utils/data/get_utt2num_frames.sh --cmd "$cmd" --nj $nj $whole_data
 cp $whole_data/utt2num_frames $dir/reco2num_frames
 
-$cmd JOB=1:$nj $dir/log/merge_targets_to_reco.JOB.log \
+$cmd --num-threads $num_threads JOB=1:$nj $dir/log/merge_targets_to_reco.JOB.log \
   steps/segmentation/internal/merge_segment_targets_to_recording.py \
     --reco2num-frames=$dir/reco2num_frames --frame-shift=$frame_shift \
+    --num-jobs=$num_threads \
     --default-targets="$default_targets" \
     $dir/split${nj}reco/reco2utt.JOB $dir/split${nj}reco/segments.JOB \
     $dir/split${nj}reco/targets.JOB.scp - \| \
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+# Apache 2.0
+
+"""
+Microbenchmark of merge_targets.py: merges synthetic pasted targets of
+1-hour recordings (360000 frames at 10 ms) with the frame-by-frame
+implementation the script used before and with merge_targets(), checks that
+the outputs are identical and prints the time of both.
+
+Usage: steps/segmentation/internal/benchmark_merge_targets.py [options]
+ e.g.: steps/segmentation/internal/benchmark_merge_targets.py --hours=1 --num-sources=3
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from merge_targets import merge_targets, should_remove_frame
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Microbenchmark of merge_targets.py")
+    parser.add_argument("--hours", type=float, default=1.0,
+                        help="Length of each synthetic recording")
+    parser.add_argument("--num-recordings", type=int, default=1,
+                        help="Number of synthetic recordings")
+    parser.add_argument("--num-sources", type=int, default=3)
+    parser.add_argument("--dim", type=int, default=3)
+    parser.add_argument("--frame-shift", type=float, default=0.01)
+    return parser.parse_args()
+
+
+def synthetic_targets(num_frames, num_sources, dim, rng):
+    """Pasted targets in which the sources mostly agree: a random class per
+    frame, with some disagreeing and some unconfident sources."""
+    classes = rng.randint(dim, size=num_frames)
+    mat = np.zeros([num_frames, num_sources * dim])
+    for i in range(num_sources):
+        source_classes = np.where(rng.rand(num_frames) < 0.1,
+                                  rng.randint(dim, size=num_frames), classes)
+        probs = rng.dirichlet(np.ones(dim) * 0.3, size=num_frames)
+        probs[np.arange(num_frames), source_classes] += rng.rand(num_frames)
+        probs /= probs.sum(axis=1, keepdims=True)
+        mat[:, i * dim:(i + 1) * dim] = probs
+    return mat.astype(np.float32)
+
+
+def legacy_merge(mat, dim, weights=None, remove_mismatch_frames=False):
+    """The per-frame implementation of merge_targets.py."""
+    mat = np.matrix(mat, dtype=np.float64)
+    num_sources = mat.shape[1] // dim
+    out_mat = np.matrix(np.zeros([mat.shape[0], dim]))
+
+    if remove_mismatch_frames:
+        for n in range(mat.shape[0]):
+            if should_remove_frame(mat[n, :].getA()[0], dim):
+                out_mat[n, :] = np.zeros([1, dim])
+            else:
+                for i in range(num_sources):
+                    out_mat[n, :] += (
+                        mat[n, (i * dim): ((i+1) * dim)]
+                        * (1.0 if weights is None else weights[i]))
+    else:
+        for i in range(num_sources):
+            out_mat += (mat[:, (i * dim): ((i+1) * dim)]
+                        * (1.0 if weights is None else weights[i]))
+    return out_mat.getA()
+
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return result, time.time() - start
+
+
+def main():
+    args = get_args()
+    rng = np.random.RandomState(0)
+    num_frames = int(args.hours * 3600 / args.frame_shift)
+    weights = list(rng.dirichlet(np.ones(args.num_sources)))
+
+    for remove in (False, True):
+        legacy_time = new_time = 0.0
+        for _ in range(args.num_recordings):
+            mat = synthetic_targets(num_frames, args.num_sources, args.dim,
+                                    rng)
+            legacy, seconds = timed(legacy_merge, mat, args.dim, weights,
+                                    remove)
+            legacy_time += seconds
+            new, seconds = timed(merge_targets, mat, args.dim, weights,
+                                 remove)
+            new_time += seconds
+            assert np.array_equal(legacy, new)
+
+        print("remove-mismatch-frames={0}: {1} x {2} frames".format(
+            str(remove).lower(), args.num_recordings, num_frames))
+        print("  per-frame:     {0:.3f}s".format(legacy_time))
+        print("  merge_targets: {0:.3f}s ({1:.0f}x)".format(
+            new_time, legacy_time / max(new_time, 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,13 +8,17 @@ This script merges targets matrices corresponding to
 segments into targets matrix for whole recording. The frames that are not
 in any of the segments are assigned the default targets vector, specified by
 the option --default-targets or [ 0 0 0 ] if unspecified.
+
+The targets matrices are read directly from their (binary) archives, in the
+order of the archive offsets, and the recordings can be processed in parallel
+(--num-jobs).
 """
 from __future__ import division
 
 import argparse
 import logging
+import multiprocessing
 import numpy as np
-import subprocess
 import sys
 
 sys.path.insert(0, 'steps')
@@ -43,6 +47,8 @@ def get_args():
                         "region")
     parser.add_argument("--length-tolerance", type=int, default=4,
                         help="Tolerate length mismatches of this many frames")
+    parser.add_argument("--num-jobs", type=int, default=1,
+                        help="Number of recordings processed in parallel")
     parser.add_argument("--verbose", type=int, default=0, choices=[0, 1, 2],
                         help="Verbose level")
 
@@ -139,6 +145,172 @@ def read_targets_scp(targets_scp, segments):
     return targets
 
 
+def kaldi_text_precision(mat):
+    """Rounds the values of a matrix the way 'copy-feats --binary=false'
+    prints them (6 significant digits) and reads them back as float32, so
+    that the output is the same as when the targets were read in text
+    format."""
+    if mat.size == 0:
+        return mat.astype('float32')
+    text = np.char.mod('%g', mat.astype(np.float64))
+    return text.astype(np.float64).astype('float32')
+
+
+def read_targets(targets_rxfilenames, handles):
+    """Reads the targets matrices of a list of utterances, in the order of
+    their archives and offsets (so every archive is read forward).
+    Returns a dictionary from utterance-id to matrix."""
+    def position(utt):
+        rxfilename = targets_rxfilenames[utt]
+        path, _, offset = rxfilename.partition(':')
+        offset = offset.split('[')[0]
+        return (path, int(offset) if offset.isdigit() else -1)
+
+    mats = {}
+    for utt in sorted(targets_rxfilenames, key=position):
+        mats[utt] = kaldi_text_precision(common_lib.read_rxfilename(
+            targets_rxfilenames[utt], handles))
+    return mats
+
+
+def merge_recording(reco, utts, num_frames_reco, segments, targets,
+                    default_targets, frame_shift, length_tolerance,
+                    handles=None):
+    """Merges the targets of the utterances of a recording.
+    Returns the recording-level matrix, the number of utterances merged and
+    the number of utterances with errors."""
+    num_utt_err = 0
+    num_utt = 0
+
+    reco_mat = np.repeat(default_targets, num_frames_reco, axis=0)
+    utts.sort(key=lambda x: segments[x][1])   # sort on start time
+
+    mats = read_targets({utt: targets[utt] for utt in utts
+                         if utt in segments and utt in targets},
+                        handles if handles is not None else {})
+
+    end_frame_accounted = 0
+
+    for i, utt in enumerate(utts):
+        if utt not in segments or utt not in targets:
+            num_utt_err += 1
+            continue
+        segment = segments[utt]
+
+        # Read the targets corresponding to the segments
+        mat = mats[utt]
+
+        start_frame = int(segment[1] / frame_shift + 0.5)
+        end_frame = int(segment[2] / frame_shift + 0.5)
+        num_frames = end_frame - start_frame
+
+        if num_frames <= 0:
+            raise ValueError("Invalid line in segments file {0}"
+                             "".format(segment))
+
+        if abs(mat.shape[0] - num_frames) > length_tolerance:
+            logger.warning("For utterance {utt}, mismatch in segment "
+                           "length and targets matrix size; "
+                           "{s_len} vs {t_len}".format(
+                               utt=utt, s_len=num_frames,
+                               t_len=mat.shape[0]))
+            num_utt_err += 1
+            continue
+
+        # Fix end_frame and num_frames if the segment goes beyond
+        # the length of the recording.
+        if end_frame > num_frames_reco:
+            end_frame = num_frames_reco
+            num_frames = end_frame - start_frame
+
+        # Fix "num_frames" and "end_frame" if "num_frames" is lower
+        # than the size of the targets matrix "mat"
+        num_frames = min(num_frames, mat.shape[0])
+        end_frame = start_frame + num_frames
+
+        if num_frames <= 0:
+            logger.warning("For utterance {utt}, start-frame {start} "
+                           "is outside the recording"
+                           "".format(utt=utt, start=start_frame))
+            num_utt_err += 1
+            continue
+
+        if end_frame < end_frame_accounted:
+            logger.warning("For utterance {utt}, end-frame {end} "
+                           "is before the end of a previous segment. "
+                           "i.e. this segment is completely within "
+                           "another segment. Ignoring this segment."
+                           "".format(utt=utt, end=end_frame))
+            num_utt_err +=1
+            continue
+
+        if start_frame < end_frame_accounted:
+            # Segment overlaps with a previous utterance
+            # Combine targets using a weighted interpolation using a
+            # triangular window with a weight of 1 at the start/end of
+            # overlap and 0 at the end/start of the segment
+            overlap = end_frame_accounted - start_frame
+            w = (np.arange(overlap) / float(overlap))[:, np.newaxis]
+            reco_mat[start_frame:end_frame_accounted, :] = (
+                reco_mat[start_frame:end_frame_accounted, :] * (1.0 - w)
+                + mat[0:overlap, :].astype(np.float64) * w)
+
+            if end_frame > end_frame_accounted:
+                reco_mat[end_frame_accounted:end_frame, :] = (
+                    mat[(end_frame_accounted-start_frame):
+                        (end_frame-start_frame), :])
+        else:
+            # No overlap with the previous utterances.
+            # So just add it to the output.
+            reco_mat[start_frame:end_frame, :] = (
+                mat[0:num_frames, :])
+        logger.debug("reco_mat shape = %s, mat shape = %s, "
+                     "start_frame = %d, end_frame = %d", reco_mat.shape,
+                     mat.shape, start_frame, end_frame)
+
+        end_frame_accounted = end_frame
+        num_utt += 1
+
+    return reco_mat, num_utt, num_utt_err
+
+
+class _TextMatrix(object):
+    """Collects the output of common_lib.write_matrix_ascii."""
+    def __init__(self):
+        self.lines = []
+
+    def write(self, text):
+        self.lines.append(text)
+
+
+# State of the worker processes (see run()).
+_worker_args = None
+_worker_handles = {}
+
+
+def _init_worker(worker_args):
+    global _worker_args
+    _worker_args = worker_args
+
+
+def _merge_task(task):
+    """Merges a recording and returns it already formatted as text, with
+    the counts of merged utterances and errors."""
+    reco, utts = task
+    (reco2num_frames, segments, targets, default_targets, frame_shift,
+     length_tolerance) = _worker_args
+    reco_mat, num_utt, num_utt_err = merge_recording(
+        reco, utts, reco2num_frames[reco], segments, targets,
+        default_targets, frame_shift, length_tolerance, _worker_handles)
+
+    text = None
+    if reco_mat.shape[0] > 0:
+        out = _TextMatrix()
+        common_lib.write_matrix_ascii(out, reco_mat, key=reco)
+        text = ''.join(out.lines)
+    return text, num_utt, num_utt_err
+
+
 def run(args):
     reco2utt = read_reco2utt_file(args.reco2utt)
     reco2num_frames = read_reco2num_frames_file(args.reco2num_frames)
@@ -147,7 +319,7 @@ def run(args):
 
     if args.default_targets is not None:
         # Read the vector of default targets for out-of-segment regions
-        default_targets = np.matrix(
+        default_targets = np.array(
             common_lib.read_matrix_ascii(args.default_targets))
     else:
         default_targets = np.zeros([1, 3])
@@ -158,117 +330,33 @@ def run(args):
     num_utt = 0
     num_reco = 0
 
-    with common_lib.smart_open(args.out_targets_ark, 'w') as fh:
-        for reco, utts in reco2utt.items():
-            # Read a recording and the list of its utterances from the
-            # reco2utt dictionary
-            reco_mat = np.repeat(default_targets, reco2num_frames[reco],
-                                 axis=0)
-            utts.sort(key=lambda x: segments[x][1])   # sort on start time
-
-            end_frame_accounted = 0
-
-            for i, utt in enumerate(utts):
-                if utt not in segments or utt not in targets:
-                    num_utt_err += 1
-                    continue
-                segment = segments[utt]
-
-                # Read the targets corresponding to the segments
-                cmd = ("copy-feats --binary=false {mat_fn} -"
-                       "".format(mat_fn=targets[utt]))
-                p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE)
-
-                try:
-                    mat = np.matrix(common_lib.read_matrix_ascii(p.stdout),
-                                    dtype='float32')
-                except Exception:
-                    logger.error("Command '{cmd}' failed".format(cmd=cmd))
-                    raise
-                finally:
-                    [stdout, stderr] = p.communicate()
-                    if p.returncode is not None and p.returncode != 0:
-                        raise RuntimeError(
-                            'Command "{cmd}" failed with status {status}; '
-                            'stderr = {stderr}'.format(cmd=cmd, status=-p.returncode,
-                                                       stderr=stderr))
-
-                start_frame = int(segment[1] / args.frame_shift + 0.5)
-                end_frame = int(segment[2] / args.frame_shift + 0.5)
-                num_frames = end_frame - start_frame
-
-                if num_frames <= 0:
-                    raise ValueError("Invalid line in segments file {0}"
-                                     "".format(segment))
-
-                if abs(mat.shape[0] - num_frames) > args.length_tolerance:
-                    logger.warning("For utterance {utt}, mismatch in segment "
-                                   "length and targets matrix size; "
-                                   "{s_len} vs {t_len}".format(
-                                       utt=utt, s_len=num_frames,
-                                       t_len=mat.shape[0]))
-                    num_utt_err += 1
-                    continue
-
-                # Fix end_frame and num_frames if the segment goes beyond
-                # the length of the recording.
-                if end_frame > reco2num_frames[reco]:
-                    end_frame = reco2num_frames[reco]
-                    num_frames = end_frame - start_frame
-
-                # Fix "num_frames" and "end_frame" if "num_frames" is lower
-                # than the size of the targets matrix "mat"
-                num_frames = min(num_frames, mat.shape[0])
-                end_frame = start_frame + num_frames
-
-                if num_frames <= 0:
-                    logger.warning("For utterance {utt}, start-frame {start} "
-                                   "is outside the recording"
-                                   "".format(utt=utt, start=start_frame))
-                    num_utt_err += 1
-                    continue
-
-                if end_frame < end_frame_accounted:
-                    logger.warning("For utterance {utt}, end-frame {end} "
-                                   "is before the end of a previous segment. "
-                                   "i.e. this segment is completely within "
-                                   "another segment. Ignoring this segment."
-                                   "".format(utt=utt, end=end_frame))
-                    num_utt_err +=1
-                    continue
-
-                if start_frame < end_frame_accounted:
-                    # Segment overlaps with a previous utterance
-                    # Combine targets using a weighted interpolation using a
-                    # triangular window with a weight of 1 at the start/end of
-                    # overlap and 0 at the end/start of the segment
-                    for n in range(0, end_frame_accounted - start_frame):
-                        w = float(n) / float(end_frame_accounted - start_frame)
-                        reco_mat[n + start_frame, :] = (
-                            reco_mat[n + start_frame, :] * (1.0 - w)
-                            + mat[n, :] * w)
-
-                    if end_frame > end_frame_accounted:
-                        reco_mat[end_frame_accounted:end_frame, :] = (
-                            mat[(end_frame_accounted-start_frame):
-                                (end_frame-start_frame), :])
-                else:
-                    # No overlap with the previous utterances.
-                    # So just add it to the output.
-                    reco_mat[start_frame:end_frame, :] = (
-                        mat[0:num_frames, :])
-                logger.debug("reco_mat shape = %s, mat shape = %s, "
-                             "start_frame = %d, end_frame = %d", reco_mat.shape,
-                             mat.shape, start_frame, end_frame)
-
-                end_frame_accounted = end_frame
-                num_utt += 1
-
-            if reco_mat.shape[0] > 0:
-                common_lib.write_matrix_ascii(fh, reco_mat,
-                                              key=reco)
-                num_reco += 1
+    worker_args = (reco2num_frames, segments, targets, default_targets,
+                   args.frame_shift, args.length_tolerance)
+    tasks = list(reco2utt.items())
+
+    if args.num_jobs > 1:
+        pool = multiprocessing.Pool(args.num_jobs, _init_worker,
+                                    (worker_args,))
+        results = pool.imap(_merge_task, tasks)
+    else:
+        pool = None
+        _init_worker(worker_args)
+        results = (_merge_task(task) for task in tasks)
+
+    try:
+        with common_lib.smart_open(args.out_targets_ark, 'w') as fh:
+            for text, reco_num_utt, reco_num_utt_err in results:
+                num_utt += reco_num_utt
+                num_utt_err += reco_num_utt_err
+                if text is not None:
+                    fh.write(text)
+                    num_reco += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for handle in _worker_handles.values():
+            handle.close()
 
     logger.info("Merged {num_utt} segment targets from {num_reco} recordings; "
                 "failed with {num_utt_err} utterances"
@@ -9,11 +9,14 @@ single targets matrices.
 
 Usage: merge_targets.py [options] <pasted-targets> <out-targets>
  e.g.: paste-feats scp:targets1.scp scp:targets2.scp ark,t:- | merge_targets.py --dim=3 - - | copy-feats ark,t:- ark:-
+       paste-feats scp:targets1.scp scp:targets2.scp ark:- | merge_targets.py --binary=true --dim=3 - - | copy-feats ark:- ark:-
 
 <pasted-targets> is matrix archive with matrices corresponding to
 targets from multiple sources appended together using paste-feats.
 The column dimension is num-sources * dim, which dim is specified by --dim
-option.
+option. It can be in binary or text format. The utterances are processed
+one at a time, with all the frames of an utterance handled as arrays of
+shape (frames, sources, dim).
 """
 
 import argparse
@@ -41,6 +44,7 @@ def get_args():
     single targets matrices.
     Usage: merge_targets.py [options] <pasted-targets> <out-targets>
      e.g.: paste-feats scp:targets1.scp scp:targets2.scp ark,t:- | merge_targets.py --dim=3 - - | copy-feats ark,t:- ark:-
+           paste-feats scp:targets1.scp scp:targets2.scp ark:- | merge_targets.py --binary=true --dim=3 - - | copy-feats ark:- ark:-
     """,
         formatter_class=argparse.RawTextHelpFormatter)
 
@@ -62,6 +66,10 @@ def get_args():
                         "they occur at different indexes e.g. silence prob is "
                         "> 0.5 for the targets from alignment, and speech prob "
                         "> 0.5 for the targets from decoding.")
+    parser.add_argument("--binary", type=str, default=False,
+                        choices=["true", "false"],
+                        action=common_lib.StrToBoolAction,
+                        help="Write the output targets in binary format")
 
     parser.add_argument("pasted_targets", type=str,
                         help="Input target matrices with columns appended "
@@ -157,42 +165,83 @@ def should_remove_frame(row, dim):
     return False
 
 
+def mismatch_frames(targets):
+    """Returns a boolean mask over frames, True for the frames that
+    should_remove_frame() would remove.
+
+    Input:
+        targets -- array of shape (frames, num-sources, dim)
+    """
+    num_frames, num_sources, dim = targets.shape
+    flat = targets.reshape(num_frames, num_sources * dim)
+    frames = np.arange(num_frames)
+
+    max_idx = np.argmax(flat, axis=1)
+    max_val = flat[frames, max_idx]
+    best_source = max_idx // dim
+    best_class = max_idx % dim
+
+    # Best class and value of every source.
+    source_idx = np.argmax(targets, axis=2)
+    source_val = np.take_along_axis(targets, source_idx[:, :, np.newaxis],
+                                    axis=2)[:, :, 0]
+    confident_in_source = source_val > 0.5
+
+    # Confident in a source other than the 'best_source', with a different
+    # best class.
+    other_source = (np.arange(num_sources)[np.newaxis, :]
+                    != best_source[:, np.newaxis])
+    mismatch = np.any(confident_in_source & other_source
+                      & (source_idx != best_class[:, np.newaxis]), axis=1)
+
+    return (max_val < 0.5) | ((confident_in_source.sum(axis=1) != 1)
+                              & mismatch)
+
+
+def merge_targets(mat, dim, weights=None, remove_mismatch_frames=False):
+    """Merges a matrix of pasted targets (frames x (num-sources * dim)) into
+    a (frames x dim) matrix: the weighted sum of the targets of the
+    sources, with the mismatch frames set to 0 if remove_mismatch_frames
+    is True."""
+    num_sources = mat.shape[1] // dim
+    targets = np.asarray(mat, dtype=np.float64).reshape(
+        mat.shape[0], num_sources, dim)
+
+    # Accumulated source by source, in the same order as the sum over the
+    # sources of the per-frame implementation, so the results are identical.
+    out_mat = np.zeros([mat.shape[0], dim])
+    for i in range(num_sources):
+        out_mat += targets[:, i, :] * (1.0 if weights is None
+                                       else weights[i])
+
+    if remove_mismatch_frames:
+        out_mat[mismatch_frames(targets), :] = 0
+    return out_mat
+
+
 def run(args):
     num_done = 0
 
-    with common_lib.smart_open(args.pasted_targets) as targets_reader, \
-            common_lib.smart_open(args.out_targets, 'w') as targets_writer:
-        for key, mat in common_lib.read_mat_ark(targets_reader):
-            mat = np.matrix(mat)
-            if mat.shape[1] % args.dim != 0:
+    with common_lib.smart_open(args.pasted_targets, 'rb') as targets_reader, \
+            common_lib.smart_open(args.out_targets,
+                                  'wb' if args.binary else 'w') as targets_writer:
+        for key, mat in common_lib.read_ark(targets_reader):
+            if mat.ndim != 2 or mat.shape[1] % args.dim != 0:
                 raise RuntimeError(
                     "For utterance {utt} in {f}, num-columns {nc} "
                     "is not a multiple of dim {dim}"
-                    "".format(utt=key, f=args.pasted_targets.name,
-                              nc=mat.shape[1], dim=args.dim))
-            num_sources = mat.shape[1] // args.dim
-
-            out_mat = np.matrix(np.zeros([mat.shape[0], args.dim]))
-
-            if args.remove_mismatch_frames:
-                for n in range(mat.shape[0]):
-                    if should_remove_frame(mat[n, :].getA()[0], args.dim):
-                        out_mat[n, :] = np.zeros([1, args.dim])
-                    else:
-                        for i in range(num_sources):
-                            out_mat[n, :] += (
-                                mat[n, (i * args.dim) : ((i+1) * args.dim)]
-                                * (1.0 if args.weights is None
-                                   else args.weights[i]))
+                    "".format(utt=key, f=args.pasted_targets,
+                              nc=mat.shape[-1], dim=args.dim))
+
+            out_mat = merge_targets(mat, args.dim, args.weights,
+                                    args.remove_mismatch_frames)
+
+            if args.binary:
+                common_lib.write_binary_object(
+                    targets_writer, out_mat.astype(np.float32), key=key)
             else:
-                # Just interpolate the targets
-                for i in range(num_sources):
-                    out_mat += (
-                        mat[:, (i * args.dim) : ((i+1) * args.dim)]
-                        * (1.0 if args.weights is None else args.weights[i]))
-
-            common_lib.write_matrix_ascii(targets_writer, out_mat.tolist(),
-                                          key=key)
+                common_lib.write_matrix_ascii(targets_writer, out_mat.tolist(),
+                                              key=key)
             num_done += 1
 
     logger.info("Merged {num_done} target matrices"
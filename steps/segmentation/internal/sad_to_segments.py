@@ -15,6 +15,9 @@ from __future__ import print_function
 import argparse
 import logging
 import sys
+import warnings
+
+import numpy as np
 
 sys.path.insert(0, 'steps')
 import libs.common as common_lib
@@ -67,6 +70,11 @@ and 2 for speech frames.
                              "This is after padding by --segment-padding seconds."
                              "0 means do not merge. Use 'inf' to not limit the duration.")
 
+    parser.add_argument("--batch-size", type=int, default=100,
+                        help="Number of recordings segmented together. "
+                             "With --verbose 2 or more, the stats are logged "
+                             "per batch.")
+
     parser.add_argument("in_sad", type=str,
                         help="Input file containing alignments in "
                              "text archive format")
@@ -151,136 +159,204 @@ def process_label(text_label):
     return prev_label
 
 
+def parse_alignment(text):
+    """Parses the labels of a line of the text archive (without the key)
+    into an integer array, without splitting the line into strings."""
+    with warnings.catch_warnings():
+        # Newer versions of numpy only warn when a token can not be parsed.
+        warnings.simplefilter("error", DeprecationWarning)
+        try:
+            return np.fromstring(text, dtype=np.int64, sep=' ')
+        except (ValueError, DeprecationWarning):
+            pass
+    return np.array([process_label(x) for x in text.split()],
+                    dtype=np.int64)
+
+
 class Segmentation(object):
-    """Stores segmentation for an utterances"""
+    """Stores the speech segments of one or more recordings.
+
+    The segments are kept as run-length arrays: 'starts' and 'ends' (in
+    seconds) and 'recordings', the index of the recording of each segment,
+    ordered by recording and then by time. All the post-processing stages
+    are array operations over all the recordings at once."""
 
     def __init__(self):
-        self.segments = None
+        self.starts = np.zeros(0)
+        self.ends = np.zeros(0)
+        self.recordings = np.zeros(0, dtype=np.int64)
+        self.num_recordings = 0
         self.stats = SegmenterStats()
 
+    @property
+    def segments(self):
+        """The segments as a list of [start, end, label]."""
+        return [[start, end, 2] for start, end in
+                zip(self.starts.tolist(), self.ends.tolist())]
+
     def initialize_segments(self, alignment, frame_shift=0.01):
         """Initializes segments from input alignment.
         The alignment is frame-level speech-activity detection marks,
         each of which must be 1 or 2."""
-        self.segments = []
-
-        assert len(alignment) > 0
-
-        prev_label = None
-        prev_length = 0
-        for i, text_label in enumerate(alignment):
-            if prev_label is not None and int(text_label) != prev_label:
-                if prev_label == 2:
-                    self.segments.append(
-                        [float(i - prev_length) * frame_shift,
-                         float(i) * frame_shift, prev_label])
-                    self.stats.initial_duration += (prev_length * frame_shift)
-                prev_label = process_label(text_label)
-                prev_length = 0
-            elif prev_label is None:
-                prev_label = process_label(text_label)
-
-            prev_length += 1
-
-        if prev_length > 0 and prev_label == 2:
-            self.segments.append(
-                [float(len(alignment) - prev_length) * frame_shift,
-                 float(len(alignment)) * frame_shift, prev_label])
-            self.stats.initial_duration += (prev_length * frame_shift)
-
-        self.stats.num_segments_initial = len(self.segments)
-        self.stats.num_segments_final = len(self.segments)
+        self.initialize_batch([alignment], frame_shift)
+
+    def initialize_batch(self, alignments, frame_shift=0.01):
+        """Initializes segments from the alignments of several recordings
+        (see initialize_segments)."""
+        labels = [np.asarray(alignment).astype(np.int64)
+                  for alignment in alignments]
+        assert all(len(x) > 0 for x in labels)
+
+        offsets = np.cumsum([0] + [len(x) for x in labels])
+        labels = np.concatenate(labels)
+        invalid = np.flatnonzero((labels != 1) & (labels != 2))
+        if len(invalid) > 0:
+            process_label(labels[invalid[0]])
+
+        # A run starts at every label change and at every recording start.
+        is_run_start = np.zeros(len(labels), dtype=bool)
+        is_run_start[np.flatnonzero(np.diff(labels)) + 1] = True
+        is_run_start[offsets[:-1]] = True
+        run_starts = np.flatnonzero(is_run_start)
+        run_ends = np.append(run_starts[1:], len(labels))
+
+        speech = labels[run_starts] == 2
+        run_starts = run_starts[speech]
+        run_ends = run_ends[speech]
+
+        self.num_recordings = len(offsets) - 1
+        self.recordings = np.searchsorted(offsets, run_starts,
+                                          side='right') - 1
+        run_starts = run_starts - offsets[self.recordings]
+        run_ends = run_ends - offsets[self.recordings]
+        self.starts = run_starts.astype(np.float64) * frame_shift
+        self.ends = run_ends.astype(np.float64) * frame_shift
+
+        self.stats.initial_duration += sum(
+            ((run_ends - run_starts) * frame_shift).tolist())
+        self.stats.num_segments_initial += len(self.starts)
+        self.stats.num_segments_final = len(self.starts)
         self.stats.final_duration = self.stats.initial_duration
 
+    def _keep(self, mask):
+        self.starts = self.starts[mask]
+        self.ends = self.ends[mask]
+        self.recordings = self.recordings[mask]
+        self.stats.num_segments_final = len(self.starts)
+
     def filter_short_segments(self, min_dur):
         """Filters out segments with durations shorter than 'min_dur'."""
         if min_dur <= 0:
             return
 
-        segments_kept = []
-        for segment in self.segments:
-            assert segment[2] == 2, segment
-            dur = segment[1] - segment[0]
-            if dur < min_dur:
-                self.stats.filter_short_duration += dur
-                self.stats.num_short_segments_filtered += 1
-            else:
-                segments_kept.append(segment)
-        self.segments = segments_kept
-        self.stats.num_segments_final = len(self.segments)
-        self.stats.final_duration -= self.stats.filter_short_duration
+        durations = self.ends - self.starts
+        short = durations < min_dur
+        filter_short_duration = sum(durations[short].tolist())
+        self.stats.filter_short_duration += filter_short_duration
+        self.stats.num_short_segments_filtered += int(np.count_nonzero(short))
+        self._keep(~short)
+        self.stats.final_duration -= filter_short_duration
 
     def pad_speech_segments(self, segment_padding, max_duration=float("inf")):
         """Pads segments by duration 'segment_padding' on either sides, but
         ensures that the segments don't go beyond the neighboring segments
-        or the duration of the utterance 'max_duration'."""
-        if max_duration == None:
+        or the duration of the utterance 'max_duration'.
+        In batch mode, 'max_duration' is a sequence with the duration of
+        every recording (None for no limit)."""
+        if max_duration is None:
             max_duration = float("inf")
-        for i, segment in enumerate(self.segments):
-            assert segment[2] == 2, segment
-            segment[0] -= segment_padding  # try adding padding on the left side
-            self.stats.padding_duration += segment_padding
-            if segment[0] < 0.0:
-                # Padding takes the segment start to before the beginning of the utterance.
-                # Reduce padding.
-                self.stats.padding_duration += segment[0]
-                segment[0] = 0.0
-            if i >= 1 and self.segments[i - 1][1] > segment[0]:
-                # Padding takes the segment start to before the end the previous segment.
-                # Reduce padding.
-                self.stats.padding_duration -= (
-                        self.segments[i - 1][1] - segment[0])
-                segment[0] = self.segments[i - 1][1]
-
-            segment[1] += segment_padding
-            self.stats.padding_duration += segment_padding
-            if segment[1] >= max_duration:
-                # Padding takes the segment end beyond the max duration of the utterance.
-                # Reduce padding.
-                self.stats.padding_duration -= (segment[1] - max_duration)
-                segment[1] = max_duration
-            if (i + 1 < len(self.segments)
-                    and segment[1] > self.segments[i + 1][0]):
-                # Padding takes the segment end beyond the start of the next segment.
-                # Reduce padding.
-                self.stats.padding_duration -= (
-                        segment[1] - self.segments[i + 1][0])
-                segment[1] = self.segments[i + 1][0]
-        self.stats.final_duration += self.stats.padding_duration
+        if np.ndim(max_duration) > 0:
+            max_duration = np.array(
+                [float("inf") if x is None else x for x in max_duration],
+                dtype=np.float64)[self.recordings]
+
+        # Neighbouring segments of the same recording.
+        same_recording = self.recordings[1:] == self.recordings[:-1]
+
+        # The end is limited by the duration of the utterance and by the
+        # (unpadded) start of the next segment; the start by the beginning of
+        # the utterance and by the (padded) end of the previous segment.
+        ends = np.minimum(self.ends + segment_padding, max_duration)
+        ends[:-1] = np.where(same_recording,
+                             np.minimum(ends[:-1], self.starts[1:]),
+                             ends[:-1])
+        starts = np.maximum(self.starts - segment_padding, 0.0)
+        starts[1:] = np.where(same_recording,
+                              np.maximum(starts[1:], ends[:-1]),
+                              starts[1:])
+
+        padding_duration = sum(((self.starts - starts)
+                                + (ends - self.ends)).tolist())
+        self.starts = starts
+        self.ends = ends
+        self.stats.padding_duration += padding_duration
+        self.stats.final_duration += padding_duration
 
     def merge_consecutive_segments(self, max_dur):
         """Merge consecutive segments (happens after padding), provided that
         the merged segment is no longer than 'max_dur'."""
-        if max_dur <= 0 or not self.segments:
+        num_segments = len(self.starts)
+        if max_dur <= 0 or num_segments == 0:
             return
 
-        merged_segments = [self.segments[0]]
-        for segment in self.segments[1:]:
-            assert segment[2] == 2, segment
-            if segment[0] == merged_segments[-1][1] and \
-                    segment[1] - merged_segments[-1][0] <= max_dur:
-                # The segment starts at the same time the last segment ends,
-                # and the merged segment is shorter than 'max_dur'.
-                # Extend the previous segment.
-                merged_segments[-1][1] = segment[1]
-                self.stats.num_merges += 1
-            else:
-                merged_segments.append(segment)
-
-        self.segments = merged_segments
-        self.stats.num_segments_final = len(self.segments)
+        # A segment can only be merged into the previous one if it starts at
+        # the same time the previous one ends.
+        touching = np.zeros(num_segments, dtype=bool)
+        touching[1:] = ((self.starts[1:] == self.ends[:-1])
+                        & (self.recordings[1:] == self.recordings[:-1]))
+        is_group_start = ~touching
+
+        if not np.isinf(max_dur):
+            # Within every chain of touching segments, a new merged segment
+            # is started at the first segment that would make it longer than
+            # 'max_dur'.
+            chain_starts = np.flatnonzero(is_group_start)
+            chain_ends = np.append(chain_starts[1:], num_segments)
+            for first, last in zip(chain_starts[chain_ends - chain_starts > 1],
+                                   chain_ends[chain_ends - chain_starts > 1]):
+                ends = self.ends[first:last]
+                group_start = 0
+                while True:
+                    start = self.starts[first + group_start]
+                    k = group_start + int(np.searchsorted(
+                        ends[group_start:], start + max_dur, side='right'))
+                    k = max(k, group_start + 1)
+                    # Compare exactly as a single subtraction does.
+                    while k < len(ends) and ends[k] - start <= max_dur:
+                        k += 1
+                    while k > group_start + 1 and ends[k - 1] - start > max_dur:
+                        k -= 1
+                    if k >= len(ends):
+                        break
+                    is_group_start[first + k] = True
+                    group_start = k
+
+        group_starts = np.flatnonzero(is_group_start)
+        group_ends = np.append(group_starts[1:], num_segments) - 1
+        self.stats.num_merges += num_segments - len(group_starts)
+        self.starts = self.starts[group_starts]
+        self.ends = self.ends[group_ends]
+        self.recordings = self.recordings[group_starts]
+        self.stats.num_segments_final = len(self.starts)
 
     def write(self, key, file_handle):
-        """Write segments to file"""
+        """Write segments to file. In batch mode, 'key' is the list of the
+        keys of the recordings."""
+        keys = [key] if self.num_recordings <= 1 else key
         if global_verbose >= 2:
             logger.info("For key {key}, got stats {stats}".format(
-                key=key, stats=self.stats))
-        for segment in self.segments:
-            seg_id = "{key}-{st:07d}-{end:07d}".format(
-                key=key, st=int(segment[0] * 100), end=int(segment[1] * 100))
-            print("{seg_id} {key} {st:.2f} {end:.2f}".format(
-                seg_id=seg_id, key=key, st=segment[0], end=segment[1]),
-                file=file_handle)
+                key=" ".join(keys), stats=self.stats))
+        lines = []
+        for recording, start, end, st, en in zip(
+                self.recordings.tolist(), self.starts.tolist(),
+                self.ends.tolist(),
+                (self.starts * 100).astype(np.int64).tolist(),
+                (self.ends * 100).astype(np.int64).tolist()):
+            utt_id = keys[recording]
+            lines.append("{key}-{st:07d}-{end:07d} {key} {start:.2f} "
+                         "{stop:.2f}\n".format(key=utt_id, st=st, end=en,
+                                               start=start, stop=end))
+        file_handle.write("".join(lines))
 
 
 def run(args):
@@ -298,28 +374,46 @@ def run(args):
     global_stats = SegmenterStats()
     with common_lib.smart_open(args.in_sad) as in_sad_fh, \
             common_lib.smart_open(args.out_segments, 'w') as out_segments_fh:
+        batch = []
         for line in in_sad_fh:
-            parts = line.strip().split()
-            utt_id = parts[0]
+            parts = line.strip().split(None, 1)
 
             if len(parts) < 2:
                 raise RuntimeError("Unable to parse line '{0}' in {1}"
                                    "".format(line.strip(),
                                              in_sad_fh))
 
-            segmentation = Segmentation()
-            segmentation.initialize_segments(
-                parts[1:], args.frame_shift)
-            segmentation.filter_short_segments(args.min_segment_dur)
-            segmentation.pad_speech_segments(args.segment_padding,
-                                             None if args.utt2dur is None
-                                             else utt2dur[utt_id])
-            segmentation.merge_consecutive_segments(args.merge_consecutive_max_dur)
-            segmentation.write(utt_id, out_segments_fh)
-            global_stats.add(segmentation.stats)
+            batch.append((parts[0], parse_alignment(parts[1])))
+            if len(batch) >= args.batch_size:
+                global_stats.add(process_batch(args, batch, utt2dur,
+                                               out_segments_fh))
+                batch = []
+        if batch:
+            global_stats.add(process_batch(args, batch, utt2dur,
+                                           out_segments_fh))
     logger.info(global_stats)
 
 
+def process_batch(args, batch, utt2dur, out_segments_fh):
+    """Segments the alignments of a batch of recordings, given as
+    (utt_id, labels) pairs, and writes the segments. Returns the stats of
+    the batch."""
+    utt_ids = [utt_id for utt_id, _ in batch]
+
+    segmentation = Segmentation()
+    segmentation.initialize_batch([labels for _, labels in batch],
+                                  args.frame_shift)
+    segmentation.filter_short_segments(args.min_segment_dur)
+    segmentation.pad_speech_segments(args.segment_padding,
+                                     [None] * len(batch)
+                                     if args.utt2dur is None
+                                     else [utt2dur[x] for x in utt_ids])
+    segmentation.merge_consecutive_segments(args.merge_consecutive_max_dur)
+    segmentation.write(utt_ids if len(batch) > 1 else utt_ids[0],
+                       out_segments_fh)
+    return segmentation.stats
+
+
 def main():
     """Parses arguments and calls the run method"""
     args = get_args()
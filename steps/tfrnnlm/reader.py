@@ -21,10 +21,16 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import hashlib
 import os
+import shutil
 
+import numpy as np
 import tensorflow as tf
 
+# Number of word-ids converted before they are appended to the cache file.
+_CHUNK_SIZE = 1 << 20
+
 def _read_words(filename):
   with tf.gfile.GFile(filename, "r") as f:
     return f.read().decode("utf-8").split()
@@ -35,9 +41,48 @@ def _build_vocab(filename):
   return word_to_id
 
 
+def _vocab_hash(word_to_id):
+  words = sorted(word_to_id, key=word_to_id.get)
+  return hashlib.sha1("\n".join(words).encode("utf-8")).hexdigest()[:16]
+
+
 def _file_to_word_ids(filename, word_to_id):
-  data = _read_words(filename)
-  return [word_to_id[word] for word in data if word in word_to_id]
+  """Converts a text file to word-ids, through an int32 .npy cache.
+
+  The first time a file is read with a given vocabulary, its word-ids are
+  written (a chunk at a time, words not in the vocabulary being skipped) to
+  "<filename>.<vocab-hash>.npy"; afterwards, and as long as the cache is newer
+  than the text, the cache is just memory-mapped, so the corpus never has to
+  fit in memory.
+
+  Returns:
+    a read-only np.memmap of the int32 word-ids.
+  """
+  cache_path = "{}.{}.npy".format(filename, _vocab_hash(word_to_id))
+  if (not os.path.exists(cache_path) or
+      os.path.getmtime(cache_path) < os.path.getmtime(filename)):
+    raw_path = cache_path + ".raw.tmp"
+    tmp_path = cache_path + ".tmp"
+    num_ids = 0
+    with tf.io.gfile.GFile(filename, "rb") as f, open(raw_path, "wb") as raw:
+      ids = []
+      for line in f:
+        ids.extend(word_to_id[word] for word in line.decode("utf-8").split()
+                   if word in word_to_id)
+        if len(ids) >= _CHUNK_SIZE:
+          np.array(ids, dtype=np.int32).tofile(raw)
+          num_ids += len(ids)
+          ids = []
+      np.array(ids, dtype=np.int32).tofile(raw)
+      num_ids += len(ids)
+    with open(tmp_path, "wb") as f, open(raw_path, "rb") as raw:
+      np.lib.format.write_array_header_1_0(
+          f, {"descr": np.lib.format.dtype_to_descr(np.dtype(np.int32)),
+              "fortran_order": False, "shape": (num_ids,)})
+      shutil.copyfileobj(raw, f)
+    os.remove(raw_path)
+    os.rename(tmp_path, cache_path)
+  return np.load(cache_path, mmap_mode="r")
 
 
 def rnnlm_raw_data(data_path, vocab_path):
@@ -47,8 +92,9 @@ def rnnlm_raw_data(data_path, vocab_path):
     data_path: string path to the directory where train/valid files are stored
 
   Returns:
-    tuple (train_data, valid_data, test_data, vocabulary)
-    where each of the data objects can be passed to RNNLMIterator.
+    tuple (train_data, valid_data, vocabulary, word_to_id)
+    where each of the data objects is a memory-mapped int32 array (see
+    _file_to_word_ids) that can be passed to RNNLMProducer.
   """
 
   train_path = os.path.join(data_path, "train")
@@ -90,7 +136,13 @@ def rnnlm_gen_data(*files):
 
 
 class RNNLMProducer(tf.Module):
-  """This is the data feeder."""
+  """This is the data feeder.
+
+  The batches are strided views of the word-ids (which may be a memory-mapped
+  array), so only the batch being fed is copied: batch i holds, for each of
+  its batch_size rows, num_steps consecutive words as inputs and the words
+  following them as targets.
+  """
 
   def __init__(self, raw_data, batch_size, num_steps, name=None):
     super().__init__(name)
@@ -98,16 +150,19 @@ class RNNLMProducer(tf.Module):
     self.num_steps = num_steps
     self.epoch_size = (len(raw_data) - 1) // num_steps // batch_size
 
-    # load data into a variable so that it will be separated from graph
-    self._raw_data = tf.Variable(raw_data, dtype=tf.int32, trainable=False)
+    raw_data = np.asarray(raw_data, dtype=np.int32)
+    shape = (self.epoch_size, batch_size, num_steps)
+    num_words = self.epoch_size * batch_size * num_steps
+    self._inputs = raw_data[:num_words].reshape(shape)
+    self._targets = raw_data[1:num_words + 1].reshape(shape)
+
+    spec = tf.TensorSpec(shape=(batch_size, num_steps), dtype=tf.int32)
+    self._ds = tf.data.Dataset.from_generator(self._batches,
+                                              output_signature=(spec, spec))
 
-    ds_x = tf.data.Dataset.from_tensor_slices(self._raw_data)
-    ds_y = ds_x.skip(1)
-    ds = tf.data.Dataset.zip((ds_x, ds_y))
-    # form samples
-    ds = ds.batch(num_steps, drop_remainder=True)
-    # form batches
-    self._ds = ds.batch(batch_size, drop_remainder=True)
+  def _batches(self):
+    for i in range(self.epoch_size):
+      yield self._inputs[i], self._targets[i]
 
   def iterate(self):
     return self._ds
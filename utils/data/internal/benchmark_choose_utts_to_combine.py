@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+# Apache 2.0
+
+""" Compares CombineList() and GetUtteranceGroups() of
+choose_utts_to_combine.py with the previous implementation of CombineList(),
+which rewrote the group-start of every member of a group on each merge, on
+synthetic speakers with many short utterances (like the sub-second chunks of
+ArchiMob).  Both have to give the same groups, and the time taken by each of
+them is printed.
+
+e.g.: python3 utils/data/internal/benchmark_choose_utts_to_combine.py \
+          --num-speakers 4 --utts-per-speaker 50000 --num-jobs 4
+With --max-utt-duration small enough that a whole speaker stays below
+--min-duration (e.g. 0.01), the previous implementation becomes quadratic.
+"""
+
+from __future__ import print_function
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from choose_utts_to_combine import LessThan, CombineList, GetUtteranceGroups
+
+
+def GetArgs():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the utterance-combination code")
+    parser.add_argument("--num-speakers", type = int, default = 4,
+                        help="Number of synthetic speakers")
+    parser.add_argument("--utts-per-speaker", type = int, default = 50000,
+                        help="Number of utterances of each speaker")
+    parser.add_argument("--min-utt-duration", type = float, default = 0.05,
+                        help="Minimum duration of the synthetic utterances")
+    parser.add_argument("--max-utt-duration", type = float, default = 1.0,
+                        help="Maximum duration of the synthetic utterances")
+    parser.add_argument("--min-duration", type = float, default = 1.55,
+                        help="Minimum duration of the combined utterances")
+    parser.add_argument("--num-jobs", type = int, default = 4,
+                        help="Number of processes for GetUtteranceGroups()")
+    parser.add_argument("--skip-legacy", action = "store_true",
+                        help="Do not run the previous implementation")
+    parser.add_argument("--seed", type = int, default = 0,
+                        help="Random seed")
+    return parser.parse_args()
+
+
+# The previous implementation of CombineList() (with group_start made a list,
+# as a range can't be assigned to in Python 3).
+def LegacyCombineList(min_duration, durations):
+    num_utts = len(durations)
+    group_start = list(range(num_utts))
+    group_durations = list(durations)
+    group_end = [ x + 1 for x in range(num_utts) ]
+    queue = [ i for i in range(num_utts) if LessThan(group_durations[i], min_duration) ]
+    while len(queue) > 0:
+        i = queue.pop()
+        if group_start[i] != i or not LessThan(group_durations[i], min_duration):
+            continue
+        this_dur = group_durations[i]
+        left_dur = group_durations[group_start[i-1]] if i > 0 else 0.0
+        right_dur = group_durations[group_end[i]] if group_end[i] < num_utts else 0.0
+        if left_dur == 0.0 and right_dur == 0.0:
+            break
+        if left_dur == 0.0:
+            combine_left = False
+        elif right_dur == 0.0:
+            combine_left = True
+        elif LessThan(left_dur + this_dur, min_duration):
+            combine_left = False
+        elif LessThan(right_dur + this_dur, min_duration):
+            combine_left = True
+        elif LessThan(left_dur, right_dur):
+            combine_left = True
+        else:
+            combine_left = False
+        if combine_left:
+            new_group_start = group_start[i-1]
+            group_end[new_group_start] = group_end[i]
+            for j in range(group_start[i], group_end[i]):
+                group_start[j] = new_group_start
+                group_durations[new_group_start] += durations[j]
+        else:
+            old_group_end = group_end[i]
+            new_group_end = group_end[old_group_end]
+            group_end[i] = new_group_end
+            for j in range(old_group_end, new_group_end):
+                group_durations[i] += durations[j]
+                group_start[j] = i
+            if LessThan(group_durations[i], min_duration):
+                queue.append(i)
+    ans = []
+    cur_group_start = 0
+    while cur_group_start < num_utts:
+        ans.append( (cur_group_start, group_end[cur_group_start]) )
+        cur_group_start = group_end[cur_group_start]
+    return ans
+
+
+def Main():
+    args = GetArgs()
+    random.seed(args.seed)
+    spk2utt = []
+    utt2dur = dict()
+    spk_durations = []
+    for s in range(args.num_speakers):
+        utts = [ "spk{0}-utt{1}".format(s, u) for u in range(args.utts_per_speaker) ]
+        durations = [ random.uniform(args.min_utt_duration, args.max_utt_duration)
+                      for u in utts ]
+        spk2utt.append(("spk{0}".format(s), utts))
+        utt2dur.update(zip(utts, durations))
+        spk_durations.append(durations)
+    print("{0} speakers with {1} utterances each".format(
+        args.num_speakers, args.utts_per_speaker))
+
+    start_time = time.time()
+    ranges = [ CombineList(args.min_duration, durations) for durations in spk_durations ]
+    print("CombineList: {0:.2f} seconds".format(time.time() - start_time))
+
+    if not args.skip_legacy:
+        start_time = time.time()
+        legacy_ranges = [ LegacyCombineList(args.min_duration, durations)
+                          for durations in spk_durations ]
+        print("previous CombineList: {0:.2f} seconds".format(time.time() - start_time))
+        if legacy_ranges != ranges:
+            sys.exit("benchmark_choose_utts_to_combine.py: the implementations "
+                     "gave different groups")
+
+    for num_jobs in sorted(set([1, args.num_jobs])):
+        start_time = time.time()
+        groups = GetUtteranceGroups(args.min_duration, spk2utt, utt2dur, num_jobs)
+        print("GetUtteranceGroups with {0} job(s): {1:.2f} seconds, {2} groups".format(
+            num_jobs, time.time() - start_time, len(groups)))
+
+
+if __name__ == "__main__":
+    Main()
@@ -9,6 +9,8 @@ import argparse
 from random import randint
 import sys
 import os
+import functools
+import multiprocessing
 from collections import defaultdict
 
 
@@ -37,6 +39,9 @@ to the grouped utterance.
 
 parser.add_argument("--min-duration", type = float, default = 1.55,
                     help="Minimum utterance duration")
+parser.add_argument("--num-jobs", type = int, default = 1,
+                    help="Number of processes used to combine the utterances of "
+                    "the different speakers in parallel")
 parser.add_argument("spk2utt_in", type = str, metavar = "<spk2utt-in>",
                     help="Filename of [input] speaker to utterance map needed "
                     "because this script tries to merge utterances from the "
@@ -56,9 +61,6 @@ parser.add_argument("utt2dur_out", type = str, metavar = "<utt2spk-out>",
                     "the durations of the source utterances.")
 
 
-args = parser.parse_args()
-
-
 # This LessThan is designed to be impervious to roundoff effects in cases where
 # numbers are really always separated by a distance >> 1.0e-05.  It will return
 # false if x and y are almost identical, differing only by roundoff effects.
@@ -86,30 +88,42 @@ def CombineList(min_duration, durations):
 
     num_utts = len(durations)
 
-    # for each utterance-index i, group_start[i] gives us the
-    # start-index of the group of utterances of which it's currently
-    # a member.
-    group_start = range(num_utts)
+    # The current groups of utterances form a doubly-linked list, in which
+    # each group is represented by its start-index; merging two groups only
+    # changes the entries for their start-indexes, so it takes constant time
+    # however large the groups are.
+    # is_group_start[i] is true if utterance-index i currently corresponds to
+    # the start of a group of utterances.
+    is_group_start = [ True ] * num_utts
     # if utterance-index i currently corresponds to the start of a group
     # of utterances, then group_durations[i] is the total duration of
     # that utterance-group, otherwise undefined.
     group_durations = list(durations)
     # if utterance-index i currently corresponds to the start of a group
     # of utterances, then group_end[i] is the end-index (i.e. last index plus one
-    # of that utterance-group, otherwise undefined.
+    # of that utterance-group, which is also the start-index of the next
+    # group), otherwise undefined.
     group_end = [ x + 1 for x in range(num_utts) ]
-
+    # if utterance-index i currently corresponds to the start of a group
+    # of utterances, then group_prev[i] is the start-index of the previous
+    # group, or -1 if there is none, otherwise undefined.
+    group_prev = [ x - 1 for x in range(num_utts) ]
+
+    # the start-indexes of the groups below the minimum duration.  It is
+    # popped from the end, and the only index ever pushed back is the one that
+    # was just popped, so the groups are always processed from the highest
+    # start-index down.
     queue = [ i for i in range(num_utts) if LessThan(group_durations[i], min_duration) ]
 
     while len(queue) > 0:
         i = queue.pop()
-        if group_start[i] != i or not LessThan(group_durations[i], min_duration):
+        if not is_group_start[i] or not LessThan(group_durations[i], min_duration):
             # this group no longer exists or already has at least the minimum duration.
             continue
         this_dur = group_durations[i]
         # left_dur is the duration of the group to the left of this group,
         # or 0.0 if there is no such group.
-        left_dur = group_durations[group_start[i-1]] if i > 0 else 0.0
+        left_dur = group_durations[group_prev[i]] if group_prev[i] >= 0 else 0.0
         # right_dur is the duration of the group to the right of this group,
         # or 0.0 if there is no such group.
         right_dur = group_durations[group_end[i]] if group_end[i] < num_utts else 0.0
@@ -117,7 +131,7 @@ def CombineList(min_duration, durations):
 
         if left_dur == 0.0 and right_dur == 0.0:
             # there is only one group.  Nothing more to merge; break
-            assert group_start[i] == 0 and group_end[i] == num_utts
+            assert i == 0 and group_end[i] == num_utts
             break
         # work out whether to combine left or right,
         # by means of the combine_left variable [ True or False ]
@@ -149,11 +163,13 @@ def CombineList(min_duration, durations):
 
         if combine_left:
             assert left_dur != 0.0
-            new_group_start = group_start[i-1]
-            group_end[new_group_start] = group_end[i]
-            for j in range(group_start[i], group_end[i]):
-                group_start[j] = new_group_start
-                group_durations[new_group_start] += durations[j]
+            new_group_start = group_prev[i]
+            new_group_end = group_end[i]
+            group_end[new_group_start] = new_group_end
+            group_durations[new_group_start] += this_dur
+            if new_group_end < num_utts:
+                group_prev[new_group_end] = new_group_start
+            is_group_start[i] = False
             # note: there is no need to add group_durations[new_group_start] to
             # the queue even if it is still below the minimum length, because it
             # would have previously had to have been below the minimum length,
@@ -164,9 +180,10 @@ def CombineList(min_duration, durations):
             old_group_end = group_end[i]
             new_group_end = group_end[old_group_end]
             group_end[i] = new_group_end
-            for j in range(old_group_end, new_group_end):
-                group_durations[i] += durations[j]
-                group_start[j] = i
+            group_durations[i] += right_dur
+            if new_group_end < num_utts:
+                group_prev[new_group_end] = i
+            is_group_start[old_group_end] = False
             if LessThan(group_durations[i], min_duration):
                 # the group starting at i is still below the minimum length, so
                 # we need to put it back on the queue.
@@ -218,10 +235,12 @@ def SelfTest():
 # 'min_duration' which is the minimum utterance length in seconds.
 # 'spk2utt' which is a list of pairs (speaker-id, [list-of-utterances])
 # 'utt2dur' which is a dict from utterance-id to duration (as a float)
+# 'num_jobs' which is the number of processes used to combine the utterances
+# of the different speakers (the first pass below) in parallel.
 # It returns a lists of lists of utterances; each list corresponds to
 # a group, e.g.
 # [ ['utt1'], ['utt2', 'utt3'] ]
-def GetUtteranceGroups(min_duration, spk2utt, utt2dur):
+def GetUtteranceGroups(min_duration, spk2utt, utt2dur, num_jobs = 1):
     # utt_groups will be a list of lists of utterance-ids formed from the
     # first pass of combination.
     utt_groups = []
@@ -231,6 +250,7 @@ def GetUtteranceGroups(min_duration, spk2utt, utt2dur):
 
     # This block calls CombineList for the utterances of each speaker
     # separately, in the 'first pass' of combination.
+    spk_durations = []  # durations for the utts of each speaker.
     for i in range(len(spk2utt)):
         (spk, utts) = spk2utt[i]
         durations = [] # durations for this group of utts.
@@ -241,7 +261,19 @@ def GetUtteranceGroups(min_duration, spk2utt, utt2dur):
                 sys.exit("choose_utts_to_combine.py: no duration available "
                          "in utt2dur file {0} for utterance {1}".format(
                         args.utt2dur_in, utt))
-        ranges = CombineList(min_duration, durations)
+        spk_durations.append(durations)
+    combine = functools.partial(CombineList, min_duration)
+    if num_jobs > 1 and len(spk2utt) > 1:
+        pool = multiprocessing.Pool(num_jobs)
+        try:
+            spk_ranges = pool.map(combine, spk_durations,
+                                  chunksize = max(1, len(spk2utt) // (4 * num_jobs)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        spk_ranges = [ combine(durations) for durations in spk_durations ]
+    for (spk, utts), durations, ranges in zip(spk2utt, spk_durations, spk_ranges):
         for start, end in ranges:  # each element of 'ranges' is a 2-tuple (start, end)
             utt_groups.append( [ utts[i] for i in range(start, end) ])
             group_durations.append(sum([ durations[i] for i in range(start, end) ]))
@@ -274,111 +306,120 @@ def GetUtteranceGroups(min_duration, spk2utt, utt2dur):
 
 
 
-SelfTest()
-
-if args.min_duration < 0.0:
-    print("choose_utts_to_combine.py: bad minium duration {0}".format(
-            args.min_duration))
-
-# spk2utt is a list of 2-tuples (speaker-id, [list-of-utterances])
-spk2utt = []
-# utt2spk is a dict from speaker-id to utternace-id.
-utt2spk = dict()
-try:
-    f = open(args.spk2utt_in)
-except:
-    sys.exit("choose_utts_to_combine.py: error opening --spk2utt={0}".format(args.spk2utt_in))
-while True:
-    line = f.readline()
-    if line == '':
-        break
-    a = line.split()
-    if len(a) < 2:
-        sys.exit("choose_utts_to_combine.py: bad line in spk2utt file: " + line)
-    spk = a[0]
-    utts = a[1:]
-    spk2utt.append((spk, utts))
-    for utt in utts:
-        if utt in utt2spk:
-            sys.exit("choose_utts_to_combine.py: utterance {0} is listed more than once"
-                     "in the spk2utt file {1}".format(utt, args.spk2utt_in))
-        utt2spk[utt] = spk
-f.close()
-
-# utt2dur is a dict from utterance-id (as a string) to duration in seconds (as a float)
-utt2dur = dict()
-try:
-    f = open(args.utt2dur_in)
-except:
-    sys.exit("choose_utts_to_combine.py: error opening utt2dur file {0}".format(args.utt2dur_in))
-while True:
-    line = f.readline()
-    if line == '':
-        break
+def Main():
+    SelfTest()
+
+    if args.min_duration < 0.0:
+        print("choose_utts_to_combine.py: bad minium duration {0}".format(
+                args.min_duration))
+    if args.num_jobs < 1:
+        sys.exit("choose_utts_to_combine.py: bad --num-jobs={0}".format(
+                args.num_jobs))
+
+    # spk2utt is a list of 2-tuples (speaker-id, [list-of-utterances])
+    spk2utt = []
+    # utt2spk is a dict from speaker-id to utternace-id.
+    utt2spk = dict()
     try:
-        [ utt, dur ] = line.split()
-        dur = float(dur)
-        utt2dur[utt] = dur
+        f = open(args.spk2utt_in)
     except:
-        sys.exit("choose_utts_to_combine.py: bad line in utt2dur file {0}: {1}".format(
-                args.utt2dur_in, line))
-
-
-utt_groups = GetUtteranceGroups(args.min_duration, spk2utt, utt2dur)
-
-# set utt_group names to an array like [ 'utt1', 'utt2-comb2', 'utt4', ... ]
-utt_group_names = [ group[0] if len(group)==1 else group[0] + "-comb" + str(len(group))
-                    for group in utt_groups ]
-
-
-# write the utt2utts file.
-try:
-    with open(args.utt2utts_out, 'w') as f:
-        for i in range(len(utt_groups)):
-            print(utt_group_names[i], ' '.join(utt_groups[i]), file = f)
-except Exception as e:
-    sys.exit("choose_utts_to_combine.py: exception writing to "
-             "<utt2utts-out>={0}: {1}".format(args.utt2utts_out, str(e)))
-
-# write the utt2spk file.
-try:
-    with open(args.utt2spk_out, 'w') as f:
-        for i in range(len(utt_groups)):
-            utt_group = utt_groups[i]
-            spk_list = [ utt2spk[utt] for utt in utt_group ]
-            if spk_list == [ spk_list[0] ] * len(utt_group):
-                spk = spk_list[0]
-            else:
-                spk2dur = defaultdict(float)
-                # spk2dur is a map from the speaker-id to the duration within this
-                # utt, that it comprises.
-                for utt in utt_group:
-                    spk2dur[utt2spk[utt]] += utt2dur[utt]
-                # the following code, which picks the speaker that contributed
-                # the most to the duration of this utterance, is a little
-                # complex because we want to break ties in a deterministic way
-                # picking the earlier spaker in case of a tied duration.
-                longest_spk_dur = -1.0
-                spk = None
-                for this_spk in sorted(spk2dur.keys()):
-                    if LessThan(longest_spk_dur, spk2dur[this_spk]):
-                        longest_spk_dur = spk2dur[this_spk]
-                        spk = this_spk
-                assert spk != None
-            new_utt = utt_group_names[i]
-            print(new_utt, spk, file = f)
-except Exception as e:
-    sys.exit("choose_utts_to_combine.py: exception writing to "
-             "<utt2spk-out>={0}: {1}".format(args.utt2spk_out, str(e)))
-
-# write the utt2dur file.
-try:
-    with open(args.utt2dur_out, 'w') as f:
-        for i in range(len(utt_groups)):
-            utt_name = utt_group_names[i]
-            duration = sum([ utt2dur[utt] for utt in utt_groups[i]])
-            print(utt_name, duration, file = f)
-except Exception as e:
-    sys.exit("choose_utts_to_combine.py: exception writing to "
-             "<utt2dur-out>={0}: {1}".format(args.utt2dur_out, str(e)))
+        sys.exit("choose_utts_to_combine.py: error opening --spk2utt={0}".format(args.spk2utt_in))
+    while True:
+        line = f.readline()
+        if line == '':
+            break
+        a = line.split()
+        if len(a) < 2:
+            sys.exit("choose_utts_to_combine.py: bad line in spk2utt file: " + line)
+        spk = a[0]
+        utts = a[1:]
+        spk2utt.append((spk, utts))
+        for utt in utts:
+            if utt in utt2spk:
+                sys.exit("choose_utts_to_combine.py: utterance {0} is listed more than once"
+                         "in the spk2utt file {1}".format(utt, args.spk2utt_in))
+            utt2spk[utt] = spk
+    f.close()
+
+    # utt2dur is a dict from utterance-id (as a string) to duration in seconds (as a float)
+    utt2dur = dict()
+    try:
+        f = open(args.utt2dur_in)
+    except:
+        sys.exit("choose_utts_to_combine.py: error opening utt2dur file {0}".format(args.utt2dur_in))
+    while True:
+        line = f.readline()
+        if line == '':
+            break
+        try:
+            [ utt, dur ] = line.split()
+            dur = float(dur)
+            utt2dur[utt] = dur
+        except:
+            sys.exit("choose_utts_to_combine.py: bad line in utt2dur file {0}: {1}".format(
+                    args.utt2dur_in, line))
+
+
+    utt_groups = GetUtteranceGroups(args.min_duration, spk2utt, utt2dur,
+                                    args.num_jobs)
+
+    # set utt_group names to an array like [ 'utt1', 'utt2-comb2', 'utt4', ... ]
+    utt_group_names = [ group[0] if len(group)==1 else group[0] + "-comb" + str(len(group))
+                        for group in utt_groups ]
 
+
+    # write the utt2utts file.
+    try:
+        with open(args.utt2utts_out, 'w') as f:
+            for i in range(len(utt_groups)):
+                print(utt_group_names[i], ' '.join(utt_groups[i]), file = f)
+    except Exception as e:
+        sys.exit("choose_utts_to_combine.py: exception writing to "
+                 "<utt2utts-out>={0}: {1}".format(args.utt2utts_out, str(e)))
+
+    # write the utt2spk file.
+    try:
+        with open(args.utt2spk_out, 'w') as f:
+            for i in range(len(utt_groups)):
+                utt_group = utt_groups[i]
+                spk_list = [ utt2spk[utt] for utt in utt_group ]
+                if spk_list == [ spk_list[0] ] * len(utt_group):
+                    spk = spk_list[0]
+                else:
+                    spk2dur = defaultdict(float)
+                    # spk2dur is a map from the speaker-id to the duration within this
+                    # utt, that it comprises.
+                    for utt in utt_group:
+                        spk2dur[utt2spk[utt]] += utt2dur[utt]
+                    # the following code, which picks the speaker that contributed
+                    # the most to the duration of this utterance, is a little
+                    # complex because we want to break ties in a deterministic way
+                    # picking the earlier spaker in case of a tied duration.
+                    longest_spk_dur = -1.0
+                    spk = None
+                    for this_spk in sorted(spk2dur.keys()):
+                        if LessThan(longest_spk_dur, spk2dur[this_spk]):
+                            longest_spk_dur = spk2dur[this_spk]
+                            spk = this_spk
+                    assert spk != None
+                new_utt = utt_group_names[i]
+                print(new_utt, spk, file = f)
+    except Exception as e:
+        sys.exit("choose_utts_to_combine.py: exception writing to "
+                 "<utt2spk-out>={0}: {1}".format(args.utt2spk_out, str(e)))
+
+    # write the utt2dur file.
+    try:
+        with open(args.utt2dur_out, 'w') as f:
+            for i in range(len(utt_groups)):
+                utt_name = utt_group_names[i]
+                duration = sum([ utt2dur[utt] for utt in utt_groups[i]])
+                print(utt_name, duration, file = f)
+    except Exception as e:
+        sys.exit("choose_utts_to_combine.py: exception writing to "
+                 "<utt2dur-out>={0}: {1}".format(args.utt2dur_out, str(e)))
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    Main()
@@ -4,11 +4,14 @@
 # Apache 2.0.
 
 from __future__ import print_function
+import io
 import sys
 import argparse
 import math
 from collections import defaultdict
 
+import arpa_index
+
 # note, this was originally based
 
 parser = argparse.ArgumentParser(description="""
@@ -40,146 +43,68 @@ parser.add_argument('--verbose', type = int, default = 0,
 
 args = parser.parse_args()
 
+sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding="utf8")
+sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding="utf8")
+
 if args.verbose >= 1:
     print(' '.join(sys.argv), file = sys.stderr)
 
 
-class HistoryState:
-    def __init__(self):
-        # note: neither backoff_prob nor the floats
-        # in word_to_prob are in log space.
-        self.backoff_prob = 1.0
-        # will be a dict from string to float.  the prob is
-        # the actual probability of the word, including any probability
-        # mass from backoff (they get added together while writing out
-        # the arpa, and these probs are read in from the arpa).
-        self.word_to_prob = dict()
-
-
 class ArpaModel:
     def __init__(self):
-        # self.orders is indexed by history-length [i.e. 0 for unigram,
-        # 1 for bigram and so on], and is then a dict indexed
-        # by tuples of history-words.  E.g. for trigrams, we'd index
-        # it as self.orders[2][('a', 'b')].
-        # The value-type of the dict is HistoryState.  E.g. to set the
-        # probability of the trigram a b -> c to 0.2, we'd do
-        # self.orders[2][('a', 'b')].word_to_prob['c'] = 0.2
-        self.orders = []
+        # self.index is an ArpaIndex (see arpa_index.py), which stores the
+        # n-grams of each history-length [i.e. 0 for unigram, 1 for bigram and
+        # so on] in sorted, memory-mapped arrays of integer word-ids.
+        # Histories and words are represented here as word-ids; e.g. the
+        # probability of the trigram a b -> c is self.GetProb((a, b), c),
+        # where a, b and c are the ids of 'a', 'b' and 'c'.
+        self.index = None
+        # the word-ids of <s> and </s>; set in PrintAsFst().
+        self.bos = None
+        self.eos = None
+        self.log10 = math.log(10.0)
 
     def Read(self, arpa_in):
-        assert len(self.orders) == 0
-        log10 = math.log(10.0)
-        if arpa_in == "" or arpa_in == "-":
-            arpa_in = "/dev/stdin"
+        assert self.index is None
         try:
-            f = open(arpa_in, "r")
-        except:
-            sys.exit("{0}: error opening ARPA file {1}".format(
-                     sys.argv[0], arpa_in))
-        # first read till the \data\ marker.
-        while True:
-            line = f.readline()
-            if line == '':
-                sys.exit("{0}: reading {1}, got EOF looking for \\data\\ marker.".format(
-                    sys.argv[0], arpa_in))
-            if line[0:6] == '\\data\\':
-                break
-        while True:
-            # read, and ignore, the lines like 'ngram 1=1264'...
-            line = f.readline()
-            if line == '\n' or line == '\r\n':
-                break
-            if line[0:5] != 'ngram':
-                sys.exit("{0}: reading {1}, read something unexpected in header: {2}".format(
-                    sys.argv[0], arpa_in, line[:-1]))
-            rest=line[5:]
-            a = rest.split('=')  # e.g. a = [ '1', '1264] ]
-            if len(a) != 2:
-                sys.exit("{0}: reading {1}, read something unexpected in header: {2}".format(
-                    sys.argv[0], arpa_in, line[:-1]))
-            max_order = int(a[0])
-
-
-        for n in range(max_order):
-            # self.orders[n], indexed by history-length (length of the
-            # history-vector, == order-1), is a map from history as a tuple
-            # of strings, to class HistoryState.
-            self.orders.append(defaultdict(lambda: HistoryState()))
-
-        cur_order = 0
-        while True:
-            line = f.readline()
-            if line == '':
-                sys.exit("{0}: reading {1}, found EOF while looking for \\end\\ marker.".format(
-                    sys.argv[0], arpa_in))
-            elif line[0:5] == '\\end\\':
-                if len(self.orders) == 0:
-                    sys.exit("{0}: reading {1}, read no n-grams.".format(sys.argv[0], arpa_in))
-                break
-            else:
-                cur_order += 1
-                expected_line = '\\{0}-grams:'.format(cur_order)
-                if not expected_line in line:  # e.g. allow trailing whitespace and newline
-                    sys.exit("{0}: reading {1}, expected line {1}, got {2}".format(arpa_in, expected_line, line[:-1]))
-                if args.verbose >= 2:
-                    print("{0}: reading {1}-grams".format(
-                        sys.argv[0], cur_order), file = sys.stderr)
-
-                # now read all the n-grams from this order.
-                while True:
-                    line = f.readline()
-                    # the section of n-grams is terminated by a blank line.
-                    if line == '\n' or line == '\r\n':
-                        break
-                    a = line.split()
-                    l = len(a)
-                    if l != cur_order + 1 and l != cur_order + 2:
-                        sys.exit("{0}: reading {1}: in {2}-grams section, got bad line: {3}".format(
-                            sys.argv[0], arpa_in, cur_order, line[:-1]))
-                    try:
-                        prob = math.exp(float(a[0]) * log10)
-                        hist = tuple(a[1:cur_order])  # tuple of strings
-                        word = a[cur_order]  # a string
-                        backoff_prob = math.exp(float(a[cur_order+1]) * log10) if l == cur_order + 2 else None
-                    except Exception as e:
-                        sys.exit("{0}: reading {1}: in {2}-grams section, got bad "
-                                 "line (exception is: {3}): {4}".format(
-                                     sys.argv[0], arpa_in, cur_order,
-                                     str(type(e)) + ',' + str(e), line[:-1]))
-                    self.orders[cur_order-1][hist].word_to_prob[word] = prob
-                    if backoff_prob != None:
-                        self.orders[cur_order][hist + (word,)].backoff_prob = backoff_prob
-
+            self.index = arpa_index.GetArpaIndex(arpa_in, verbose = args.verbose)
+        except (IOError, OSError) as e:
+            sys.exit("{0}: error opening ARPA file {1}: {2}".format(
+                     sys.argv[0], arpa_in, str(e)))
+        except ValueError as e:
+            sys.exit("{0}: {1}".format(sys.argv[0], str(e)))
         if args.verbose >= 2:
             print("{0}: read {1}-gram model from {2}".format(
-                sys.argv[0], cur_order, arpa_in), file = sys.stderr)
-        if cur_order < 2:
+                sys.argv[0], self.index.order, arpa_in), file = sys.stderr)
+        if self.index.order < 2:
             # we'd have to have some if-statements in the code to make this work,
             # and I don't want to have to test it.
             sys.exit("{0}: this script does not work when the ARPA language model "
                      "is unigram.".format(sys.argv[0]))
 
+    # Returns the probability (not in log space) of row i of the n-grams with
+    # history-length n.
+    def GetNgramProb(self, n, i):
+        return math.exp(float(self.index.log_probs[n][i]) * self.log10)
+
+    # Returns the backoff probability (not in log space) of history-state
+    # 'hist'; this is 1.0 if the ARPA file has no backoff weight for it.
+    def GetBackoffProb(self, hist):
+        i = self.index.Find(hist)
+        log_backoff = float(self.index.log_backoffs[len(hist) - 1][i]) if i != -1 else 0.0
+        return math.exp(log_backoff * self.log10) if not math.isnan(log_backoff) else 1.0
+
     # Returns the probability of word 'word' in history-state 'hist'.
     # Dies with error if this word is not predicted at all by the LM (not in vocab).
-    # history-state does not exist.
     def GetProb(self, hist, word):
-        assert len(hist) < len(self.orders)
+        assert len(hist) < self.index.order
+        i = self.index.Find(hist + (word,))
+        if i != -1:
+            return self.GetNgramProb(len(hist), i)
         if len(hist) == 0:
-            word_to_prob = self.orders[0][()].word_to_prob
-            if not word in word_to_prob:
-                sys.exit("{0}: no probability in unigram for word {1}".format(
-                    sys.argv[0], word))
-            return word_to_prob[word]
-        else:
-            if hist in self.orders[len(hist)]:
-                hist_state = self.orders[len(hist)][hist]
-                if word in hist_state.word_to_prob:
-                    return hist_state.word_to_prob[word]
-                else:
-                    return hist_state.backoff_prob * self.GetProb(hist[1:], word)
-            else:
-                return self.GetProb(hist[1:], word)
+            sys.exit("{0}: no probability in unigram for word {1}".format(
+                sys.argv[0], self.index.words[word]))
+        return self.GetBackoffProb(hist) * self.GetProb(hist[1:], word)
 
     # This gets the state corresponding to 'hist' in 'hist_to_state', but backs
     # off for us if there is no such state.
@@ -191,13 +116,16 @@ class ArpaModel:
                 # this would likely be a code error, but possibly an error
                 # in the ARPA file
                 sys.exit("{0}: error processing histories: history-state {1} "
-                         "does not exist.".format(sys.argv[0], hist))
+                         "does not exist.".format(sys.argv[0], self.HistToWords(hist)))
             return self.GetStateForHist(hist_to_state, hist[1:])
 
+    # Converts a history (tuple of word-ids) to a tuple of strings, for messages.
+    def HistToWords(self, hist):
+        return tuple(self.index.words[word] for word in hist)
 
     def GetHistToStateMap(self):
         # This function, called from PrintAsFst, returns (hist_to_state,
-        # state_to_hist), which map from history (as a tuple of strings) to
+        # state_to_hist), which map from history (as a tuple of word-ids) to
         # integer FST-state and vice versa.
 
         hist_to_state = dict()
@@ -206,7 +134,7 @@ class ArpaModel:
         # Make sure the initial bigram state comes first (and that
         # we have such a state even if it was completely pruned
         # away in the bigram LM.. which is unlikely of course)
-        hist = ('<s>',)
+        hist = (self.bos,)
         hist_to_state[hist] = len(state_to_hist)
         state_to_hist.append(hist)
 
@@ -214,8 +142,8 @@ class ArpaModel:
         # didn't naturally have such bigram states, we'll create them so that we
         # can enforce the bigram constraints supplied in 'bigrams_file' by the
         # user.
-        for word in self.orders[0][()].word_to_prob:
-            if word != '<s>' and word != '</s>':
+        for word in self.index.ngrams[0][:, 0].tolist():
+            if word != self.bos and word != self.eos:
                 hist = (word,)
                 hist_to_state[hist] = len(state_to_hist)
                 state_to_hist.append(hist)
@@ -224,27 +152,54 @@ class ArpaModel:
         # we don't have a unigram state in the output FST, only bigram states; and
         # we don't iterate over bigram histories because we covered them all above;
         # that's why we start 'n' from 2 below instead of from 0.
-        for n in range(2, len(self.orders)):
-            for hist in self.orders[n].keys():
-                # note: hist is a tuple of strings.
+        for n in range(2, self.index.order):
+            for hist in self.index.HistoryStates(n).tolist():
+                # note: hist is a tuple of word-ids.
+                hist = tuple(hist)
                 assert not hist in hist_to_state
                 hist_to_state[hist] = len(state_to_hist)
                 state_to_hist.append(hist)
 
         return (hist_to_state, state_to_hist)
 
+    # This function converts bigram_map (which is indexed by strings) to a
+    # dict from left-word id to the set of allowed right-word ids, for the
+    # left-words that are in the ARPA model.  Dies with error if an allowed
+    # right-word is not in the model, as GetProb() would.
+    def GetBigramIdMap(self, bigram_map):
+        ans = dict()
+        for context_word, word_set in bigram_map.items():
+            if context_word == '</s>' or not context_word in self.index.word_to_id:
+                continue
+            ids = set()
+            for word in word_set:
+                if not word in self.index.word_to_id:
+                    sys.exit("{0}: no probability in unigram for word {1}".format(
+                        sys.argv[0], word))
+                ids.add(self.index.word_to_id[word])
+            ans[self.index.word_to_id[context_word]] = ids
+        return ans
+
     # This function prints the estimated language model as an FST.
     # disambig_symbol will be something like '#0' (a symbol introduced
     # to make the result determinizable).
     # bigram_map represent the allowed bigrams (left-word, right-word): it's a map
     # from left-word to a set of right-words (both are strings).
     def PrintAsFst(self, disambig_symbol, bigram_map):
+        words = self.index.words
+        if not '<s>' in self.index.word_to_id or not '</s>' in self.index.word_to_id:
+            sys.exit("{0}: the ARPA language model does not contain <s> and </s>".format(
+                sys.argv[0]))
+        self.bos = self.index.word_to_id['<s>']
+        self.eos = self.index.word_to_id['</s>']
+        bigram_id_map = self.GetBigramIdMap(bigram_map)
+
         # History will map from history (as a tuple) to integer FST-state.
         (hist_to_state, state_to_hist) = self.GetHistToStateMap()
 
 
         # The following 3 things are just for diagnostics.
-        normalization_stats = [ [0, 0.0] for x in range(len(self.orders)) ]
+        normalization_stats = [ [0, 0.0] for x in range(self.index.order) ]
         num_ngrams_allowed = 0
         num_ngrams_disallowed = 0
 
@@ -254,13 +209,13 @@ class ArpaModel:
             assert hist_len > 0
             if hist_len == 1:  # it's a bigram state...
                 context_word = hist[0]
-                if not context_word in bigram_map:
+                if not context_word in bigram_id_map:
                     print("{0}: warning: word {1} appears in ARPA but is not listed "
                           "as a left context in the bigram map".format(
-                              sys.argv[0], context_word), file = sys.stderr)
+                              sys.argv[0], words[context_word]), file = sys.stderr)
                     continue
                 # word list is a list of words that can follow this word.  It must be nonempty.
-                word_list = list(bigram_map[context_word])
+                word_list = sorted(bigram_id_map[context_word])
 
                 normalization_stats[hist_len][0] += 1
 
@@ -271,43 +226,46 @@ class ArpaModel:
                     cost = -math.log(prob)
                     if abs(cost) < 0.01 and args.verbose >= 3:
                         print("{0}: warning: very small cost {1} for {2}->{3}".format(
-                            sys.argv[0], cost, context_word, word), file=sys.stderr)
-                    if word == '</s>':
+                            sys.argv[0], cost, words[context_word], words[word]),
+                              file=sys.stderr)
+                    if word == self.eos:
                         # print the final-prob of this state.
                         print("%d %.3f" % (state, cost))
                     else:
                         next_state = self.GetStateForHist(hist_to_state,
                                                           (context_word, word))
                         print("%d %d %s %s %.3f" %
-                              (state, next_state, word, word, cost))
+                              (state, next_state, words[word], words[word], cost))
             else:  # it's a higher-order than bigram state.
-                assert hist in self.orders[hist_len]
-                hist_state = self.orders[hist_len][hist]
                 most_recent_word = hist[-1]
+                allowed_words = bigram_id_map.get(most_recent_word, set())
 
                 normalization_stats[hist_len][0] += 1
                 normalization_stats[hist_len][1] += \
-                  sum([ self.GetProb(hist, word) for word in bigram_map[most_recent_word]])
-
-                for word, prob in hist_state.word_to_prob.items():
-                    cost = -math.log(prob)
-                    if word in bigram_map[most_recent_word]:
+                  sum([ self.GetProb(hist, word) for word in allowed_words ])
+
+                # the rows [begin, end) of the n-grams with history-length
+                # hist_len are the words that this history-state predicts.
+                (begin, end) = self.index.HistoryRange(hist)
+                next_words = self.index.ngrams[hist_len][begin:end, hist_len].tolist()
+                for i, word in zip(range(begin, end), next_words):
+                    cost = -math.log(self.GetNgramProb(hist_len, i))
+                    if word in allowed_words:
                         num_ngrams_allowed += 1
                     else:
                         num_ngrams_disallowed += 1
                         continue
-                    if word == '</s>':
+                    if word == self.eos:
                         # print the final-prob of this state.
                         print("%d %.3f" % (state, cost))
                     else:
                         next_state = self.GetStateForHist(hist_to_state,
                                                           (hist) + (word,))
                         print("%d %d %s %s %.3f" %
-                              (state, next_state, word, word, cost))
+                              (state, next_state, words[word], words[word], cost))
                 # Now deal with the backoff probability of this state (back off
                 # to the lower-order state).
-                assert hist in self.orders[hist_len]
-                backoff_prob = self.orders[hist_len][hist].backoff_prob
+                backoff_prob = self.GetBackoffProb(hist)
                 assert backoff_prob != 0.0
                 cost = -math.log(backoff_prob)
                 backoff_hist = hist[1:]
@@ -315,15 +273,16 @@ class ArpaModel:
                 # note: we only print the disambig symbol on the input side.
                 if args.verbose >= 3 and abs(cost) < 0.001:
                     print("{0}: very low backoff cost {1} for history {2}, state = {3}".format(
-                        sys.argv[0], cost, str(hist), state), file = sys.stderr)
+                        sys.argv[0], cost, str(self.HistToWords(hist)), state),
+                          file = sys.stderr)
 
                 # For hist-states that completely back off (they have no words coming out of them),
                 # there is no need to disambiguate, we can print an epsilon that will later be removed.
-                this_disambig_symbol = disambig_symbol if len(hist_state.word_to_prob) != 0 else '<eps>'
+                this_disambig_symbol = disambig_symbol if end != begin else '<eps>'
                 print("%d %d %s <eps> %.3f" %
                       (state, backoff_state, this_disambig_symbol, cost))
         if args.verbose >= 1:
-            for hist_len in range(1, len(self.orders)):
+            for hist_len in range(1, self.index.order):
                 num_states = normalization_stats[hist_len][0]
                 avg_prob_sum = normalization_stats[hist_len][1] / num_states if num_states > 0 else 0.0
                 print("{0}: for {1}-gram states, over {2} states the average sum of "
@@ -348,7 +307,7 @@ def ReadBigramMap(bigrams_file):
     have_one_regular = False
 
     try:
-        f = open(bigrams_file, "r")
+        f = io.open(bigrams_file, "r", encoding="utf-8")
     except:
         sys.exit("utils/lang/internal/arpa2fst_constrained.py: error opening "
                  "bigrams file " + bigrams_file)
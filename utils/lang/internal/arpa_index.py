@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+
+# Apache 2.0.
+
+"""This module provides an indexed, memory-mapped form of an ARPA-format
+language model, for scripts that need random access to its n-grams (e.g.
+utils/lang/internal/arpa2fst_constrained.py and utils/reverse_arpa.py)
+without holding the whole model in Python dicts.
+
+The index is a directory, by default <arpa-file>.index, containing:
+  info                   the format version, the n-gram order and the size and
+                         modification time of the ARPA file it was built from
+  words.txt              the vocabulary (UTF-8), one word per line, sorted; the
+                         line number (from 0) is the word's integer id
+  ngrams.<n>.npy         for history-length n (n-gram order n + 1), the n-grams
+                         as a (num-ngrams, n + 1) array of big-endian uint32
+                         word ids, sorted lexicographically
+  log_probs.<n>.npy      the log10 probability of each n-gram (float64)
+  log_backoffs.<n>.npy   the log10 backoff weight of each n-gram (float64),
+                         NaN where the ARPA file has none
+Because the word ids are big-endian and the vocabulary is sorted, sorting the
+rows of ngrams.<n>.npy as byte-strings is the same as sorting the n-grams as
+sequences of words; lookups are binary searches on such byte-string views.
+
+The index is built the first time it is needed and reused as long as the ARPA
+file does not change; see GetArpaIndex().
+"""
+
+from __future__ import print_function
+import io
+import os
+import shutil
+import sys
+import tempfile
+import atexit
+from array import array
+
+import numpy as np
+
+_INDEX_VERSION = 1
+_MAX_WORD_ID = 0xffffffff
+
+
+def _KeyDtype(length):
+    # The dtype of the byte-string view of a row of 'length' word ids.
+    return np.dtype('V{0}'.format(4 * length))
+
+
+def _Keys(ids):
+    # Returns a 1-d byte-string view of 'ids', a 2-d array of word ids, with
+    # one element per row.
+    ids = np.ascontiguousarray(ids, dtype='>u4')
+    if ids.shape[0] == 0:
+        return np.zeros(0, dtype=_KeyDtype(ids.shape[1]))
+    return ids.view(_KeyDtype(ids.shape[1])).reshape(-1)
+
+
+def _Lookup(table_keys, keys):
+    # Returns, for each element of 'keys', its position in the sorted array
+    # 'table_keys', or -1 if it is not there.
+    pos = np.searchsorted(table_keys, keys)
+    if len(table_keys) == 0:
+        return np.full(len(keys), -1, dtype=np.int64)
+    found = table_keys[np.minimum(pos, len(table_keys) - 1)] == keys
+    return np.where(found & (pos < len(table_keys)), pos, -1)
+
+
+def FindRows(table, ngrams):
+    """Returns, for each row of the 2-d array of word ids 'ngrams', the
+    position of the same row in 'table' (a 2-d array of word ids with the same
+    number of columns, sorted like ArpaIndex.ngrams[n]), or -1 if it is not
+    there."""
+    return _Lookup(_Keys(table), _Keys(ngrams))
+
+
+class ArpaIndex:
+    ## This class gives access to an index directory written by
+    ## BuildArpaIndex().  Its arrays are memory-mapped, so opening the index
+    ## is cheap and only the parts that are used get read.  Attributes:
+    ##   self.order is the n-gram order of the model;
+    ##   self.words is the list of words (text strings), indexed by word id,
+    ##      and self.word_to_id the reverse map;
+    ##   self.ngrams[n], self.log_probs[n] and self.log_backoffs[n] are the
+    ##      arrays for history-length n (see the module docstring).
+    def __init__(self, index_dir):
+        info = _ReadInfo(index_dir)
+        if info is None or info.get('version') != str(_INDEX_VERSION):
+            raise ValueError("{0} is not a valid ARPA index (version {1} expected)".format(
+                index_dir, _INDEX_VERSION))
+        self.order = int(info['order'])
+        with io.open(os.path.join(index_dir, 'words.txt'),
+                     encoding='utf-8', newline='\n') as f:
+            self.words = f.read().split('\n')[:-1]
+        self.word_to_id = dict((word, i) for i, word in enumerate(self.words))
+        self.ngrams = []
+        self.log_probs = []
+        self.log_backoffs = []
+        self._keys = []
+        for n in range(self.order):
+            def Load(name):
+                return np.load(os.path.join(index_dir, '{0}.{1}.npy'.format(name, n)),
+                               mmap_mode='r')
+            self.ngrams.append(Load('ngrams'))
+            self.log_probs.append(Load('log_probs'))
+            self.log_backoffs.append(Load('log_backoffs'))
+            self._keys.append(_Keys(self.ngrams[n]))
+
+    def NumNgrams(self, n):
+        # Returns the number of n-grams with history-length n.
+        return self.ngrams[n].shape[0]
+
+    def WordIds(self, words):
+        # Converts a sequence of words (text strings) to a tuple of word ids;
+        # raises KeyError if a word is not in the vocabulary.
+        return tuple(self.word_to_id[word] for word in words)
+
+    def Find(self, ngram):
+        # Returns the row of 'ngram' (a tuple of word ids) in the table for
+        # history-length len(ngram) - 1, or -1 if the model doesn't have it.
+        n = len(ngram) - 1
+        return int(_Lookup(self._keys[n], _Keys([ngram]))[0])
+
+    def FindAll(self, ngrams):
+        # Like Find(), but for a 2-d array of n-grams (one per row, all of the
+        # same length); returns an array of rows.
+        ngrams = np.asarray(ngrams)
+        return _Lookup(self._keys[ngrams.shape[1] - 1], _Keys(ngrams))
+
+    def HistoryRange(self, hist):
+        # Returns (begin, end), the range of rows in the table for
+        # history-length len(hist) of the n-grams whose history is 'hist' (a
+        # tuple of word ids).
+        n = len(hist)
+        keys = self._keys[n]
+        begin = np.searchsorted(keys, _Keys([hist + (0,)])[0], side='left')
+        end = np.searchsorted(keys, _Keys([hist + (_MAX_WORD_ID,)])[0], side='right')
+        return int(begin), int(end)
+
+    def HistoryStates(self, n):
+        # Returns the histories of length n (n >= 1) that have a history-state
+        # in the model, i.e. that are followed by some word or have a backoff
+        # weight, as a sorted (num-histories, n) array of word ids.
+        if n < self.order:
+            followed = np.unique(_Keys(self.ngrams[n][:, :n]))
+        else:
+            followed = np.zeros(0, dtype=_KeyDtype(n))
+        with_backoff = self._keys[n - 1][~np.isnan(self.log_backoffs[n - 1])]
+        states = np.union1d(followed, with_backoff)
+        return states.view('>u4').reshape(-1, n)
+
+
+def _ReadInfo(index_dir):
+    # Returns the contents of the 'info' file of an index as a dict, or None if
+    # it can't be read.
+    try:
+        with open(os.path.join(index_dir, 'info')) as f:
+            return dict(line.split(None, 1) for line in f.read().splitlines())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _SourceInfo(arpa_in):
+    # Returns the size and modification time of the ARPA file, as strings, so
+    # we can tell if an index is stale.
+    st = os.stat(arpa_in)
+    return str(st.st_size), repr(st.st_mtime)
+
+
+def _ParseArpa(f, arpa_in, verbose):
+    # Reads an ARPA file from the binary file object f.  Returns (words,
+    # ngrams, log_probs, log_backoffs), where 'words' is a list of the words
+    # (byte strings) indexed by provisional word id (the order of first
+    # appearance), and the others are lists indexed by history-length of,
+    # respectively, flat array('l') of word ids, and array('d') of log10
+    # probabilities and backoffs (NaN if none).  Raises ValueError on
+    # malformed input.
+    word_to_id = dict()
+    words = []
+    while True:
+        line = f.readline()
+        if line == b'':
+            raise ValueError("reading {0}, got EOF looking for \\data\\ marker.".format(
+                arpa_in))
+        if line[0:6] == b'\\data\\':
+            break
+    max_order = 0
+    while True:
+        line = f.readline()
+        if line.strip() == b'':
+            if line == b'' or max_order > 0:
+                break
+            continue
+        # lines like 'ngram 1=1264'.
+        a = line[5:].split(b'=') if line[0:5] == b'ngram' else []
+        if len(a) != 2:
+            raise ValueError("reading {0}, read something unexpected in header: {1}".format(
+                arpa_in, line.rstrip().decode('utf-8', 'replace')))
+        max_order = int(a[0])
+    if max_order == 0:
+        raise ValueError("reading {0}, read no n-gram counts in header.".format(arpa_in))
+
+    ngrams = [ array('l') for n in range(max_order) ]
+    log_probs = [ array('d') for n in range(max_order) ]
+    log_backoffs = [ array('d') for n in range(max_order) ]
+    nan = float('nan')
+    cur_order = 0
+    line = f.readline()
+    while True:
+        if line == b'':
+            raise ValueError("reading {0}, found EOF while looking for \\end\\ marker.".format(
+                arpa_in))
+        line = line.strip()
+        if line == b'':
+            line = f.readline()
+            continue
+        if line == b'\\end\\':
+            break
+        cur_order += 1
+        expected_line = '\\{0}-grams:'.format(cur_order).encode()
+        if line != expected_line or cur_order > max_order:
+            raise ValueError("reading {0}, expected line {1}, got {2}".format(
+                arpa_in, expected_line.decode(), line.decode('utf-8', 'replace')))
+        if verbose >= 2:
+            print("{0}: reading {1}-grams".format(sys.argv[0], cur_order),
+                  file=sys.stderr)
+        these_ngrams = ngrams[cur_order - 1]
+        these_log_probs = log_probs[cur_order - 1]
+        these_log_backoffs = log_backoffs[cur_order - 1]
+        # now read all the n-grams from this order; the section is normally
+        # terminated by a blank line, but we also accept the next section
+        # header (or \end\) directly.
+        while True:
+            line = f.readline()
+            a = line.split()
+            l = len(a)
+            if l == 0 or (l == 1 and line[0:1] == b'\\'):
+                break
+            if l != cur_order + 1 and l != cur_order + 2:
+                raise ValueError("reading {0}: in {1}-grams section, got bad line: {2}".format(
+                    arpa_in, cur_order, line.rstrip().decode('utf-8', 'replace')))
+            try:
+                these_log_probs.append(float(a[0]))
+                these_log_backoffs.append(float(a[cur_order + 1]) if l == cur_order + 2 else nan)
+            except ValueError as e:
+                raise ValueError("reading {0}: in {1}-grams section, got bad "
+                                 "line (exception is: {2}): {3}".format(
+                                     arpa_in, cur_order, str(e),
+                                     line.rstrip().decode('utf-8', 'replace')))
+            for word in a[1:cur_order + 1]:
+                i = word_to_id.get(word)
+                if i is None:
+                    i = len(words)
+                    word_to_id[word] = i
+                    words.append(word)
+                these_ngrams.append(i)
+    if cur_order == 0:
+        raise ValueError("reading {0}, read no n-grams.".format(arpa_in))
+    del ngrams[cur_order:], log_probs[cur_order:], log_backoffs[cur_order:]
+    return words, ngrams, log_probs, log_backoffs
+
+
+def BuildArpaIndex(arpa_in, index_dir, verbose = 0):
+    """Reads the ARPA file 'arpa_in' ('-' for the standard input) and writes
+    its index to the directory 'index_dir', which is created (replacing any
+    existing index atomically).  Raises ValueError if the ARPA file is
+    malformed."""
+    if arpa_in == '-' or arpa_in == '/dev/stdin':
+        f = getattr(sys.stdin, 'buffer', sys.stdin)
+        words, ngrams, log_probs, log_backoffs = _ParseArpa(f, arpa_in, verbose)
+        source_info = None
+    else:
+        source_info = _SourceInfo(arpa_in)
+        with open(arpa_in, 'rb') as f:
+            words, ngrams, log_probs, log_backoffs = _ParseArpa(f, arpa_in, verbose)
+
+    # renumber the words so that the ids are in sorted order of the words.
+    text_words = [ word.decode('utf-8') for word in words ]
+    order = sorted(range(len(words)), key=lambda i: text_words[i])
+    new_id = np.zeros(len(words), dtype='>u4')
+    new_id[order] = np.arange(len(words))
+
+    parent_dir = os.path.dirname(os.path.abspath(index_dir))
+    tmp_dir = tempfile.mkdtemp(dir=parent_dir, prefix=os.path.basename(index_dir) + '.tmp')
+    try:
+        with io.open(os.path.join(tmp_dir, 'words.txt'), 'w',
+                     encoding='utf-8', newline='\n') as f:
+            for i in order:
+                f.write(text_words[i] + u'\n')
+        for n in range(len(ngrams)):
+            ids = new_id[np.frombuffer(ngrams[n], dtype=np.dtype('l'))
+                         .astype(np.int64)].reshape(-1, n + 1)
+            these_log_probs = np.frombuffer(log_probs[n], dtype=np.float64)
+            these_log_backoffs = np.frombuffer(log_backoffs[n], dtype=np.float64)
+            # sort the n-grams (stably, so that if an n-gram is repeated, the
+            # last copy comes last) and drop all but the last copy of each.
+            keys = _Keys(ids)
+            rows = np.argsort(keys, kind='stable')
+            keys = keys[rows]
+            keep = np.ones(len(rows), dtype=bool)
+            keep[:-1] = keys[:-1] != keys[1:]
+            rows = rows[keep]
+            np.save(os.path.join(tmp_dir, 'ngrams.{0}.npy'.format(n)), ids[rows])
+            np.save(os.path.join(tmp_dir, 'log_probs.{0}.npy'.format(n)),
+                    these_log_probs[rows])
+            np.save(os.path.join(tmp_dir, 'log_backoffs.{0}.npy'.format(n)),
+                    these_log_backoffs[rows])
+        with open(os.path.join(tmp_dir, 'info'), 'w') as f:
+            print('version', _INDEX_VERSION, file=f)
+            print('order', len(ngrams), file=f)
+            if source_info is not None:
+                print('source-size', source_info[0], file=f)
+                print('source-mtime', source_info[1], file=f)
+        if os.path.isdir(index_dir):
+            shutil.rmtree(index_dir, ignore_errors=True)
+        os.rename(tmp_dir, index_dir)
+    except:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def GetArpaIndex(arpa_in, index_dir = None, verbose = 0):
+    """Returns an ArpaIndex for the ARPA file 'arpa_in'.  The index is read
+    from 'index_dir' (default: arpa_in + '.index') if it exists and is up to
+    date, and otherwise built there first.  If the ARPA file is read from the
+    standard input, or the index can't be written next to it, it is built in a
+    temporary directory that is removed when the program exits.  Raises
+    ValueError if the ARPA file is malformed."""
+    if arpa_in == '' or arpa_in == '-' or arpa_in == '/dev/stdin':
+        index_dir = None
+        arpa_in = '-'
+    else:
+        if not os.path.isfile(arpa_in):
+            raise ValueError("error opening ARPA file {0}".format(arpa_in))
+        if index_dir is None:
+            index_dir = arpa_in + '.index'
+        info = _ReadInfo(index_dir)
+        if info is not None and info.get('version') == str(_INDEX_VERSION) and \
+          (info.get('source-size'), info.get('source-mtime')) == _SourceInfo(arpa_in):
+            return ArpaIndex(index_dir)
+        parent_dir = os.path.dirname(os.path.abspath(index_dir))
+        if not os.access(parent_dir, os.W_OK):
+            index_dir = None
+    if index_dir is None:
+        tmp_dir = tempfile.mkdtemp(prefix='arpa_index')
+        atexit.register(shutil.rmtree, tmp_dir, True)
+        index_dir = os.path.join(tmp_dir, 'index')
+    if verbose >= 1:
+        print("{0}: building index of ARPA file {1} in {2}".format(
+            sys.argv[0], arpa_in, index_dir), file=sys.stderr)
+    BuildArpaIndex(arpa_in, index_dir, verbose)
+    return ArpaIndex(index_dir)
@@ -7,6 +7,8 @@ from __future__ import print_function
 import sys
 import argparse
 import math
+import bisect
+from array import array
 from collections import defaultdict
 
 # note, this was originally based
@@ -65,59 +67,173 @@ if args.verbose >= 1:
 
 
 
-class CountsForHistory:
-    ## This class (which is more like a struct) stores the counts seen in a
-    ## particular history-state.  It is used inside class NgramCounts.
-    ## It really does the job of a dict from int to float, but it also
-    ## keeps track of the total count.
-    def __init__(self):
-        # The 'lambda: defaultdict(float)' is an anonymous function taking no
-        # arguments that returns a new defaultdict(float).
-        self.word_to_count = defaultdict(int)
-        self.total_count = 0
-
-    def Words(self):
-        return self.word_to_count.keys()
-
-    def __str__(self):
-        # e.g. returns ' total=12 3->4 4->6 -1->2'
-        return ' total={0} {1}'.format(
-            str(self.total_count),
-            ' '.join(['{0} -> {1}'.format(word, count)
-                      for word, count in self.word_to_count.items()]))
-
-
-    ## Adds a certain count (expected to be integer, but might be negative).  If
-    ## the resulting count for this word is zero, removes the dict entry from
-    ## word_to_count.
+class CountsForOrder:
+    ## This class stores, in packed form, the counts of all the n-grams with a
+    ## particular history-length.  It is used inside class NgramCounts.  The
+    ## n-grams are sorted on (history, predicted-word), so the n-grams of each
+    ## history-state occupy a contiguous range of rows:
+    ##   self.hist_to_state maps a history (a tuple) to a state index s, and
+    ##      self.state_hists[s] is that history (or None if the state has been
+    ##      removed);
+    ##   rows self.state_begin[s] to self.state_end[s] - 1 hold its n-grams;
+    ##   self.state_total[s] is the total count of the state, and
+    ##      self.state_backoff[s] is the count of the backoff symbol (zero if
+    ##      the state has no backoff), which is not stored as a row;
+    ##   self.state_num_words[s] is the number of rows of the state that are
+    ##      present.
+    ## For row i, self.words[i] is the predicted word and self.counts[i] is its
+    ## count, or -1 if the n-gram has been removed (a removed n-gram's row is
+    ## re-used if the n-gram is added again).  self.like_changes is a cache,
+    ## parallel to the rows, of the log-likelihood change from pruning each
+    ## n-gram; it is None when nothing has been cached.
+    def __init__(self, ngram_to_count = {}, hist_to_backoff = {}):
+        self.SetCounts(ngram_to_count, hist_to_backoff)
+
+    # (Re)builds the packed arrays.  'ngram_to_count' is a dict from n-gram
+    # (a tuple hist + (word,)) to count, 'hist_to_backoff' a dict from history
+    # to backoff count; a history-state exists if it appears in either.
+    def SetCounts(self, ngram_to_count, hist_to_backoff):
+        hists = set(ngram[:-1] for ngram in ngram_to_count)
+        hists.update(hist_to_backoff.keys())
+        ngrams = sorted(ngram_to_count)
+        self.words = array('i', [ ngram[-1] for ngram in ngrams ])
+        self.counts = array('l', [ ngram_to_count[ngram] for ngram in ngrams ])
+        self.like_changes = None
+        self.state_hists = sorted(hists)
+        self.hist_to_state = dict((hist, s) for s, hist in enumerate(self.state_hists))
+        self.state_begin = array('l')
+        self.state_end = array('l')
+        self.state_total = array('l')
+        self.state_backoff = array('l')
+        self.state_num_words = array('l')
+        i = 0
+        for hist in self.state_hists:
+            begin = i
+            while i < len(ngrams) and ngrams[i][:-1] == hist:
+                i += 1
+            backoff = hist_to_backoff.get(hist, 0)
+            self.state_begin.append(begin)
+            self.state_end.append(i)
+            self.state_total.append(sum(self.counts[begin:i]) + backoff)
+            self.state_backoff.append(backoff)
+            self.state_num_words.append(i - begin)
+
+    # Returns the counts in the form accepted by SetCounts().
+    def GetCounts(self):
+        ngram_to_count = dict()
+        hist_to_backoff = dict()
+        for s, hist in self.States():
+            if self.state_backoff[s] > 0:
+                hist_to_backoff[hist] = self.state_backoff[s]
+            for i in self.Rows(s):
+                ngram_to_count[hist + (self.words[i],)] = self.counts[i]
+        return ngram_to_count, hist_to_backoff
+
+    # Yields (state-index, history) for the states present, in sorted order
+    # of history.
+    def States(self):
+        for s, hist in enumerate(self.state_hists):
+            if hist is not None:
+                yield s, hist
+
+    # Returns the indexes of the rows of state s that are present.
+    def Rows(self, s):
+        counts = self.counts
+        return [ i for i in range(self.state_begin[s], self.state_end[s])
+                 if counts[i] >= 0 ]
+
+    # Returns the row for 'word' in state s (which may be a removed n-gram), or
+    # -1 if there is no such row.
+    def FindRow(self, s, word):
+        end = self.state_end[s]
+        i = bisect.bisect_left(self.words, word, self.state_begin[s], end)
+        return i if i < end and self.words[i] == word else -1
+
+    # Returns the number of n-grams present (not counting backoff symbols).
+    def NumNgrams(self):
+        return sum(self.state_num_words[s] for s, hist in self.States())
+
+    def RemoveRow(self, s, i):
+        self.state_total[s] -= self.counts[i]
+        self.counts[i] = -1
+        self.state_num_words[s] -= 1
+
+    def RemoveState(self, s):
+        del self.hist_to_state[self.state_hists[s]]
+        self.state_hists[s] = None
+
+    ## Adds a certain count (expected to be integer, but might be negative) to
+    ## row i of state s.  If the resulting count is zero, removes the n-gram.
     ## [note, though, that in some circumstances we 'add back' zero counts
     ## where the presence of n-grams would be structurally required by the arpa,
     ## specifically if a higher-order history state has a nonzero count,
     ## we need to structurally have the count there in the states it backs
-    ## off to.
-    def AddCount(self, predicted_word, count):
-        self.total_count += count
-        assert self.total_count >= 0
-        old_count = self.word_to_count[predicted_word]
+    ## off to; see AddCounts().]
+    def AddCount(self, s, i, count):
+        old_count = self.counts[i]
+        if old_count < 0:
+            old_count = 0
+            self.counts[i] = 0
+            self.state_num_words[s] += 1
         new_count = old_count + count
         if new_count < 0:
             print("predicted-word={0}, old-count={1}, count={2}".format(
-                    predicted_word, old_count, count))
+                    self.words[i], old_count, count))
         assert new_count >= 0
+        self.state_total[s] += count
+        assert self.state_total[s] >= 0
+        self.counts[i] = new_count
         if new_count == 0:
-            del self.word_to_count[predicted_word]
-        else:
-            self.word_to_count[predicted_word] = new_count
+            self.RemoveRow(s, i)
+
+    # Adds counts to n-grams, creating the n-grams (and history-states) that
+    # are not present; a zero count just makes sure that the n-gram exists.
+    # 'hist_to_word_counts' is a dict from history to a dict from word to
+    # count.  If any rows need to be created, the arrays are rebuilt.
+    def AddCounts(self, hist_to_word_counts):
+        missing = []
+        for hist, word_to_count in hist_to_word_counts.items():
+            s = self.hist_to_state.get(hist)
+            for word, count in word_to_count.items():
+                i = -1 if s is None else self.FindRow(s, word)
+                if i == -1:
+                    missing.append((hist + (word,), count))
+                    continue
+                if self.counts[i] < 0:
+                    self.counts[i] = 0
+                    self.state_num_words[s] += 1
+                self.counts[i] += count
+                self.state_total[s] += count
+        # the cached log-likelihood changes may no longer be valid.
+        self.like_changes = None
+        if len(missing) > 0:
+            ngram_to_count, hist_to_backoff = self.GetCounts()
+            for ngram, count in missing:
+                ngram_to_count[ngram] = count
+            self.SetCounts(ngram_to_count, hist_to_backoff)
+
+    def StateToString(self, s, backoff_symbol):
+        # e.g. returns ' total=12 3 -> 4 4 -> 6 -1 -> 2'
+        word_counts = [ (self.words[i], self.counts[i]) for i in self.Rows(s) ]
+        if self.state_backoff[s] > 0:
+            word_counts.append((backoff_symbol, self.state_backoff[s]))
+        return ' total={0} {1}'.format(
+            str(self.state_total[s]),
+            ' '.join(['{0} -> {1}'.format(word, count)
+                      for word, count in word_counts]))
+
 
 class NgramCounts:
     ## A note on data-structure.  Firstly, all words are represented as
     ## integers.  We store n-gram counts as an array, indexed by (history-length
-    ## == n-gram order minus one) (note: python calls arrays "lists") of dicts
-    ## from histories to counts, where histories are arrays of integers and
-    ## "counts" are dicts from integer to float.  For instance, when
+    ## == n-gram order minus one) (note: python calls arrays "lists") of
+    ## CountsForOrder objects, which store the n-grams of that order as sorted
+    ## integer arrays with a dict from history to the range of rows for that
+    ## history.  While reading the input data we instead accumulate the counts
+    ## in self.raw_counts, an array of dicts from n-gram (a tuple of the
+    ## history and the predicted word) to count.  For instance, when
     ## accumulating the 4-gram count for the '8' in the sequence '5 6 7 8', we'd
-    ## do as follows: self.counts[3][[5,6,7]][8] += 1.0 where the [3] indexes an
-    ## array, the [[5,6,7]] indexes a dict, and the [8] indexes a dict.
+    ## do as follows: self.raw_counts[3][(5,6,7,8)] += 1.
     def __init__(self, ngram_order):
         assert ngram_order >= 2
         # Integerized counts will never contain negative numbers, so
@@ -133,20 +249,20 @@ class NgramCounts:
         # the backoff counts in each state.
         self.backoff_symbol = -1
         self.total_num_words = 0  # count includes EOS but not BOS.
-        self.counts = []
+        self.raw_counts = []
         for n in range(ngram_order):
-            self.counts.append(defaultdict(lambda: CountsForHistory()))
-
-    # adds a raw count (called while processing input data).
-    # Suppose we see the sequence '6 7 8 9' and ngram_order=4, 'history'
-    # would be (6,7,8) and 'predicted_word' would be 9; 'count' would be
-    # 1.
-    def AddCount(self, history, predicted_word, count):
-        self.counts[len(history)][history].AddCount(predicted_word, count)
-
+            self.raw_counts.append(defaultdict(int))
+        self.counts = None
+        # the histories whose counts have changed since the cached
+        # log-likelihood changes were computed; see PruneToIntermediateTarget().
+        self.changed_hists = set()
 
     # 'line' is a string containing a sequence of integer word-ids.
     # This function adds the un-smoothed counts from this line of text.
+    # Suppose we see the sequence '6 7 8 9' and ngram_order=4, the 4-gram
+    # (6,7,8,9) would get a count of 1, as would the n-grams (<s>,6),
+    # (<s>,6,7) and (<s>,6,7,8) whose histories are truncated at the start of
+    # the line.
     def AddRawCountsFromLine(self, line):
         try:
             words = [self.bos_symbol] + [ int(x) for x in line.split() ] + [self.eos_symbol]
@@ -154,12 +270,13 @@ class NgramCounts:
             sys.exit("make_phone_lm.py: bad input line {0} (expected a sequence "
                      "of integers)".format(line))
 
-        for n in range(1, len(words)):
-            predicted_word = words[n]
-            history_start = max(0, n + 1 - args.ngram_order)
-            history = tuple(words[history_start:n])
-            self.AddCount(history, predicted_word, 1)
-            self.total_num_words += 1
+        ngram_order = args.ngram_order
+        for n in range(1, min(ngram_order - 1, len(words))):
+            self.raw_counts[n][tuple(words[:n + 1])] += 1
+        top_order_counts = self.raw_counts[ngram_order - 1]
+        for ngram in zip(*[ words[n:] for n in range(ngram_order) ]):
+            top_order_counts[ngram] += 1
+        self.total_num_words += len(words) - 1
 
     def AddRawCountsFromStandardInput(self):
         lines_processed = 0
@@ -172,6 +289,8 @@ class NgramCounts:
         if lines_processed == 0 or args.verbose > 0:
             print("make_phone_lm.py: processed {0} lines of input".format(
                     lines_processed), file = sys.stderr)
+        self.counts = [ CountsForOrder(raw_counts) for raw_counts in self.raw_counts ]
+        self.raw_counts = None
 
 
     # This backs off the counts by subtracting 1 and assigning the subtracted
@@ -189,21 +308,23 @@ class NgramCounts:
             initial_num_ngrams = self.GetNumNgrams()
         for n in reversed(range(args.no_backoff_ngram_order, args.ngram_order)):
             this_order_counts = self.counts[n]
-            for hist, counts_for_hist in this_order_counts.items():
-                backoff_hist = hist[1:]
-                backoff_counts_for_hist = self.counts[n-1][backoff_hist]
+            backoff_additions = defaultdict(lambda: defaultdict(int))
+            for s, hist in this_order_counts.States():
+                backoff_word_to_count = backoff_additions[hist[1:]]
                 this_discount_total = 0
-                for word in counts_for_hist.Words():
-                    counts_for_hist.AddCount(word, -1)
+                for i in this_order_counts.Rows(s):
+                    this_order_counts.AddCount(s, i, -1)
                     # You can interpret the following line as incrementing the
                     # count-of-counts for the next-lower order.  Note, however,
                     # that later when we remove n-grams, we'll also add their
                     # counts to the next-lower-order history state, so the
                     # resulting counts won't strictly speaking be
                     # counts-of-counts.
-                    backoff_counts_for_hist.AddCount(word, 1)
+                    backoff_word_to_count[this_order_counts.words[i]] += 1
                     this_discount_total += 1
-                counts_for_hist.AddCount(self.backoff_symbol, this_discount_total)
+                this_order_counts.state_backoff[s] += this_discount_total
+                this_order_counts.state_total[s] += this_discount_total
+            self.counts[n-1].AddCounts(backoff_additions)
 
         if args.verbose >= 1:
             # Note: because D == 1, we completely back off singletons.
@@ -220,12 +341,12 @@ class NgramCounts:
         total = 0.0
         total_excluding_backoff = 0.0
         for this_order_counts in self.counts:
-            for hist, counts_for_hist in this_order_counts.items():
-                print(str(hist) + str(counts_for_hist), file = sys.stderr)
-                total += counts_for_hist.total_count
-                total_excluding_backoff += counts_for_hist.total_count
-                if self.backoff_symbol in counts_for_hist.word_to_count:
-                    total_excluding_backoff -= counts_for_hist.word_to_count[self.backoff_symbol]
+            for s, hist in this_order_counts.States():
+                print(str(hist) + this_order_counts.StateToString(s, self.backoff_symbol),
+                      file = sys.stderr)
+                total += this_order_counts.state_total[s]
+                total_excluding_backoff += (this_order_counts.state_total[s] -
+                                            this_order_counts.state_backoff[s])
         print('total count = {0}, excluding backoff = {1}'.format(
                 total, total_excluding_backoff), file = sys.stderr)
 
@@ -235,7 +356,7 @@ class NgramCounts:
         hist_to_state = dict()
         fst_state_counter = 0
         for n in range(0, args.ngram_order):
-            for hist in self.counts[n].keys():
+            for s, hist in self.counts[n].States():
                 hist_to_state[hist] = fst_state_counter
                 fst_state_counter += 1
         return hist_to_state
@@ -246,26 +367,67 @@ class NgramCounts:
     # Returns None if there is no such word in this history-state, or this
     # history-state does not exist.
     def GetProb(self, hist, word):
-        if len(hist) >= args.ngram_order or not hist in self.counts[len(hist)]:
+        if len(hist) >= args.ngram_order:
             return None
-        counts_for_hist = self.counts[len(hist)][hist]
-        total_count = float(counts_for_hist.total_count)
-        if not word in counts_for_hist.word_to_count:
+        this_order_counts = self.counts[len(hist)]
+        s = this_order_counts.hist_to_state.get(hist)
+        if s is None:
+            return None
+        total_count = float(this_order_counts.state_total[s])
+        backoff_count = this_order_counts.state_backoff[s]
+        if word == self.backoff_symbol:
+            count = backoff_count
+        else:
+            i = this_order_counts.FindRow(s, word)
+            count = this_order_counts.counts[i] if i != -1 else -1
+        if count < 0 or (word == self.backoff_symbol and count == 0):
             print("make_phone_lm.py: no prob for {0} -> {1} "
                   "[no such count]".format(hist, word),
                   file = sys.stderr)
             return None
-        prob = float(counts_for_hist.word_to_count[word]) / total_count
-        if len(hist) > 0 and word != self.backoff_symbol and \
-          self.backoff_symbol in counts_for_hist.word_to_count:
+        prob = float(count) / total_count
+        if len(hist) > 0 and word != self.backoff_symbol and backoff_count > 0:
             prob_in_backoff = self.GetProb(hist[1:], word)
-            backoff_prob = float(counts_for_hist.word_to_count[self.backoff_symbol]) / total_count
+            backoff_prob = float(backoff_count) / total_count
             try:
                 prob += backoff_prob * prob_in_backoff
             except:
                 sys.exit("problem, hist is {0}, word is {1}".format(hist, word))
         return prob
 
+    # Returns a dict from each word present in history-state 'hist' to its
+    # probability, i.e. to what self.GetProb(hist, word) would return (words
+    # for which GetProb() would fail are left out).  The dicts are cached in
+    # 'prob_cache', a dict from history to such dicts, which the caller must
+    # discard when the counts change.
+    def GetWordProbs(self, hist, prob_cache):
+        probs = prob_cache.get(hist)
+        if probs is not None:
+            return probs
+        probs = dict()
+        this_order_counts = self.counts[len(hist)]
+        s = this_order_counts.hist_to_state.get(hist)
+        if s is not None:
+            total_count = float(this_order_counts.state_total[s])
+            backoff_count = this_order_counts.state_backoff[s]
+            if len(hist) > 0 and backoff_count > 0:
+                backoff_probs = self.GetWordProbs(hist[1:], prob_cache)
+                backoff_prob = float(backoff_count) / total_count
+            else:
+                backoff_probs = None
+            words = this_order_counts.words
+            counts = this_order_counts.counts
+            for i in this_order_counts.Rows(s):
+                word = words[i]
+                prob = float(counts[i]) / total_count
+                if backoff_probs is not None:
+                    if not word in backoff_probs:
+                        continue
+                    prob += backoff_prob * backoff_probs[word]
+                probs[word] = prob
+        prob_cache[hist] = probs
+        return probs
+
     def PruneEmptyStates(self):
         # Removes history-states that have no counts.
 
@@ -279,11 +441,12 @@ class NgramCounts:
         for n in reversed(range(args.no_backoff_ngram_order,
                                 args.ngram_order)):
             num_states_removed = 0
-            for hist, counts_for_hist in self.counts[n].items():
-                l = len(counts_for_hist.word_to_count)
-                assert l > 0 and self.backoff_symbol in counts_for_hist.word_to_count
-                if l == 1 and not hist in protected_histories:  # only the backoff symbol has a count.
-                    del self.counts[n][hist]
+            this_order_counts = self.counts[n]
+            for s, hist in this_order_counts.States():
+                assert this_order_counts.state_backoff[s] > 0
+                if this_order_counts.state_num_words[s] == 0 and \
+                  not hist in protected_histories:  # only the backoff symbol has a count.
+                    this_order_counts.RemoveState(s)
                     num_states_removed += 1
                 else:
                     # if this state was not pruned away, then the state that
@@ -304,19 +467,25 @@ class NgramCounts:
         # we have a unigram state].
         if args.verbose >= 1:
             num_ngrams_initial = self.GetNumNgrams()
+        # zero_counts[m] is a dict from history to a dict from word to zero,
+        # for the n-grams of history-length m that we need to add; the
+        # n-grams are added to the state before we process it.
+        zero_counts = [ defaultdict(dict) for n in range(args.ngram_order) ]
         for n in reversed(range(args.no_backoff_ngram_order,
                                 args.ngram_order)):
-
-            for hist, counts_for_hist in self.counts[n].items():
+            this_order_counts = self.counts[n]
+            this_order_counts.AddCounts(zero_counts[n])
+            for s, hist in this_order_counts.States():
+                words = [ this_order_counts.words[i] for i in this_order_counts.Rows(s) ]
                 # This loop ensures that if we have an n-gram like (6, 7, 8) -> 9,
                 # then, say, (7, 8) -> 9 and (8) -> 9 exist.
                 reduced_hist = hist
                 for m in reversed(range(args.no_backoff_ngram_order, n)):
                     reduced_hist = reduced_hist[1:]  # shift an element off
                                                      # the history.
-                    counts_for_backoff_hist = self.counts[m][reduced_hist]
-                    for word in counts_for_hist.word_to_count.keys():
-                        counts_for_backoff_hist.word_to_count[word] += 0
+                    word_to_count = zero_counts[m][reduced_hist]
+                    for word in words:
+                        word_to_count[word] = 0
                 # This loop ensures that if we have an n-gram like (6, 7, 8) -> 9,
                 # then, say, (6, 7) -> 8 and (6) -> 7 exist.  This will be needed
                 # for FST representations of the ARPA LM.
@@ -325,8 +494,7 @@ class NgramCounts:
                     this_word = reduced_hist[-1]
                     reduced_hist = reduced_hist[:-1]  # pop an element off the
                                                       # history
-                    counts_for_backoff_hist = self.counts[m][reduced_hist]
-                    counts_for_backoff_hist.word_to_count[this_word] += 0
+                    zero_counts[m][reduced_hist][this_word] = 0
         if args.verbose >= 1:
             print("make_phone_lm.py: in EnsureStructurallyNeededNgramsExist(), "
                   "added {0} n-grams".format(self.GetNumNgrams() - num_ngrams_initial),
@@ -338,7 +506,8 @@ class NgramCounts:
     def PrintAsFst(self, word_disambig_symbol):
         # n is the history-length (== order + 1).  We iterate over the
         # history-length in the order 1, 0, 2, 3, and then iterate over the
-        # histories of each order in sorted order.  Putting order 1 first
+        # histories of each order in sorted order (that's the order in which
+        # CountsForOrder stores them).  Putting order 1 first
         # and sorting on the histories
         # ensures that the bigram state with <s> as the left context comes first.
         # (note: self.bos_symbol is the most negative symbol)
@@ -346,15 +515,15 @@ class NgramCounts:
         # History will map from history (as a tuple) to integer FST-state.
         hist_to_state = self.GetHistToStateMap()
 
-        for n in [ 1, 0 ] + range(2, args.ngram_order):
+        for n in [ 1, 0 ] + list(range(2, args.ngram_order)):
             this_order_counts = self.counts[n]
-            # For order 1, make sure the keys are sorted.
-            keys = this_order_counts.keys() if n != 1 else sorted(this_order_counts.keys())
-            for hist in keys:
-                word_to_count = this_order_counts[hist].word_to_count
+            for s, hist in this_order_counts.States():
+                words = [ this_order_counts.words[i] for i in this_order_counts.Rows(s) ]
+                if this_order_counts.state_backoff[s] > 0:
+                    words.append(self.backoff_symbol)
                 this_fst_state = hist_to_state[hist]
 
-                for word in word_to_count.keys():
+                for word in words:
                     # work out this_cost.  Costs in OpenFst are negative logs.
                     this_cost = -math.log(self.GetProb(hist, word))
 
@@ -383,7 +552,9 @@ class NgramCounts:
     def GetProtectedNgrams(self):
         ans = set()
         for n in range(args.no_backoff_ngram_order + 1, args.ngram_order):
-            for hist, counts_for_hist in self.counts[n].items():
+            this_order_counts = self.counts[n]
+            for s, hist in this_order_counts.States():
+                words = [ this_order_counts.words[i] for i in this_order_counts.Rows(s) ]
                 # If we have an n-gram (6, 7, 8) -> 9, the following loop will
                 # add the backed-off n-grams (7, 8) -> 9 and (8) -> 9 to
                 # 'protected-ngrams'.
@@ -392,9 +563,8 @@ class NgramCounts:
                     reduced_hist = reduced_hist[1:]  # shift an element off
                                                      # the history.
 
-                    for word in counts_for_hist.word_to_count.keys():
-                        if word != self.backoff_symbol:
-                            ans.add(reduced_hist + (word,))
+                    for word in words:
+                        ans.add(reduced_hist + (word,))
                 # The following statement ensures that if we are in a
                 # history-state (6, 7, 8), then n-grams (6, 7, 8) and (6, 7) are
                 # protected.  This assures that the FST states are accessible.
@@ -406,14 +576,26 @@ class NgramCounts:
         return ans
 
     def PruneNgram(self, hist, word):
-        counts_for_hist = self.counts[len(hist)][hist]
-        assert word != self.backoff_symbol and word in counts_for_hist.word_to_count
-        count = counts_for_hist.word_to_count[word]
-        del counts_for_hist.word_to_count[word]
-        counts_for_hist.word_to_count[self.backoff_symbol] += count
-        # the next call adds the count to the symbol 'word' in the backoff
-        # history-state, and also updates its 'total_count'.
-        self.counts[len(hist) - 1][hist[1:]].AddCount(word, count)
+        this_order_counts = self.counts[len(hist)]
+        s = this_order_counts.hist_to_state[hist]
+        i = this_order_counts.FindRow(s, word)
+        assert word != self.backoff_symbol and i != -1 and this_order_counts.counts[i] >= 0
+        count = this_order_counts.counts[i]
+        this_order_counts.RemoveRow(s, i)
+        this_order_counts.state_backoff[s] += count
+        this_order_counts.state_total[s] += count
+        # the next lines add the count to the symbol 'word' in the backoff
+        # history-state, and also update its total count.
+        backoff_hist = hist[1:]
+        backoff_order_counts = self.counts[len(hist) - 1]
+        backoff_s = backoff_order_counts.hist_to_state.get(backoff_hist)
+        j = -1 if backoff_s is None else backoff_order_counts.FindRow(backoff_s, word)
+        if j != -1:
+            backoff_order_counts.AddCount(backoff_s, j, count)
+        elif count != 0:
+            backoff_order_counts.AddCounts({ backoff_hist: { word: count } })
+        self.changed_hists.add(hist)
+        self.changed_hists.add(backoff_hist)
 
     # The function PruningLogprobChange is the same as the same-named
     # function in float-counts-prune.cc in pocolm.  Note, it doesn't access
@@ -544,12 +726,15 @@ class NgramCounts:
 
 
     def GetLikeChangeFromPruningNgram(self, hist, word):
-        counts_for_hist = self.counts[len(hist)][hist]
-        counts_for_backoff_hist = self.counts[len(hist) - 1][hist[1:]]
-        assert word != self.backoff_symbol and word in counts_for_hist.word_to_count
-        count = counts_for_hist.word_to_count[word]
-        discount = counts_for_hist.word_to_count[self.backoff_symbol]
-        backoff_total = counts_for_backoff_hist.total_count
+        this_order_counts = self.counts[len(hist)]
+        backoff_order_counts = self.counts[len(hist) - 1]
+        s = this_order_counts.hist_to_state[hist]
+        i = this_order_counts.FindRow(s, word)
+        assert word != self.backoff_symbol and i != -1 and this_order_counts.counts[i] >= 0
+        count = this_order_counts.counts[i]
+        discount = this_order_counts.state_backoff[s]
+        backoff_total = backoff_order_counts.state_total[
+            backoff_order_counts.hist_to_state[hist[1:]]]
         # backoff_count is a pseudo-count: it's like the count of 'word' in the
         # backoff history-state, but adding something to account for further
         # levels of backoff.
@@ -574,31 +759,87 @@ class NgramCounts:
         num_pruned_per_order = [ 0 ] * args.ngram_order
 
 
-        # like_change_and_ngrams this will be a list of tuples consisting
-        # of the likelihood change as a float and then the words of the n-gram
-        # that we're considering pruning,
-        # e.g. (-0.164, 7, 8, 9)
-        # meaning that pruning the n-gram (7, 8) -> 9 leads to
-        # a likelihood change of -0.164.  We'll later sort this list
-        # so we can prune the n-grams that made the least-negative
-        # likelihood change.
-        like_change_and_ngrams = []
+        # candidate_like_changes and candidate_ngrams are parallel lists of the
+        # likelihood change and the n-gram (as a tuple hist + (word,)) for
+        # the n-grams that we're considering pruning.  The likelihood changes
+        # are cached in self.counts[n].like_changes between calls, and we only
+        # recompute those that may have changed: the ones in history-states
+        # where the state, or a state it backs off to, is in
+        # self.changed_hists.  (A cached value of NaN means the n-gram was
+        # protected, so we didn't compute it).  The computation is the same as
+        # in GetLikeChangeFromPruningNgram(), but with the quantities that
+        # depend only on the history-state looked up once per state, and the
+        # backoff probabilities from GetWordProbs().
+        candidate_like_changes = []
+        candidate_ngrams = []
+        prob_cache = dict()
+        nan = float('nan')
         for n in range(args.no_backoff_ngram_order, args.ngram_order):
-            for hist, counts_for_hist in self.counts[n].items():
-                for word, count in counts_for_hist.word_to_count.items():
-                    if word != self.backoff_symbol:
-                        if not hist + (word,) in protected_ngrams:
+            this_order_counts = self.counts[n]
+            backoff_order_counts = self.counts[n - 1]
+            words = this_order_counts.words
+            counts = this_order_counts.counts
+            like_changes = this_order_counts.like_changes
+            all_changed = like_changes is None
+            if all_changed:
+                like_changes = array('d', [ nan ]) * len(words)
+                this_order_counts.like_changes = like_changes
+            for s, hist in this_order_counts.States():
+                changed = all_changed or any(hist[k:] in self.changed_hists
+                                             for k in range(len(hist) + 1))
+                backoff_probs = None
+                for i in this_order_counts.Rows(s):
+                    word = words[i]
+                    ngram = hist + (word,)
+                    if ngram in protected_ngrams:
+                        if changed:
+                            like_changes[i] = nan
+                        continue
+                    like_change = like_changes[i]
+                    if changed or like_change != like_change:
+                        if backoff_probs is None:
+                            backoff_probs = self.GetWordProbs(hist[1:], prob_cache)
+                            discount = float(this_order_counts.state_backoff[s])
+                            backoff_total = backoff_order_counts.state_total[
+                                backoff_order_counts.hist_to_state[hist[1:]]]
+                        if word in backoff_probs:
+                            like_change = self.PruningLogprobChange(
+                                float(counts[i]), discount,
+                                backoff_probs[word] * backoff_total, float(backoff_total))
+                        else:
                             like_change = self.GetLikeChangeFromPruningNgram(hist, word)
-                            like_change_and_ngrams.append((like_change,) + hist + (word,))
-                            num_candidates_per_order[len(hist)] += 1
-
-        like_change_and_ngrams.sort(reverse = True)
+                        like_changes[i] = like_change
+                    candidate_like_changes.append(like_change)
+                    candidate_ngrams.append(ngram)
+                    num_candidates_per_order[n] += 1
+        self.changed_hists.clear()
 
-        if num_ngrams_to_prune > len(like_change_and_ngrams):
+        if num_ngrams_to_prune > len(candidate_ngrams):
             print('make_phone_lm.py: aimed to prune {0} n-grams but could only '
-                  'prune {1}'.format(num_ngrams_to_prune, len(like_change_and_ngrams)),
+                  'prune {1}'.format(num_ngrams_to_prune, len(candidate_ngrams)),
                   file = sys.stderr)
-            num_ngrams_to_prune = len(like_change_and_ngrams)
+            num_ngrams_to_prune = len(candidate_ngrams)
+
+        # like_change_and_ngrams will be a list of tuples consisting
+        # of the likelihood change as a float and then the words of the n-gram
+        # that we're considering pruning,
+        # e.g. (-0.164, 7, 8, 9)
+        # meaning that pruning the n-gram (7, 8) -> 9 leads to
+        # a likelihood change of -0.164, sorted so we can prune the n-grams
+        # that made the least-negative likelihood change.  Unless we need
+        # all of it for the debug output, it only contains the n-grams we'll
+        # prune: we find the likelihood change of the last one to be pruned
+        # by sorting just the floats, and sort only the tuples at or above it.
+        if args.verbose >= 3 or num_ngrams_to_prune == 0:
+            like_change_and_ngrams = [ (like_change,) + ngram for like_change, ngram
+                                       in zip(candidate_like_changes, candidate_ngrams) ]
+        else:
+            threshold = sorted(candidate_like_changes,
+                               reverse = True)[num_ngrams_to_prune - 1]
+            like_change_and_ngrams = [ (like_change,) + ngram for like_change, ngram
+                                       in zip(candidate_like_changes, candidate_ngrams)
+                                       if like_change >= threshold ]
+        like_change_and_ngrams.sort(reverse = True)
 
         total_loglike_change = 0.0
 
@@ -706,12 +947,9 @@ class NgramCounts:
                 ans += self.GetNumNgrams(hist_len)
             return ans
         else:
-            for counts_for_hist in self.counts[hist_len].values():
-                ans += len(counts_for_hist.word_to_count)
-                if self.backoff_symbol in counts_for_hist.word_to_count:
-                    ans -= 1  # don't count the backoff symbol, it doesn't produce
-                              # its own n-gram line.
-            return ans
+            # note: the backoff symbol is not stored as an n-gram (it doesn't
+            # produce its own n-gram line), so it isn't counted here.
+            return self.counts[hist_len].NumNgrams()
 
 
     # this function, used in PrintAsArpa, converts an integer to
@@ -753,17 +991,18 @@ class NgramCounts:
                 if backoff_prob != None:
                     print('-99\t<s>\t{0}'.format('%.5f' % math.log10(backoff_prob)))
 
-            for hist in self.counts[hist_len].keys():
-                for word in self.counts[hist_len][hist].word_to_count.keys():
-                    if word != self.backoff_symbol:
-                        prob = self.GetProb(hist, word)
-                        assert prob != None and prob > 0
-                        backoff_prob = self.GetProb((hist)+(word,), self.backoff_symbol)
-                        line = '{0}\t{1}'.format('%.5f' % math.log10(prob),
-                                                 ' '.join(self.IntToString(x) for x in hist + (word,)))
-                        if backoff_prob != None:
-                            line += '\t{0}'.format('%.5f' % math.log10(backoff_prob))
-                        print(line)
+            this_order_counts = self.counts[hist_len]
+            for s, hist in this_order_counts.States():
+                for i in this_order_counts.Rows(s):
+                    word = this_order_counts.words[i]
+                    prob = self.GetProb(hist, word)
+                    assert prob != None and prob > 0
+                    backoff_prob = self.GetProb((hist)+(word,), self.backoff_symbol)
+                    line = '{0}\t{1}'.format('%.5f' % math.log10(prob),
+                                             ' '.join(self.IntToString(x) for x in hist + (word,)))
+                    if backoff_prob != None:
+                        line += '\t{0}'.format('%.5f' % math.log10(backoff_prob))
+                    print(line)
             print('')
         print('\\end\\')
 
@@ -2,12 +2,25 @@
 # -*- coding: utf-8 -*-
 # Copyright 2012 Mirko Hannemann BUT, mirko.hannemann@gmail.com
 
+from __future__ import print_function
+import os
 import sys
 import codecs # for UTF-8/unicode
 
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'lang', 'internal'))
+import arpa_index
+
+if sys.version_info.major == 2:
+  sys.stdout = codecs.getwriter('utf-8')(sys.stdout, 'strict')
+else:
+  sys.stdout = codecs.getwriter('utf-8')(sys.stdout.buffer, 'strict')
+
 if len(sys.argv) != 2:
-    print 'usage: reverse_arpa arpa.in'
-    sys.exit()
+  print('usage: reverse_arpa arpa.in')
+  sys.exit()
 arpaname = sys.argv[1]
 
 #\data\
@@ -30,95 +43,58 @@ arpaname = sys.argv[1]
 #-0.23940	a b </s>
 #\end\
 
-# read language model in ARPA format
-try:
-  file = codecs.open(arpaname, "r", "utf-8")
-except IOError:
-  print 'file not found: ' + arpaname
-  sys.exit()
-
-text=file.readline()
-while (text and text[:6] != "\\data\\"): text=file.readline()
-if not text:
-  print "invalid ARPA file"
+# read language model in ARPA format; the n-grams are read from an index of
+# the ARPA file (see utils/lang/internal/arpa_index.py), which is built the
+# first time it is needed.
+if not os.path.isfile(arpaname):
+  print('file not found: ' + arpaname)
   sys.exit()
-#print text,
-while (text and text[:5] != "ngram"): text=file.readline()
-
-# get ngram counts
-cngrams=[]
-n=0
-while (text and text[:5] == "ngram"):
-  ind = text.split("=")
-  counts = int(ind[1].strip())
-  r = ind[0].split()
-  read_n = int(r[1].strip())
-  if read_n != n+1:
-    print "invalid ARPA file:", text
-    sys.exit()
-  n = read_n
-  cngrams.append(counts)
-  #print text,
-  text=file.readline()
-
-# read all n-grams order by order
-sentprob = 0.0 # sentence begin unigram
-ngrams=[]
-inf=float("inf")
-for n in range(1,len(cngrams)+1): # unigrams, bigrams, trigrams
-  while (text and "-grams:" not in text): text=file.readline()
-  if n != int(text[1]):
-    print "invalid ARPA file:", text
-    sys.exit()
-  #print text,cngrams[n-1]
-  this_ngrams={} # stores all read ngrams
-  for ng in range(cngrams[n-1]):
-    while (text and len(text.split())<2):
-      text=file.readline()
-      if (not text) or ((len(text.split())==1) and (("-grams:" in text) or (text[:5] == "\\end\\"))): break
-    if (not text) or ((len(text.split())==1) and (("-grams:" in text) or (text[:5] == "\\end\\"))):
-      break # to deal with incorrect ARPA files
-    entry = text.split()
-    prob = float(entry[0])
-    if len(entry)>n+1:
-      back = float(entry[-1])
-      words = entry[1:n+1]
-    else:
-      back = 0.0
-      words = entry[1:]
-    ngram = " ".join(words)
-    if (n==1) and words[0]=="<s>":
-      sentprob = prob
-      prob = 0.0
-    this_ngrams[ngram] = (prob,back)
-    #print prob,ngram.encode("utf-8"),back
-
-    for x in range(n-1,0,-1):
-      # add all missing backoff ngrams for reversed lm
-      l_ngram = " ".join(words[:x]) # shortened ngram
-      r_ngram = " ".join(words[1:1+x]) # shortened ngram with offset one
-      if l_ngram not in ngrams[x-1]: # create missing ngram
-        ngrams[x-1][l_ngram] = (0.0,inf)
-        #print ngram, "create 0.0", l_ngram, "inf"
-      if r_ngram not in ngrams[x-1]: # create missing ngram
-        ngrams[x-1][r_ngram] = (0.0,inf)
-        #print ngram, "create 0.0", r_ngram, "inf",x,n,h_ngram
-
-      # add all missing backoff ngrams for forward lm
-      h_ngram = " ".join(words[n-x:]) # shortened history
-      if h_ngram not in ngrams[x-1]: # create missing ngram
-        ngrams[x-1][h_ngram] = (0.0,inf)
-        #print "create inf", h_ngram, "0.0"
-    text=file.readline()
-    if (not text) or ((len(text.split())==1) and (("-grams:" in text) or (text[:5] == "\\end\\"))): break
-  ngrams.append(this_ngrams)
-
-while (text and text[:5] != "\\end\\"): text=file.readline()
-if not text:
-  print "invalid ARPA file"
+try:
+  index = arpa_index.GetArpaIndex(arpaname)
+except ValueError as e:
+  print('invalid ARPA file: ' + str(e))
   sys.exit()
-file.close()
-#print text,
+words = index.words
+inf = float("inf")
+
+# ngram_ids[n-1] is a sorted (num-ngrams, n) array of the word ids of the
+# n-grams of order n, and probs[n-1] and backs[n-1] their log-probs and backoff
+# weights.  An n-gram with no backoff weight gets 0.0; the n-grams we create
+# below (that the reversed or forward model needs for backoff but the ARPA
+# file does not have) get (0.0, inf).
+ngram_ids = []
+probs = []
+backs = []
+for n in range(1, index.order + 1): # unigrams, bigrams, trigrams
+  ngram_ids.append(np.asarray(index.ngrams[n-1]))
+  probs.append(np.array(index.log_probs[n-1]))
+  log_backoffs = index.log_backoffs[n-1]
+  backs.append(np.where(np.isnan(log_backoffs), 0.0, log_backoffs))
+
+# sentence begin unigram
+sentprob = 0.0
+if "<s>" in index.word_to_id:
+  i = index.Find((index.word_to_id["<s>"],))
+  if i != -1:
+    sentprob = float(probs[0][i])
+    probs[0][i] = 0.0
+
+for x in range(1, index.order):
+  # add all missing backoff ngrams for reversed lm (the shortened ngrams, and
+  # the shortened ngrams with offset one) and for forward lm (the shortened
+  # histories) of the ngrams of each higher order n.
+  needed = [ ]
+  for n in range(x + 1, index.order + 1):
+    ids = ngram_ids[n-1]
+    needed += [ ids[:, :x], ids[:, 1:1+x], ids[:, n-x:] ]
+  needed = np.unique(np.concatenate(needed), axis=0)
+  missing = needed[arpa_index.FindRows(ngram_ids[x-1], needed) == -1]
+  if len(missing) != 0:
+    ids = np.concatenate([ngram_ids[x-1], missing])
+    order = np.lexsort(ids.T[::-1])
+    ngram_ids[x-1] = ids[order]
+    probs[x-1] = np.concatenate([probs[x-1], np.zeros(len(missing))])[order]
+    backs[x-1] = np.concatenate([backs[x-1], np.full(len(missing), inf)])[order]
 
 #fourgram "maxent" model (b(ABCD)=0):
 #p(A)+b(A) A 0
@@ -132,44 +108,42 @@ file.close()
 #p(ABC)+b(ABC)-p(BC)+p(AB)-p(B)+p(A) CBA 0
 #p(ABCD)+b(ABCD)-p(BCD)+p(ABC)-p(BC)+p(AB)-p(B)+p(A) DCBA 0
 
+def NgramString(ids):
+  return " ".join([ words[i] for i in ids ])
+
 # compute new reversed ARPA model
-print "\\data\\"
-for n in range(1,len(cngrams)+1): # unigrams, bigrams, trigrams
-  print "ngram "+str(n)+"="+str(len(ngrams[n-1].keys()))
+print("\\data\\")
+for n in range(1, index.order + 1): # unigrams, bigrams, trigrams
+  print("ngram "+str(n)+"="+str(len(ngram_ids[n-1])))
 offset = 0.0
-for n in range(1,len(cngrams)+1): # unigrams, bigrams, trigrams
-  print "\\"+str(n)+"-grams:"
-  keys = ngrams[n-1].keys()
-  keys.sort()
-  for ngram in keys:
-    prob = ngrams[n-1][ngram]
+for n in range(1, index.order + 1): # unigrams, bigrams, trigrams
+  print("\\"+str(n)+"-grams:")
+  ids = ngram_ids[n-1]
+  # only backoff weights from not newly created ngrams
+  revprob = np.where(backs[n-1] != inf, probs[n-1] + backs[n-1], probs[n-1])
+  # sum all missing terms in decreasing ngram order
+  for x in range(n-1, 0, -1):
+    l_rows = arpa_index.FindRows(ngram_ids[x-1], ids[:, :x]) # shortened ngram
+    r_rows = arpa_index.FindRows(ngram_ids[x-1], ids[:, 1:1+x]) # shortened ngram with offset one
+    not_found = np.nonzero((l_rows == -1) | (r_rows == -1))[0]
+    if len(not_found) != 0:
+      i = not_found[0]
+      rev_ngram = NgramString(reversed(ids[i].tolist()))
+      rev_ngram = rev_ngram.replace("<s>","<temp>").replace("</s>","<s>").replace("<temp>","</s>")
+      sys.stderr.write(rev_ngram+": not found "+
+                       NgramString(ids[i, :x] if l_rows[i] == -1 else ids[i, 1:1+x])+"\n")
+      sys.exit(1)
+    revprob = revprob + probs[x-1][l_rows]
+    revprob = revprob - probs[x-1][r_rows]
+
+  for ngram, revprob, back in zip(ids.tolist(), revprob.tolist(), backs[n-1].tolist()):
     # reverse word order
-    words = ngram.split()
-    rstr = " ".join(reversed(words))
+    rstr = NgramString(reversed(ngram))
     # swap <s> and </s>
     rev_ngram = rstr.replace("<s>","<temp>").replace("</s>","<s>").replace("<temp>","</s>")
 
-    revprob = prob[0]
-    if (prob[1] != inf): # only backoff weights from not newly created ngrams
-      revprob = revprob + prob[1]
-    #print prob[0],prob[1]
-    # sum all missing terms in decreasing ngram order
-    for x in range(n-1,0,-1): 
-      l_ngram = " ".join(words[:x]) # shortened ngram
-      if l_ngram not in ngrams[x-1]:
-        sys.stderr.write(rev_ngram+": not found "+l_ngram+"\n")
-      p_l = ngrams[x-1][l_ngram][0]
-      #print p_l,l_ngram
-      revprob = revprob + p_l
-
-      r_ngram = " ".join(words[1:1+x]) # shortened ngram with offset one
-      if r_ngram not in ngrams[x-1]:
-        sys.stderr.write(rev_ngram+": not found "+r_ngram+"\n")
-      p_r = ngrams[x-1][r_ngram][0]
-      #print -p_r,r_ngram
-      revprob = revprob - p_r
-
-    if n != len(cngrams): #not highest order
+    if n != index.order: #not highest order
+      created = (back == inf)
       back = 0.0
       if rev_ngram[:3] == "<s>": # special handling since arpa2fst ignores <s> weight
         if n == 1:
@@ -178,11 +152,11 @@ for n in range(1,len(cngrams)+1): # unigrams, bigrams, trigrams
           back = offset
         elif n == 2:
           revprob = revprob + offset # add <s> weight to bigrams starting with <s>
-      if (prob[1] != inf): # only backoff weights from not newly created ngrams
-        print revprob,rev_ngram.encode("utf-8"),back
+      if not created: # only backoff weights from not newly created ngrams
+        print(str(revprob),rev_ngram,str(back))
       else:
-        print revprob,rev_ngram.encode("utf-8"),"-100000.0"
+        print(str(revprob),rev_ngram,"-100000.0")
     else: # highest order - no backoff weights
       if (n==2) and (rev_ngram[:3] == "<s>"): revprob = revprob + offset
-      print revprob,rev_ngram.encode("utf-8")
-print "\\end\\"
+      print(str(revprob),rev_ngram)
+print("\\end\\")